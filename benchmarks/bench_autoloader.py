@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+"""
+Benchmark for omimgr.autoloader
+
+Simulates an operator who loads discs into file-backed fake drives: as soon
+as a job finishes the tray "opens", and after a short delay the next fake
+disc is written to the drive and its tray reports a disc (fakes.FakeTrays).
+The autoloader starts a job for each disc. One more drive cannot be polled
+at all. Reports the delay between loading a disc and the start of its job,
+and the number of tray polls (overall, while a drive was busy, and of the
+drive that cannot be polled). The tests in tests/test_autoloader.py check
+the jobs and images.
+
+Usage: python3 benchmarks/bench_autoloader.py [--drives N] [--discs N]
+                                              [--size BYTES] [--interval SECONDS]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from omimgr.autoloader import Autoloader
+from omimgr.scheduler import Scheduler
+import fakes
+
+
+def main():
+    """Run benchmark and print results as JSON"""
+    parser = argparse.ArgumentParser(description='omimgr autoloader benchmark')
+    parser.add_argument('--drives', type=int, default=3, help='number of fake drives')
+    parser.add_argument('--discs', type=int, default=9, help='number of discs to load')
+    parser.add_argument('--size', type=int, default=8 * 2**20, help='size of each fake disc')
+    parser.add_argument('--interval', type=float, default=0.1, help='poll interval in seconds')
+    args = parser.parse_args()
+
+    fakes.useStubs()
+    output = {'drives': args.drives, 'discs': args.discs, 'pollInterval': args.interval}
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        configFile = os.path.join(tempDir, 'omimgr.json')
+        fakes.writeConfig(configFile)
+        drives = fakes.makeFakeDevices(tempDir, args.drives + 1, args.size)
+        brokenDrive = drives.pop()
+        baseDir = os.path.join(tempDir, 'out')
+        os.mkdir(baseDir)
+
+        scheduler = Scheduler(drives + [brokenDrive], allowFileDevice=True,
+                              configFile=configFile)
+        trays = fakes.FakeTrays(drives, scheduler, brokenDrive)
+        identifiers = ['disc%04d' % i for i in range(args.discs)]
+        autoloader = Autoloader(scheduler, baseDir, identifiers, {'readMethod': 'ddrescue'},
+                                pollInterval=args.interval, maxInterval=8 * args.interval,
+                                trayStatus=trays.trayStatus, startCallback=trays.onStart,
+                                finishCallback=trays.onFinish)
+        scheduler.start()
+        startTime = time.perf_counter()
+        autoloader.start(stopWhenExhausted=True)
+        trays.loadDiscs(args.discs, args.size, 2 * args.interval)
+        autoloader.thread.join()
+        results = scheduler.join()
+        wallTime = time.perf_counter() - startTime
+        autoloader.stop()
+
+        startDelays = trays.startDelays
+        brokenGaps = [b - a for a, b in zip(trays.brokenPolls, trays.brokenPolls[1:])]
+        output['jobs'] = len(results)
+        output['wallSeconds'] = round(wallTime, 3)
+        output['startDelaySeconds'] = {'mean': round(sum(startDelays) / len(startDelays), 3),
+                                       'max': round(max(startDelays), 3)}
+        output['trayPolls'] = trays.polls
+        output['trayPollsPerDriveSecond'] = round(trays.polls / args.drives / wallTime, 2)
+        output['busyDrivePolls'] = trays.busyPolls
+        output['brokenDrivePolls'] = len(trays.brokenPolls)
+        output['brokenDriveMaxGapSeconds'] = round(max(brokenGaps, default=0), 3)
+
+    print(json.dumps(output, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#! /usr/bin/env python3
+"""
+Benchmark for omimgr.catalogue
+
+Writes a tree of synthetic job directories, each with a metadata file, and
+compares answering typical questions (was an identifier imaged, which job
+has a checksum, which jobs failed in the last week, average MB/s of each
+drive) by crawling the metadata files with answering them from the
+catalogue, after a bulk import. Also reports the time to import the tree
+(and to import it again), and the rate of jobs added from several threads
+at once. The tests in tests/test_catalogue.py check the answers.
+
+Usage: python3 benchmarks/bench_catalogue.py [--jobs N] [--threads N]
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from omimgr.catalogue import Catalogue, parseTimestamp
+import fakes
+
+
+def crawl(rootDir):
+    """Yield (dirOut, metadata) for every metadata file under rootDir"""
+    for dirPath, dirNames, fileNames in os.walk(rootDir):
+        if 'metadata.json' in fileNames:
+            with io.open(os.path.join(dirPath, 'metadata.json'), 'r', encoding='utf-8') as f:
+                yield dirPath, json.load(f)
+
+
+def crawlAnswers(rootDir, identifier, digest, since):
+    """Answer the questions by crawling the metadata files"""
+    identifierDirs = []
+    digestDirs = []
+    failedDirs = []
+    throughput = {}
+    for dirOut, metadata in crawl(rootDir):
+        if metadata['identifier'] == identifier:
+            identifierDirs.append(dirOut)
+        if any(digest in fileDigests.values() for fileDigests in metadata['digests'].values()):
+            digestDirs.append(dirOut)
+        if not metadata['successFlag'] and parseTimestamp(metadata['acquisitionStart']) >= since:
+            failedDirs.append(dirOut)
+        throughput.setdefault(metadata['omDevice'], []).append(
+            metadata['timing']['phases']['read']['MBPerSecond'])
+    averages = {drive: round(sum(values) / len(values), 3)
+                for drive, values in throughput.items()}
+    return sorted(identifierDirs), sorted(digestDirs), sorted(failedDirs), averages
+
+
+def catalogueAnswers(catalogue, identifier, digest, since):
+    """Answer the questions from the catalogue"""
+    identifierDirs = [job['dirOut'] for job in catalogue.findJobs(identifier=identifier)]
+    digestDirs = [job['dirOut'] for job in catalogue.findJobs(digest=digest)]
+    failedDirs = [job['dirOut'] for job in catalogue.findJobs(since=since, failed=True)]
+    averages = {row['omDevice']: row['averageMBPerSecond']
+                for row in catalogue.driveStatistics()}
+    return sorted(identifierDirs), sorted(digestDirs), sorted(failedDirs), averages
+
+
+def timed(function, *args):
+    """Return result of function(*args) and the time it took"""
+    startTime = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - startTime
+
+
+def main():
+    """Run benchmark and print results as JSON"""
+    parser = argparse.ArgumentParser(description='omimgr job catalogue benchmark')
+    parser.add_argument('--jobs', type=int, default=2000, help='number of synthetic jobs')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='number of threads that add jobs at the same time')
+    args = parser.parse_args()
+
+    output = {'jobs': args.jobs}
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        rootDir = os.path.join(tempDir, 'images')
+        jobs = fakes.writeMetadataTree(rootDir, args.jobs)
+        dbFile = os.path.join(tempDir, 'catalogue.sqlite')
+        catalogue = Catalogue(dbFile)
+
+        (noImported, failed), importTime = timed(catalogue.importTree, rootDir)
+        output['importSeconds'] = round(importTime, 3)
+        output['importJobsPerSecond'] = round(noImported / importTime)
+        _, reimportTime = timed(catalogue.importTree, rootDir)
+        output['reimportSeconds'] = round(reimportTime, 3)
+
+        # The same questions, by crawling and from the catalogue
+        identifier = 'disc%06d' % (args.jobs // 2)
+        digest = jobs[args.jobs // 3][1]['digests']['MD5']['disc.iso']
+        since = time.time() - 7 * 86400
+        crawled, crawlTime = timed(crawlAnswers, rootDir, identifier, digest, since)
+        queried, queryTime = timed(catalogueAnswers, catalogue, identifier, digest, since)
+        output['crawlSeconds'] = round(crawlTime, 4)
+        output['catalogueSeconds'] = round(queryTime, 4)
+        output['speedup'] = round(crawlTime / queryTime, 1)
+        output['failedLastWeek'] = len(queried[2])
+        _, lookupTime = timed(catalogue.latestMetadata, identifier)
+        output['identifierLookupMs'] = round(1000 * lookupTime, 3)
+
+        # Concurrent writers (as with several drives), each with its own
+        # Catalogue instance
+        rng = random.Random(2)
+
+        def addJobs(threadNo):
+            threadCatalogue = Catalogue(dbFile)
+            for i in range(50):
+                number = 1000000 + threadNo * 1000 + i
+                threadCatalogue.addJob(fakes.syntheticMetadata(rng, number, time.time()),
+                                       os.path.join(tempDir, 'threads', str(number)))
+
+        threads = [threading.Thread(target=addJobs, args=(i,)) for i in range(args.threads)]
+        startTime = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        output['concurrentAddsPerSecond'] = round(50 * args.threads /
+                                                  (time.perf_counter() - startTime))
+        output['catalogueBytes'] = os.path.getsize(dbFile)
+
+    print(json.dumps(output, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+"""
+Benchmark for omimgr.devices
+
+Builds a fake sysfs tree with a number of optical drives (and other block
+devices that must be ignored), and measures the time of a full inventory
+scan. Then plugs in, changes and removes a drive while the inventory
+monitors the tree, and reports the events and how long each took to arrive.
+The tests in tests/test_devices.py check the inventory and its use by the
+scheduler.
+
+Usage: python3 benchmarks/bench_devices.py [--drives N] [--scans N]
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from omimgr.devices import DeviceInventory
+import fakes
+
+
+def waitForEvent(events, timeout=5.0):
+    """Return (eventType, device name, seconds) of next event, or None on timeout"""
+    startTime = time.perf_counter()
+    try:
+        eventType, device = events.get(timeout=timeout)
+    except queue.Empty:
+        return None
+    return eventType, device.name, round(time.perf_counter() - startTime, 3)
+
+
+def main():
+    """Run harness and print results as JSON"""
+    parser = argparse.ArgumentParser(description='omimgr device inventory harness')
+    parser.add_argument('--drives', type=int, default=4, help='number of fake drives')
+    parser.add_argument('--scans', type=int, default=1000, help='number of timed scans')
+    args = parser.parse_args()
+
+    output = {'drives': args.drives}
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        sysRoot = os.path.join(tempDir, 'sys')
+        devRoot = os.path.join(tempDir, 'dev')
+        for i in range(args.drives):
+            fakes.addFakeDrive(sysRoot, devRoot, 'sr' + str(i), size=(i % 2) * 2**20)
+        # Block devices that are not optical drives
+        for name in ['sda', 'sdb', 'nvme0n1'] + ['loop' + str(i) for i in range(32)]:
+            os.makedirs(os.path.join(sysRoot, 'block', name, 'device'))
+
+        inventory = DeviceInventory(sysRoot, devRoot, pollInterval=0.05)
+        output['devices'] = [{'path': os.path.basename(device.path), 'vendor': device.vendor,
+                              'model': device.model, 'serial': device.serial,
+                              'size': device.size} for device in inventory.devices()]
+        startTime = time.perf_counter()
+        for _ in range(args.scans):
+            inventory.scan()
+        output['scanMicroseconds'] = round(1e6 * (time.perf_counter() - startTime) / args.scans, 1)
+
+        # Hotplug events
+        events = queue.Queue()
+        inventory.subscribe(lambda eventType, device: events.put((eventType, device)))
+        inventory.start()
+        output['monitorMode'] = inventory.monitorMode
+        output['events'] = []
+        newDrive = 'sr' + str(args.drives)
+        fakes.addFakeDrive(sysRoot, devRoot, newDrive)
+        output['events'].append(waitForEvent(events))
+        fakes.setFakeDiscSize(sysRoot, newDrive, 2**20)
+        output['events'].append(waitForEvent(events))
+        fakes.removeFakeDrive(sysRoot, devRoot, newDrive)
+        output['events'].append(waitForEvent(events))
+        inventory.close()
+
+    print(json.dumps(output, indent=4))
+
+
+if __name__ == "__main__":
+    main()
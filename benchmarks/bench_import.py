@@ -0,0 +1,90 @@
+#! /usr/bin/env python3
+"""
+Startup benchmark for omimgr
+
+Imports the GUI and CLI modules in fresh interpreters with python -X importtime,
+and reports the total import time of each, the slowest modules, and the
+wall time of 'omimgr-cli --version' (interpreter start included). Exits with
+status 1 if any of these exceeds the budget.
+
+Usage: python3 benchmarks/bench_import.py [--budget MS] [--runs N] [--top N]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def importTimes(module):
+    """Import module in a fresh interpreter; returns list of (module name,
+    self time, cumulative time) in microseconds, or None if the import failed"""
+    env = dict(os.environ, PYTHONPATH=repoDir)
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env,
+                       universal_newlines=True)
+    if p.returncode != 0:
+        return None
+    times = []
+    for line in p.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith('import time:') and '|' in line:
+            selfTime, cumulative, name = line[len('import time:'):].split('|')
+            if selfTime.strip().isdigit():
+                times.append((name.strip(), int(selfTime), int(cumulative)))
+    return times
+
+
+def startupTime():
+    """Wall time in seconds of 'omimgr-cli --version' in a fresh interpreter"""
+    env = dict(os.environ, PYTHONPATH=repoDir)
+    startTime = time.perf_counter()
+    subprocess.run([sys.executable, '-c',
+                    'import sys; from omimgr.cli import main; '
+                    'sys.argv = ["omimgr-cli", "--version"]; main()'],
+                   stdout=subprocess.DEVNULL, env=env)
+    return time.perf_counter() - startTime
+
+
+def main():
+    """Run benchmark and print results as JSON"""
+    parser = argparse.ArgumentParser(description='omimgr startup benchmark')
+    parser.add_argument('--budget', type=float, default=500, help='budget in milliseconds')
+    parser.add_argument('--runs', type=int, default=5, help='number of runs (best one counts)')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest modules to list')
+    args = parser.parse_args()
+
+    output = {'budgetMilliseconds': args.budget, 'modules': {}}
+    overBudget = False
+
+    for module in ['omimgr.gui', 'omimgr.cli']:
+        runs = [importTimes(module) for _ in range(args.runs)]
+        runs = [run for run in runs if run]
+        if not runs:
+            # e.g. no tkinter on this machine
+            output['modules'][module] = {'error': 'import failed'}
+            continue
+        best = min(runs, key=lambda run: run[-1][2])
+        importMilliseconds = best[-1][2] / 1000
+        slowest = sorted(best, key=lambda item: item[1], reverse=True)[:args.top]
+        output['modules'][module] = {
+            'importMilliseconds': round(importMilliseconds, 1),
+            'slowestModules': [{'module': name, 'selfMilliseconds': round(selfTime / 1000, 1)}
+                               for name, selfTime, _ in slowest]}
+        overBudget = overBudget or importMilliseconds > args.budget
+
+    cliMilliseconds = 1000 * min(startupTime() for _ in range(args.runs))
+    output['cliVersionMilliseconds'] = round(cliMilliseconds, 1)
+    overBudget = overBudget or cliMilliseconds > args.budget
+    output['withinBudget'] = not overBudget
+
+    print(json.dumps(output, indent=4))
+    return 1 if overBudget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
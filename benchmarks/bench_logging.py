@@ -0,0 +1,133 @@
+#! /usr/bin/env python3
+"""
+Benchmark of log writing on a slow filesystem
+
+Feeds the ddrescue transcript to the ddrescue output parser of
+omimgr.wrappers (logging every status block), with the log file on a
+simulated slow filesystem that waits a fixed latency on every flush (e.g. an
+NFS share). Compares a plain FileHandler, which flushes after every record
+in the thread that reads the tool's output, with the queued handler from
+omimgr.shared, which writes the file from a separate thread and flushes at
+an interval. Reports the number of records per second the parser sustains.
+Whether the queued handler writes all records is checked by
+tests/test_shared.py.
+
+Usage: python3 benchmarks/bench_logging.py [--latency SECONDS] [--repeat N]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from omimgr import wrappers
+from omimgr import shared
+
+transcript = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transcripts',
+                          'ddrescue-1.22.txt')
+
+
+class SlowStream:
+    """File object that waits latency seconds on every flush"""
+
+    def __init__(self, f, latency):
+        """initialise SlowStream instance"""
+        self.f = f
+        self.latency = latency
+        self.flushes = 0
+
+    def write(self, data):
+        """Write data to buffer"""
+        return self.f.write(data)
+
+    def flush(self):
+        """Flush after waiting"""
+        time.sleep(self.latency)
+        self.flushes += 1
+        self.f.flush()
+
+    def close(self):
+        """Close file"""
+        self.f.close()
+
+
+def makeHandler(kind, logFile, latency):
+    """Return handler of kind 'direct' or 'queued' that writes to logFile on
+    the slow filesystem, and the SlowStream"""
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    if kind == 'direct':
+        fileHandler = logging.FileHandler(logFile)
+    else:
+        fileHandler = shared.BufferedFileHandler(logFile)
+    fileHandler.setFormatter(formatter)
+    fileHandler.stream = SlowStream(fileHandler.stream, latency)
+    if kind == 'direct':
+        return fileHandler, fileHandler.stream
+    return shared.QueuedLogHandler([fileHandler]), fileHandler.stream
+
+
+def replay(logger, repeat):
+    """Feed transcript to a ddrescue parser repeat times, as OutputReader
+    does; returns the time this took"""
+    with open(transcript, 'rb') as f:
+        data = f.read()
+    lines = []
+    start = 0
+    for match in re.finditer(rb'\r\n|\r|\n', data):
+        lines.append((data[start:match.start()].decode(), match.group() == b'\r'))
+        start = match.end()
+    startTime = time.perf_counter()
+    for _ in range(repeat):
+        parser = wrappers.RescueParser('ddrescue', logger=logger, logInterval=0)
+        for line, isProgress in lines:
+            parser.processLine(line, 'stdout', isProgress)
+        parser.finish()
+    return time.perf_counter() - startTime
+
+
+def main():
+    """Run benchmark and print results as JSON"""
+    parser = argparse.ArgumentParser(description='omimgr log writing benchmark')
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='latency of each flush in seconds')
+    parser.add_argument('--repeat', type=int, default=2,
+                        help='number of times the transcript is replayed')
+    args = parser.parse_args()
+
+    output = {'flushLatencySeconds': args.latency, 'handlers': []}
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        for kind in ['direct', 'queued']:
+            logFile = os.path.join(tempDir, kind + '.log')
+            handler, stream = makeHandler(kind, logFile, args.latency)
+            logger = logging.getLogger('bench.' + kind)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            counter = []
+            logger.addFilter(lambda record: counter.append(1) or True)
+            logger.addHandler(handler)
+
+            parseTime = replay(logger, args.repeat)
+            startTime = time.perf_counter()
+            handler.close()
+            closeTime = time.perf_counter() - startTime
+            logger.removeHandler(handler)
+
+            output['handlers'].append({'handler': kind,
+                                       'records': len(counter),
+                                       'parseSeconds': round(parseTime, 3),
+                                       'recordsPerSecond': round(len(counter) / parseTime),
+                                       'closeSeconds': round(closeTime, 3),
+                                       'flushes': stream.flushes})
+
+    print(json.dumps(output, indent=4))
+
+
+if __name__ == "__main__":
+    main()
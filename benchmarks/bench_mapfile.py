@@ -0,0 +1,123 @@
+#! /usr/bin/env python3
+"""
+Benchmark for omimgr.mapfile
+
+Writes a synthetic ddrescue mapfile for a 100 GB Blu-ray with many small
+bad areas, and measures the time of a full parse, of an incremental update
+after ddrescue changed the blocks near the end of the map, and of range
+queries on the result.
+
+Usage: python3 benchmarks/bench_mapfile.py [--blocks N] [--queries N]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from omimgr.mapfile import RescueMap
+
+header = ('# Mapfile. Created by GNU ddrescue version 1.22\n'
+          '# Command line: ddrescue -b 2048 -r4 -v /dev/sr0 disc.iso disc.map\n'
+          '# Start time:   2020-01-01 12:00:00\n'
+          '# Current time: 2020-01-01 14:00:00\n'
+          '# Scraping failed blocks... (forwards)\n'
+          '# current_pos  current_status  current_pass\n'
+          '0x%010X     /               1\n'
+          '#      pos        size  status\n')
+
+
+def makeBlocks(noBlocks, discSize, seed=0):
+    """Return list of (pos, size, status) tuples that cover discSize bytes;
+    finished blocks alternate with bad, non-trimmed and non-scraped ones"""
+    rng = random.Random(seed)
+    noSectors = discSize // 2048
+    # Random, sorted block boundaries (in sectors)
+    boundaries = sorted(rng.sample(range(1, noSectors), noBlocks - 1))
+    blocks = []
+    start = 0
+    for i, end in enumerate(boundaries + [noSectors]):
+        status = '+' if i % 2 == 0 else rng.choice('-*/-')
+        blocks.append((start * 2048, (end - start) * 2048, status))
+        start = end
+    return blocks
+
+
+def writeMap(mapFile, blocks, currentPos):
+    """Write blocks to mapfile"""
+    with open(mapFile, 'w') as f:
+        f.write(header % currentPos)
+        f.writelines('0x%010X  0x%08X  %s\n' % block for block in blocks)
+
+
+def timed(function, *args):
+    """Return result and wall time of function(*args)"""
+    startTime = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - startTime
+
+
+def main():
+    """Run benchmark and print results as JSON"""
+    parser = argparse.ArgumentParser(description='omimgr mapfile benchmark')
+    parser.add_argument('--blocks', type=int, default=2 * 10**6, help='number of blocks in map')
+    parser.add_argument('--queries', type=int, default=10**5, help='number of range queries')
+    args = parser.parse_args()
+
+    discSize = 100 * 10**9
+    blocks = makeBlocks(args.blocks, discSize)
+    output = {'blocks': args.blocks, 'discSize': discSize}
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        mapFile = os.path.join(tempDir, 'disc.map')
+        writeMap(mapFile, blocks, 0)
+        output['mapFileSize'] = os.path.getsize(mapFile)
+
+        rescueMap = RescueMap(mapFile)
+        _, output['fullParseSeconds'] = timed(rescueMap.update)
+
+        # ddrescue marks a couple of blocks near the end as finished; the
+        # current position in the header changes as well
+        changed = list(blocks)
+        for i in range(len(changed) - 99, len(changed), 2):
+            pos, size, _ = changed[i]
+            changed[i] = (pos, size, '+')
+        writeMap(mapFile, changed, changed[-100][0])
+        os.utime(mapFile, ns=(time.time_ns(), time.time_ns() + 10**9))
+        _, output['incrementalUpdateSeconds'] = timed(rescueMap.update)
+        output['incrementalBlocksParsed'] = rescueMap.noParsedBlocks
+
+        rng = random.Random(1)
+        ranges = []
+        for _ in range(args.queries):
+            start = rng.randrange(discSize)
+            ranges.append((start, rng.randrange(start, discSize + 1)))
+
+        def runQueries(query):
+            for start, end in ranges:
+                query(start, end)
+
+        for name, query in [['rescuedBytes', rescueMap.rescuedBytes],
+                            ['badSectorCount', rescueMap.badSectorCount],
+                            ['largestBadArea', rescueMap.largestBadArea]]:
+            _, elapsed = timed(runQueries, query)
+            output[name + 'MicrosecondsPerQuery'] = round(1e6 * elapsed / args.queries, 2)
+
+        arrays = [rescueMap.positions, rescueMap.sizes, rescueMap.statuses,
+                  rescueMap.badBlocks, rescueMap.badTree]
+        arrays += list(rescueMap.cumulative.values())
+        output['arrayBytes'] = sum(sys.getsizeof(a) for a in arrays)
+        output['summary'] = rescueMap.summary()
+
+    for key in ['fullParseSeconds', 'incrementalUpdateSeconds']:
+        output[key] = round(output[key], 3)
+    print(json.dumps(output, indent=4))
+
+
+if __name__ == "__main__":
+    main()
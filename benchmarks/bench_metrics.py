@@ -0,0 +1,156 @@
+#! /usr/bin/env python3
+"""
+Benchmark for omimgr.metrics
+
+Images file-backed fake drives with the scheduler (one readom, ddrescue and
+native job per drive; one drive has unreadable sectors), with the metrics
+file and HTTP endpoint enabled in the configuration file. A scraper
+stand-in fetches /metrics at a fixed interval while the jobs run. Reports
+the number of scrapes and their latency, the size of the exposition, and
+the time to render the registry. The tests in tests/test_metrics.py check
+the text format and the counters.
+
+Usage: python3 benchmarks/bench_metrics.py [--drives N] [--size BYTES]
+                                           [--interval SECONDS]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from omimgr.om import Disc
+from omimgr.scheduler import Scheduler
+from omimgr.omimgr import __version__
+from omimgr import config
+from omimgr import metrics
+import fakes
+
+
+class Scraper:
+    """Scraper stand-in: fetches url every interval seconds from a thread"""
+
+    def __init__(self, url, interval):
+        """initialise Scraper instance"""
+        self.url = url
+        self.interval = interval
+        self.scrapes = 0
+        self.failures = 0
+        self.latencies = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def scrape(self):
+        """Fetch metrics; returns the text"""
+        startTime = time.perf_counter()
+        with urllib.request.urlopen(self.url, timeout=5) as response:
+            text = response.read().decode('utf-8')
+        self.latencies.append(time.perf_counter() - startTime)
+        self.scrapes += 1
+        return text
+
+    def run(self):
+        """Scrape until stopped"""
+        while not self.stopped.wait(self.interval):
+            try:
+                self.scrape()
+            except (OSError, urllib.error.URLError):
+                self.failures += 1
+
+    def start(self):
+        """Start scraping in the background"""
+        self.thread.start()
+
+    def stop(self):
+        """Stop scraping"""
+        self.stopped.set()
+        self.thread.join()
+
+
+def main():
+    """Run benchmark and print results as JSON"""
+    parser = argparse.ArgumentParser(description='omimgr metrics benchmark')
+    parser.add_argument('--drives', type=int, default=2, help='number of fake drives')
+    parser.add_argument('--size', type=int, default=16 * 2**20, help='size of each fake disc')
+    parser.add_argument('--interval', type=float, default=0.05, help='scrape interval in seconds')
+    args = parser.parse_args()
+
+    fakes.useStubs()
+    config.version = __version__
+    output = {'drives': args.drives}
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        metricsFile = os.path.join(tempDir, 'omimgr.prom')
+        configFile = os.path.join(tempDir, 'omimgr.json')
+        # Port 0: any free port
+        fakes.writeConfig(configFile, metricsFile=metricsFile, metricsAddress='127.0.0.1:0')
+        drives = [os.path.join(tempDir, 'sr' + str(i)) for i in range(args.drives)]
+        for drive in drives:
+            fakes.makeFakeImage(drive, args.size)
+        # Unreadable sectors on the first drive (ddrescue stand-in only)
+        with open(drives[0] + '.bad', 'w') as f:
+            f.write('%d %d\n' % (args.size // 2, 4096))
+
+        # Start exporting, as omimgr-cli and the GUI do
+        disc = Disc()
+        disc.configFile = configFile
+        disc.getConfiguration()
+        disc.startMetrics()
+        if metrics.exporter.server is None:
+            print(json.dumps({'error': 'metrics endpoint not started'}, indent=4))
+            return
+        scraper = Scraper(metrics.exporter.server.url(), args.interval)
+        scraper.start()
+
+        scheduler = Scheduler(drives, allowFileDevice=True, configFile=configFile)
+        scheduler.start()
+        startTime = time.perf_counter()
+        for method in ['readom', 'ddrescue', 'native']:
+            for drive in drives:
+                dirOut = os.path.join(tempDir, os.path.basename(drive) + '-' + method)
+                os.mkdir(dirOut)
+                scheduler.submit({'omDevice': drive, 'readMethod': method, 'dirOut': dirOut})
+        results = scheduler.join()
+        wallTime = time.perf_counter() - startTime
+        scraper.stop()
+        finalText = scraper.scrape()
+
+        renderTimes = []
+        for _ in range(100):
+            renderStart = time.perf_counter()
+            metrics.registry.render()
+            renderTimes.append(time.perf_counter() - renderStart)
+        updateTimes = []
+        for _ in range(20):
+            updateStart = time.perf_counter()
+            metrics.exporter.update()
+            updateTimes.append(time.perf_counter() - updateStart)
+        metrics.exporter.stop()
+
+        output['jobs'] = len(results)
+        output['jobStatus'] = {result['dirOut'].rsplit('-', 1)[1] + ' ' +
+                               os.path.basename(result['omDevice']): result['status']
+                               for result in results}
+        output['wallSeconds'] = round(wallTime, 3)
+        output['scrapes'] = scraper.scrapes
+        output['scrapeFailures'] = scraper.failures
+        output['scrapeLatencyMs'] = {
+            'mean': round(1000 * sum(scraper.latencies) / len(scraper.latencies), 3),
+            'max': round(1000 * max(scraper.latencies), 3)}
+        output['samples'] = len(metrics.parseSamples(finalText))
+        output['expositionBytes'] = len(finalText.encode('utf-8'))
+        output['renderMs'] = round(1000 * min(renderTimes), 3)
+        output['fileUpdateMs'] = round(1000 * min(updateTimes), 3)
+
+    print(json.dumps(output, indent=4))
+
+
+if __name__ == "__main__":
+    main()
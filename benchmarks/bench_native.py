@@ -0,0 +1,93 @@
+#! /usr/bin/env python3
+"""
+Benchmark for omimgr.native
+
+Images a fake disc with the built-in sector reader and with the ddrescue
+stand-in, and compares their wall times. Then images the disc with
+unreadable sectors (listed in a .bad file, as for the ddrescue stand-in),
+and reports the time of that run and of a ddrescue stand-in pass that
+continues from the native reader's mapfile. The tests in tests/test_native.py
+check the images and checksums.
+
+Usage: python3 benchmarks/bench_native.py [--size BYTES]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from omimgr.native import SectorReader
+from omimgr.mapfile import RescueMap
+import fakes
+
+
+def timed(function, *args, **kwargs):
+    """Return result and wall time of function(*args, **kwargs)"""
+    startTime = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - startTime
+
+
+def main():
+    """Run harness and print results as JSON"""
+    parser = argparse.ArgumentParser(description='omimgr native reader harness')
+    parser.add_argument('--size', type=int, default=256 * 2**20, help='size of fake disc')
+    args = parser.parse_args()
+
+    fakes.useStubs()
+    rng = random.Random(0)
+    output = {'discSize': args.size}
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        disc = os.path.join(tempDir, 'sr0')
+        fakes.makeFakeImage(disc, args.size)
+
+        # Clean run, with in-process hashing (the stand-in doesn't hash)
+        imageFile = os.path.join(tempDir, 'native.iso')
+        reader = SectorReader(disc, imageFile, os.path.join(tempDir, 'native.map'),
+                              algorithms=['sha512'])
+        result, output['nativeSeconds'] = timed(reader.run)
+        output['nativeResult'] = result
+
+        # Same disc with the ddrescue stand-in
+        stubArgs = ['ddrescue', '-b', '2048', disc, os.path.join(tempDir, 'stub.iso'),
+                    os.path.join(tempDir, 'stub.map')]
+        _, output['ddrescueStubSeconds'] = timed(subprocess.run, stubArgs,
+                                                 stdout=subprocess.DEVNULL)
+
+        # Faulty copy of the disc, followed by a ddrescue pass on a clean copy
+        noSectors = args.size // 2048
+        with open(disc + '.bad', 'w') as f:
+            for _ in range(20):
+                f.write('%d %d\n' % (rng.randrange(64, noSectors) * 2048, 2048))
+        imageFile = os.path.join(tempDir, 'faulty.iso')
+        mapFile = os.path.join(tempDir, 'faulty.map')
+        reader = fakes.FaultyReader(disc, imageFile, mapFile, retries=1)
+        output['faultyResult'], output['faultySeconds'] = timed(reader.run)
+        output['faultyReadErrors'] = reader.readErrors
+        rescueMap = RescueMap(mapFile)
+        rescueMap.update()
+        output['faultyMapSummary'] = rescueMap.summary()
+
+        os.remove(disc + '.bad')
+        _, output['afterDdrescueSeconds'] = timed(
+            subprocess.run, ['ddrescue', '-b', '2048', disc, imageFile, mapFile],
+            stdout=subprocess.DEVNULL)
+        rescueMap.update()
+        output['afterDdrescueRescuedBytes'] = rescueMap.rescuedBytes()
+
+    for key in ['nativeSeconds', 'ddrescueStubSeconds', 'faultySeconds',
+                'afterDdrescueSeconds']:
+        output[key] = round(output[key], 3)
+    print(json.dumps(output, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+#! /usr/bin/env python3
+"""
+Benchmark suite for the imaging pipeline
+
+Measures, with the readom / ddrescue stand-ins in benchmarks/stubs and
+file-backed fake discs:
+
+- parsing: throughput of the wrapper output parsers on the recorded readom
+  and ddrescue transcripts;
+- hashing: throughput of shared.generate_file_sha512;
+- validation: time to validate a fake CD, DVD and BD image from its volume
+  descriptors, and with isolyzer (if it is installed);
+- processDisc: wall time of Disc.processDisc for a CD, DVD and BD with each
+  read method.
+
+Disc sizes are the nominal CD, DVD and BD sizes times --scale (default
+0.01, use 1 for full-size discs). Results are printed as JSON, together with
+the omimgr and Python versions, and can be written to a file with
+--output. With --baseline (a results file of an earlier run, e.g. of the
+previous release) each result also gets the ratio to the baseline value.
+Whether the images are correct is checked by tests/test_pipeline.py.
+
+Usage: python3 benchmarks/bench_pipeline.py [--scale F] [--rate BYTES_PER_SECOND]
+                                            [--methods readom,ddrescue,native]
+                                            [--hash-size BYTES] [--repeat N]
+                                            [--output FILE] [--baseline FILE]
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoDir)
+
+from omimgr.om import Disc
+from omimgr.omimgr import __version__
+from omimgr import config
+from omimgr import pipeline
+from omimgr import shared
+from omimgr import wrappers
+import bench_reader
+import fakes
+
+
+def environment():
+    """Return versions and machine details"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repoDir,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'omimgrVersion': __version__,
+            'gitCommit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def benchParsing(repeat):
+    """Throughput of the wrapper output parsers on the recorded transcripts"""
+    results = {}
+    for fileName, stream, parserClass in bench_reader.TRANSCRIPTS:
+        transcript = os.path.join(bench_reader.transcriptsDir, fileName)
+        mbytes = os.path.getsize(transcript) * repeat / 1e6
+        cpuTime, wallTime = bench_reader.timeRun(
+            transcript, stream, repeat,
+            lambda p: wrappers.OutputReader(p, parserClass(fileName)).run())
+        # Keyed by tool name (readom, ddrescue)
+        toolName = fileName.split('.')[0].split('-')[0]
+        results[toolName] = {'outputMB': round(mbytes, 3),
+                             'MBPerSecond': round(mbytes / wallTime, 2),
+                             'cpuSecondsPerMB': round(cpuTime / mbytes, 5)}
+    return results
+
+
+def benchHashing(tempDir, size, repeat):
+    """Throughput of generate_file_sha512 (best of repeat runs)"""
+    imageFile = os.path.join(tempDir, 'hash.iso')
+    size = fakes.makeFakeImage(imageFile, size)
+    times = []
+    for _ in range(repeat):
+        startTime = time.perf_counter()
+        shared.generate_file_sha512(imageFile)
+        times.append(time.perf_counter() - startTime)
+    os.remove(imageFile)
+    return {'sizeBytes': size,
+            'seconds': round(min(times), 3),
+            'MBPerSecond': round(size / min(times) / 1e6, 2)}
+
+
+def benchValidation(images, repeat):
+    """Time to validate each image from its volume descriptors and with
+    isolyzer (best of repeat runs)"""
+    try:
+        import isolyzer
+        haveIsolyzer = True
+    except ImportError:
+        haveIsolyzer = False
+    results = {}
+    for discType, imageFile in images.items():
+        times = []
+        for _ in range(repeat):
+            startTime = time.perf_counter()
+            _, success, _ = pipeline.scanImage(imageFile, ['sha512'], hashImage=False)
+            times.append(time.perf_counter() - startTime)
+        results[discType] = {'volumeDescriptorsSeconds': round(min(times), 4),
+                             'volumeDescriptorsSuccess': success}
+        if haveIsolyzer:
+            times = []
+            for _ in range(repeat):
+                startTime = time.perf_counter()
+                success, _ = pipeline.runIsolyzer(imageFile)
+                times.append(time.perf_counter() - startTime)
+            results[discType]['isolyzerSeconds'] = round(min(times), 4)
+            results[discType]['isolyzerSuccess'] = success
+    return results
+
+
+def runDisc(device, dirOut, readMethod, configFile):
+    """Image device with Disc.processDisc; returns the Disc and the wall time"""
+    disc = Disc()
+    disc.configFile = configFile
+    disc.getConfiguration()
+    disc.readMethod = readMethod
+    disc.retries = disc.retriesDefault
+    disc.omDevice = device
+    disc.dirOut = dirOut
+    disc.allowFileDevice = True
+    os.mkdir(dirOut)
+    disc.validateInput()
+    disc.prepareOutput(False)
+    startTime = time.perf_counter()
+    disc.processDisc()
+    return disc, time.perf_counter() - startTime
+
+
+def benchProcessDisc(tempDir, images, methods, configFile):
+    """Wall time of processDisc for each image and read method"""
+    results = {}
+    for discType, device in images.items():
+        results[discType] = {}
+        for readMethod in methods:
+            dirOut = os.path.join(tempDir, discType + '-' + readMethod)
+            disc, wallTime = runDisc(device, dirOut, readMethod, configFile)
+            imageSize = os.path.getsize(disc.imageFile)
+            results[discType][readMethod] = {'wallSeconds': round(wallTime, 3),
+                                             'MBPerSecond': round(imageSize / wallTime / 1e6, 2)}
+            # Only one image at a time on disk
+            os.remove(disc.imageFile)
+    return results
+
+
+def flatten(results, prefix=''):
+    """Return dictionary with dotted path and value of every number in results"""
+    items = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            items.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            items[prefix + key] = value
+    return items
+
+
+def compare(results, baseline):
+    """Return ratio of each result to its baseline value"""
+    baselineItems = flatten(baseline)
+    ratios = {}
+    for path, value in flatten(results).items():
+        if baselineItems.get(path):
+            ratios[path] = round(value / baselineItems[path], 3)
+    return ratios
+
+
+def main():
+    """Run benchmark suite and print results as JSON"""
+    parser = argparse.ArgumentParser(description='omimgr imaging pipeline benchmark suite')
+    parser.add_argument('--scale', type=float, default=0.01,
+                        help='disc sizes as fraction of nominal CD / DVD / BD sizes')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='read rate of the stand-ins in bytes per second (0: unlimited)')
+    parser.add_argument('--methods', default='readom,ddrescue,native',
+                        help='comma-separated list of read methods')
+    parser.add_argument('--hash-size', type=int, default=256 * 2**20, dest='hashSize',
+                        help='size of the file that is hashed')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs for parsing, hashing and validation')
+    parser.add_argument('--output', help='also write results to this file')
+    parser.add_argument('--baseline', help='results file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    fakes.useStubs()
+    if args.rate > 0:
+        os.environ['OMIMGR_STUB_RATE'] = str(args.rate)
+    config.version = __version__
+    methods = [method.strip() for method in args.methods.split(',') if method.strip()]
+
+    output = {'environment': environment(),
+              'settings': {'scale': args.scale, 'rate': args.rate, 'methods': methods,
+                           'repeat': args.repeat},
+              'results': {}}
+    results = output['results']
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        configFile = os.path.join(tempDir, 'omimgr.json')
+        fakes.writeConfig(configFile)
+
+        results['parsing'] = benchParsing(args.repeat)
+        results['hashing'] = benchHashing(tempDir, args.hashSize, args.repeat)
+
+        images = {}
+        for discType, size in fakes.discSizes.items():
+            images[discType] = os.path.join(tempDir, discType.lower())
+            fakes.makeFakeImage(images[discType], int(size * args.scale))
+        output['settings']['discSizes'] = {discType: os.path.getsize(image)
+                                           for discType, image in images.items()}
+
+        results['validation'] = benchValidation(images, args.repeat)
+        results['processDisc'] = benchProcessDisc(tempDir, images, methods, configFile)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        output['baselineEnvironment'] = baseline.get('environment', {})
+        output['ratioToBaseline'] = compare(results, baseline.get('results', {}))
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(output, f, indent=4)
+    print(json.dumps(output, indent=4))
+
+
+if __name__ == "__main__":
+    main()
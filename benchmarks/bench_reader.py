@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+"""
+Micro-benchmark of the subprocess output readers in omimgr.wrappers
+
+Replays readom / ddrescue transcripts through a stub process, and measures the
+CPU time that omimgr spends per MB of tool output, for the chunked
+OutputReader and for the old byte-at-a-time loop, and the number of log
+records each of them produces.
+
+Usage: python3 benchmarks/bench_reader.py [--repeat N]
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import subprocess as sub
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from omimgr import wrappers
+
+transcriptsDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'transcripts')
+
+# Stub that writes a transcript to stdout or stderr a number of times, in
+# chunks of the size a tty-less tool typically flushes
+STUB = """
+import sys
+data = open(sys.argv[1], 'rb').read()
+stream = sys.stdout.buffer if sys.argv[2] == 'stdout' else sys.stderr.buffer
+for i in range(int(sys.argv[3])):
+    for pos in range(0, len(data), 4096):
+        stream.write(data[pos:pos + 4096])
+        stream.flush()
+"""
+
+TRANSCRIPTS = [
+    ['readom.txt', 'stderr', wrappers.ReadomParser],
+    ['ddrescue-1.22.txt', 'stdout', wrappers.RescueParser],
+]
+
+
+class CountingHandler(logging.Handler):
+    """Logging handler that only counts records"""
+
+    def __init__(self):
+        """initialise CountingHandler instance"""
+        logging.Handler.__init__(self)
+        self.count = 0
+
+    def emit(self, record):
+        """Count record"""
+        self.count += 1
+
+
+def startStub(transcript, stream, repeat):
+    """Start stub process that replays transcript"""
+    args = [sys.executable, '-c', STUB, transcript, stream, str(repeat)]
+    return sub.Popen(args, stdout=sub.PIPE, stderr=sub.PIPE, shell=False)
+
+
+def legacyReader(p, stream):
+    """Byte-at-a-time loop as used by omimgr 0.3.0"""
+    line = ""
+    char = " "
+    textStream = open(stream.fileno(), 'r', encoding='utf-8', closefd=False)
+    while p.poll() is None or char != "":
+        char = textStream.read(1)
+        line += char
+        if char == "\n":
+            tidy_line = line.replace("\n", "").replace("\r", "").replace("\x1b[A", "")
+            if tidy_line != "":
+                logging.info(tidy_line)
+            line = ""
+
+
+def timeRun(transcript, stream, repeat, reader):
+    """Returns CPU seconds used by this process while reading all output"""
+    p = startStub(transcript, stream, repeat)
+    cpuStart = time.process_time()
+    wallStart = time.perf_counter()
+    reader(p)
+    cpuTime = time.process_time() - cpuStart
+    wallTime = time.perf_counter() - wallStart
+    p.wait()
+    return cpuTime, wallTime
+
+
+def main():
+    """Run benchmark and print results as JSON"""
+    parser = argparse.ArgumentParser(description='omimgr output reader benchmark')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='number of times each transcript is replayed')
+    args = parser.parse_args()
+
+    # Log records are created and counted, but not written anywhere
+    counter = CountingHandler()
+    logging.basicConfig(level=logging.INFO, handlers=[counter])
+
+    results = []
+    for fileName, stream, parserClass in TRANSCRIPTS:
+        transcript = os.path.join(transcriptsDir, fileName)
+        mbytes = os.path.getsize(transcript) * args.repeat / 1e6
+
+        def chunked(p):
+            wrappers.OutputReader(p, parserClass(fileName)).run()
+
+        def legacy(p):
+            legacyReader(p, p.stdout if stream == 'stdout' else p.stderr)
+
+        for readerName, reader in [['chunked', chunked], ['legacy', legacy]]:
+            counter.count = 0
+            cpuTime, wallTime = timeRun(transcript, stream, args.repeat, reader)
+            results.append({'transcript': fileName,
+                            'reader': readerName,
+                            'outputMB': round(mbytes, 3),
+                            'cpuSeconds': round(cpuTime, 4),
+                            'wallSeconds': round(wallTime, 4),
+                            'cpuSecondsPerMB': round(cpuTime / mbytes, 5),
+                            'logRecords': counter.count})
+
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+"""
+Test harness for omimgr.rescue
+
+Creates copies of one fake disc as fake drives, each with its own set of
+unreadable sectors (so every drive can read parts the others can't), and
+rescues the disc with ddrescue passes on all drives. Prints the passes, the
+bytes recovered per drive and the time the passes took.
+
+Usage: python3 benchmarks/bench_rescue.py [--drives N] [--size BYTES]
+"""
+
+import os
+import sys
+import json
+import shutil
+import random
+import argparse
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from omimgr.om import Disc
+import fakes
+
+
+def main():
+    """Run harness and print results as JSON"""
+    parser = argparse.ArgumentParser(description='omimgr rescue orchestration harness')
+    parser.add_argument('--drives', type=int, default=3, help='number of fake drives')
+    parser.add_argument('--size', type=int, default=32 * 2**20, help='size of fake disc')
+    args = parser.parse_args()
+
+    fakes.useStubs()
+    rng = random.Random(0)
+    swaps = []
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        configFile = os.path.join(tempDir, 'omimgr.json')
+        fakes.writeConfig(configFile)
+
+        # Every drive fails on its own random areas, which don't overlap
+        # between drives
+        drives = [os.path.join(tempDir, 'sr' + str(i)) for i in range(args.drives)]
+        fakes.makeFakeImage(drives[0], args.size)
+        noSectors = args.size // 2048
+        for i, drive in enumerate(drives):
+            if i > 0:
+                shutil.copy(drives[0], drive)
+            with open(drive + '.bad', 'w') as f:
+                for _ in range(20):
+                    start = rng.randrange(64, noSectors - 64)
+                    start -= start % args.drives - i
+                    f.write('%d %d\n' % (start * 2048, 2048))
+
+        disc = Disc()
+        disc.configFile = configFile
+        disc.getConfiguration()
+        disc.readMethod = 'ddrescue'
+        disc.retries = '1'
+        disc.omDevice = drives[0]
+        disc.rescueDrives = drives[1:]
+        disc.dirOut = os.path.join(tempDir, 'out')
+        disc.allowFileDevice = True
+        disc.swapCallback = lambda fromDrive, toDrive: swaps.append(
+            [os.path.basename(fromDrive), os.path.basename(toDrive)]) or True
+        os.mkdir(disc.dirOut)
+        disc.validateInput()
+        disc.prepareOutput(False)
+        startTime = time.perf_counter()
+        disc.processDisc()
+        seconds = time.perf_counter() - startTime
+
+        output = {'drives': args.drives,
+                  'discSize': args.size,
+                  'swaps': swaps,
+                  'passes': [{'omDevice': os.path.basename(ddrescuePass['omDevice']),
+                              'bytesRecovered': ddrescuePass['bytesRecovered'],
+                              'rescuedFraction': ddrescuePass['rescuedFraction']}
+                             for ddrescuePass in disc.rescuePasses],
+                  'successFlag': disc.successFlag,
+                  'seconds': round(seconds, 3)}
+
+    print(json.dumps(output, indent=4))
+
+
+if __name__ == "__main__":
+    main()
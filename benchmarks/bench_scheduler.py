@@ -0,0 +1,98 @@
+#! /usr/bin/env python3
+"""
+Throughput benchmark for omimgr.scheduler
+
+Creates file-backed fake optical devices, and images them with the
+readom / ddrescue stand-ins in benchmarks/stubs, first one disc after another,
+then with one worker per drive, and reports aggregate throughput for both
+runs. The tests in tests/test_scheduler.py check the images.
+
+Usage: python3 benchmarks/bench_scheduler.py [--drives N] [--size BYTES]
+                                             [--rate BYTES_PER_SECOND]
+                                             [--method readom|ddrescue]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from omimgr.scheduler import Scheduler
+import fakes
+
+
+def runJobs(devices, jobs, configFile):
+    """Run jobs with a scheduler for devices, and return results and wall time"""
+    scheduler = Scheduler(devices, allowFileDevice=True, configFile=configFile)
+    scheduler.start()
+    startTime = time.perf_counter()
+    for job in jobs:
+        scheduler.submit(job)
+    results = scheduler.join()
+    return results, time.perf_counter() - startTime
+
+
+def main():
+    """Run harness and print results as JSON"""
+    parser = argparse.ArgumentParser(description='omimgr scheduler harness')
+    parser.add_argument('--drives', type=int, default=4, help='number of fake drives')
+    parser.add_argument('--size', type=int, default=64 * 2**20, help='size of each fake disc')
+    parser.add_argument('--rate', type=float, default=16 * 2**20,
+                        help='read rate of each fake drive in bytes per second')
+    parser.add_argument('--method', default='ddrescue', choices=['readom', 'ddrescue'])
+    args = parser.parse_args()
+
+    fakes.useStubs()
+    os.environ['OMIMGR_STUB_RATE'] = str(args.rate)
+
+    output = {'drives': args.drives, 'discSize': args.size, 'driveRate': args.rate,
+              'readMethod': args.method, 'runs': []}
+
+    with tempfile.TemporaryDirectory() as tempDir:
+        configFile = os.path.join(tempDir, 'omimgr.json')
+        fakes.writeConfig(configFile)
+
+        devices = []
+        for i in range(args.drives):
+            device = os.path.join(tempDir, 'sr' + str(i))
+            fakes.makeFakeImage(device, args.size)
+            devices.append(device)
+
+        for runName in ['serial', 'parallel']:
+            jobs = []
+            for i, device in enumerate(devices):
+                dirOut = os.path.join(tempDir, runName + '-' + str(i))
+                os.mkdir(dirOut)
+                jobs.append({'omDevice': device, 'dirOut': dirOut,
+                             'readMethod': args.method, 'identifier': 'disc' + str(i)})
+
+            if runName == 'serial':
+                # One disc after another, as with a single drive
+                results = []
+                wallTime = 0
+                for job in jobs:
+                    jobResults, jobTime = runJobs([job['omDevice']], [job], configFile)
+                    results += jobResults
+                    wallTime += jobTime
+            else:
+                results, wallTime = runJobs(devices, jobs, configFile)
+
+            totalBytes = sum(result.get('imageSize', 0) for result in results)
+            output['runs'].append({'run': runName,
+                                   'jobs': len(results),
+                                   'wallSeconds': round(wallTime, 3),
+                                   'aggregateMBPerSecond': round(totalBytes / wallTime / 1e6, 3),
+                                   'jobResults': [{'dirOut': os.path.basename(r['dirOut']),
+                                                   'status': r['status'],
+                                                   'MBPerSecond': r.get('MBPerSecond')}
+                                                  for r in results]})
+
+    print(json.dumps(output, indent=4))
+
+
+if __name__ == "__main__":
+    main()
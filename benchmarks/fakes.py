@@ -0,0 +1,297 @@
+#! /usr/bin/env python3
+"""Helpers that create fake optical devices and omimgr configurations for the
+benchmarks and test harnesses"""
+
+import os
+import io
+import json
+import struct
+import time
+import random
+import shutil
+import hashlib
+import datetime
+import threading
+from omimgr.native import SectorReader
+from omimgr import devices
+from omimgr import shared
+
+stubsDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs')
+
+# Sizes of fake discs in bytes
+discSizes = {'CD': 700 * 10**6,
+             'DVD': 4700 * 10**6,
+             'BD': 25 * 10**9}
+
+
+def makeFakeImage(fileOut, size, sectorSize=2048):
+    """Write a file of (about) size bytes that passes omimgr's ISO 9660 checks:
+    a Primary Volume Descriptor and terminator at sector 16, followed by
+    pseudo-random data"""
+    noSectors = max(size // sectorSize, 32)
+
+    pvd = bytearray(sectorSize)
+    pvd[0] = 1
+    pvd[1:6] = b'CD001'
+    pvd[6] = 1
+    pvd[80:88] = struct.pack('<I', noSectors) + struct.pack('>I', noSectors)
+    pvd[128:132] = struct.pack('<H', sectorSize) + struct.pack('>H', sectorSize)
+    terminator = bytearray(sectorSize)
+    terminator[0] = 255
+    terminator[1:6] = b'CD001'
+
+    # 1 MiB block of random data that is repeated (with a varying header so
+    # blocks are not identical)
+    block = bytearray(os.urandom(2**20))
+    with open(fileOut, 'wb') as f:
+        f.write(bytes(16 * sectorSize))
+        f.write(pvd)
+        f.write(terminator)
+        remaining = noSectors * sectorSize - 18 * sectorSize
+        blockNo = 0
+        while remaining > 0:
+            block[0:8] = struct.pack('<Q', blockNo)
+            f.write(block[:min(remaining, len(block))])
+            remaining -= len(block)
+            blockNo += 1
+    return noSectors * sectorSize
+
+
+def makeFakeDevices(directory, noDevices, size=4 * 2**20):
+    """Write noDevices fake discs of size bytes (sr0, sr1, ...) to directory;
+    returns their paths"""
+    devices = []
+    for i in range(noDevices):
+        device = os.path.join(str(directory), 'sr' + str(i))
+        makeFakeImage(device, size)
+        devices.append(device)
+    return devices
+
+
+def writeConfig(configFile, **settings):
+    """Write omimgr configuration file with default values, updated with
+    settings"""
+    configSettings = {'retries': '4',
+                      'catalogueFile': '',
+                      'checksumFileName': 'checksums.sha512',
+                      'checksumAlgorithms': 'sha512',
+                      'checksumWorkers': '1',
+                      'chunkManifest': 'False',
+                      'consoleLines': '1000',
+                      'logFileName': 'omimgr.log',
+                      'metadataFileName': 'metadata.json',
+                      'metricsAddress': '',
+                      'metricsFile': '',
+                      'prefix': 'disc',
+                      'profileDir': '',
+                      'extension': 'iso',
+                      'rescueDirectDiscMode': 'False',
+                      'autoRetry': 'False',
+                      'pipelineHashing': 'True',
+                      'progressLogInterval': '60',
+                      'readCommand': 'readom',
+                      'timeZone': 'Europe/Amsterdam',
+                      'defaultDir': ''}
+    configSettings.update(settings)
+    with io.open(configFile, 'w', encoding='utf-8') as f:
+        json.dump(configSettings, f, indent=4, sort_keys=True)
+
+
+def useStubs():
+    """Put the readom / ddrescue stand-ins in front of PATH"""
+    os.environ['PATH'] = stubsDir + os.pathsep + os.environ.get('PATH', '')
+
+
+def addFakeDrive(sysRoot, devRoot, name, size=0, vendor='HL-DT-ST', model='DVDRAM GP57EB40',
+                 serial=None):
+    """Add optical drive to a fake sysfs tree under sysRoot (the same layout as
+    /sys/block/<name>), with a disc of size bytes. The device node in devRoot
+    is a regular file holding a fake disc of that size (an empty one for
+    size 0). The drive appears at once, so an inventory that scans the tree
+    meanwhile never sees it half-written"""
+    os.makedirs(devRoot, exist_ok=True)
+    devicePath = os.path.join(devRoot, name)
+    if size:
+        makeFakeImage(devicePath, size)
+    else:
+        open(devicePath, 'wb').close()
+    # Written outside sysRoot/block, then moved into place
+    blockDir = os.path.join(sysRoot, '.new-' + name)
+    deviceDir = os.path.join(blockDir, 'device')
+    os.makedirs(deviceDir)
+    with open(os.path.join(blockDir, 'size'), 'w') as f:
+        f.write(str(size // 512) + '\n')
+    with open(os.path.join(deviceDir, 'vendor'), 'w') as f:
+        f.write(vendor.ljust(8) + '\n')
+    with open(os.path.join(deviceDir, 'model'), 'w') as f:
+        f.write(model.ljust(16) + '\n')
+    if serial is None:
+        serial = 'K' + name.upper() + '0001'
+    # Unit serial number VPD page, as the kernel exposes it for SCSI devices
+    with open(os.path.join(deviceDir, 'vpd_pg80'), 'wb') as f:
+        f.write(bytes([5, 0x80]) + struct.pack('>H', len(serial)) + serial.encode('ascii'))
+    os.makedirs(os.path.join(sysRoot, 'block'), exist_ok=True)
+    os.rename(blockDir, os.path.join(sysRoot, 'block', name))
+    return devicePath
+
+
+def setFakeDiscSize(sysRoot, name, size):
+    """Set size of the disc in a fake drive, as a disc change does in sysfs
+    (replaces the size file, so it is never seen empty)"""
+    sizeFile = os.path.join(sysRoot, 'block', name, 'size')
+    with open(sizeFile + '.new', 'w') as f:
+        f.write(str(size // 512) + '\n')
+    os.replace(sizeFile + '.new', sizeFile)
+
+
+def removeFakeDrive(sysRoot, devRoot, name):
+    """Remove optical drive from fake sysfs tree; it disappears at once"""
+    oldDir = os.path.join(sysRoot, '.old-' + name)
+    os.rename(os.path.join(sysRoot, 'block', name), oldDir)
+    os.remove(os.path.join(devRoot, name))
+    shutil.rmtree(oldDir)
+
+
+class FaultyReader(SectorReader):
+    """SectorReader that fails on the byte ranges in <device>.bad (the same
+    file the ddrescue stand-in uses)"""
+
+    def __init__(self, *args, **kwargs):
+        """initialise FaultyReader instance"""
+        super().__init__(*args, **kwargs)
+        self.badRanges = []
+        with open(self.device + '.bad', 'r') as f:
+            for line in f:
+                start, size = line.split()
+                self.badRanges.append((int(start, 0), int(start, 0) + int(size, 0)))
+
+    def readInto(self, fd, view, offset):
+        """Fail (like an EIO) if the read overlaps a bad range"""
+        end = offset + len(view)
+        for badStart, badEnd in self.badRanges:
+            if offset < badEnd and badStart < end:
+                return -1
+        return super().readInto(fd, view, offset)
+
+
+class FakeTrays:
+    """Tray status of file-backed fake drives, and an operator who loads a
+    new disc as soon as the tray of a drive opens at the end of its job.
+    Pass trayStatus, onStart and onFinish to the autoloader. brokenDrive
+    is a drive whose tray status cannot be read"""
+
+    def __init__(self, drives, scheduler, brokenDrive=None):
+        """initialise FakeTrays instance"""
+        self.status = {drive: devices.CDS_TRAY_OPEN for drive in drives}
+        self.brokenDrive = brokenDrive
+        self.scheduler = scheduler
+        self.lock = threading.Lock()
+        self.polls = 0
+        self.busyPolls = 0
+        self.brokenPolls = []
+        self.loadTimes = {}
+        # Digest of the disc in each drive, and of the disc of each job
+        self.digests = {}
+        self.jobDigests = {}
+        self.startDelays = []
+        # Drives with an open tray, in the order they opened
+        self.emptyDrives = list(drives)
+
+    def trayStatus(self, drive):
+        """Tray status function for the autoloader"""
+        if drive == self.brokenDrive:
+            self.brokenPolls.append(time.monotonic())
+            raise OSError(5, 'Input/output error')
+        with self.lock:
+            self.polls += 1
+            if self.scheduler.queueLength(drive) > 0:
+                self.busyPolls += 1
+            return self.status[drive]
+
+    def onStart(self, drive, job):
+        """Autoloader startCallback: record delay since loading, and the disc"""
+        with self.lock:
+            self.startDelays.append(time.monotonic() - self.loadTimes[drive])
+            self.jobDigests[job['identifier']] = self.digests[drive]
+
+    def onFinish(self, result):
+        """Autoloader finishCallback: open the tray"""
+        with self.lock:
+            self.status[result['omDevice']] = devices.CDS_TRAY_OPEN
+            self.emptyDrives.append(result['omDevice'])
+
+    def load(self, drive, size):
+        """Write a new fake disc to drive and close the tray"""
+        makeFakeImage(drive, size)
+        with self.lock:
+            self.digests[drive] = shared.generate_file_sha512(drive)
+            self.status[drive] = devices.CDS_DRIVE_NOT_READY
+        time.sleep(0.05)
+        with self.lock:
+            self.loadTimes[drive] = time.monotonic()
+            self.status[drive] = devices.CDS_DISC_OK
+
+    def loadDiscs(self, noDiscs, size, delay):
+        """Load noDiscs discs of size bytes, each delay seconds after a tray
+        opened"""
+        loaded = 0
+        while loaded < noDiscs:
+            with self.lock:
+                drive = self.emptyDrives.pop(0) if self.emptyDrives else None
+            if drive is None:
+                time.sleep(0.01)
+                continue
+            time.sleep(delay)
+            self.load(drive, size)
+            loaded += 1
+
+
+def syntheticMetadata(rng, number, now, drives=('/dev/sr0', '/dev/sr1', '/dev/sr2', '/dev/sr3')):
+    """Return metadata dictionary of synthetic job number (as written by
+    processDisc), started in the 30 days before now"""
+    start = now - rng.uniform(0, 30 * 86400)
+    readSeconds = rng.uniform(200, 900)
+    size = rng.randrange(100, 700) * 2**20
+    success = rng.random() > 0.1
+    digests = {}
+    for algorithm, label in [('sha512', 'SHA-512'), ('md5', 'MD5')]:
+        digests[label] = {
+            name: hashlib.new(algorithm, (str(number) + name).encode()).hexdigest()
+            for name in ['disc.iso', 'omimgr.log', 'metadata.json']}
+    tz = datetime.timezone(datetime.timedelta(hours=2))
+    return {'identifier': 'disc%06d' % number,
+            'description': 'synthetic job ' + str(number),
+            'notes': '',
+            'omDevice': rng.choice(drives),
+            'readMethod': rng.choice(['readom', 'ddrescue', 'native']),
+            'prefix': 'disc',
+            'extension': 'iso',
+            'acquisitionStart': datetime.datetime.fromtimestamp(start, tz).isoformat(),
+            'acquisitionEnd': datetime.datetime.fromtimestamp(start + readSeconds + 20,
+                                                              tz).isoformat(),
+            'successFlag': success,
+            'interruptedFlag': False,
+            'imageTruncated': not success,
+            'omimgrVersion': '0.3.0',
+            'checksums': digests['SHA-512'],
+            'checksumType': 'SHA-512',
+            'digests': digests,
+            'timing': {'phases': {'read': {'seconds': round(readSeconds, 3), 'bytes': size,
+                                           'MBPerSecond': round(size / readSeconds / 1e6, 3)}},
+                       'totalSeconds': round(readSeconds + 20, 3)}}
+
+
+def writeMetadataTree(rootDir, noJobs, seed=1):
+    """Write noJobs job directories with a synthetic metadata file under
+    rootDir (500 per batch directory); returns list of (dirOut, metadata)"""
+    rng = random.Random(seed)
+    now = time.time()
+    jobs = []
+    for number in range(noJobs):
+        dirOut = os.path.join(rootDir, 'batch%03d' % (number // 500), 'disc%06d' % number)
+        os.makedirs(dirOut)
+        metadata = syntheticMetadata(rng, number, now)
+        with io.open(os.path.join(dirOut, 'metadata.json'), 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, indent=4, sort_keys=True)
+        jobs.append((dirOut, metadata))
+    return jobs
@@ -0,0 +1,197 @@
+#! /usr/bin/env python3
+"""Autoloader mode: watches the trays of all drives of a scheduler, and
+starts a job as soon as a disc is loaded into an idle drive"""
+
+import os
+import time
+import uuid
+import queue
+import threading
+from . import devices
+from . import shared
+
+
+class Autoloader:
+    """Polls the tray status of the drives of scheduler (a scheduler.Scheduler
+    that is already started), and submits a job for every disc that is
+    loaded. Each job gets the next identifier from the identifier queue, and
+    output directory baseDir/identifier; other job items come from jobTemplate.
+    Without identifiers, a UUID is generated for each disc.
+
+    Polling is cheap (a non-blocking open and one ioctl per drive), and
+    skips drives that have a queued or running job. A drive must report a
+    disc after having reported no disc (or an unknown status) before it gets
+    a job, so a disc that stays in the tray after its job (e.g. because it
+    could not be ejected) is not imaged twice. A disc that is already loaded
+    when the autoloader starts does get a job. Drives that cannot be polled
+    are retried with exponential back-off, up to maxInterval seconds.
+
+    With an inventory (devices.DeviceInventory), a drive is polled right
+    away when the inventory sees that the disc in it changed.
+    """
+
+    def __init__(self, scheduler, baseDir, identifiers=None, jobTemplate=None,
+                 pollInterval=1.0, maxInterval=16.0, trayStatus=None, inventory=None,
+                 startCallback=None, finishCallback=None, logger=None):
+        """initialise Autoloader instance"""
+        self.scheduler = scheduler
+        self.baseDir = os.path.abspath(baseDir)
+        self.jobTemplate = dict(jobTemplate or {})
+        self.pollInterval = pollInterval
+        self.maxInterval = maxInterval
+        # Function that returns the tray status (devices.CDS_ value) of a drive
+        if trayStatus is None:
+            trayStatus = devices.getTrayStatus
+        self.trayStatus = trayStatus
+        # Called as startCallback(device, job) and finishCallback(result)
+        self.startCallback = startCallback
+        self.finishCallback = finishCallback
+        self.logger = shared.getLogger(logger)
+        self.generateIdentifiers = identifiers is None
+        self.identifiers = queue.Queue()
+        for identifier in identifiers or []:
+            self.identifiers.put(identifier)
+        # Last tray status, poll interval and time of next poll of each drive
+        self.lastStatus = {}
+        self.intervals = {}
+        self.nextPoll = {}
+        self.reported = 0
+        self.jobsStarted = 0
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.inventory = inventory
+        if inventory is not None:
+            inventory.subscribe(self.onDeviceEvent)
+
+    def addIdentifier(self, identifier):
+        """Add identifier to the queue"""
+        self.identifiers.put(identifier)
+        self.wakeup.set()
+
+    def nextJob(self):
+        """Return job for the next identifier, or None if the queue is empty"""
+        if self.generateIdentifiers:
+            identifier = str(uuid.uuid1())
+        else:
+            try:
+                identifier = self.identifiers.get_nowait()
+            except queue.Empty:
+                return None
+        job = dict(self.jobTemplate)
+        job['identifier'] = identifier
+        job['dirOut'] = os.path.join(self.baseDir, identifier)
+        return job
+
+    def onDeviceEvent(self, eventType, device):
+        """Called by the inventory; poll a drive with another disc right away"""
+        if eventType == 'change':
+            self.nextPoll[device.path] = 0
+            self.wakeup.set()
+
+    def isIdle(self):
+        """Returns True if no drive has a queued or running job"""
+        with self.scheduler.lock:
+            drives = list(self.scheduler.queues)
+        return all(self.scheduler.queueLength(device) == 0 for device in drives)
+
+    def isExhausted(self):
+        """Returns True if there are no identifiers left for new discs"""
+        return not self.generateIdentifiers and self.identifiers.empty()
+
+    def pollDrive(self, device, now):
+        """Poll tray of device, and submit a job if a disc was loaded.
+        Returns True if a job was submitted"""
+        try:
+            status = self.trayStatus(device)
+        except OSError as e:
+            interval = min(2 * self.intervals.get(device, self.pollInterval), self.maxInterval)
+            if interval != self.intervals.get(device):
+                self.logger.warning('cannot read tray status of ' + device + ': ' + str(e))
+            self.intervals[device] = interval
+            self.nextPoll[device] = now + interval
+            self.lastStatus[device] = devices.CDS_NO_INFO
+            return False
+        self.intervals[device] = self.pollInterval
+        self.nextPoll[device] = now + self.pollInterval
+
+        # Drive that is spinning up keeps its last status until it is ready
+        if status == devices.CDS_DRIVE_NOT_READY:
+            return False
+        lastStatus = self.lastStatus.get(device)
+        self.lastStatus[device] = status
+        if status != devices.CDS_DISC_OK or lastStatus == devices.CDS_DISC_OK:
+            return False
+
+        job = self.nextJob()
+        if job is None:
+            self.logger.warning('disc loaded in ' + device + ', but there are no identifiers left')
+            return False
+        try:
+            os.makedirs(job['dirOut'], exist_ok=True)
+            job['omDevice'] = device
+            self.scheduler.submit(job)
+        except (OSError, ValueError) as e:
+            self.logger.error('cannot start job ' + job['identifier'] + ' in ' + device +
+                              ': ' + str(e))
+            return False
+        self.jobsStarted += 1
+        self.logger.info('disc loaded in ' + device + ', started job ' + job['identifier'])
+        if self.startCallback is not None:
+            self.startCallback(device, job)
+        return True
+
+    def poll(self, now=None):
+        """Poll all idle drives that are due; returns number of jobs submitted"""
+        if now is None:
+            now = time.monotonic()
+        with self.scheduler.lock:
+            drives = list(self.scheduler.devices)
+        started = 0
+        for device in drives:
+            # Back off while the drive is busy
+            if self.scheduler.queueLength(device) > 0 or self.nextPoll.get(device, 0) > now:
+                continue
+            if self.pollDrive(device, now):
+                started += 1
+        return started
+
+    def reportResults(self):
+        """Pass results of jobs that finished since the last call to finishCallback"""
+        results = self.scheduler.results[self.reported:]
+        self.reported += len(results)
+        if self.finishCallback is not None:
+            for result in results:
+                self.finishCallback(result)
+
+    def run(self, stopWhenExhausted=True):
+        """Poll until stop is called, or (if stopWhenExhausted is True) until
+        the identifiers have run out and all jobs are finished"""
+        while not self.stopped.is_set():
+            self.poll()
+            self.reportResults()
+            if stopWhenExhausted and self.isExhausted() and self.isIdle():
+                break
+            # Sleep until the first drive is due, or until woken up
+            now = time.monotonic()
+            due = [t for device, t in self.nextPoll.items() if device in self.scheduler.devices]
+            timeout = max(0, min(due, default=now + self.pollInterval) - now)
+            self.wakeup.wait(min(timeout, self.pollInterval))
+            self.wakeup.clear()
+        self.reportResults()
+
+    def start(self, stopWhenExhausted=False):
+        """Run in a background thread"""
+        self.thread = threading.Thread(target=self.run, args=(stopWhenExhausted,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop polling (running jobs are not affected)"""
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.inventory is not None:
+            self.inventory.unsubscribe(self.onDeviceEvent)
+            self.inventory = None
@@ -0,0 +1,444 @@
+#! /usr/bin/env python3
+"""
+Catalogue of imaging jobs: an SQLite database with one record per
+processDisc run, indexed on identifier, checksum, device and date. Jobs are
+added by processDisc, or imported from existing metadata files.
+
+Command line tool for importing metadata files and querying the catalogue.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import datetime
+from . import shared
+
+SCHEMA_VERSION = 1
+
+schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    identifier TEXT,
+    dirOut TEXT NOT NULL,
+    omDevice TEXT,
+    readMethod TEXT,
+    acquisitionStart TEXT,
+    acquisitionEnd TEXT,
+    startTime REAL,
+    successFlag INTEGER,
+    interruptedFlag INTEGER,
+    imageTruncated INTEGER,
+    imageFile TEXT,
+    imageSize INTEGER,
+    readSeconds REAL,
+    MBPerSecond REAL,
+    badSectorCount INTEGER,
+    omimgrVersion TEXT,
+    description TEXT,
+    notes TEXT,
+    metadata TEXT NOT NULL,
+    UNIQUE (dirOut, acquisitionStart)
+);
+CREATE TABLE IF NOT EXISTS checksums (
+    jobId INTEGER NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+    fileName TEXT NOT NULL,
+    algorithm TEXT NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobsIdentifier ON jobs (identifier);
+CREATE INDEX IF NOT EXISTS jobsDevice ON jobs (omDevice);
+CREATE INDEX IF NOT EXISTS jobsStartTime ON jobs (startTime);
+CREATE INDEX IF NOT EXISTS checksumsDigest ON checksums (digest);
+CREATE INDEX IF NOT EXISTS checksumsJob ON checksums (jobId);
+"""
+
+# Columns of jobs that are returned by queries (all but the metadata)
+jobColumns = ['id', 'identifier', 'dirOut', 'omDevice', 'readMethod', 'acquisitionStart',
+              'acquisitionEnd', 'startTime', 'successFlag', 'interruptedFlag',
+              'imageTruncated', 'imageFile', 'imageSize', 'readSeconds', 'MBPerSecond',
+              'badSectorCount', 'omimgrVersion', 'description', 'notes']
+
+
+def parseTimestamp(dateTime):
+    """Return seconds since the epoch for an ISO 8601 date / time string (as
+    in the metadata file), or None if it cannot be parsed. Date / time
+    strings without a time zone are taken to be local time"""
+    try:
+        return datetime.datetime.fromisoformat(dateTime).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def parseSince(value, now=None):
+    """Return seconds since the epoch for a --since / --until value: a
+    number of days or hours ago (e.g. 7d, 12h), or an ISO 8601 date or date /
+    time"""
+    if now is None:
+        now = time.time()
+    units = {'d': 86400, 'h': 3600}
+    if value[-1:] in units:
+        try:
+            return now - float(value[:-1]) * units[value[-1]]
+        except ValueError:
+            pass
+    timestamp = parseTimestamp(value)
+    if timestamp is None:
+        raise ValueError('cannot parse date ' + value + ' (use e.g. 7d, 12h or 2026-10-01)')
+    return timestamp
+
+
+def jobRecord(metadata, dirOut):
+    """Return dictionary with the columns of the jobs table for metadata (a
+    dictionary read from a metadata file) of a job in dirOut"""
+    imageFile = ''
+    if metadata.get('prefix') and metadata.get('extension'):
+        imageFile = os.path.join(dirOut, metadata['prefix'] + '.' + metadata['extension'])
+    # Timing and rescueMap are missing in metadata of older omimgr versions
+    readPhase = metadata.get('timing', {}).get('phases', {}).get('read', {})
+    imageSize = readPhase.get('bytes')
+    if imageSize is None and imageFile and os.path.isfile(imageFile):
+        imageSize = os.path.getsize(imageFile)
+    return {'identifier': metadata.get('identifier'),
+            'dirOut': dirOut,
+            'omDevice': metadata.get('omDevice'),
+            'readMethod': metadata.get('readMethod'),
+            'acquisitionStart': metadata.get('acquisitionStart'),
+            'acquisitionEnd': metadata.get('acquisitionEnd'),
+            'startTime': parseTimestamp(metadata.get('acquisitionStart')),
+            'successFlag': metadata.get('successFlag'),
+            'interruptedFlag': metadata.get('interruptedFlag'),
+            'imageTruncated': metadata.get('imageTruncated'),
+            'imageFile': imageFile,
+            'imageSize': imageSize,
+            'readSeconds': readPhase.get('seconds'),
+            'MBPerSecond': readPhase.get('MBPerSecond'),
+            'badSectorCount': metadata.get('rescueMap', {}).get('badSectorCount'),
+            'omimgrVersion': metadata.get('omimgrVersion'),
+            'description': metadata.get('description'),
+            'notes': metadata.get('notes'),
+            'metadata': json.dumps(metadata, sort_keys=True)}
+
+
+def jobChecksums(metadata):
+    """Return list of (fileName, algorithm, digest) tuples from metadata, with
+    the digests in lower case (as findJobs looks them up)"""
+    checksums = []
+    digests = metadata.get('digests')
+    if not digests:
+        # Metadata of older omimgr versions only have SHA-512 checksums
+        digests = {'SHA-512': metadata.get('checksums', {})}
+    for algorithm, fileDigests in sorted(digests.items()):
+        for fileName, digest in sorted(fileDigests.items()):
+            checksums.append((fileName, algorithm, digest.lower()))
+    return checksums
+
+
+class Catalogue:
+    """Job catalogue in SQLite database dbFile (created if it doesn't exist).
+    Every method opens its own connection, so an instance can be shared by
+    the jobs of several drives; concurrent writers wait for each other"""
+
+    def __init__(self, dbFile, logger=None, timeout=30.0):
+        """initialise Catalogue instance, and create the tables if needed"""
+        self.dbFile = os.path.abspath(dbFile)
+        self.logger = shared.getLogger(logger)
+        self.timeout = timeout
+        conn = self.connect()
+        try:
+            if conn.execute('PRAGMA user_version').fetchone()[0] == 0:
+                # Write-ahead log: readers don't block the writer and vice versa
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.executescript(schema)
+                conn.execute('PRAGMA user_version=' + str(SCHEMA_VERSION))
+                conn.commit()
+        finally:
+            conn.close()
+
+    def connect(self):
+        """Return new connection; used as context manager it commits (or
+        rolls back) a transaction, but doesn't close the connection"""
+        conn = sqlite3.connect(self.dbFile, timeout=self.timeout)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    def insertJob(self, conn, metadata, dirOut):
+        """Insert job in transaction of conn, replacing any record of the same
+        run (same output directory and start time); returns id of the record"""
+        record = jobRecord(metadata, os.path.abspath(dirOut))
+        conn.execute('DELETE FROM jobs WHERE dirOut = ? AND acquisitionStart IS ?',
+                     (record['dirOut'], record['acquisitionStart']))
+        columns = sorted(record)
+        cursor = conn.execute('INSERT INTO jobs (' + ', '.join(columns) + ') VALUES (' +
+                              ', '.join('?' * len(columns)) + ')',
+                              [record[column] for column in columns])
+        jobId = cursor.lastrowid
+        conn.executemany('INSERT INTO checksums (jobId, fileName, algorithm, digest) '
+                         'VALUES (?, ?, ?, ?)',
+                         [(jobId,) + checksum for checksum in jobChecksums(metadata)])
+        return jobId
+
+    def addJob(self, metadata, dirOut):
+        """Add job with metadata (dictionary) in output directory dirOut, in
+        one transaction; returns id of the record"""
+        conn = self.connect()
+        try:
+            with conn:
+                return self.insertJob(conn, metadata, dirOut)
+        finally:
+            conn.close()
+
+    def importTree(self, rootDir, metadataFileName='metadata.json', batchSize=500):
+        """Import every metadata file called metadataFileName under rootDir,
+        batchSize files per transaction. Files that were imported before are
+        replaced. Returns number of imported files, and list of files that
+        could not be read"""
+        noImported = 0
+        failed = []
+        batch = []
+
+        def commit():
+            conn = self.connect()
+            try:
+                with conn:
+                    for metadata, dirOut in batch:
+                        self.insertJob(conn, metadata, dirOut)
+            finally:
+                conn.close()
+            del batch[:]
+
+        for dirPath, dirNames, fileNames in os.walk(rootDir):
+            dirNames.sort()
+            if metadataFileName not in fileNames:
+                continue
+            metadataFile = os.path.join(dirPath, metadataFileName)
+            try:
+                with io.open(metadataFile, 'r', encoding='utf-8') as f:
+                    metadata = json.load(f)
+                if not isinstance(metadata, dict):
+                    raise ValueError('not a JSON object')
+            except (OSError, ValueError) as e:
+                self.logger.warning('cannot import ' + metadataFile + ': ' + str(e))
+                failed.append(metadataFile)
+                continue
+            batch.append((metadata, dirPath))
+            noImported += 1
+            if len(batch) >= batchSize:
+                commit()
+        if batch:
+            commit()
+        return noImported, failed
+
+    def findJobs(self, identifier=None, omDevice=None, digest=None, since=None, until=None,
+                 failed=None, limit=None):
+        """Return list of jobs (dictionaries, newest first) that match all
+        given criteria: identifier, device, checksum of any of the files,
+        start time (seconds since the epoch) from since and before until,
+        and (if failed is True or False) whether the job failed"""
+        conditions = []
+        values = []
+        if identifier is not None:
+            conditions.append('identifier = ?')
+            values.append(identifier)
+        if omDevice is not None:
+            conditions.append('omDevice = ?')
+            values.append(omDevice)
+        if digest is not None:
+            conditions.append('id IN (SELECT jobId FROM checksums WHERE digest = ?)')
+            values.append(digest.lower())
+        if since is not None:
+            conditions.append('startTime >= ?')
+            values.append(since)
+        if until is not None:
+            conditions.append('startTime < ?')
+            values.append(until)
+        if failed is not None:
+            conditions.append('successFlag = ?')
+            values.append(0 if failed else 1)
+        query = 'SELECT ' + ', '.join(jobColumns) + ' FROM jobs'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY startTime DESC, id DESC'
+        if limit is not None:
+            query += ' LIMIT ' + str(int(limit))
+        conn = self.connect()
+        try:
+            return [dict(row) for row in conn.execute(query, values)]
+        finally:
+            conn.close()
+
+    def latestMetadata(self, identifier):
+        """Return metadata (dictionary) and output directory of the most
+        recent job for identifier, or (None, None) if there is none"""
+        conn = self.connect()
+        try:
+            row = conn.execute('SELECT metadata, dirOut FROM jobs WHERE identifier = ? '
+                               'ORDER BY startTime DESC, id DESC LIMIT 1',
+                               (identifier,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None, None
+        return json.loads(row['metadata']), row['dirOut']
+
+    def checksums(self, jobId):
+        """Return list of (fileName, algorithm, digest) tuples of job jobId"""
+        conn = self.connect()
+        try:
+            return [tuple(row) for row in conn.execute(
+                'SELECT fileName, algorithm, digest FROM checksums WHERE jobId = ? '
+                'ORDER BY fileName, algorithm', (jobId,))]
+        finally:
+            conn.close()
+
+    def driveStatistics(self, since=None, until=None):
+        """Return list of dictionaries with the number of jobs, failed jobs,
+        bytes imaged and the average throughput (MB/s, of jobs that have it)
+        of each device"""
+        query = ('SELECT omDevice, COUNT(*) AS jobs, '
+                 'SUM(CASE WHEN successFlag THEN 0 ELSE 1 END) AS failedJobs, '
+                 'SUM(imageSize) AS bytesImaged, '
+                 'ROUND(AVG(MBPerSecond), 3) AS averageMBPerSecond FROM jobs')
+        conditions = []
+        values = []
+        if since is not None:
+            conditions.append('startTime >= ?')
+            values.append(since)
+        if until is not None:
+            conditions.append('startTime < ?')
+            values.append(until)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' GROUP BY omDevice ORDER BY omDevice'
+        conn = self.connect()
+        try:
+            return [dict(row) for row in conn.execute(query, values)]
+        finally:
+            conn.close()
+
+
+def parseCommandLine(parser):
+    """Parse command line"""
+    parser.add_argument('--db',
+                        action='store',
+                        dest='dbFile',
+                        help='catalogue file (default: catalogueFile from the configuration file)')
+    subparsers = parser.add_subparsers(dest='command')
+
+    parserImport = subparsers.add_parser('import',
+                                         help='import the metadata files in one or more '
+                                         'directory trees')
+    parserImport.add_argument('dirs', nargs='+', help='root directory')
+
+    parserFind = subparsers.add_parser('find', help='list jobs that match all criteria')
+    parserFind.add_argument('--identifier', '-i', dest='identifier', help='identifier')
+    parserFind.add_argument('--device', '-d', dest='omDevice', help='optical device')
+    parserFind.add_argument('--checksum', '-c', dest='digest',
+                            help='checksum of any file of the job (any algorithm)')
+    parserFind.add_argument('--since', dest='since',
+                            help='jobs started since, e.g. 7d, 12h, 2026-10-01')
+    parserFind.add_argument('--until', dest='until', help='jobs started before')
+    parserFind.add_argument('--failed', action='store_const', const=True, dest='failed',
+                            help='failed jobs only')
+    parserFind.add_argument('--succeeded', action='store_const', const=False, dest='failed',
+                            help='successful jobs only')
+    parserFind.add_argument('--limit', type=int, dest='limit', help='maximum number of jobs')
+    parserFind.add_argument('--checksums', action='store_true', dest='checksumsFlag',
+                            default=False, help='include checksums of each job')
+    parserFind.add_argument('--json', action='store_true', dest='jsonFlag', default=False,
+                            help='one JSON object per job')
+
+    parserDrives = subparsers.add_parser('drives',
+                                         help='number of jobs, failures and average MB/s '
+                                         'of each device')
+    parserDrives.add_argument('--since', dest='since', help='jobs started since')
+    parserDrives.add_argument('--until', dest='until', help='jobs started before')
+    parserDrives.add_argument('--json', action='store_true', dest='jsonFlag', default=False,
+                              help='one JSON object per device')
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.error('no command given')
+    return args
+
+
+def printRows(rows, columns, jsonFlag):
+    """Print rows (dictionaries) as JSON lines, or as tab-separated columns"""
+    if jsonFlag:
+        for row in rows:
+            sys.stdout.write(json.dumps(row) + '\n')
+        return
+    sys.stdout.write('\t'.join(columns) + '\n')
+    for row in rows:
+        sys.stdout.write('\t'.join('' if row.get(column) is None else str(row[column])
+                                   for column in columns) + '\n')
+
+
+def main():
+    """Import metadata files into, or query, the job catalogue"""
+    # Imported here, to keep imports of the catalogue by processDisc light
+    from .om import Disc
+    from .omimgr import __version__
+    from . import config
+
+    config.version = __version__
+    parser = argparse.ArgumentParser(description='omimgr job catalogue')
+    args = parseCommandLine(parser)
+
+    disc = Disc()
+    disc.getConfiguration()
+    dbFile = args.dbFile
+    if dbFile is None:
+        dbFile = disc.catalogueFile if disc.configSuccess else ''
+    if not dbFile:
+        sys.stderr.write('ERROR: no catalogue file (set catalogueFile in the configuration '
+                         'file, or use --db)\n')
+        sys.exit(2)
+    metadataFileName = disc.metadataFileName or 'metadata.json'
+
+    try:
+        catalogue = Catalogue(dbFile)
+        if args.command == 'import':
+            exitStatus = 0
+            for rootDir in args.dirs:
+                noImported, failed = catalogue.importTree(rootDir, metadataFileName)
+                sys.stdout.write(json.dumps({'dir': os.path.abspath(rootDir),
+                                             'imported': noImported,
+                                             'failed': failed}) + '\n')
+                if failed:
+                    exitStatus = 1
+            sys.exit(exitStatus)
+
+        since = parseSince(args.since) if args.since else None
+        until = parseSince(args.until) if args.until else None
+        if args.command == 'find':
+            jobs = catalogue.findJobs(args.identifier, args.omDevice, args.digest, since, until,
+                                      args.failed, args.limit)
+            columns = ['identifier', 'acquisitionStart', 'omDevice', 'readMethod',
+                       'successFlag', 'imageSize', 'MBPerSecond', 'dirOut']
+            if args.checksumsFlag:
+                for job in jobs:
+                    job['checksums'] = [{'fileName': fileName, 'algorithm': algorithm,
+                                         'digest': digest}
+                                        for fileName, algorithm, digest
+                                        in catalogue.checksums(job['id'])]
+                columns.append('checksums')
+            printRows(jobs, columns, args.jsonFlag)
+        elif args.command == 'drives':
+            printRows(catalogue.driveStatistics(since, until),
+                      ['omDevice', 'jobs', 'failedJobs', 'bytesImaged', 'averageMBPerSecond'],
+                      args.jsonFlag)
+    except ValueError as e:
+        sys.stderr.write('ERROR: ' + str(e) + '\n')
+        sys.exit(2)
+    except sqlite3.Error as e:
+        sys.stderr.write('ERROR: cannot use catalogue ' + dbFile + ': ' + str(e) + '\n')
+        sys.exit(3)
+
+
+if __name__ == "__main__":
+    main()
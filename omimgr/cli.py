@@ -0,0 +1,453 @@
+#! /usr/bin/env python3
+"""
+omimgr, automated reading of optical media
+Command line interface for headless and batch use
+
+Author: Johan van der Knijff
+Research department,  KB / National Library of the Netherlands
+"""
+
+import os
+import io
+import sys
+import json
+import signal
+import logging
+import argparse
+from .om import Disc, jobItems
+from .omimgr import __version__
+from .wrappers import CancelToken
+from .rescue import PassPolicy
+from . import config
+from . import shared
+
+# Exit status codes
+EXIT_SUCCESS = 0
+EXIT_ERRORS = 1
+EXIT_INVALID_INPUT = 2
+EXIT_CONFIG = 3
+EXIT_INTERRUPTED = 130
+
+def parseCommandLine(parser):
+    """Parse command line"""
+
+    parser.add_argument('--job', '-j',
+                        action='store',
+                        dest='jobFile',
+                        help='JSON job file with any of the items ' + ', '.join(jobItems) +
+                        '; values given on the command line take precedence')
+    parser.add_argument('--device', '-d',
+                        action='store',
+                        dest='omDevice',
+                        help='optical device (e.g. /dev/sr0)')
+    parser.add_argument('--dir', '-o',
+                        action='store',
+                        dest='dirOut',
+                        help='output directory')
+    parser.add_argument('--method', '-m',
+                        action='store',
+                        dest='readMethod',
+                        choices=['readom', 'ddrescue', 'native'],
+                        help='read method; native is the built-in sector reader (default: readom)')
+    parser.add_argument('--retries', '-r',
+                        action='store',
+                        type=int,
+                        dest='retries',
+                        help='maximum number of retries (default: value from configuration file)')
+    parser.add_argument('--prefix', '-p',
+                        action='store',
+                        dest='prefix',
+                        help='output prefix (default: value from configuration file)')
+    parser.add_argument('--extension', '-e',
+                        action='store',
+                        dest='extension',
+                        help='output file extension (default: value from configuration file)')
+    parser.add_argument('--identifier', '-i',
+                        action='store',
+                        dest='identifier',
+                        help='unique identifier')
+    parser.add_argument('--description',
+                        action='store',
+                        dest='description',
+                        help='description of the disc')
+    parser.add_argument('--notes',
+                        action='store',
+                        dest='notes',
+                        help='additional notes')
+    parser.add_argument('--direct',
+                        action='store_const',
+                        const=True,
+                        dest='rescueDirectDiscMode',
+                        help='use direct disc mode (ddrescue and native only; the native '
+                        'reader then uses O_DIRECT)')
+    parser.add_argument('--auto-retry',
+                        action='store_const',
+                        const=True,
+                        dest='autoRetry',
+                        help='automatically retry with ddrescue on readom failure')
+    parser.add_argument('--rescue-drives',
+                        action='store',
+                        dest='rescueDrives',
+                        help='comma-separated list of additional drives for ddrescue passes; '
+                        'the disc is moved from drive to drive until the rescued fraction '
+                        'stops improving')
+    parser.add_argument('--max-passes',
+                        action='store',
+                        type=int,
+                        dest='maxPasses',
+                        help='maximum number of ddrescue passes with --rescue-drives')
+    parser.add_argument('--image-checksum',
+                        action='store_true',
+                        dest='forceImageChecksum',
+                        default=False,
+                        help='compute full image checksums even if the image has read errors '
+                        '(only has effect if chunkManifest is enabled in the configuration file)')
+    parser.add_argument('--autoload',
+                        action='store_true',
+                        dest='autoloadFlag',
+                        default=False,
+                        help='autoloader mode: image every disc that is loaded into one of '
+                        'the drives (all drives, or a comma-separated list given with '
+                        '--device), each into a subdirectory of --dir named after its identifier')
+    parser.add_argument('--identifiers',
+                        action='store',
+                        dest='identifiersFile',
+                        help='text file with one identifier per line, used in order by '
+                        '--autoload; without it, a UUID is generated for each disc and '
+                        'omimgr-cli runs until interrupted')
+    parser.add_argument('--profile',
+                        action='store',
+                        dest='profileDir',
+                        help='profile the job with cProfile and tracemalloc, and write the '
+                        'profile to this directory')
+    parser.add_argument('--overwrite',
+                        action='store_true',
+                        dest='overwriteFlag',
+                        default=False,
+                        help='overwrite existing image file when using readom')
+    parser.add_argument('--quiet', '-q',
+                        action='store_true',
+                        dest='quietFlag',
+                        default=False,
+                        help="don't write log messages to stderr")
+    parser.add_argument('--version', '-v',
+                        action='version',
+                        version=__version__)
+
+    # Parse arguments
+    args = parser.parse_args()
+    return args
+
+
+def errorExit(msg, exitStatus):
+    """Print error to stderr and exit"""
+    msgString = ('ERROR: ' + msg + '\n')
+    sys.stderr.write(msgString)
+    sys.exit(exitStatus)
+
+
+def emitEvent(eventType, **items):
+    """Write event as one line of JSON to stdout"""
+    event = {'event': eventType}
+    event.update(items)
+    sys.stdout.write(json.dumps(event) + '\n')
+    sys.stdout.flush()
+
+
+def setSignalHandlers(handler):
+    """Set handler for SIGINT and SIGTERM (or, if handler is a dictionary
+    as returned by this function, the handler of each signal); returns
+    dictionary with the previous handlers"""
+    previousHandlers = {}
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signalHandler = handler[signum] if isinstance(handler, dict) else handler
+        previousHandlers[signum] = signal.signal(signum, signalHandler)
+    return previousHandlers
+
+
+def convertJobItem(item, value):
+    """Return value of job file item as Disc expects it; raises ValueError
+    with a description of the expected type if the value has another type"""
+    if item in ['rescueDirectDiscMode', 'autoRetry']:
+        if not isinstance(value, bool):
+            raise ValueError('true or false')
+    elif item == 'retries':
+        # bool is a subclass of int
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError('an integer')
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError('an integer')
+    elif item == 'rescueDrives':
+        # List of drives, or a comma-separated string like --rescue-drives
+        if not isinstance(value, (list, str)) or \
+                (isinstance(value, list) and not all(isinstance(drive, str) for drive in value)):
+            raise ValueError('a list of drives')
+    elif not isinstance(value, str):
+        raise ValueError('a string')
+    return value
+
+
+def readJobFile(jobFile):
+    """Read job file and return dictionary with job items"""
+    try:
+        with io.open(jobFile, 'r', encoding='utf-8') as f:
+            jobDict = json.load(f)
+    except IOError:
+        errorExit('cannot read job file ' + jobFile, EXIT_INVALID_INPUT)
+    except ValueError:
+        errorExit('cannot decode JSON from job file ' + jobFile, EXIT_INVALID_INPUT)
+
+    if not isinstance(jobDict, dict):
+        errorExit('job file ' + jobFile + ' does not contain a JSON object', EXIT_INVALID_INPUT)
+
+    for item, value in jobDict.items():
+        if item not in jobItems:
+            errorExit('unknown item ' + item + ' in job file ' + jobFile, EXIT_INVALID_INPUT)
+        try:
+            jobDict[item] = convertJobItem(item, value)
+        except ValueError as e:
+            errorExit('item ' + item + ' in job file ' + jobFile + ' must be ' + str(e),
+                      EXIT_INVALID_INPUT)
+
+    return jobDict
+
+
+def setupLogger(logFile, quietFlag):
+    """Set up logger configuration"""
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    otherHandlers = []
+    if not quietFlag:
+        consoleHandler = logging.StreamHandler(sys.stderr)
+        consoleHandler.setFormatter(logging.Formatter('%(message)s'))
+        otherHandlers.append(consoleHandler)
+
+    # Log file and console are written by a separate thread, so that
+    # logging doesn't wait for (possibly slow) file I/O
+    logger.addHandler(shared.queuedFileHandler(
+        logFile, logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'),
+        otherHandlers))
+
+
+def onProgress(event):
+    """Write ddrescue progress event to stdout"""
+    emitEvent('progress', **event.asDict())
+
+
+def swapDisc(fromDrive, toDrive):
+    """Ask the operator to move the disc to the next drive; returns False if
+    the operator wants to stop"""
+    emitEvent('swap', fromDrive=fromDrive, toDrive=toDrive)
+    sys.stderr.write('Move the disc from ' + fromDrive + ' to ' + toDrive +
+                     ', then press Enter (or type q and Enter to stop): ')
+    sys.stderr.flush()
+    answer = sys.stdin.readline()
+    # End of input also means stop
+    return answer != '' and answer.strip().lower() != 'q'
+
+
+def runDisc(disc, cancelToken):
+    """Process disc and report result on stdout"""
+    emitEvent('started', omDevice=disc.omDevice, dirOut=disc.dirOut,
+              readMethod=disc.readMethod, imageFile=disc.imageFile)
+    disc.processDisc(cancelToken)
+    emitEvent('finished', readMethod=disc.readMethod, successFlag=disc.successFlag,
+              readErrorFlag=disc.readErrorFlag, interruptedFlag=disc.interruptedFlag,
+              isolyzerSuccess=disc.isolyzerSuccess, imageTruncated=disc.imageTruncated)
+
+
+def readIdentifiersFile(identifiersFile):
+    """Read identifiers file and return list of identifiers"""
+    try:
+        with io.open(identifiersFile, 'r', encoding='utf-8') as f:
+            identifiers = [line.strip() for line in f if line.strip()]
+    except IOError:
+        errorExit('cannot read identifiers file ' + identifiersFile, EXIT_INVALID_INPUT)
+    for identifier in identifiers:
+        if os.sep in identifier or identifier in ['.', '..']:
+            errorExit('identifier ' + identifier + ' cannot be used as a directory name',
+                      EXIT_INVALID_INPUT)
+    return identifiers
+
+
+def runAutoloader(args, jobDict):
+    """Image every disc that is loaded into a drive, until the identifiers run
+    out or omimgr-cli is interrupted. Each job has its own log file; jobs are
+    reported on stdout"""
+    from .autoloader import Autoloader
+    from .devices import DeviceInventory
+    from .scheduler import Scheduler
+
+    baseDir = os.path.abspath(jobDict.pop('dirOut', '') or '')
+    if not os.path.isdir(baseDir):
+        errorExit('output directory ' + baseDir + ' does not exist', EXIT_INVALID_INPUT)
+    identifiers = None
+    if args.identifiersFile is not None:
+        identifiers = readIdentifiersFile(args.identifiersFile)
+    for item in ['identifier', 'rescueDrives']:
+        if jobDict.pop(item, None):
+            errorExit(item + ' cannot be used with --autoload', EXIT_INVALID_INPUT)
+    if jobDict.get('readMethod', 'readom') not in ['readom', 'ddrescue', 'native']:
+        errorExit('unknown read method ' + str(jobDict['readMethod']), EXIT_INVALID_INPUT)
+    if 'retries' in jobDict:
+        try:
+            jobDict['retries'] = str(int(jobDict['retries']))
+        except ValueError:
+            errorExit('retries must be an integer', EXIT_INVALID_INPUT)
+
+    inventory = None
+    omDevice = jobDict.pop('omDevice', None)
+    if omDevice:
+        drives = [drive.strip() for drive in omDevice.split(',') if drive.strip()]
+    else:
+        inventory = DeviceInventory()
+        inventory.start()
+        drives = None
+
+    if not args.quietFlag:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    scheduler = Scheduler(drives, overwriteFlag=args.overwriteFlag, inventory=inventory)
+    scheduler.start()
+    autoloader = Autoloader(scheduler, baseDir, identifiers, jobDict, inventory=inventory,
+                            startCallback=lambda device, job: emitEvent(
+                                'loaded', omDevice=device, identifier=job['identifier'],
+                                dirOut=job['dirOut']),
+                            finishCallback=lambda result: emitEvent('jobFinished', **result))
+    emitEvent('autoloader', drives=list(scheduler.devices), baseDir=baseDir)
+
+    interrupted = []
+
+    def onSignal(signum, frame):
+        """Stop watching the trays and interrupt running jobs"""
+        interrupted.append(signum)
+        autoloader.stopped.set()
+        autoloader.wakeup.set()
+        scheduler.cancelAll()
+
+    previousHandlers = setSignalHandlers(onSignal)
+
+    autoloader.run(stopWhenExhausted=identifiers is not None)
+    results = scheduler.join()
+    setSignalHandlers(previousHandlers)
+    autoloader.reportResults()
+    autoloader.stop()
+    if inventory is not None:
+        inventory.close()
+
+    if interrupted:
+        exitStatus = EXIT_INTERRUPTED
+    elif all(result['status'] == 'success' for result in results):
+        exitStatus = EXIT_SUCCESS
+    else:
+        exitStatus = EXIT_ERRORS
+    logging.shutdown()
+    sys.exit(exitStatus)
+
+
+def main():
+    """Image one disc without GUI"""
+
+    config.version = __version__
+
+    # Parse command line
+    parser = argparse.ArgumentParser(description='omimgr command line interface')
+    args = parseCommandLine(parser)
+
+    # Read configuration file
+    disc = Disc()
+    disc.getConfiguration()
+    if not disc.configSuccess:
+        errorExit("error reading configuration file, run '(sudo) omimgr-config' to fix this",
+                  EXIT_CONFIG)
+    disc.startMetrics()
+
+    # Defaults from configuration file
+    disc.readMethod = 'readom'
+    disc.retries = disc.retriesDefault
+
+    # Job file, then command line arguments
+    jobDict = {}
+    if args.jobFile is not None:
+        jobDict = readJobFile(args.jobFile)
+    for item in jobItems:
+        if getattr(args, item) is not None:
+            jobDict[item] = getattr(args, item)
+    if isinstance(jobDict.get('rescueDrives'), str):
+        jobDict['rescueDrives'] = [drive.strip() for drive in jobDict['rescueDrives'].split(',')
+                                   if drive.strip()]
+    if args.autoloadFlag:
+        if not jobDict.get('dirOut'):
+            errorExit('no value for dirOut (use --dir or a job file)', EXIT_INVALID_INPUT)
+        runAutoloader(args, jobDict)
+    for item, value in jobDict.items():
+        setattr(disc, item, value)
+
+    for item in ['omDevice', 'dirOut']:
+        if not jobDict.get(item):
+            errorExit('no value for ' + item + ' (use --device / --dir or a job file)',
+                      EXIT_INVALID_INPUT)
+    if disc.readMethod not in ['readom', 'ddrescue', 'native']:
+        errorExit('unknown read method ' + str(disc.readMethod), EXIT_INVALID_INPUT)
+    try:
+        disc.retries = str(int(disc.retries))
+    except ValueError:
+        errorExit('retries must be an integer', EXIT_INVALID_INPUT)
+    disc.dirOut = os.path.abspath(disc.dirOut)
+
+    # Validate input
+    disc.validateInput()
+    validationErrors = disc.getValidationErrors()
+    if validationErrors:
+        errorExit('; '.join(msg.replace('\n', ' ') for msg in validationErrors),
+                  EXIT_INVALID_INPUT)
+
+    if not disc.prepareOutput(args.overwriteFlag):
+        errorExit('writing to ' + disc.dirOut + ' would overwrite existing files, '
+                  'use --overwrite to allow this', EXIT_INVALID_INPUT)
+
+    try:
+        setupLogger(disc.logFile, args.quietFlag)
+    except OSError:
+        errorExit('error trying to write log file to ' + disc.logFile, EXIT_INVALID_INPUT)
+
+    # Interrupt readom / ddrescue gracefully on SIGINT and SIGTERM
+    cancelToken = CancelToken()
+    previousHandlers = setSignalHandlers(lambda signum, frame: cancelToken.cancel())
+
+    disc.forceImageChecksum = args.forceImageChecksum
+    if args.profileDir is not None:
+        disc.profileDir = os.path.abspath(args.profileDir)
+    disc.progressCallback = onProgress
+    disc.swapCallback = swapDisc
+    if args.maxPasses is not None:
+        disc.rescuePolicy = PassPolicy(disc.retries, [disc.rescueDirectDiscMode],
+                                       maxPasses=args.maxPasses)
+    runDisc(disc, cancelToken)
+
+    # Retry with ddrescue on readom failure
+    if disc.needsRescueRetry():
+        logging.info('*** Retrying with ddrescue ***')
+        disc.prepareRescueRetry()
+        runDisc(disc, cancelToken)
+
+    # The token's pipe must not be used after it is closed
+    setSignalHandlers(previousHandlers)
+    cancelToken.close()
+
+    if disc.interruptedFlag:
+        exitStatus = EXIT_INTERRUPTED
+    elif disc.successFlag and not disc.readErrorFlag:
+        exitStatus = EXIT_SUCCESS
+    else:
+        exitStatus = EXIT_ERRORS
+
+    logging.shutdown()
+    sys.exit(exitStatus)
+
+
+if __name__ == "__main__":
+    main()
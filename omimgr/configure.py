@@ -51,12 +51,22 @@ def writeConfigFile(configRootDir, removeFlag):
     configSettings = {}
     configSettings['retries'] = '4'
     configSettings['checksumFileName'] = 'checksums.sha512'
+    configSettings['checksumAlgorithms'] = 'sha512'
+    configSettings['checksumWorkers'] = '1'
+    configSettings['chunkManifest'] = 'False'
+    configSettings['consoleLines'] = '1000'
     configSettings['logFileName'] = 'omimgr.log'
     configSettings['metadataFileName'] = 'metadata.json'
+    configSettings['metricsAddress'] = ''
+    configSettings['metricsFile'] = ''
     configSettings['prefix'] = 'disc'
+    configSettings['profileDir'] = ''
     configSettings['extension'] = 'iso'
     configSettings['rescueDirectDiscMode'] = 'False'
     configSettings['autoRetry'] = 'False'
+    configSettings['catalogueFile'] = ''
+    configSettings['pipelineHashing'] = 'True'
+    configSettings['progressLogInterval'] = '60'
     configSettings['readCommand'] = 'readom'
     configSettings['timeZone'] = 'Europe/Amsterdam'
     configSettings['defaultDir'] = ''
@@ -0,0 +1,238 @@
+#! /usr/bin/env python3
+"""Inventory of optical drives, read from sysfs and kept up to date while
+drives are plugged in or removed"""
+
+import os
+import fcntl
+import socket
+import selectors
+import threading
+from . import shared
+
+# Netlink protocol for kernel uevents (linux/netlink.h)
+NETLINK_KOBJECT_UEVENT = 15
+
+# CDROM_DRIVE_STATUS ioctl and its results (linux/cdrom.h)
+CDROM_DRIVE_STATUS = 0x5326
+CDS_NO_INFO = 0
+CDS_NO_DISC = 1
+CDS_TRAY_OPEN = 2
+CDS_DRIVE_NOT_READY = 3
+CDS_DISC_OK = 4
+
+
+def getTrayStatus(drivePath):
+    """Return tray status of drive (one of the CDS_ values). The device is
+    opened non-blocking, which doesn't wait for the disc or lock the tray"""
+    fd = os.open(drivePath, os.O_RDONLY | os.O_NONBLOCK)
+    try:
+        return fcntl.ioctl(fd, CDROM_DRIVE_STATUS)
+    finally:
+        os.close(fd)
+
+
+def readAttribute(path):
+    """Return stripped contents of sysfs attribute file, or '' if it doesn't exist"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read().decode('utf-8', 'replace').strip()
+    except OSError:
+        return ''
+
+
+def readSerial(deviceDir):
+    """Return serial number from sysfs device directory: the serial attribute
+    if there is one, otherwise the unit serial number VPD page (0x80)"""
+    serial = readAttribute(os.path.join(deviceDir, 'serial'))
+    if serial:
+        return serial
+    try:
+        with open(os.path.join(deviceDir, 'vpd_pg80'), 'rb') as f:
+            page = f.read()
+    except OSError:
+        return ''
+    # 4-byte header, of which bytes 2-3 give the length of the serial number
+    if len(page) < 4:
+        return ''
+    length = int.from_bytes(page[2:4], 'big')
+    return page[4:4 + length].decode('ascii', 'replace').strip()
+
+
+class OpticalDevice:
+    """Optical drive, as described by sysfs"""
+
+    def __init__(self, name, path, vendor='', model='', serial='', size=0, accessible=False):
+        """initialise OpticalDevice instance"""
+        self.name = name
+        self.path = path
+        self.vendor = vendor
+        self.model = model
+        self.serial = serial
+        # Size of the disc in the drive in bytes (0 if there is no disc)
+        self.size = size
+        # True if the current user can read the device
+        self.accessible = accessible
+
+    def key(self):
+        """Properties that identify this state of the device; a change means
+        that another drive or disc was inserted"""
+        return self.path, self.vendor, self.model, self.serial, self.size, self.accessible
+
+    def description(self):
+        """Device path with its size, as shown in the GUI"""
+        return self.path + ' (' + shared.sizeof_fmt(self.size) + ')'
+
+
+class DeviceInventory:
+    """Cached list of the optical drives (block devices named sr*) under
+    sysRoot. Everything is read from sysfs, which never blocks on a drive
+    that is spinning up (unlike opening the device).
+
+    After start(), a monitor thread updates the list on kernel uevents
+    (netlink), or by rescanning every pollInterval seconds if netlink is not
+    available or sysRoot is not /sys (e.g. a fake sysfs tree for testing).
+    Sysfs doesn't support inotify, so there is no inotify fallback.
+    Subscribers are called as callback(eventType, device) with eventType
+    'add', 'remove' or 'change', from the thread that noticed the change.
+    """
+
+    def __init__(self, sysRoot='/sys', devRoot='/dev', pollInterval=2.0, logger=None):
+        """initialise DeviceInventory instance"""
+        self.sysRoot = sysRoot
+        self.devRoot = devRoot
+        self.pollInterval = pollInterval
+        self.logger = shared.getLogger(logger)
+        self.cache = {}
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.thread = None
+        self.monitorMode = None
+        self.stopRead, self.stopWrite = os.pipe()
+        self.rescan()
+
+    def readDevice(self, name):
+        """Return OpticalDevice for block device name, from sysfs"""
+        blockDir = os.path.join(self.sysRoot, 'block', name)
+        deviceDir = os.path.join(blockDir, 'device')
+        path = os.path.join(self.devRoot, name)
+        try:
+            # Size attribute is in 512-byte sectors
+            size = int(readAttribute(os.path.join(blockDir, 'size')) or 0) * 512
+        except ValueError:
+            size = 0
+        return OpticalDevice(name, path,
+                             readAttribute(os.path.join(deviceDir, 'vendor')),
+                             readAttribute(os.path.join(deviceDir, 'model')),
+                             readSerial(deviceDir), size,
+                             os.access(path, os.R_OK))
+
+    def scan(self):
+        """Return dictionary with OpticalDevice for each drive, by name"""
+        devices = {}
+        try:
+            names = os.listdir(os.path.join(self.sysRoot, 'block'))
+        except OSError:
+            names = []
+        for name in names:
+            if name.startswith('sr') and \
+                    os.path.exists(os.path.join(self.sysRoot, 'block', name, 'device')):
+                devices[name] = self.readDevice(name)
+        return devices
+
+    def rescan(self):
+        """Update cached list from sysfs, and notify subscribers of any changes"""
+        devices = self.scan()
+        events = []
+        with self.lock:
+            for name, device in devices.items():
+                if name not in self.cache:
+                    events.append(('add', device))
+                elif device.key() != self.cache[name].key():
+                    events.append(('change', device))
+            for name, device in self.cache.items():
+                if name not in devices:
+                    events.append(('remove', device))
+            self.cache = devices
+            subscribers = list(self.subscribers)
+        for eventType, device in events:
+            self.logger.info('optical device ' + eventType + ': ' + device.path)
+            for callback in subscribers:
+                callback(eventType, device)
+        return events
+
+    def devices(self, accessibleOnly=False):
+        """Return cached list of OpticalDevice instances, sorted by path"""
+        with self.lock:
+            devices = sorted(self.cache.values(), key=lambda device: device.path)
+        if accessibleOnly:
+            devices = [device for device in devices if device.accessible]
+        return devices
+
+    def subscribe(self, callback):
+        """Call callback(eventType, device) on every change"""
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Stop calling callback"""
+        with self.lock:
+            self.subscribers.remove(callback)
+
+    def openNetlink(self):
+        """Return socket that receives kernel uevents, or None if that isn't
+        possible"""
+        if os.path.realpath(self.sysRoot) != '/sys' or not hasattr(socket, 'AF_NETLINK'):
+            return None
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            # Port id 0: assigned by the kernel; group 1: kernel uevents
+            sock.bind((0, 1))
+        except OSError:
+            return None
+        return sock
+
+    def start(self):
+        """Start monitor thread"""
+        sock = self.openNetlink()
+        self.monitorMode = 'poll' if sock is None else 'netlink'
+        self.thread = threading.Thread(target=self.monitor, args=(sock,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop monitor thread"""
+        if self.thread is not None:
+            os.write(self.stopWrite, b'x')
+            self.thread.join()
+            self.thread = None
+
+    def monitor(self, sock):
+        """Rescan on uevents for block devices (or every pollInterval seconds
+        without netlink) until stop is called"""
+        selector = selectors.DefaultSelector()
+        selector.register(self.stopRead, selectors.EVENT_READ)
+        timeout = self.pollInterval
+        if sock is not None:
+            selector.register(sock, selectors.EVENT_READ)
+            timeout = None
+        while True:
+            ready = selector.select(timeout)
+            if any(key.fileobj == self.stopRead for key, _ in ready):
+                os.read(self.stopRead, 1)
+                break
+            if sock is None:
+                self.rescan()
+                continue
+            # Message is 'action@devpath' followed by KEY=value items, all
+            # separated by null bytes
+            items = sock.recv(8192).split(b'\0')
+            if b'SUBSYSTEM=block' in items:
+                self.rescan()
+        selector.close()
+        if sock is not None:
+            sock.close()
+
+    def close(self):
+        """Stop monitor thread and release resources"""
+        self.stop()
+        os.close(self.stopRead)
+        os.close(self.stopWrite)
@@ -10,23 +10,27 @@ Research department,  KB / National Library of the Netherlands
 import sys
 import os
 import io
-import time
 import threading
 import logging
 import queue
 import uuid
 import json
+import datetime
 from pathlib import Path
 import tkinter as tk
 from tkinter import filedialog as tkFileDialog
 from tkinter import scrolledtext as ScrolledText
 from tkinter import messagebox as tkMessageBox
 from tkinter import ttk
-from tkfilebrowser import askopendirname
 from .om import Disc
+from .wrappers import CancelToken
+from .devices import DeviceInventory
 from . import shared
 from . import config
 
+# Maximum number of log records that wait to be displayed. If the GUI falls
+# behind, the oldest ones are dropped (they are still in the log file)
+logQueueSize = 10000
 
 class omimgrGUI(tk.Frame):
 
@@ -41,13 +45,25 @@ class omimgrGUI(tk.Frame):
         # Logging stuff
         self.logger = logging.getLogger()
         # Create a logging handler using a queue
-        self.log_queue = queue.Queue(-1)
+        self.log_queue = queue.Queue(logQueueSize)
         self.queue_handler = QueueHandler(self.log_queue)
+        # Queue through which the worker thread signals that it has finished
+        self.event_queue = queue.Queue()
+        self.polling = False
+        # Cancellation token of the running job
+        self.cancelToken = None
+        # Optical drives; the inventory reports plugged in or removed drives
+        # (from its monitor thread) through device_queue
+        self.inventory = DeviceInventory()
+        self.device_queue = queue.Queue()
+        self.inventory.subscribe(lambda eventType, device: self.device_queue.put(eventType))
+        self.inventory.start()
         # Create disc instance
         self.disc = Disc()
         self.t1 = None
         # Read configuration file
         self.disc.getConfiguration()
+        self.disc.startMetrics()
         # Set dirOut, depending on whether value from config is a directory
         if os.path.isdir(self.disc.defaultDir):
             self.disc.dirOut = self.disc.defaultDir
@@ -55,16 +71,16 @@ class omimgrGUI(tk.Frame):
             self.disc.dirOut = os.path.expanduser("~")
         # Build the GUI
         self.build_gui()
+        self.after(250, self.poll_device_queue)
 
     def on_quit(self, event=None):
         """Quit omimgr"""
+        # Write any log records that are still queued
+        logging.shutdown()
         os._exit(0)
 
     def on_submit(self, event=None):
-        """fetch and validate entered input, and start processing"""
-
-        # This flag is true if all input validates
-        inputValidateFlag = True
+        """fetch entered input, and validate it in a separate thread"""
 
         # Fetch entered values (strip any leading / trailing whitespace characters)
         self.disc.omDevice =  self.bdVar.get().split(' (')[0].strip()
@@ -84,42 +100,34 @@ class omimgrGUI(tk.Frame):
         self.disc.rescueDirectDiscMode = self.rescueDirectDiscMode.get()
         self.disc.autoRetry = self.autoRetry.get()
 
-        # Validate input
-        self.disc.validateInput()
+        # Validation checks the device and the installed tools, which can take
+        # a while, so it runs outside the GUI thread
+        self.start_button.config(state='disabled')
+        self.validation_queue = queue.Queue()
+        threading.Thread(target=lambda: self.validation_queue.put(self.disc.validate()),
+                         daemon=True).start()
+        self.after(50, self.poll_validation)
 
-        # Show error message for any parameters that didn't pass validation
-        if not self.disc.dirOutIsDirectory:
-            inputValidateFlag = False
-            msg = ("Output directory doesn't exist:\n" + self.disc.dirOut)
-            tkMessageBox.showerror("ERROR", msg)
+    def poll_validation(self):
+        """Check every 50ms if validation has finished"""
+        try:
+            result = self.validation_queue.get(block=False)
+        except queue.Empty:
+            self.after(50, self.poll_validation)
+        else:
+            self.on_validated(result)
 
-        if not self.disc.dirOutIsWritable:
-            inputValidateFlag = False
-            msg = ('Cannot write to directory ' + self.disc.dirOut)
-            tkMessageBox.showerror("ERROR", msg)
+    def on_validated(self, result):
+        """Report validation errors, and start processing if all input is valid"""
 
-        if not self.disc.deviceExistsFlag:
-            inputValidateFlag = False
-            msg = ('Selected device is not accessible')
-            tkMessageBox.showerror("ERROR", msg)
+        # This flag is true if all input validates
+        inputValidateFlag = True
 
-        if not self.disc.discInTrayFlag:
-            inputValidateFlag = False
-            msg = ('No disc in tray')
-            tkMessageBox.showerror("ERROR", msg)
+        self.disc.applyValidation(result)
 
-        if not self.disc.readomInstalled:
-            inputValidateFlag = False
-            msg = ("readom not installed!\n"
-                   "install with:\n"
-                   "'sudo apt install wodim'")
-            tkMessageBox.showerror("ERROR", msg)
-
-        if not self.disc.ddrescueInstalled:
+        # Show error message for any parameters that didn't pass validation
+        for msg in self.disc.getValidationErrors():
             inputValidateFlag = False
-            msg = ("ddrescue not installed!\n"
-                   "install with:\n"
-                   "'sudo apt install gddrescue'")
             tkMessageBox.showerror("ERROR", msg)
 
         # Ask confirmation if readom is used on dir with existing files
@@ -128,37 +136,30 @@ class omimgrGUI(tk.Frame):
             msg = ('writing to ' + self.disc.dirOut + ' will overwrite existing files!\n'
                    'press OK to continue, otherwise press Cancel')
             outDirConfirmFlag = tkMessageBox.askokcancel("Overwrite files?", msg)
-            if outDirConfirmFlag:
-                # Delete old image file (and map file, if it exists)
-                os.remove(self.disc.imageFile)
-                try:
-                    os.remove(self.disc.mapFile)
-                except OSError:
-                    pass
-            else:
+            if not outDirConfirmFlag:
                 inputValidateFlag = False
-        # If ddrescue is used, delete old image file, but only if no map file
-        # can be found (which indicates readom output)
-        elif self.disc.outputExistsFlag and self.disc.readMethod == 'ddrescue':
-            if not os.path.isfile(self.disc.mapFile):
-                try:
-                    os.remove(self.disc.imageFile)
-                except:
-                    pass
-
         if inputValidateFlag:
+            # Remove results of any previous run (same rules as omimgr-cli)
+            self.disc.prepareOutput(True)
+
+        if not inputValidateFlag:
+            self.start_button.config(state='normal')
+        else:
 
             # Start logger
             successLogger = True
             try:
                 self.setupLogger()
                 # Start polling log messages from the queue
-                self.after(100, self.poll_log_queue)
+                if not self.polling:
+                    self.polling = True
+                    self.after(100, self.poll_log_queue)
             except OSError:
                 # Something went wrong while trying to write to log file
                 msg = ('error trying to write log file to ' + self.disc.logFile)
                 tkMessageBox.showerror("ERROR", msg)
                 successLogger = False
+                self.start_button.config(state='normal')
 
             if successLogger:
                 # Enable interrupt button
@@ -176,6 +177,7 @@ class omimgrGUI(tk.Frame):
                 self.extension_entry.config(state='disabled')
                 self.rbReadom.config(state='disabled')
                 self.rbRescue.config(state='disabled')
+                self.rbNative.config(state='disabled')
                 self.identifier_entry.config(state='disabled')
                 self.loadJsonButton.config(state='disabled')
                 self.uuidButton.config(state='disabled')
@@ -185,7 +187,13 @@ class omimgrGUI(tk.Frame):
                 self.quit_button.config(state='disabled')
 
                 # Launch disc processing function as subprocess
-                self.t1 = threading.Thread(target=self.disc.processDisc)
+                self.disc.finishedCallback = self.jobFinished
+                self.disc.progressCallback = self.jobProgress
+                self.progress_bar['value'] = 0
+                self.progress_label['text'] = ''
+                self.cancelToken = CancelToken()
+                self.t1 = threading.Thread(target=self.disc.processDisc,
+                                           args=(self.cancelToken,))
                 self.t1.start()
 
 
@@ -198,6 +206,8 @@ class omimgrGUI(tk.Frame):
 
     def selectOutputDirectory(self, event=None):
         """Select output directory"""
+        # Imported here, as it is only needed once the button is pressed
+        from tkfilebrowser import askopendirname
         dirInit = self.disc.dirOut
         self.disc.dirOut = askopendirname(initialdir=dirInit)
         self.outDirLabel['text'] = self.disc.dirOut
@@ -208,7 +218,14 @@ class omimgrGUI(tk.Frame):
         metadataFileExists = True
         loadSuccessFlag = True
         """Set prefix, extension, identifier, description, notes
-        according to existing metadata file"""
+        according to existing metadata file. If a job catalogue is used and
+        an identifier is entered, the most recent job with that identifier is
+        looked up in the catalogue first (which also sets the output
+        directory)"""
+        identifier = self.identifier_entry.get().strip()
+        if self.disc.catalogueFile and identifier and self.importFromCatalogue(identifier):
+            return
+
         metadataFile = os.path.join(self.disc.dirOut, self.disc.metadataFileName)
 
         if not os.path.isfile(metadataFile):
@@ -232,34 +249,86 @@ class omimgrGUI(tk.Frame):
                 tkMessageBox.showerror("ERROR", msg)
         
             if loadSuccessFlag:
-                try:         
-                    self.prefix_entry.delete(0, tk.END)
-                    self.prefix_entry.insert(tk.END, mdDict['prefix'])
-                    self.extension_entry.delete(0, tk.END)
-                    self.extension_entry.insert(tk.END, mdDict['extension'])
-                    self.identifier_entry.delete(0, tk.END)
-                    self.identifier_entry.insert(tk.END, mdDict['identifier'])
-                    self.description_entry.delete(0, tk.END)
-                    self.description_entry.insert(tk.END, mdDict['description'])
-                    self.notes_entry.delete(1.0, tk.END)
-                    self.notes_entry.insert(tk.END, mdDict['notes'])
-                except KeyError:
-                    msg = ("Parsing of metadata file resulted in an error")
-                    tkMessageBox.showerror("ERROR", msg)
+                self.fillFromMetadata(mdDict)
+
+    def importFromCatalogue(self, identifier):
+        """Fill in the fields from the most recent job for identifier in the
+        job catalogue, and select its output directory. Returns False if the
+        catalogue has no job for identifier"""
+        # Imported here, as most setups don't use a catalogue
+        import sqlite3
+        from .catalogue import Catalogue
+        try:
+            mdDict, dirOut = Catalogue(self.disc.catalogueFile).latestMetadata(identifier)
+        except (sqlite3.Error, OSError) as e:
+            msg = ("Cannot read catalogue " + self.disc.catalogueFile + ": " + str(e))
+            tkMessageBox.showerror("ERROR", msg)
+            return True
+        if mdDict is None:
+            return False
+        self.disc.dirOut = dirOut
+        self.outDirLabel['text'] = dirOut
+        self.fillFromMetadata(mdDict)
+        return True
+
+    def fillFromMetadata(self, mdDict):
+        """Set prefix, extension, identifier, description and notes fields
+        from metadata dictionary"""
+        try:
+            self.prefix_entry.delete(0, tk.END)
+            self.prefix_entry.insert(tk.END, mdDict['prefix'])
+            self.extension_entry.delete(0, tk.END)
+            self.extension_entry.insert(tk.END, mdDict['extension'])
+            self.identifier_entry.delete(0, tk.END)
+            self.identifier_entry.insert(tk.END, mdDict['identifier'])
+            self.description_entry.delete(0, tk.END)
+            self.description_entry.insert(tk.END, mdDict['description'])
+            self.notes_entry.delete(1.0, tk.END)
+            self.notes_entry.insert(tk.END, mdDict['notes'])
+        except KeyError:
+            msg = ("Parsing of metadata file resulted in an error")
+            tkMessageBox.showerror("ERROR", msg)
+
+    def deviceDescriptions(self):
+        """Return list with path and size of each available device"""
+        return [device.description() for device in self.inventory.devices(accessibleOnly=True)]
+
+    def updateDeviceMenu(self):
+        """Update device menu from the inventory, keeping the selected device
+        if it is still there"""
+        DEVICES = self.deviceDescriptions()
+        selected = self.bdVar.get()
+        selectedPath = selected.split(' (')[0]
+        for description in DEVICES:
+            if description.split(' (')[0] == selectedPath:
+                selected = description
+                break
+        else:
+            selected = DEVICES[0] if DEVICES else "N/A"
+        self.omDevice_entry.set_menu(selected, *DEVICES)
 
     def refreshDevices(self, event=None):
         """Refresh list of available devices"""
-        devices = shared.getOpticalDevices()
-        DEVICES = []
-        for device in devices:
-            # Display both device with its corresponding size
-            DEVICES.append(device[0] + ' (' + device[1] + ')')
-        
-        self.omDevice_entry.set_menu(*DEVICES)
+        self.inventory.rescan()
+        self.updateDeviceMenu()
+
+    def poll_device_queue(self):
+        """Check every 250ms if drives were plugged in, removed or changed"""
+        changed = False
+        while True:
+            try:
+                self.device_queue.get(block=False)
+            except queue.Empty:
+                break
+            changed = True
+        if changed:
+            self.updateDeviceMenu()
+        self.after(250, self.poll_device_queue)
 
     def interruptImaging(self, event=None):
         """Interrupt imaging process"""
-        config.interruptFlag = True
+        if self.cancelToken is not None:
+            self.cancelToken.cancel()
         self.interrupt_button.configure(state='disabled')
 
     def decreaseRetries(self, event=None):
@@ -303,7 +372,7 @@ class omimgrGUI(tk.Frame):
 
         # Set GUI geometry
         windowWidth = 720
-        windowHeight = 760
+        windowHeight = 790
 
         # get the screen dimension
         screenWidth = self.root.winfo_screenwidth()
@@ -334,11 +403,7 @@ class omimgrGUI(tk.Frame):
         ttk.Separator(self, orient='horizontal').grid(column=0, row=4, columnspan=4, sticky='ew')
 
         # Device
-        devices = shared.getOpticalDevices()
-        DEVICES = []
-        for device in devices:
-            # Display both device with its corresponding size
-            DEVICES.append(device[0] + ' (' + device[1] + ')')
+        DEVICES = self.deviceDescriptions()
         self.bdVar = tk.StringVar()
         try:
             self.bdVar.set(DEVICES[0])
@@ -346,7 +411,7 @@ class omimgrGUI(tk.Frame):
             # We end up here if omimgr is launched with insufficient rights
             # or user is not part of cdrom group
             self.bdVar.set("N/A")
-        self.omDevice_entry = ttk.OptionMenu(self, self.bdVar, *DEVICES)
+        self.omDevice_entry = ttk.OptionMenu(self, self.bdVar, self.bdVar.get(), *DEVICES)
         tk.Label(self, text='Optical device').grid(column=0, row=5, sticky='w')
         self.omDevice_entry.grid(column=1, row=5, sticky='w')
 
@@ -358,7 +423,7 @@ class omimgrGUI(tk.Frame):
                                         width=4)
         self.refresh_button.grid(column=1, row=5, sticky='e')
 
-        # Read command (readom or ddrescue)
+        # Read command (readom, ddrescue or built-in reader)
         self.v = tk.IntVar()
         self.v.set(1)
 
@@ -367,6 +432,7 @@ class omimgrGUI(tk.Frame):
         self.readMethods = [
             ['readom', 1, 0],
             ['ddrescue', 2, 3],
+            ['native', 3, 0],
         ]
 
         tk.Label(self, text='Read method').grid(column=0, row=6, sticky='w')
@@ -383,6 +449,12 @@ class omimgrGUI(tk.Frame):
                                     value=2)
         self.rbRescue.grid(column=1, row=7, sticky='w')
 
+        self.rbNative = tk.Radiobutton(self,
+                                    text='built-in',
+                                    variable=self.v,
+                                    value=3)
+        self.rbNative.grid(column=1, row=6, sticky='e')
+
         # Retries
         tk.Label(self, text='Retries').grid(column=0, row=8, sticky='w')
         self.retries_entry = tk.Entry(self, width=20)
@@ -399,7 +471,7 @@ class omimgrGUI(tk.Frame):
         self.increaseRetriesButton.grid(column=2, row=8, sticky='w')
 
         # Direct disc mode
-        tk.Label(self, text='Direct disc mode (ddrescue)').grid(column=0, row=9, sticky='w')
+        tk.Label(self, text='Direct disc mode (ddrescue / built-in)').grid(column=0, row=9, sticky='w')
         self.rescueDirectDiscMode = tk.BooleanVar()
         self.rescueDirectDiscMode.set(self.disc.rescueDirectDiscMode)
         self.rescueDirectDiscMode_entry = tk.Checkbutton(self, variable=self.rescueDirectDiscMode)
@@ -496,6 +568,14 @@ class omimgrGUI(tk.Frame):
         self.st['background'] = 'white'
         self.st.grid(column=0, row=21, sticky='ew', columnspan=4)
 
+        # Progress bar and rate / ETA label (ddrescue only)
+        self.progress_bar = ttk.Progressbar(self, orient='horizontal',
+                                            mode='determinate', maximum=100,
+                                            length=200)
+        self.progress_bar.grid(column=0, row=22, sticky='w')
+        self.progress_label = tk.Label(self, text='')
+        self.progress_label.grid(column=1, row=22, sticky='w', columnspan=3)
+
         # Define bindings for keyboard shortcuts: buttons
         self.root.bind_all('<Control-Key-d>', self.selectOutputDirectory)
         self.root.bind_all('<Control-Key-i>', self.interruptImaging)
@@ -527,10 +607,13 @@ class omimgrGUI(tk.Frame):
         # Logging stuff
         self.logger = logging.getLogger()
         # Create a logging handler using a queue
-        self.log_queue = queue.Queue(-1)
+        self.log_queue = queue.Queue(logQueueSize)
         self.queue_handler = QueueHandler(self.log_queue)
         # Disable interrupt button
         self.interrupt_button.config(state='disabled')
+        # Reset progress bar
+        self.progress_bar['value'] = 0
+        self.progress_label['text'] = ''
         # Enable entry widgets
         self.outDirButton_entry.config(state='normal')
         self.omDevice_entry.config(state='normal')
@@ -544,6 +627,7 @@ class omimgrGUI(tk.Frame):
         self.extension_entry.config(state='normal')
         self.rbReadom.config(state='normal')
         self.rbRescue.config(state='normal')
+        self.rbNative.config(state='normal')
         self.loadJsonButton.config(state='normal')
         self.identifier_entry.config(state='normal')
         self.uuidButton.config(state='normal')
@@ -574,55 +658,239 @@ class omimgrGUI(tk.Frame):
     def setupLogger(self):
         """Set up logger configuration"""
 
-        # Basic configuration
-        logging.basicConfig(filename=self.disc.logFile,
-                            level=logging.INFO,
-                            format='%(asctime)s - %(levelname)s - %(message)s')
-
-        # Add the handler to logger
         self.logger = logging.getLogger()
+        self.logger.setLevel(logging.INFO)
 
-        # This sets the console output format (slightly different from basicConfig!)
+        # This sets the console output format (slightly different from the log file!)
         formatter = logging.Formatter('%(message)s')
         self.queue_handler.setFormatter(formatter)
-        self.logger.addHandler(self.queue_handler)
 
-    def display(self, record):
-        """Display log record in scrolledText widget"""
-        msg = self.queue_handler.format(record)
+        # Log file and console are written by a separate thread, so that
+        # logging doesn't wait for (possibly slow) file I/O
+        fileFormatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        self.logger.addHandler(shared.queuedFileHandler(self.disc.logFile, fileFormatter,
+                                                        [self.queue_handler]))
+
+    def display(self, items):
+        """Display list of (message, level name) items in scrolledText widget
+        with one insert, and remove the oldest lines if there are more than
+        consoleLines"""
+        # Older items would be removed right away
+        items = items[-self.disc.consoleLines:]
+        # Text and tag arguments of insert; consecutive messages with the
+        # same level share one text argument
+        args = []
+        for msg, levelname in items:
+            if args and args[-1] == levelname:
+                args[-2] += msg + '\n'
+            else:
+                args += [msg + '\n', levelname]
         self.st.configure(state='normal')
-        self.st.insert(tk.END, msg + '\n', record.levelname)
+        self.st.insert(tk.END, *args)
+        # Index of the end of the text is the number of lines + 1
+        excess = int(self.st.index('end-1c').split('.')[0]) - 1 - self.disc.consoleLines
+        if excess > 0:
+            self.st.delete('1.0', str(excess + 1) + '.0')
         self.st.configure(state='disabled')
 
         # Autoscroll to the bottom
         self.st.yview(tk.END)
 
+    def drain_log_queue(self):
+        """Display all messages that are currently in the queue"""
+        items = []
+        while True:
+            try:
+                items.append(self.log_queue.get(block=False))
+            except queue.Empty:
+                break
+        dropped = self.queue_handler.takeDropped()
+        if dropped:
+            items.insert(0, (str(dropped) + ' messages not shown, see log file', 'WARNING'))
+        if items:
+            self.display(items)
+
     def poll_log_queue(self):
-        """Check every 100ms if there is a new message in the queue to display"""
+        """Check every 100ms if there is a new message in the queue to display,
+        and if the worker thread has finished. Polling stops once it has"""
+        self.drain_log_queue()
+        finished = False
         while True:
             try:
-                record = self.log_queue.get(block=False)
+                eventType, payload = self.event_queue.get(block=False)
             except queue.Empty:
                 break
-            else:
-                self.display(record)
-        self.after(100, self.poll_log_queue)
+            if eventType == 'progress':
+                self.showProgress(payload)
+            elif eventType == 'finished':
+                finished = True
+
+        if finished:
+            # Display anything that was logged just before the worker finished
+            self.drain_log_queue()
+            self.polling = False
+            self.on_finished()
+        else:
+            self.after(100, self.poll_log_queue)
+
+    def jobFinished(self, disc):
+        """Called from the worker thread when processDisc has finished. Tk is not
+        thread-safe, so this only puts an event in the queue that is picked up
+        by poll_log_queue"""
+        self.event_queue.put(('finished', disc))
+
+    def jobProgress(self, event):
+        """Called from the worker thread for every ddrescue status update"""
+        self.event_queue.put(('progress', event))
+
+    def showProgress(self, event):
+        """Update progress bar and rate / ETA label from ddrescue progress event"""
+        if event.pctRescued is not None:
+            self.progress_bar['value'] = event.pctRescued
+        items = []
+        if event.rescued is not None:
+            items.append('rescued: ' + shared.sizeof_fmt(event.rescued))
+        if event.currentRate is not None:
+            items.append('rate: ' + shared.sizeof_fmt(event.currentRate) + '/s')
+        eta = event.eta()
+        if eta is not None:
+            items.append('ETA: ' + str(datetime.timedelta(seconds=eta)))
+        if event.readErrors:
+            items.append('read errors: ' + str(event.readErrors))
+        self.progress_label['text'] = ', '.join(items)
+
+    def on_finished(self):
+        """Report outcome of finished job, and either start a retry or reset the GUI"""
+        self.t1.join()
+        self.cancelToken.close()
+        self.cancelToken = None
+        handlers = self.logger.handlers[:]
+        for handler in handlers:
+            handler.close()
+            self.logger.removeHandler(handler)
+        # Closing the handlers passed any remaining records to the console queue
+        self.drain_log_queue()
+
+        retryFromReadomFlag = False
+        retryFromRescueFlag = False
+
+        if self.disc.omDeviceIOError:
+            # Optical device not accessible
+            msg = ('Cannot access optical device ' + self.disc.omDevice +
+                   '. Check that device exists.')
+            errorExit(msg)
+        elif self.disc.successFlag and not self.disc.readErrorFlag:
+            # Imaging completed with no errors
+            msg = ('Disc processed without errors')
+            tkMessageBox.showinfo("Success", msg)
+        elif self.disc.readMethod == 'readom' and self.disc.autoRetry:
+            # Imaging resulted in errors, auto-retry with ddrescue
+            retryFromReadomFlag = True
+        elif self.disc.readMethod == 'readom' and not self.disc.autoRetry:
+            # Imaging resulted in errors, as if user wants to retry with ddrescue
+            msg = ('Errors occurred while processing this disc\n'
+                   'Try again with ddrescue? (This will overwrite\n'
+                   'existing image file)')
+            if tkMessageBox.askyesno("Errors", msg):
+                retryFromReadomFlag = True
+        elif self.disc.readMethod == 'native' and self.disc.autoRetry:
+            # Imaging resulted in errors, auto-retry with ddrescue, which
+            # continues from the map file of the built-in reader
+            retryFromReadomFlag = True
+        elif self.disc.readMethod == 'native' and not self.disc.autoRetry:
+            msg = ('Errors occurred while processing this disc\n'
+                   'Try a ddrescue pass? (ddrescue continues where\n'
+                   'the built-in reader left off)')
+            if tkMessageBox.askyesno("Errors", msg):
+                retryFromReadomFlag = True
+        elif self.disc.readMethod == 'ddrescue':
+            # Imaging resulted in errors
+            msg = ('One or more errors occurred while processing disc\n'
+                   'Try another ddrescue pass? (Hint: you may try using\n'
+                   'Direct Disc mode and/or another optical device)')
+            if tkMessageBox.askyesno("Errors", msg):
+                retryFromRescueFlag = True
+
+        if retryFromReadomFlag:
+            # Reset flags
+            self.disc.readErrorFlag = False
+            self.disc.finishedFlag = False
+            # Set readMethod to ddrescue
+            self.v.set(2)
+            self.on_submit()
+        elif retryFromRescueFlag:
+            # Reset flags
+            self.disc.readErrorFlag = False
+            self.disc.finishedFlag = False
+            # Enable entry widgets
+            self.omDevice_entry.config(state='normal')
+            self.retries_entry.config(state='normal')
+            self.decreaseRetriesButton.config(state='normal')
+            self.increaseRetriesButton.config(state='normal')
+            self.rescueDirectDiscMode_entry.config(state='normal')
+            self.autoRetry_entry.config(state='normal')
+            self.start_button.config(state='normal')
+            self.quit_button.config(state='normal')
+            self.interrupt_button.config(state='disabled')
+            self.refresh_button.config(state='normal')
+        else:
+            # Reset dirOut to parent dir of current value (returns root
+            # dir if dirOut is root)
+            dirOutNew = str(Path(self.disc.dirOut).parent)
+            # Reset the GUI
+            self.reset_gui(dirOutNew)
+
+    def report_callback_exception(self, exc, val, tb):
+        """Handle exceptions raised in Tk callbacks"""
+        # Unexpected error
+        msg = 'An unexpected error occurred, see log file for details'
+        logging.error(val, exc_info=(exc, val, tb))
+        errorExit(msg)
 
 
 class QueueHandler(logging.Handler):
-    """Class to send logging records to a queue
+    """Class to send formatted logging records to a queue
 
     It can be used from different threads
-    The ConsoleUi class polls this queue to display records in a ScrolledText widget
-    Taken from https://github.com/beenje/tkinter-logging-text-widget/blob/master/main.py
+    The GUI polls this queue to display records in a ScrolledText widget.
+    If the queue is bounded and full, the oldest message is dropped, and
+    counted in dropped
+    Adapted from https://github.com/beenje/tkinter-logging-text-widget/blob/master/main.py
     """
 
     def __init__(self, log_queue):
         super().__init__()
         self.log_queue = log_queue
+        self.dropped = 0
 
     def emit(self, record):
-        self.log_queue.put(record)
+        """Put (message, level name) in the queue. Called with the handler
+        lock held, so only one thread at a time adds messages"""
+        try:
+            item = (self.format(record), record.levelname)
+        except Exception:
+            self.handleError(record)
+            return
+        while True:
+            try:
+                self.log_queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.log_queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def takeDropped(self):
+        """Return number of dropped messages since the last call"""
+        self.acquire()
+        try:
+            dropped = self.dropped
+            self.dropped = 0
+        finally:
+            self.release()
+        return dropped
 
 
 def checkDirExists(dirIn):
@@ -648,84 +916,8 @@ def main():
     myGUI = omimgrGUI(root)
     # This ensures application quits normally if user closes window
     root.protocol('WM_DELETE_WINDOW', myGUI.on_quit)
-    retryFromReadomFlag = False
-    retryFromRescueFlag = False
-
-    while True:
-        try:
-            root.update_idletasks()
-            root.update()
-            time.sleep(0.1)
-            if myGUI.disc.finishedFlag:
-                myGUI.t1.join()
-                handlers = myGUI.logger.handlers[:]
-                for handler in handlers:
-                    handler.close()
-                    myGUI.logger.removeHandler(handler)
-
-                if myGUI.disc.omDeviceIOError:
-                    # Optical device not accessible
-                    msg = ('Cannot access optical device ' + myGUI.disc.omDevice +
-                           '. Check that device exists.')
-                    errorExit(msg)
-                elif myGUI.disc.successFlag and not myGUI.disc.readErrorFlag:
-                    # Imaging completed with no errors
-                    msg = ('Disc processed without errors')
-                    tkMessageBox.showinfo("Success", msg)
-                elif myGUI.disc.readMethod == 'readom' and myGUI.disc.autoRetry:
-                    # Imaging resulted in errors, auto-retry with ddrescue
-                    retryFromReadomFlag = True
-                elif myGUI.disc.readMethod == 'readom' and not myGUI.disc.autoRetry:
-                    # Imaging resulted in errors, as if user wants to retry with ddrescue
-                    msg = ('Errors occurred while processing this disc\n'
-                           'Try again with ddrescue? (This will overwrite\n'
-                           'existing image file)')
-                    if tkMessageBox.askyesno("Errors", msg):
-                        retryFromReadomFlag = True
-                elif myGUI.disc.readMethod == 'ddrescue':
-                    # Imaging resulted in errors
-                    msg = ('One or more errors occurred while processing disc\n'
-                           'Try another ddrescue pass? (Hint: you may try using\n'
-                           'Direct Disc mode and/or another optical device)')
-                    if tkMessageBox.askyesno("Errors", msg):
-                        retryFromRescueFlag = True
-
-                if retryFromReadomFlag:
-                    # Reset flags
-                    myGUI.disc.readErrorFlag = False
-                    myGUI.disc.finishedFlag = False
-                    # Set readMethod to ddrescue
-                    myGUI.v.set(2)
-                    myGUI.on_submit()
-                    retryFromReadomFlag = False
-                elif retryFromRescueFlag:
-                    # Reset flags
-                    myGUI.disc.readErrorFlag = False
-                    myGUI.disc.finishedFlag = False
-                    # Enable entry widgets
-                    myGUI.omDevice_entry.config(state='normal')
-                    myGUI.retries_entry.config(state='normal')
-                    myGUI.decreaseRetriesButton.config(state='normal')
-                    myGUI.increaseRetriesButton.config(state='normal')
-                    myGUI.rescueDirectDiscMode_entry.config(state='normal')
-                    myGUI.autoRetry_entry.config(state='normal')
-                    myGUI.start_button.config(state='normal')
-                    myGUI.quit_button.config(state='normal')
-                    myGUI.interrupt_button.config(state='disabled')
-                    myGUI.refresh_button.config(state='normal')
-                    retryFromRescueFlag = False
-                else:
-                    # Reset dirOut to parent dir of current value (returns root 
-                    # dir if dirOut is root)
-                    dirOutNew = str(Path(myGUI.disc.dirOut).parent)
-                    # Reset the GUI
-                    myGUI.reset_gui(dirOutNew)
-
-        except Exception as e:
-            # Unexpected error
-            msg = 'An unexpected error occurred, see log file for details'
-            logging.error(e, exc_info=True)
-            errorExit(msg)
+    root.report_callback_exception = myGUI.report_callback_exception
+    root.mainloop()
 
 if __name__ == "__main__":
     main()
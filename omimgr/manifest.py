@@ -0,0 +1,167 @@
+#! /usr/bin/env python3
+"""Per-chunk digests of a (partially rescued) image, with a Merkle root, so
+that after another ddrescue pass only the chunks it changed are hashed again"""
+
+import os
+import re
+import io
+import json
+import hashlib
+from bisect import bisect_right
+from . import shared
+
+
+def finishedRanges(rescueMap):
+    """Return list of (start, end) byte ranges that are finished in rescueMap
+    (a mapfile.RescueMap); adjacent finished blocks are merged"""
+    ranges = []
+    for run in re.finditer(rb'\++', rescueMap.statuses):
+        last = run.end() - 1
+        ranges.append((rescueMap.positions[run.start()],
+                       rescueMap.positions[last] + rescueMap.sizes[last]))
+    return ranges
+
+
+def subtractRanges(ranges, other):
+    """Return the parts of ranges that are not covered by other (both sorted
+    lists of non-overlapping (start, end) ranges)"""
+    otherStarts = [start for start, _ in other]
+    result = []
+    for start, end in ranges:
+        # Start with the last range in other that begins at or before start
+        i = max(bisect_right(otherStarts, start) - 1, 0)
+        pos = start
+        while i < len(other) and other[i][0] < end:
+            otherStart, otherEnd = other[i]
+            if otherEnd > pos:
+                if otherStart > pos:
+                    result.append((pos, otherStart))
+                pos = max(pos, otherEnd)
+            i += 1
+        if pos < end:
+            result.append((pos, end))
+    return result
+
+
+def merkleRoot(digests, algorithm='sha256'):
+    """Return Merkle root (hex) of list of chunk digests (hex). Pairs of
+    nodes are hashed together; an odd node at the end of a level moves up
+    unchanged"""
+    level = [bytes.fromhex(digest) for digest in digests]
+    if not level:
+        return hashlib.new(algorithm).hexdigest()
+    while len(level) > 1:
+        nextLevel = [hashlib.new(algorithm, level[i] + level[i + 1]).digest()
+                     for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            nextLevel.append(level[-1])
+        level = nextLevel
+    return level[0].hex()
+
+
+class ChunkManifest:
+    """Digest of every chunkSize bytes of an image, stored as JSON in
+    manifestFile. Together with the digests the manifest keeps the finished
+    ranges of the mapfile at the time of hashing. ddrescue only writes to the
+    image where it rescues data, so on the next update only the chunks that
+    overlap newly finished ranges are hashed again.
+    """
+
+    def __init__(self, manifestFile, chunkSize=4 * 2**20, algorithm='sha256', logger=None):
+        """initialise ChunkManifest instance"""
+        self.manifestFile = manifestFile
+        self.chunkSize = chunkSize
+        self.algorithm = algorithm
+        self.logger = shared.getLogger(logger)
+        self.imageSize = 0
+        self.digests = []
+        self.finished = []
+        self.noChunksHashed = 0
+
+    def load(self):
+        """Read manifest file; returns False if it doesn't exist, can't be
+        read, or uses another chunk size or algorithm"""
+        try:
+            with io.open(self.manifestFile, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest['chunkSize'] != self.chunkSize or manifest['algorithm'] != self.algorithm:
+                return False
+            self.imageSize = manifest['imageSize']
+            self.digests = manifest['digests']
+            finished = manifest['finished']
+            self.finished = list(zip(finished[0::2], finished[1::2]))
+        except (IOError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    def save(self):
+        """Write manifest file"""
+        manifest = {'algorithm': self.algorithm,
+                    'chunkSize': self.chunkSize,
+                    'imageSize': self.imageSize,
+                    'merkleRoot': self.merkleRoot(),
+                    'finished': [pos for finishedRange in self.finished for pos in finishedRange],
+                    'digests': self.digests}
+        try:
+            with io.open(self.manifestFile, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f)
+        except IOError:
+            self.logger.error('error while writing chunk manifest ' + self.manifestFile)
+
+    def merkleRoot(self):
+        """Merkle root of the chunk digests"""
+        return merkleRoot(self.digests, self.algorithm)
+
+    def changedChunks(self, finished, imageSize):
+        """Return sorted list of indices of chunks that must be hashed again,
+        or None if the whole image must be hashed"""
+        # ddrescue never un-finishes a block, so if any range that was finished
+        # no longer is, the map or image was replaced
+        if imageSize < self.imageSize or subtractRanges(self.finished, finished):
+            return None
+        chunks = set()
+        for start, end in subtractRanges(finished, self.finished):
+            chunks.update(range(start // self.chunkSize, -(-end // self.chunkSize)))
+        # The last chunk of the old image is incomplete if the image grew
+        noChunks = -(-imageSize // self.chunkSize)
+        if imageSize > self.imageSize:
+            chunks.update(range(self.imageSize // self.chunkSize, noChunks))
+        return sorted(chunk for chunk in chunks if chunk < noChunks)
+
+    def update(self, imageFile, rescueMap):
+        """Hash the chunks of imageFile that changed since the last update
+        (all of them if there is no usable manifest), and save the manifest.
+        Returns the number of chunks that were hashed"""
+        imageSize = os.path.getsize(imageFile)
+        finished = finishedRanges(rescueMap)
+        noChunks = -(-imageSize // self.chunkSize)
+
+        chunks = None
+        if self.load():
+            chunks = self.changedChunks(finished, imageSize)
+        if chunks is None:
+            chunks = range(noChunks)
+            self.digests = [''] * noChunks
+        else:
+            self.digests.extend([''] * (noChunks - len(self.digests)))
+
+        with open(imageFile, 'rb') as f:
+            for chunk in chunks:
+                f.seek(chunk * self.chunkSize)
+                self.digests[chunk] = hashlib.new(self.algorithm,
+                                                  f.read(self.chunkSize)).hexdigest()
+
+        self.imageSize = imageSize
+        self.finished = finished
+        self.noChunksHashed = len(chunks)
+        self.save()
+        return self.noChunksHashed
+
+    def summary(self):
+        """Return dictionary with manifest properties, for the metadata file"""
+        return {'manifestFile': os.path.basename(self.manifestFile),
+                'algorithm': self.algorithm,
+                'chunkSize': self.chunkSize,
+                'noChunks': len(self.digests),
+                'noChunksHashed': self.noChunksHashed,
+                'merkleRoot': self.merkleRoot()}
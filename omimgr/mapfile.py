@@ -0,0 +1,326 @@
+#! /usr/bin/env python3
+"""Compact model of a ddrescue mapfile, which is updated incrementally while
+ddrescue keeps rewriting the file"""
+
+import os
+import re
+import zlib
+from array import array
+from itertools import accumulate, islice
+from bisect import bisect_left, bisect_right
+
+# ddrescue block status codes
+NON_TRIED = ord('?')
+NON_TRIMMED = ord('*')
+NON_SCRAPED = ord('/')
+BAD_SECTOR = ord('-')
+FINISHED = ord('+')
+
+statusNames = {NON_TRIED: 'nonTried',
+               NON_TRIMMED: 'nonTrimmed',
+               NON_SCRAPED: 'nonScraped',
+               BAD_SECTOR: 'badSector',
+               FINISHED: 'rescued'}
+
+# Status line (current_pos current_status [current_pass]), and block lines
+# (pos size status)
+statusLine = re.compile(rb'^[ \t]*(0x[0-9A-Fa-f]+)[ \t]+(\S)(?:[ \t]+(\d+))?[ \t]*\r?$', re.M)
+blockLine = re.compile(rb'^[ \t]*(0x[0-9A-Fa-f]+)[ \t]+(0x[0-9A-Fa-f]+)[ \t]+([?*/+-])', re.M)
+
+
+class RescueMap:
+    """Run-length representation of a ddrescue mapfile. Positions, sizes and
+    status codes of the blocks are held in arrays, with running totals of the
+    finished and bad-sector bytes, and a max tree over the bad areas. This
+    makes the queries below O(log n), also for maps with millions of blocks.
+
+    update() re-reads the mapfile if it changed. ddrescue rewrites the whole
+    file, but most of it usually stays the same, so only the blocks from the
+    first changed chunk onwards are parsed again.
+    """
+
+    def __init__(self, mapFile, sectorSize=2048, chunkSize=2**16):
+        """initialise RescueMap instance"""
+        self.mapFile = mapFile
+        self.sectorSize = sectorSize
+        self.chunkSize = chunkSize
+        self.currentPos = None
+        self.currentStatus = None
+        self.currentPass = None
+        # Block data
+        self.positions = array('Q')
+        self.sizes = array('Q')
+        self.statuses = bytearray()
+        # Number of bytes with each status
+        self.totals = dict.fromkeys(statusNames, 0)
+        # cumulative[status][i] is number of bytes with status in blocks 0 .. i-1
+        self.cumulative = {FINISHED: array('Q', [0]), BAD_SECTOR: array('Q', [0])}
+        # Indices of bad-sector blocks, and max tree of their sizes
+        self.badBlocks = array('Q')
+        self.badTree = array('Q')
+        self.badLeaves = 0
+        # State of the last parsed version of the file
+        self.fileStat = None
+        self.blocksStart = None
+        self.oneBlockPerLine = False
+        self.chunkCrcs = []
+        self.noParsedBlocks = 0
+
+    def __len__(self):
+        """Number of blocks"""
+        return len(self.statuses)
+
+    def update(self):
+        """Re-read mapfile if it changed since the last call. Returns True if
+        the map changed"""
+        try:
+            st = os.stat(self.mapFile)
+            if self.fileStat == (st.st_mtime_ns, st.st_size):
+                return False
+            with open(self.mapFile, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return False
+        self.fileStat = (st.st_mtime_ns, st.st_size)
+        self.parse(data)
+        return True
+
+    def parse(self, data):
+        """Parse mapfile contents, re-using the blocks that precede the first
+        changed chunk of the previous version"""
+        match = statusLine.search(data)
+        if match is None:
+            # No status line (yet), so no blocks either
+            self.truncate(0)
+            self.blocksStart = None
+            self.chunkCrcs = []
+            return
+        self.currentPos = int(match.group(1), 16)
+        self.currentStatus = match.group(2).decode('ascii', errors='replace')
+        self.currentPass = int(match.group(3)) if match.group(3) else None
+
+        firstBlock = blockLine.search(data, match.end())
+        blocksStart = firstBlock.start() if firstBlock is not None else len(data)
+        chunkCrcs = [zlib.crc32(data[i:i + self.chunkSize])
+                     for i in range(blocksStart, len(data), self.chunkSize)]
+
+        # ddrescue writes one block per line, so the number of complete lines
+        # before the first changed chunk is the number of blocks we can keep.
+        # If the header changed size the offsets shifted, so parse everything
+        keepBlocks = 0
+        startPos = blocksStart
+        if blocksStart == self.blocksStart and self.oneBlockPerLine:
+            firstChanged = 0
+            for oldCrc, newCrc in zip(self.chunkCrcs, chunkCrcs):
+                if oldCrc != newCrc:
+                    break
+                firstChanged += 1
+            boundary = blocksStart + firstChanged * self.chunkSize
+            keepBlocks = data.count(b'\n', blocksStart, boundary)
+            if 0 < keepBlocks <= len(self.statuses):
+                startPos = data.rfind(b'\n', blocksStart, boundary) + 1
+            else:
+                keepBlocks = 0
+        self.truncate(keepBlocks)
+        noKeptBad = len(self.badBlocks)
+        self.blocksStart = blocksStart
+        self.chunkCrcs = chunkCrcs
+
+        matches = blockLine.findall(data, startPos)
+        noLines = data.count(b'\n', startPos) + int(not data.endswith(b'\n'))
+        self.oneBlockPerLine = (keepBlocks == 0 or self.oneBlockPerLine) and \
+            noLines == len(matches)
+
+        sizes = [int(size, 16) for _, size, _ in matches]
+        statuses = b''.join(status for _, _, status in matches)
+        offset = len(self.statuses)
+        self.badBlocks.extend(offset + i for i, status in enumerate(statuses)
+                              if status == BAD_SECTOR)
+        self.positions.extend([int(pos, 16) for pos, _, _ in matches])
+        self.sizes.extend(sizes)
+        self.statuses.extend(statuses)
+        for status, cumulative in self.cumulative.items():
+            statusSizes = [size if blockStatus == status else 0
+                           for size, blockStatus in zip(sizes, statuses)]
+            # accumulate starts with the initial value, which is already there
+            cumulative.extend(islice(accumulate(statusSizes, initial=cumulative[-1]), 1, None))
+        for size, status in zip(sizes, statuses):
+            self.totals[status] += size
+
+        self.noParsedBlocks = len(matches)
+        self.updateBadTree(noKeptBad)
+
+    def truncate(self, noBlocks):
+        """Remove all blocks from noBlocks onwards"""
+        for i in range(noBlocks, len(self.statuses)):
+            self.totals[self.statuses[i]] -= self.sizes[i]
+        del self.positions[noBlocks:]
+        del self.sizes[noBlocks:]
+        del self.statuses[noBlocks:]
+        for cumulative in self.cumulative.values():
+            del cumulative[noBlocks + 1:]
+        del self.badBlocks[bisect_left(self.badBlocks, noBlocks):]
+
+    def updateBadTree(self, firstChanged):
+        """Update max tree over the sizes of the bad-sector blocks, for leaves
+        from firstChanged onwards. The tree is rebuilt if it is too small"""
+        noBad = len(self.badBlocks)
+        if noBad > self.badLeaves or self.badLeaves == 0:
+            self.badLeaves = 1
+            while self.badLeaves < noBad:
+                self.badLeaves *= 2
+            self.badTree = array('Q', bytes(16 * self.badLeaves))
+            firstChanged = 0
+        tree = self.badTree
+        leaves = self.badLeaves
+        if firstChanged >= leaves:
+            return
+
+        # Leaves beyond noBad may still hold sizes of blocks that are gone
+        end = firstChanged
+        for i in range(firstChanged, leaves):
+            if i >= noBad and tree[leaves + i] == 0:
+                break
+            tree[leaves + i] = self.sizes[self.badBlocks[i]] if i < noBad else 0
+            end = i + 1
+        lo = leaves + firstChanged
+        hi = leaves + end - 1
+        while lo > 1 and hi >= lo:
+            lo //= 2
+            hi //= 2
+            for node in range(lo, hi + 1):
+                tree[node] = max(tree[2 * node], tree[2 * node + 1])
+
+    def badTreeArgmax(self, first, last):
+        """Index (in badBlocks) of largest bad-sector block among badBlocks[first:last]"""
+        tree = self.badTree
+        best = None
+        lo = first + self.badLeaves
+        hi = last + self.badLeaves
+        nodes = []
+        while lo < hi:
+            if lo & 1:
+                nodes.append(lo)
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                nodes.append(hi)
+            lo //= 2
+            hi //= 2
+        for node in nodes:
+            if best is None or tree[node] > tree[best]:
+                best = node
+        if best is None or tree[best] == 0:
+            return None
+        # Descend to the leaf that holds the maximum
+        while best < self.badLeaves:
+            best = 2 * best if tree[2 * best] >= tree[2 * best + 1] else 2 * best + 1
+        return best - self.badLeaves
+
+    def domainEnd(self):
+        """Position just after the last block"""
+        if not self.statuses:
+            return 0
+        return self.positions[-1] + self.sizes[-1]
+
+    def blockIndex(self, offset):
+        """Index of the block that contains offset (-1 if offset precedes the map)"""
+        return bisect_right(self.positions, offset) - 1
+
+    def overlap(self, block, start, end):
+        """Number of bytes of block within [start, end)"""
+        blockStart = self.positions[block]
+        blockEnd = blockStart + self.sizes[block]
+        return max(0, min(blockEnd, end) - max(blockStart, start))
+
+    def blockRange(self, start, end):
+        """Indices of first and last block that overlap [start, end), or None"""
+        if end is None:
+            end = self.domainEnd()
+        if not self.statuses or end <= start:
+            return None
+        first = max(self.blockIndex(start), 0)
+        last = self.blockIndex(end - 1)
+        if last < first:
+            return None
+        return first, last
+
+    def statusBytes(self, status, start=0, end=None):
+        """Number of bytes in [start, end) with status FINISHED or BAD_SECTOR"""
+        blocks = self.blockRange(start, end)
+        if blocks is None:
+            return 0
+        if end is None:
+            end = self.domainEnd()
+        first, last = blocks
+        cumulative = self.cumulative[status]
+        if first == last:
+            return self.overlap(first, start, end) if self.statuses[first] == status else 0
+        total = cumulative[last] - cumulative[first + 1]
+        for block in (first, last):
+            if self.statuses[block] == status:
+                total += self.overlap(block, start, end)
+        return total
+
+    def rescuedBytes(self, start=0, end=None):
+        """Number of finished bytes in [start, end)"""
+        return self.statusBytes(FINISHED, start, end)
+
+    def badSectorBytes(self, start=0, end=None):
+        """Number of bad-sector bytes in [start, end)"""
+        return self.statusBytes(BAD_SECTOR, start, end)
+
+    def badSectorCount(self, start=0, end=None):
+        """Number of bad sectors in [start, end)"""
+        return -(-self.badSectorBytes(start, end) // self.sectorSize)
+
+    def badAreaCount(self, start=0, end=None):
+        """Number of bad areas (bad-sector blocks) that overlap [start, end)"""
+        blocks = self.blockRange(start, end)
+        if blocks is None:
+            return 0
+        first, last = blocks
+        return bisect_right(self.badBlocks, last) - bisect_left(self.badBlocks, first)
+
+    def largestBadArea(self, start=0, end=None):
+        """Position and size of the largest bad area within [start, end) as a
+        tuple, or None if there aren't any"""
+        blocks = self.blockRange(start, end)
+        if blocks is None:
+            return None
+        if end is None:
+            end = self.domainEnd()
+        first, last = blocks
+
+        candidates = []
+        # Blocks at the edges may only partly fall within the range
+        for block in {first, last}:
+            if self.statuses[block] == BAD_SECTOR:
+                candidates.append((self.overlap(block, start, end),
+                                   max(self.positions[block], start)))
+        if last - first > 1:
+            i = self.badTreeArgmax(bisect_left(self.badBlocks, first + 1),
+                                   bisect_left(self.badBlocks, last))
+            if i is not None:
+                block = self.badBlocks[i]
+                candidates.append((self.sizes[block], self.positions[block]))
+        if not candidates:
+            return None
+        size, pos = max(candidates)
+        return pos, size
+
+    def summary(self):
+        """Return dictionary with totals for the whole map"""
+        largest = self.largestBadArea()
+        summary = {'currentPos': self.currentPos,
+                   'currentStatus': self.currentStatus,
+                   'currentPass': self.currentPass,
+                   'domainSize': self.domainEnd(),
+                   'noBlocks': len(self),
+                   'badSectorCount': self.badSectorCount(),
+                   'badAreas': len(self.badBlocks),
+                   'largestBadAreaPos': largest[0] if largest else None,
+                   'largestBadAreaSize': largest[1] if largest else 0}
+        for status, name in statusNames.items():
+            summary[name] = self.totals[status]
+        return summary
@@ -0,0 +1,474 @@
+#! /usr/bin/env python3
+"""Counters and histograms of imaging jobs, exported in the Prometheus text
+format to a file (for the node_exporter textfile collector) and / or a local
+HTTP /metrics endpoint"""
+
+import os
+import re
+import math
+import fcntl
+import socket
+import tempfile
+import threading
+from . import config
+from . import shared
+
+# Sample line of the text format: name{labels} value
+sampleLine = re.compile(r'^([A-Za-z_:][A-Za-z0-9_:]*)(?:\{(.*)\})?[ \t]+(\S+)[ \t]*$')
+labelPair = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def escapeLabelValue(value):
+    """Escape label value for the text format"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def unescapeLabelValue(value):
+    """Undo escapeLabelValue"""
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), value)
+
+
+def formatValue(value):
+    """Format sample value for the text format"""
+    value = float(value)
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def parseSamples(text):
+    """Return list of (name, labels, value) tuples for the samples in text,
+    with labels a dictionary. Comments and lines that cannot be parsed are
+    skipped"""
+    samples = []
+    for line in text.splitlines():
+        match = sampleLine.match(line)
+        if match is None or line.startswith('#'):
+            continue
+        name, labelString, valueString = match.groups()
+        labels = {key: unescapeLabelValue(value)
+                  for key, value in labelPair.findall(labelString or '')}
+        try:
+            value = float(valueString)
+        except ValueError:
+            continue
+        samples.append((name, labels, value))
+    return samples
+
+
+class Metric:
+    """Base class of metric families. Each combination of label values (in
+    the order of labelNames) has its own value"""
+
+    metricType = 'untyped'
+
+    def __init__(self, name, description, labelNames=()):
+        """initialise Metric instance"""
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        """Return tuple of label values, in the order of labelNames"""
+        if set(labels) != set(self.labelNames):
+            raise ValueError(self.name + ' needs labels ' + ', '.join(self.labelNames))
+        return tuple(str(labels[labelName]) for labelName in self.labelNames)
+
+    def labelString(self, key, extra=()):
+        """Return {name="value",...} for key and extra (name, value) pairs"""
+        pairs = list(zip(self.labelNames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(name + '="' + escapeLabelValue(value) + '"'
+                              for name, value in pairs) + '}'
+
+    def samples(self):
+        """Return list of (suffix, labelString, value) tuples; overridden by subclasses"""
+        with self.lock:
+            return [('', self.labelString(key), value)
+                    for key, value in sorted(self.values.items())]
+
+    def render(self):
+        """Return metric family in the text format"""
+        lines = ['# HELP ' + self.name + ' ' + self.description.replace('\\', '\\\\'),
+                 '# TYPE ' + self.name + ' ' + self.metricType]
+        for suffix, labelString, value in self.samples():
+            lines.append(self.name + suffix + labelString + ' ' + formatValue(value))
+        return '\n'.join(lines) + '\n'
+
+    def restore(self, samples):
+        """Add values from parsed samples of an earlier run"""
+        self.merge(samples, [])
+
+    def merge(self, samples, writtenSamples):
+        """Add values from parsed samples (e.g. a metrics file that other
+        processes update too), minus those in writtenSamples (the values this
+        process wrote earlier); overridden by metrics that survive a restart"""
+
+
+class Counter(Metric):
+    """Value that only goes up"""
+
+    metricType = 'counter'
+
+    def __init__(self, name, description, labelNames=()):
+        """initialise Counter instance; a counter without labels starts at 0"""
+        Metric.__init__(self, name, description, labelNames)
+        if not self.labelNames:
+            self.values[()] = 0
+
+    def inc(self, value=1, **labels):
+        """Add value (which must not be negative)"""
+        if value < 0:
+            raise ValueError('counters cannot decrease')
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def get(self, **labels):
+        """Return current value"""
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def parseValues(self, samples):
+        """Return dictionary with the value of each label combination in samples"""
+        values = {}
+        for name, labels, value in samples:
+            if name == self.name and set(labels) == set(self.labelNames):
+                key = self.key(labels)
+                values[key] = values.get(key, 0) + value
+        return values
+
+    def merge(self, samples, writtenSamples):
+        """Add values in samples, minus those in writtenSamples"""
+        values = self.parseValues(samples)
+        writtenValues = self.parseValues(writtenSamples)
+        with self.lock:
+            for key in set(values) | set(writtenValues):
+                # Difference first, so that a file nobody else changed adds
+                # exactly 0 (no rounding of the sum)
+                self.values[key] = (self.values.get(key, 0) +
+                                    (values.get(key, 0) - writtenValues.get(key, 0)))
+
+
+class Gauge(Metric):
+    """Value that can go up and down"""
+
+    metricType = 'gauge'
+
+    def set(self, value, **labels):
+        """Set value"""
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def get(self, **labels):
+        """Return current value (None if it was never set)"""
+        with self.lock:
+            return self.values.get(self.key(labels))
+
+
+class Histogram(Metric):
+    """Distribution of observed values over buckets (upper bounds), with
+    their count and sum"""
+
+    metricType = 'histogram'
+
+    def __init__(self, name, description, labelNames=(), buckets=()):
+        """initialise Histogram instance"""
+        Metric.__init__(self, name, description, labelNames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def newValue(self):
+        """Return empty value: cumulative bucket counts, sum"""
+        return [[0] * len(self.buckets), 0.0]
+
+    def observe(self, value, **labels):
+        """Add observation"""
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.setdefault(key, self.newValue())
+            for i, upperBound in enumerate(self.buckets):
+                if value <= upperBound:
+                    counts[i] += 1
+            self.values[key][1] = total + value
+
+    def get(self, **labels):
+        """Return (count, sum) of observations"""
+        with self.lock:
+            counts, total = self.values.get(self.key(labels), self.newValue())
+            return counts[-1], total
+
+    def samples(self):
+        """Return bucket, sum and count samples"""
+        samples = []
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                for upperBound, count in zip(self.buckets, counts):
+                    samples.append(('_bucket',
+                                    self.labelString(key, [('le', formatValue(upperBound))]),
+                                    count))
+                samples.append(('_sum', self.labelString(key), total))
+                samples.append(('_count', self.labelString(key), counts[-1]))
+        return samples
+
+    def parseValues(self, samples):
+        """Return dictionary with the buckets and sum of each label combination
+        in samples"""
+        values = {}
+        for name, labels, value in samples:
+            if name == self.name + '_bucket':
+                labels = dict(labels)
+                upperBound = float(labels.pop('le', 'nan'))
+                if upperBound not in self.buckets or set(labels) != set(self.labelNames):
+                    continue
+                counts = values.setdefault(self.key(labels), self.newValue())[0]
+                counts[self.buckets.index(upperBound)] += int(value)
+            elif name == self.name + '_sum' and set(labels) == set(self.labelNames):
+                values.setdefault(self.key(labels), self.newValue())[1] += value
+        return values
+
+    def merge(self, samples, writtenSamples):
+        """Add buckets and sums in samples, minus those in writtenSamples"""
+        values = self.parseValues(samples)
+        writtenValues = self.parseValues(writtenSamples)
+        with self.lock:
+            for key in set(values) | set(writtenValues):
+                counts, total = self.values.setdefault(key, self.newValue())
+                addCounts, addTotal = values.get(key, self.newValue())
+                writtenCounts, writtenTotal = writtenValues.get(key, self.newValue())
+                self.values[key] = [[count + added - written for count, added, written
+                                     in zip(counts, addCounts, writtenCounts)],
+                                    total + (addTotal - writtenTotal)]
+
+
+class Registry:
+    """Collection of metrics that are exported together"""
+
+    def __init__(self):
+        """initialise Registry instance"""
+        self.metrics = []
+
+    def add(self, metric):
+        """Add metric and return it"""
+        if any(m.name == metric.name for m in self.metrics):
+            raise ValueError('duplicate metric ' + metric.name)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labelNames=()):
+        """Add and return Counter"""
+        return self.add(Counter(name, description, labelNames))
+
+    def gauge(self, name, description, labelNames=()):
+        """Add and return Gauge"""
+        return self.add(Gauge(name, description, labelNames))
+
+    def histogram(self, name, description, labelNames=(), buckets=()):
+        """Add and return Histogram"""
+        return self.add(Histogram(name, description, labelNames, buckets))
+
+    def render(self):
+        """Return all metrics in the text format"""
+        return ''.join(metric.render() for metric in self.metrics)
+
+    def restore(self, text):
+        """Add counters and histograms of an earlier run (text in the text
+        format, e.g. an earlier metrics file)"""
+        self.merge(text, '')
+
+    def merge(self, text, writtenText):
+        """Add counters and histograms in text (e.g. a metrics file that other
+        processes update too), minus those in writtenText (what this process
+        wrote to it earlier)"""
+        samples = parseSamples(text)
+        writtenSamples = parseSamples(writtenText)
+        for metric in self.metrics:
+            metric.merge(samples, writtenSamples)
+
+
+# Metrics of this process; fed by Disc.processDisc, the wrappers and the
+# native reader
+registry = Registry()
+discsProcessed = registry.counter(
+    'omimgr_discs_processed_total', 'Discs processed, by read method and result '
+    '(success, errors, interrupted).', ['method', 'result'])
+bytesImaged = registry.counter(
+    'omimgr_bytes_imaged_total', 'Bytes read in the read phase (for ddrescue and the '
+    'native reader, the bytes rescued by that run), by drive and read method.',
+    ['drive', 'method'])
+readSeconds = registry.counter(
+    'omimgr_read_seconds_total', 'Time spent in the read phase, by drive.', ['drive'])
+driveThroughput = registry.histogram(
+    'omimgr_drive_read_megabytes_per_second', 'Read throughput of each job (MB/s), by drive.',
+    ['drive'], [0.5, 1, 2, 4, 8, 16, 32, 64, 128])
+phaseDuration = registry.histogram(
+    'omimgr_phase_duration_seconds', 'Duration of each phase of a job.', ['phase'],
+    [0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200])
+retryPasses = registry.counter(
+    'omimgr_retry_passes_total', 'Read passes after the first one: ddrescue passes with '
+    'rescue drives (rescuePass) and ddrescue retries after readom failure (autoRetry).',
+    ['kind'])
+readErrors = registry.counter(
+    'omimgr_read_errors_total', 'Read errors reported by ddrescue and the native reader.',
+    ['tool'])
+toolRuns = registry.counter(
+    'omimgr_tool_runs_total', 'Runs of readom and ddrescue, by exit status.',
+    ['tool', 'status'])
+toolDuration = registry.histogram(
+    'omimgr_tool_duration_seconds', 'Run time of readom, ddrescue and the native reader.',
+    ['tool'], [1, 10, 60, 300, 600, 1200, 1800, 3600, 7200, 14400])
+buildInfo = registry.gauge(
+    'omimgr_build_info', 'omimgr version (always 1).', ['version'])
+
+
+def parseAddress(address):
+    """Return (host, port) for address 'host:port', '[ipv6]:port' or 'port'
+    (host 127.0.0.1)"""
+    host, sep, port = address.strip().rpartition(':')
+    host = host.strip('[]') if sep else '127.0.0.1'
+    return host or '0.0.0.0', int(port)
+
+
+class MetricsServer:
+    """HTTP server that serves registry at /metrics, from a background thread"""
+
+    def __init__(self, registry, address, logger=None):
+        """initialise MetricsServer instance, and bind to address ('host:port')"""
+        # Imported here, as most runs don't use it
+        import http.server
+        import socketserver
+
+        self.logger = shared.getLogger(logger)
+        host, port = parseAddress(address)
+        log = self.logger
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """Serves /metrics"""
+
+            def do_GET(self):
+                """Send metrics, or 404 for anything but /metrics"""
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                """Requests go to the debug log instead of stderr"""
+                log.debug('metrics request from ' + self.address_string() + ': ' +
+                          format % args)
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            """Server for IPv4 or IPv6 addresses"""
+            address_family = socket.AF_INET6 if ':' in host else socket.AF_INET
+
+        self.httpd = Server((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.host = host
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self):
+        """Return URL of the endpoint"""
+        host = '[' + self.host + ']' if ':' in self.host else self.host
+        return 'http://' + host + ':' + str(self.port) + '/metrics'
+
+    def stop(self):
+        """Stop serving and close the socket"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+
+class Exporter:
+    """Exports registry to a metrics file and / or an HTTP endpoint. Started
+    once per process; the file is rewritten by update()"""
+
+    def __init__(self, registry):
+        """initialise Exporter instance"""
+        self.registry = registry
+        self.metricsFile = ''
+        # Registry as rendered for the last update; anything counted since
+        # then is added to the metrics file by the next update
+        self.writtenText = ''
+        self.server = None
+        self.started = False
+        self.lock = threading.Lock()
+
+    def start(self, metricsFile='', metricsAddress='', logger=None):
+        """Start exporting, if not done already. Counters and histograms
+        continue from the values in an existing metricsFile, so they keep
+        counting over separate (and parallel) omimgr-cli runs. If the HTTP
+        server cannot be started, a warning is logged and only the file is
+        written"""
+        logger = shared.getLogger(logger)
+        with self.lock:
+            if self.started or not (metricsFile or metricsAddress):
+                return
+            self.started = True
+            buildInfo.set(1, version=config.version)
+            if metricsFile:
+                # The first update adds the values in the file
+                self.metricsFile = os.path.abspath(metricsFile)
+            if metricsAddress:
+                try:
+                    self.server = MetricsServer(self.registry, metricsAddress, logger)
+                    logger.info('serving metrics at ' + self.server.url())
+                except (OSError, ValueError) as e:
+                    logger.warning('cannot serve metrics at ' + metricsAddress + ': ' + str(e))
+        self.update(logger)
+
+    def update(self, logger=None):
+        """Add what was counted since the last update to the metrics file.
+        Other omimgr processes may update the same file, so the file is
+        locked while it is read, merged with the registry and rewritten
+        (atomically, so the collector never reads a partial file)"""
+        if not self.metricsFile:
+            return
+        with self.lock:
+            tempFile = None
+            try:
+                # Locks a separate file, as the metrics file itself is replaced
+                with open(self.metricsFile + '.lock', 'a') as lockFile:
+                    fcntl.flock(lockFile, fcntl.LOCK_EX)
+                    try:
+                        with open(self.metricsFile, 'r', encoding='utf-8') as f:
+                            fileText = f.read()
+                    except FileNotFoundError:
+                        fileText = ''
+                    self.registry.merge(fileText, self.writtenText)
+                    self.writtenText = self.registry.render()
+                    fd, tempFile = tempfile.mkstemp(dir=os.path.dirname(self.metricsFile),
+                                                    prefix='.omimgr-metrics-', suffix='.tmp')
+                    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                        f.write(self.writtenText)
+                    os.chmod(tempFile, 0o644)
+                    os.replace(tempFile, self.metricsFile)
+            except OSError as e:
+                shared.getLogger(logger).warning('cannot write metrics file ' +
+                                                 self.metricsFile + ': ' + str(e))
+                if tempFile is not None and os.path.exists(tempFile):
+                    os.remove(tempFile)
+
+    def stop(self):
+        """Stop the HTTP server, and write the metrics file a last time"""
+        self.update()
+        with self.lock:
+            if self.server is not None:
+                self.server.stop()
+                self.server = None
+            self.metricsFile = ''
+            self.started = False
+
+
+exporter = Exporter(registry)
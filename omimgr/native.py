@@ -0,0 +1,367 @@
+#! /usr/bin/env python3
+"""Built-in sector reader, used as a third read method next to readom and
+ddrescue. It works on any block device or regular file."""
+
+import os
+import re
+import mmap
+import time
+from . import config
+from . import shared
+from . import progress
+from . import mapfile
+from . import metrics
+
+# Runs of sectors with the same status in the sector status array
+statusRun = re.compile(rb'\?+|\*+|/+|-+|\++')
+# Runs of bad sectors (bad areas)
+badRun = re.compile(rb'-+')
+
+
+class SectorReader:
+    """Copies a device to an image file with large aligned reads into one
+    reusable buffer. A chunk that cannot be read is re-read sector by sector,
+    with up to retries retries for each sector; sectors that still fail are
+    marked as bad, and the image is left empty there.
+
+    The state of each sector is kept in a bytearray with ddrescue status codes,
+    and saved as a ddrescue-compatible mapfile every mapInterval seconds and
+    at the end. A run resumes from an existing mapfile, and ddrescue can also
+    continue where the reader stopped.
+
+    If the image is written from scratch without any read errors, the data
+    are hashed while they are read, so no separate checksum pass is needed.
+
+    If the image cannot be written (e.g. the disk is full), the reader logs
+    an error and stops; the sectors that were not written stay non-tried.
+    """
+
+    def __init__(self, device, imageFile, mapFile, retries=4, directIO=False,
+                 algorithms=None, sectorSize=2048, chunkSize=2**20,
+                 progressCallback=None, logger=None, cancelToken=None,
+                 progressInterval=1.0, mapInterval=30.0):
+        """initialise SectorReader instance"""
+        self.device = device
+        self.imageFile = imageFile
+        self.mapFile = mapFile
+        self.retries = int(retries)
+        self.directIO = directIO
+        self.algorithms = algorithms
+        self.sectorSize = sectorSize
+        # Multiple of the sector size and of the page size (O_DIRECT)
+        self.chunkSize = max(chunkSize // mmap.PAGESIZE, 1) * mmap.PAGESIZE
+        self.progressCallback = progressCallback
+        self.logger = shared.getLogger(logger)
+        self.cancelToken = cancelToken
+        self.progressInterval = progressInterval
+        self.mapInterval = mapInterval
+        self.size = 0
+        self.status = bytearray()
+        # Number of rescued and bad sectors, and of bad areas, in status
+        self.noRescuedSectors = 0
+        self.noBadSectors = 0
+        self.noBadAreas = 0
+        self.currentPos = 0
+        self.currentStatus = '?'
+        self.rescuedBytes = 0
+        self.readErrors = 0
+        self.writeFailedFlag = False
+        self.digests = None
+        self.startTime = None
+        self.lastReadTime = None
+
+    def commandLine(self):
+        """Description of the read in command line style, for logging and metadata"""
+        return ('omimgr-native dev=' + self.device + ' f=' + self.imageFile + ' map=' +
+                self.mapFile + ' retries=' + str(self.retries) + ' direct=' +
+                str(self.directIO))
+
+    def openDevice(self):
+        """Open device for reading, with O_DIRECT if requested and supported"""
+        if self.directIO:
+            try:
+                return os.open(self.device, os.O_RDONLY | os.O_DIRECT)
+            except (OSError, AttributeError):
+                self.logger.warning('O_DIRECT not supported for ' + self.device +
+                                    ', using buffered reads')
+                self.directIO = False
+        fd = os.open(self.device, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (OSError, AttributeError):
+            pass
+        return fd
+
+    def readMap(self, noSectors):
+        """Return sector status array, initialised from an existing mapfile"""
+        status = bytearray(b'?' * noSectors)
+        rescueMap = mapfile.RescueMap(self.mapFile, self.sectorSize)
+        rescueMap.update()
+        for i in range(len(rescueMap)):
+            start = rescueMap.positions[i] // self.sectorSize
+            end = min(-(-(rescueMap.positions[i] + rescueMap.sizes[i]) // self.sectorSize),
+                      noSectors)
+            if end > start:
+                status[start:end] = bytes([rescueMap.statuses[i]]) * (end - start)
+        return status
+
+    def writeMap(self):
+        """Write sector status to mapfile (via a temporary file, so readers
+        never see a partial map)"""
+        lines = ['# Mapfile. Created by omimgr ' + config.version + '\n',
+                 '# Command line: ' + self.commandLine() + '\n',
+                 '# current_pos  current_status  current_pass\n',
+                 '0x%08X     %s               1\n' % (self.currentPos, self.currentStatus),
+                 '#      pos        size  status\n']
+        for run in statusRun.finditer(self.status):
+            pos = run.start() * self.sectorSize
+            end = min(run.end() * self.sectorSize, self.size)
+            lines.append('0x%08X  0x%08X  %s\n' % (pos, end - pos, chr(run.group()[0])))
+        tempFile = self.mapFile + '.tmp'
+        try:
+            with open(tempFile, 'w') as f:
+                f.writelines(lines)
+            os.replace(tempFile, self.mapFile)
+        except OSError:
+            self.logger.error('cannot write map file ' + self.mapFile)
+
+    def countStatus(self):
+        """Count rescued and bad sectors and bad areas in the whole status
+        array (only needed once, after reading the mapfile)"""
+        self.noRescuedSectors = self.status.count(b'+')
+        self.noBadSectors = self.status.count(b'-')
+        self.noBadAreas = len(badRun.findall(self.status))
+
+    def setStatus(self, first, last, code):
+        """Set status of sectors first .. last-1 to code (b'+' or b'-'), and
+        update the counts. Bad areas can only merge or split next to the
+        changed sectors, so only those and their neighbours are looked at"""
+        windowStart = max(first - 1, 0)
+        windowEnd = last + 1
+        old = self.status[first:last]
+        self.noRescuedSectors -= old.count(b'+')
+        self.noBadSectors -= old.count(b'-')
+        self.noBadAreas -= len(badRun.findall(self.status, windowStart, windowEnd))
+        self.status[first:last] = code * (last - first)
+        if code == b'+':
+            self.noRescuedSectors += last - first
+        else:
+            self.noBadSectors += last - first
+        self.noBadAreas += len(badRun.findall(self.status, windowStart, windowEnd))
+
+    def readInto(self, fd, view, offset):
+        """Read len(view) bytes at offset into view; returns number of bytes
+        read, or -1 on a read error"""
+        try:
+            return os.preadv(fd, [view], offset)
+        except OSError:
+            return -1
+
+    def writeImage(self, outFd, data, offset):
+        """Write data to the image at offset; returns False, and logs an
+        error, if it cannot be written"""
+        try:
+            while data:
+                noBytes = os.pwrite(outFd, data, offset)
+                data = data[noBytes:]
+                offset += noBytes
+            return True
+        except OSError as e:
+            self.writeFailedFlag = True
+            self.logger.error('cannot write image file ' + self.imageFile + ' at byte ' +
+                              str(offset) + ': ' + str(e))
+            return False
+
+    def isCancelled(self):
+        """Returns True if the user cancelled the read"""
+        return self.cancelToken is not None and self.cancelToken.isCancelled()
+
+    def readSectors(self, inFd, outFd, view, first, last):
+        """Read sectors first .. last-1 one by one; returns False if any sector
+        could not be read or written, or if the read was cancelled"""
+        allRead = True
+        for sector in range(first, last):
+            if self.status[sector] == ord('+'):
+                continue
+            if self.isCancelled():
+                # Remaining sectors stay non-tried
+                return False
+            offset = sector * self.sectorSize
+            length = min(self.sectorSize, self.size - offset)
+            sectorView = view[:self.sectorSize] if self.directIO else view[:length]
+            for _ in range(self.retries + 1):
+                noBytes = self.readInto(inFd, sectorView, offset)
+                if noBytes > 0 or self.isCancelled():
+                    break
+            if noBytes > 0:
+                if not self.writeImage(outFd, view[:min(noBytes, length)], offset):
+                    # Sector stays non-tried
+                    return False
+                self.setStatus(sector, sector + 1, b'+')
+                self.rescuedBytes += min(noBytes, length)
+                self.lastReadTime = time.monotonic()
+            else:
+                self.setStatus(sector, sector + 1, b'-')
+                self.readErrors += 1
+                allRead = False
+                self.logger.warning('read error at byte ' + str(offset))
+        return allRead
+
+    def makeProgressEvent(self, now):
+        """Return progress.RescueProgress event for the current state"""
+        event = progress.RescueProgress()
+        event.phase = 'Copying (omimgr native reader)'
+        event.ipos = self.currentPos
+        event.opos = self.currentPos
+        event.rescued = self.rescuedBytes
+        event.badSector = self.noBadSectors * self.sectorSize
+        event.nonTried = self.size - self.rescuedBytes - event.badSector
+        event.badAreas = self.noBadAreas
+        event.readErrors = self.readErrors
+        event.runTime = int(now - self.startTime)
+        if self.size:
+            event.pctRescued = round(100 * self.rescuedBytes / self.size, 2)
+        if now > self.startTime:
+            event.averageRate = int(self.rescuedBytes / (now - self.startTime))
+        if event.averageRate:
+            event.remainingTime = int(event.nonTried / event.averageRate)
+        if self.lastReadTime is not None:
+            event.timeSinceLastRead = int(now - self.lastReadTime)
+        return event
+
+    def run(self):
+        """Read the device; returns exit status (0 if the device could be read
+        at all), read error flag and interrupted flag"""
+        self.logger.info('Command: ' + self.commandLine())
+        try:
+            inFd = self.openDevice()
+        except OSError as e:
+            self.logger.error('cannot open ' + self.device + ': ' + str(e))
+            return 1, True, False
+
+        # Released in the finally clause, also if the image cannot be written
+        outFd = None
+        buf = None
+        view = None
+        try:
+            fromScratch = not os.path.exists(self.imageFile) and not os.path.exists(self.mapFile)
+            self.size = os.lseek(inFd, 0, os.SEEK_END)
+            noSectors = -(-self.size // self.sectorSize)
+            chunkSectors = self.chunkSize // self.sectorSize
+            self.status = self.readMap(noSectors)
+            self.countStatus()
+            self.rescuedBytes = min(self.noRescuedSectors * self.sectorSize, self.size)
+
+            try:
+                outFd = os.open(self.imageFile, os.O_WRONLY | os.O_CREAT, 0o644)
+            except OSError as e:
+                self.logger.error('cannot open ' + self.imageFile + ': ' + str(e))
+                return 1, True, False
+
+            hasher = None
+            if fromScratch and self.algorithms:
+                hasher = shared.MultiHasher(self.algorithms)
+
+            # Anonymous mmap is page aligned, which O_DIRECT requires
+            buf = mmap.mmap(-1, self.chunkSize)
+            view = memoryview(buf)
+            self.startTime = time.monotonic()
+            lastProgress = self.startTime
+            lastMapWrite = self.startTime
+            interruptedFlag = False
+            hashedBytes = 0
+
+            for first in range(0, noSectors, chunkSectors):
+                if self.isCancelled():
+                    interruptedFlag = True
+                    self.logger.warning('*** native reader interrupted by user ***')
+                    break
+                if self.writeFailedFlag:
+                    break
+                last = min(first + chunkSectors, noSectors)
+                self.currentPos = first * self.sectorSize
+                chunkStatus = self.status[first:last]
+                if chunkStatus.count(b'+') == len(chunkStatus):
+                    continue
+
+                offset = first * self.sectorSize
+                length = min(last * self.sectorSize, self.size) - offset
+                noBytes = -1
+                if b'+' not in chunkStatus:
+                    # With O_DIRECT the read size must be a multiple of the sector size
+                    readLength = (last - first) * self.sectorSize if self.directIO else length
+                    noBytes = self.readInto(inFd, view[:readLength], offset)
+                if noBytes >= length:
+                    if not self.writeImage(outFd, view[:length], offset):
+                        if hasher is not None:
+                            hasher.hexdigests()
+                        hasher = None
+                        break
+                    self.setStatus(first, last, b'+')
+                    self.rescuedBytes += length
+                    self.lastReadTime = time.monotonic()
+                    if hasher is not None:
+                        # The buffer is re-used, so hash a copy
+                        hasher.update(bytes(view[:length]))
+                        hashedBytes += length
+                elif not self.readSectors(inFd, outFd, view, first, last) or b'+' in chunkStatus:
+                    # Image is no longer written in one sequential, error-free pass;
+                    # stop the hash threads before dropping the hasher
+                    if hasher is not None:
+                        hasher.hexdigests()
+                    hasher = None
+                elif hasher is not None:
+                    with open(self.imageFile, 'rb') as f:
+                        f.seek(offset)
+                        hasher.update(f.read(length))
+                    hashedBytes += length
+
+                self.currentPos = min(last * self.sectorSize, self.size)
+                now = time.monotonic()
+                if self.progressCallback is not None and \
+                        now - lastProgress >= self.progressInterval:
+                    self.progressCallback(self.makeProgressEvent(now))
+                    lastProgress = now
+                if now - lastMapWrite >= self.mapInterval:
+                    self.writeMap()
+                    lastMapWrite = now
+
+            if not interruptedFlag and not self.writeFailedFlag and self.isCancelled() and \
+                    self.noRescuedSectors + self.noBadSectors < noSectors:
+                # Cancelled while reading the last chunk sector by sector
+                interruptedFlag = True
+                self.logger.warning('*** native reader interrupted by user ***')
+        finally:
+            if outFd is not None:
+                os.close(outFd)
+            os.close(inFd)
+            if view is not None:
+                view.release()
+            if buf is not None:
+                try:
+                    buf.close()
+                except BufferError:
+                    # Slices of the buffer are still referenced by the
+                    # traceback of an exception; it is freed with them
+                    pass
+
+        if not interruptedFlag:
+            self.currentPos = self.size
+            self.currentStatus = '+' if self.noRescuedSectors == noSectors else '-'
+        self.writeMap()
+        if self.progressCallback is not None:
+            self.progressCallback(self.makeProgressEvent(time.monotonic()))
+
+        readErrorFlag = self.noRescuedSectors != noSectors
+        self.logger.info('native reader rescued bytes: ' + str(self.rescuedBytes))
+        self.logger.info('native reader read errors: ' + str(self.readErrors))
+        metrics.readErrors.inc(self.readErrors, tool='native')
+        metrics.toolDuration.observe(time.monotonic() - self.startTime, tool='native')
+
+        if hasher is not None:
+            digests = hasher.hexdigests()
+            if not interruptedFlag and not readErrorFlag and hashedBytes == self.size:
+                self.digests = digests
+                self.logger.info('in-process checksum covers ' + str(hashedBytes) + ' bytes')
+
+        return 0, readErrorFlag, interruptedFlag
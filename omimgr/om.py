@@ -4,18 +4,89 @@ do the actual imaging.
 """
 
 import os
-import fcntl
 import io
 import json
-import time
 import logging
 import glob
 import pathlib
-from shutil import which
-from isolyzer import isolyzer
 from . import wrappers
 from . import config
 from . import shared
+from . import pipeline
+from . import progress
+from . import mapfile
+from . import rescue
+from . import native
+from . import manifest
+from . import tools
+from . import devices
+from . import timing
+from . import metrics
+
+# Job items that can be set by a job file, the CLI or the scheduler; these
+# are all Disc attributes
+jobItems = ['omDevice', 'dirOut', 'readMethod', 'retries', 'prefix', 'extension',
+            'identifier', 'description', 'notes', 'rescueDirectDiscMode', 'autoRetry',
+            'rescueDrives']
+
+
+# Attributes of ValidationResult, which validateInput copies to Disc
+validationItems = ['dirOutIsDirectory', 'outputExistsFlag', 'dirOutIsWritable',
+                   'readomInstalled', 'ddrescueInstalled', 'readomVersion',
+                   'ddRescueVersion', 'deviceExistsFlag', 'rescueDrivesExistFlag',
+                   'discInTrayFlag']
+
+
+class ValidationResult:
+    """Outcome of Disc.validate"""
+
+    def __init__(self):
+        """initialise ValidationResult instance"""
+        self.dirOut = ''
+        self.dirOutIsDirectory = False
+        self.outputExistsFlag = False
+        self.dirOutIsWritable = False
+        self.readomInstalled = False
+        self.ddrescueInstalled = False
+        self.readomVersion = ''
+        self.ddRescueVersion = ''
+        self.deviceExistsFlag = False
+        self.rescueDrivesExistFlag = True
+        self.discInTrayFlag = False
+
+    def errors(self):
+        """Return list of error messages for any input that didn't pass
+        validation (empty if all input is valid)"""
+
+        errors = []
+
+        if not self.dirOutIsDirectory:
+            errors.append("Output directory doesn't exist:\n" + self.dirOut)
+
+        if not self.dirOutIsWritable:
+            errors.append('Cannot write to directory ' + self.dirOut)
+
+        if not self.deviceExistsFlag:
+            errors.append('Selected device is not accessible')
+
+        if not self.rescueDrivesExistFlag:
+            errors.append('One or more rescue drives are not accessible')
+
+        if not self.discInTrayFlag:
+            errors.append('No disc in tray')
+
+        if not self.readomInstalled:
+            errors.append("readom not installed!\n"
+                          "install with:\n"
+                          "'sudo apt install wodim'")
+
+        if not self.ddrescueInstalled:
+            errors.append("ddrescue not installed!\n"
+                          "install with:\n"
+                          "'sudo apt install gddrescue'")
+
+        return errors
+
 
 class Disc:
     """Disc class"""
@@ -33,14 +104,21 @@ class Disc:
         self.extension = ''
         self.rescueDirectDiscMode = ''
         self.autoRetry = ''
+        # Additional drives for ddrescue passes (see rescue.RescueOrchestrator)
+        self.rescueDrives = []
+        self.pipelineHashing = True
+        self.checksumAlgorithms = ['sha512']
+        self.checksumWorkers = 1
         self.retriesDefault = ''
         self.identifier = ''
         self.description = ''
         self.notes = ''
-        # Input validation flags
+        # Result of the last validateInput call, and its flags
+        self.validation = ValidationResult()
         self.dirOutIsDirectory = False
         self.outputExistsFlag = False
         self.deviceExistsFlag = False
+        self.rescueDrivesExistFlag = True
         self.discInTrayFlag = False
         self.dirOutIsWritable = False
         # Flags that define if dependencies are installed
@@ -54,14 +132,64 @@ class Disc:
         else:
             self.configFile = os.path.normpath('/etc/omimgr/omimgr.json')
 
+        # Logger used by processDisc; the root logger unless a job scheduler
+        # gives each job its own
+        self.logger = logging.getLogger()
+        # Accept regular files as (fake) optical device, e.g. for testing
+        self.allowFileDevice = False
         # Miscellaneous attributes
         self.logFile = ''
         self.imageFile = ''
         self.mapFile = ''
+        self.progressFile = ''
+        self.manifestFile = ''
         self.logFileName = ''
         self.checksumFileName = ''
         self.metadataFileName = ''
         self.finishedFlag = False
+        # Called (from the worker thread) with a progress.RescueProgress
+        # instance for every ddrescue status update
+        self.progressCallback = None
+        self.lastProgress = None
+        self.progressRecorder = None
+        # mapfile.RescueMap of the ddrescue mapfile
+        self.rescueMap = None
+        # rescue.PassPolicy for runs with rescueDrives; derived from retries
+        # and rescueDirectDiscMode if not set
+        self.rescuePolicy = None
+        # Called (from the worker thread) as swapCallback(fromDrive, toDrive)
+        # when the disc must be moved to the next rescue drive
+        self.swapCallback = None
+        self.rescuePasses = []
+        # ddrescue phases seen in the status blocks of the last processDisc call
+        self.rescuePhases = []
+        # Keep a chunk manifest of ddrescue / native images, and leave out the
+        # full image checksums while the image still has read errors, unless
+        # forceImageChecksum is set
+        self.chunkManifest = False
+        self.forceImageChecksum = False
+        # Maximum number of lines in the GUI console
+        self.consoleLines = 1000
+        # Seconds between ddrescue status blocks in the log (see
+        # wrappers.ProgressLogPolicy)
+        self.progressLogInterval = 60.0
+        # If set, processDisc is profiled, and the profile is written to
+        # this directory
+        self.profileDir = ''
+        # Duration of each phase of the last processDisc call (see
+        # timing.PhaseTimer.summary)
+        self.timing = {}
+        # Prometheus metrics file and HTTP address (host:port); see
+        # metrics.Exporter
+        self.metricsFile = ''
+        self.metricsAddress = ''
+        # SQLite job catalogue (see catalogue.Catalogue); empty if not used
+        self.catalogueFile = ''
+        # Called (from the worker thread) with this Disc instance as its only
+        # argument once processDisc has finished
+        self.finishedCallback = None
+        # wrappers.CancelToken of the job that is running, if any
+        self.cancelToken = None
         self.omDeviceIOError = False
         self.successFlag = True
         self.interruptedFlag = False
@@ -97,11 +225,38 @@ class Disc:
                 # Convert rescueDirectDiscMode and autoRetry to Boolean
                 self.rescueDirectDiscMode = bool(self.rescueDirectDiscMode == "True")
                 self.autoRetry = bool(self.autoRetry == "True")
+                # Optional items, older configuration files may not have these
+                self.pipelineHashing = bool(configDict.get('pipelineHashing', 'True') == "True")
+                self.checksumAlgorithms = self.parseChecksumAlgorithms(
+                    configDict.get('checksumAlgorithms', 'sha512'))
+                self.checksumWorkers = max(1, int(configDict.get('checksumWorkers', '1')))
+                self.chunkManifest = bool(configDict.get('chunkManifest', 'False') == "True")
+                self.consoleLines = max(1, int(configDict.get('consoleLines', '1000')))
+                self.progressLogInterval = max(0.0, float(configDict.get('progressLogInterval',
+                                                                         '60')))
+                self.profileDir = configDict.get('profileDir', '')
+                self.metricsFile = configDict.get('metricsFile', '')
+                self.metricsAddress = configDict.get('metricsAddress', '')
+                self.catalogueFile = configDict.get('catalogueFile', '')
                 self.retriesDefault = configDict['retries']
                 self.timeZone = configDict['timeZone']
                 self.defaultDir = configDict['defaultDir']
-            except KeyError:
+            except (KeyError, ValueError):
+                self.configSuccess = False
+
+    def parseChecksumAlgorithms(self, algorithmString):
+        """Convert comma-separated list of checksum algorithms to list. SHA-512
+        is always included, as it is used for the main checksum file"""
+        algorithms = ['sha512']
+        for algorithm in algorithmString.split(','):
+            algorithm = algorithm.strip().lower()
+            if algorithm == '' or algorithm in algorithms:
+                continue
+            if algorithm not in shared.checksumLabels:
                 self.configSuccess = False
+            else:
+                algorithms.append(algorithm)
+        return algorithms
 
     def getTrayStatus(self, drivePath):
         """Return status of CD tray, adapted from https://superuser.com/a/1367091/681049
@@ -111,43 +266,66 @@ class Disc:
         3 = reading tray
         4 = disk in tray
         """
-        fd = os.open(drivePath, os.O_RDONLY | os.O_NONBLOCK)
-        status = fcntl.ioctl(fd, 0x5326)
-        os.close(fd)
+        return devices.getTrayStatus(drivePath)
 
-        return status
+    def validate(self):
+        """Validate input, and return a ValidationResult. Doesn't change
+        the Disc instance, so it can run outside the GUI thread"""
 
-    def validateInput(self):
-        """Validate and pre-process input"""
+        result = ValidationResult()
+        result.dirOut = self.dirOut
 
         # Check if dirOut is a directory
-        self.dirOutIsDirectory = os.path.isdir(self.dirOut)
+        result.dirOutIsDirectory = os.path.isdir(self.dirOut)
 
         # Check if glob pattern for dirOut, prefix and extension matches existing files
         if glob.glob(self.dirOut + '/' + self.prefix + '*.' + self.extension):
-            self.outputExistsFlag = True
+            result.outputExistsFlag = True
 
         # Check if dirOut is writable
-        self.dirOutIsWritable = os.access(self.dirOut, os.W_OK | os.X_OK)
+        result.dirOutIsWritable = os.access(self.dirOut, os.W_OK | os.X_OK)
 
-        # Check if readom and ddrescue are installed
-
-        if which("readom") is not None:
-            self.readomInstalled = True
-        if which("ddrescue") is not None:
-            self.ddrescueInstalled = True
-
-        # Get readom and ddrescue version strings
-        self.readomVersion = wrappers.getVersion(['readom'])
-        self.ddRescueVersion = wrappers.getVersion(['ddrescue'])
+        # Check if readom and ddrescue are installed, and get their version
+        # strings (probed once, and then cached by the tool registry)
+        readom = tools.registry.get('readom')
+        ddrescue = tools.registry.get('ddrescue')
+        result.readomInstalled = readom.installed
+        result.ddrescueInstalled = ddrescue.installed
+        result.readomVersion = readom.version
+        result.ddRescueVersion = ddrescue.version
 
         # Check if selected block device exists
         p = pathlib.Path(self.omDevice)
-        self.deviceExistsFlag = p.is_block_device()
+        result.deviceExistsFlag = p.is_block_device()
+        fileDevice = self.allowFileDevice and p.is_file()
+        if fileDevice:
+            result.deviceExistsFlag = True
+
+        # Check if any additional rescue drives exist
+        for drive in self.rescueDrives:
+            p = pathlib.Path(drive)
+            if not (p.is_block_device() or (self.allowFileDevice and p.is_file())):
+                result.rescueDrivesExistFlag = False
 
         # Check if disc is in tray
-        if self.getTrayStatus(self.omDevice) == 4:
-            self.discInTrayFlag = True
+        if fileDevice:
+            result.discInTrayFlag = True
+        elif result.deviceExistsFlag:
+            try:
+                if self.getTrayStatus(self.omDevice) == 4:
+                    result.discInTrayFlag = True
+            except OSError:
+                result.discInTrayFlag = False
+
+        return result
+
+    def applyValidation(self, result):
+        """Copy the flags of a ValidationResult to this instance, and set
+        the output file names"""
+
+        self.validation = result
+        for item in validationItems:
+            setattr(self, item, getattr(result, item))
 
         # Image file
         self.imageFile = os.path.join(self.dirOut, self.prefix + '.' + self.extension)
@@ -155,90 +333,323 @@ class Disc:
         # Ddrescue map file
         self.mapFile = os.path.join(self.dirOut, self.prefix + '.map')
 
+        # Ddrescue progress time series
+        self.progressFile = os.path.join(self.dirOut, self.prefix + '.progress.csv')
+
+        # Chunk digests of the image
+        self.manifestFile = os.path.join(self.dirOut, self.prefix + '.chunks.json')
+
         # Log file
         self.logFile = os.path.join(self.dirOut, self.logFileName)
 
-    def processDisc(self):
-        """Process a disc"""
+    def validateInput(self):
+        """Validate and pre-process input"""
+        self.applyValidation(self.validate())
+
+    def getValidationErrors(self):
+        """Return list of error messages for any input that didn't pass
+        validation (empty if all input is valid). Call validateInput first"""
+        return self.validation.errors()
+
+    def prepareOutput(self, overwriteFlag):
+        """Remove results of any previous readom run before imaging (same rules
+        as the GUI, except that the GUI asks for confirmation). Returns False if
+        existing files would be overwritten and overwriteFlag is False"""
+
+        if self.outputExistsFlag and self.readMethod == 'readom':
+            if not overwriteFlag:
+                return False
+            # Delete old image file (and map file and chunk manifest, if they exist)
+            for fileName in [self.imageFile, self.mapFile, self.manifestFile]:
+                try:
+                    os.remove(fileName)
+                except OSError:
+                    pass
+        # If ddrescue or the native reader is used, delete old image file, but
+        # only if no map file can be found (which indicates readom output)
+        elif self.outputExistsFlag and self.readMethod in ['ddrescue', 'native']:
+            if not os.path.isfile(self.mapFile):
+                for fileName in [self.imageFile, self.manifestFile]:
+                    try:
+                        os.remove(fileName)
+                    except OSError:
+                        pass
+
+        return True
+
+    def needsRescueRetry(self):
+        """Returns True if a finished readom or native run failed, and autoRetry is set"""
+        if self.cancelToken is not None and self.cancelToken.isCancelled():
+            return False
+        return self.readMethod in ['readom', 'native'] and self.autoRetry \
+            and not self.interruptedFlag and not (self.successFlag and not self.readErrorFlag)
+
+    def prepareRescueRetry(self):
+        """Reset flags and switch to ddrescue, for retrying a failed readom or
+        native run (ddrescue continues from the mapfile of the native reader)"""
+        metrics.retryPasses.inc(kind='autoRetry')
+        self.readMethod = 'ddrescue'
+        self.successFlag = True
+        self.readErrorFlag = False
+        self.interruptedFlag = False
+        self.finishedFlag = False
+        self.validateInput()
+        self.prepareOutput(True)
+
+    def onProgress(self, event):
+        """Record ddrescue progress event, and pass it on to progressCallback"""
+        self.lastProgress = event
+        if event.phase is not None and event.phase not in self.rescuePhases:
+            self.rescuePhases.append(event.phase)
+        self.progressRecorder.add(event)
+        # Only re-parses the parts of the mapfile that ddrescue changed
+        self.rescueMap.update()
+        if self.progressCallback is not None:
+            self.progressCallback(event)
+
+    def runRescuePasses(self):
+        """Run ddrescue passes on omDevice and rescueDrives, moving the disc
+        from drive to drive. Returns command line of the last pass, and the
+        read error and interrupted flags"""
+        drives = [self.omDevice] + [drive for drive in self.rescueDrives
+                                    if drive != self.omDevice]
+        policy = self.rescuePolicy
+        if policy is None:
+            policy = rescue.PassPolicy(self.retries, [self.rescueDirectDiscMode])
+        orchestrator = rescue.RescueOrchestrator(self.imageFile, self.mapFile, drives, policy,
+                                                 self.swapCallback, self.onProgress,
+                                                 self.logger, self.cancelToken,
+                                                 self.rescueMap, self.progressLogInterval)
+        self.rescuePasses = orchestrator.run()
+        if not self.rescuePasses:
+            # Cancelled before the first pass
+            return '', True, True
+        lastPass = self.rescuePasses[-1]
+        # Also an error if a pass failed and left parts of the disc unread
+        readErrorFlag = lastPass['readErrorFlag'] or lastPass['rescuedFraction'] < 1
+        return lastPass['readCommandLine'], readErrorFlag, lastPass['interruptedFlag']
+
+    def addToCatalogue(self, metadata):
+        """Add job with metadata to the job catalogue. The metadata file
+        remains the primary record, so an error is logged, but the job still
+        counts as a success"""
+        # Imported here, as most setups don't use a catalogue
+        import sqlite3
+        from . import catalogue
+        try:
+            catalogue.Catalogue(self.catalogueFile, self.logger).addJob(metadata, self.dirOut)
+            self.logger.info('job added to catalogue ' + self.catalogueFile)
+        except (sqlite3.Error, OSError) as e:
+            self.logger.error('cannot add job to catalogue ' + self.catalogueFile + ': ' +
+                              str(e))
+
+    def startMetrics(self):
+        """Start exporting metrics, if metricsFile or metricsAddress is set"""
+        metrics.exporter.start(self.metricsFile, self.metricsAddress, self.logger)
+
+    def recordMetrics(self):
+        """Add outcome, throughput and phase durations of the last
+        processDisc call to the metrics, and update the metrics file"""
+        if self.interruptedFlag:
+            result = 'interrupted'
+        elif self.successFlag and not self.readErrorFlag:
+            result = 'success'
+        else:
+            result = 'errors'
+        metrics.discsProcessed.inc(method=self.readMethod, result=result)
+        phases = self.timing['phases']
+        for name, phase in phases.items():
+            metrics.phaseDuration.observe(phase['seconds'], phase=name)
+        readPhase = phases.get('read', {})
+        if readPhase.get('bytes'):
+            metrics.bytesImaged.inc(readPhase['bytes'], drive=self.omDevice,
+                                    method=self.readMethod)
+            metrics.readSeconds.inc(readPhase['seconds'], drive=self.omDevice)
+            if 'MBPerSecond' in readPhase:
+                metrics.driveThroughput.observe(readPhase['MBPerSecond'], drive=self.omDevice)
+        if len(self.rescuePasses) > 1:
+            metrics.retryPasses.inc(len(self.rescuePasses) - 1, kind='rescuePass')
+        metrics.exporter.update(self.logger)
+
+    def processDisc(self, cancelToken=None):
+        """Process a disc. Cancelling cancelToken (a wrappers.CancelToken
+        instance) interrupts readom, ddrescue or the native reader"""
+
+        if cancelToken is not None:
+            self.cancelToken = cancelToken
+        self.rescuePasses = []
+        self.rescuePhases = []
+        # Does nothing if the metrics are already exported
+        self.startMetrics()
 
         # Create dictionary for storing metadata (which are later written to file)
         metadata = {}
 
         # Write some general info to log file
-        logging.info('***************************')
-        logging.info('*** OMIMGR EXTRACTION LOG ***')
-        logging.info('***************************\n')
-        logging.info('*** USER INPUT ***')
-        logging.info('omimgrVersion: ' + config.version)
-        logging.info('dirOut: ' + self.dirOut)
-        logging.info('omDevice: ' + self.omDevice)
-        logging.info('readMethod: ' + self.readMethod)
-        logging.info('maxRetries: ' + str(self.retries))
-        logging.info('prefix: ' + self.prefix)
-        logging.info('extension: ' + self.extension)
-        logging.info('direct disc mode (ddrescue only): ' + str(self.rescueDirectDiscMode))
-        logging.info('automatically retry with ddrecue on readom failure: ' + str(self.autoRetry))
+        self.logger.info('***************************')
+        self.logger.info('*** OMIMGR EXTRACTION LOG ***')
+        self.logger.info('***************************\n')
+        self.logger.info('*** USER INPUT ***')
+        self.logger.info('omimgrVersion: ' + config.version)
+        self.logger.info('dirOut: ' + self.dirOut)
+        self.logger.info('omDevice: ' + self.omDevice)
+        self.logger.info('readMethod: ' + self.readMethod)
+        self.logger.info('maxRetries: ' + str(self.retries))
+        self.logger.info('prefix: ' + self.prefix)
+        self.logger.info('extension: ' + self.extension)
+        self.logger.info('direct disc mode (ddrescue and native only): ' + str(self.rescueDirectDiscMode))
+        self.logger.info('automatically retry with ddrecue on readom failure: ' + str(self.autoRetry))
+        self.logger.info('rescue drives: ' + ','.join(self.rescueDrives))
+        self.logger.info('pipelined hashing: ' + str(self.pipelineHashing))
+        self.logger.info('checksum algorithms: ' + ','.join(self.checksumAlgorithms))
+        self.logger.info('checksum workers: ' + str(self.checksumWorkers))
+        self.logger.info('chunk manifest: ' + str(self.chunkManifest))
 
         ## Acquisition start date/time
         acquisitionStart = shared.generateDateTime(self.timeZone)
 
+        # Duration of each phase, and optional profiling
+        profileFile = None
+        if self.profileDir:
+            profileFile = timing.profileFileName(self.profileDir, self.identifier)
+        timer = timing.PhaseTimer(profileFile, self.logger)
+
         # Unmount disc
+        timer.begin('umount')
         args = ['umount', self.omDevice]
-        wrappers.umount(args)
+        wrappers.umount(args, self.logger)
+
+        # ddrescue and the native reader continue from the mapfile of earlier
+        # runs, so only count the bytes this run rescues
+        rescuedBefore = 0
+        if self.readMethod in ["ddrescue", "native"]:
+            self.rescueMap = mapfile.RescueMap(self.mapFile)
+            self.rescueMap.update()
+            rescuedBefore = self.rescueMap.rescuedBytes()
+
+        # Start hashing the image while it is being written
+        # (the native reader hashes in-process)
+        timer.begin('read')
+        hasher = None
+        if self.pipelineHashing and self.readMethod != "native":
+            hasher = pipeline.startStreamHasher(self.imageFile, self.mapFile,
+                                                self.readMethod, self.checksumAlgorithms,
+                                                self.logger)
 
         if self.readMethod == "readom":
             args = ['readom']
             args.append('retries=' + str(self.retries))
             args.append('dev=' + self.omDevice)
             args.append('f=' + self.imageFile)
-            readCmdLine, readExitStatus, self.readErrorFlag, self.interruptedFlag = wrappers.readom(args)
+            readCmdLine, readExitStatus, self.readErrorFlag, self.interruptedFlag = \
+                wrappers.readom(args, self.logger, self.cancelToken)
         elif self.readMethod == "ddrescue":
-            args = ['ddrescue']
-            if self.rescueDirectDiscMode:
-                args.append('-d')
-            args.append('-b')
-            args.append('2048')
-            args.append('-r' + str(self.retries))
-            args.append('-v')
-            args.append(self.omDevice)
-            args.append(self.imageFile)
-            args.append(self.mapFile)
-            readCmdLine, readExitStatus, self.readErrorFlag, self.interruptedFlag = wrappers.ddrescue(args)
-
-        # Run isolyzer to verify if ISO is complete and extract volume identifier text string
-        try:
-            isolyzerResult = isolyzer.processImage(self.imageFile, 0)
-            # Isolyzer status
-            try:
-                if isolyzerResult.find('statusInfo/success').text == "True":
-                    self.isolyzerSuccess = True
-                else:
-                    self.isolyzerSuccess = False
-            except AttributeError:
-                self.isolyzerSuccess = False
-
-            # Is ISO image smaller than expected (if True, this indicates the image may be truncated)
-            try:
-                self.imageTruncated = isolyzerResult.find('tests/smallerThanExpected').text
-            except AttributeError:
-                self.imageTruncated = True
-
-        except IOError:
-            self.isolyzerSuccess = False
-            self.imageTruncated = True
-        
-        logging.info('isolyzerSuccess: ' + str(self.isolyzerSuccess))
-        logging.info('imageTruncated: ' + str(self.imageTruncated))
+            self.progressRecorder = progress.ProgressRecorder(self.progressFile)
+            if self.rescueDrives:
+                readCmdLine, self.readErrorFlag, self.interruptedFlag = self.runRescuePasses()
+            else:
+                args = wrappers.ddrescueArgs(self.omDevice, self.imageFile, self.mapFile,
+                                             self.retries, self.rescueDirectDiscMode)
+                readCmdLine, readExitStatus, self.readErrorFlag, self.interruptedFlag = \
+                    wrappers.ddrescue(args, self.onProgress, self.logger, self.cancelToken,
+                                      self.progressLogInterval)
+            self.progressRecorder.close()
+            self.logger.info('ddrescue progress events recorded: ' +
+                             str(self.progressRecorder.noRows))
+            self.rescueMap.update()
+            for key, value in self.rescueMap.summary().items():
+                self.logger.info('mapfile ' + key + ': ' + str(value))
+        elif self.readMethod == "native":
+            self.progressRecorder = progress.ProgressRecorder(self.progressFile)
+            reader = native.SectorReader(self.omDevice, self.imageFile, self.mapFile,
+                                         self.retries, self.rescueDirectDiscMode,
+                                         self.checksumAlgorithms,
+                                         progressCallback=self.onProgress,
+                                         logger=self.logger, cancelToken=self.cancelToken)
+            readExitStatus, self.readErrorFlag, self.interruptedFlag = reader.run()
+            # After run, so it shows if O_DIRECT was not available
+            readCmdLine = reader.commandLine()
+            self.progressRecorder.close()
+            self.rescueMap.update()
+            for key, value in self.rescueMap.summary().items():
+                self.logger.info('mapfile ' + key + ': ' + str(value))
+
+        if self.readMethod in ["ddrescue", "native"]:
+            timer.addBytes('read', self.rescueMap.rescuedBytes() - rescuedBefore)
+        elif os.path.isfile(self.imageFile):
+            timer.addBytes('read', os.path.getsize(self.imageFile))
+
+        # Collect digest from pipelined hasher (None if it cannot be used)
+        timer.begin('streamHash')
+        precomputed = {}
+        # Later ddrescue passes rewrite parts of the image, which invalidates
+        # the pipelined digest
+        imageDigests = pipeline.finishStreamHasher(hasher, self.readMethod,
+                                                    self.readErrorFlag or
+                                                    len(self.rescuePasses) > 1,
+                                                    self.rescuePhases, self.rescueMap,
+                                                    self.logger)
+        if self.readMethod == "native":
+            imageDigests = reader.digests
+        if imageDigests is not None:
+            precomputed[os.path.basename(self.imageFile)] = imageDigests
+
+        # Update chunk manifest; as long as the image has read errors (so more
+        # passes are likely), its Merkle root stands in for the full checksums
+        chunkManifest = None
+        deferImageChecksum = False
+        if self.chunkManifest and self.readMethod in ["ddrescue", "native"] \
+                and os.path.isfile(self.imageFile):
+            self.logger.info('*** Updating chunk manifest ***')
+            timer.begin('manifest')
+            chunkManifest = manifest.ChunkManifest(self.manifestFile, logger=self.logger)
+            noChunksHashed = chunkManifest.update(self.imageFile, self.rescueMap)
+            timer.addBytes('manifest', min(noChunksHashed * chunkManifest.chunkSize,
+                                           os.path.getsize(self.imageFile)))
+            self.logger.info('chunks hashed: ' + str(noChunksHashed) + ' of ' +
+                             str(len(chunkManifest.digests)))
+            self.logger.info('Merkle root: ' + chunkManifest.merkleRoot())
+            deferImageChecksum = self.readErrorFlag and not self.forceImageChecksum \
+                and imageDigests is None
+            if deferImageChecksum:
+                self.logger.info('image has read errors, full image checksums deferred')
+
+        # Validate image and compute any digests that are still missing, in one scan
+        self.logger.info('*** Validating image ***')
+        timer.begin('validate')
+        hashImage = imageDigests is None and not deferImageChecksum
+        scanDigests, self.isolyzerSuccess, self.imageTruncated = \
+            pipeline.scanImage(self.imageFile, self.checksumAlgorithms,
+                               hashImage=hashImage, logger=self.logger)
+        if scanDigests is not None:
+            precomputed[os.path.basename(self.imageFile)] = scanDigests
+            timer.addBytes('validate', os.path.getsize(self.imageFile))
+
+        self.logger.info('isolyzerSuccess: ' + str(self.isolyzerSuccess))
+        self.logger.info('imageTruncated: ' + str(self.imageTruncated))
         
         if self.readErrorFlag or self.interruptedFlag or self.imageTruncated or not self.isolyzerSuccess:
             self.successFlag = False
 
-        # Create checksum file
-        logging.info('*** Creating checksum file ***')
+        # Create checksum files
+        self.logger.info('*** Creating checksum files ***')
+        timer.begin('checksums')
         checksumFile = os.path.join(self.dirOut, self.checksumFileName)
-        writeFlag, checksums = shared.checksumDirectory(self.dirOut, self.extension, checksumFile)
+        skipFiles = []
+        if deferImageChecksum:
+            skipFiles.append(os.path.basename(self.imageFile))
+        writeFlag, checksums = shared.checksumDirectory(self.dirOut, self.extension, checksumFile,
+                                                        precomputed, self.checksumAlgorithms,
+                                                        self.checksumWorkers, self.logger,
+                                                        skipFiles)
+        if not writeFlag:
+            self.logger.error('error while writing checksum files')
+        for fName in checksums['sha512']:
+            if fName not in precomputed:
+                timer.addBytes('checksums', os.path.getsize(os.path.join(self.dirOut, fName)))
 
         # Acquisition end date/time
+        timer.begin('metadata')
         acquisitionEnd = shared.generateDateTime(self.timeZone)
 
         # Fill metadata dictionary
@@ -252,6 +663,8 @@ class Disc:
             metadata['readMethodVersion'] = self.readomVersion
         if self.readMethod == "ddrescue":
             metadata['readMethodVersion'] = self.ddRescueVersion
+        if self.readMethod == "native":
+            metadata['readMethodVersion'] = 'omimgr ' + config.version
         metadata['readCommandLine'] = readCmdLine
         metadata['maxRetries'] = self.retries
         metadata['rescueDirectDiscMode'] = self.rescueDirectDiscMode
@@ -264,31 +677,57 @@ class Disc:
         metadata['isolyzerSuccess'] = self.isolyzerSuccess
         metadata['imageTruncated'] = self.imageTruncated
         metadata['interruptedFlag'] = self.interruptedFlag
-        metadata['checksums'] = checksums
+        if self.readMethod in ["ddrescue", "native"]:
+            metadata['rescueMap'] = self.rescueMap.summary()
+        if self.rescuePasses:
+            metadata['rescuePasses'] = self.rescuePasses
+        if chunkManifest is not None:
+            metadata['chunkManifest'] = chunkManifest.summary()
+            metadata['imageChecksumDeferred'] = deferImageChecksum
+        metadata['checksums'] = checksums['sha512']
         metadata['checksumType'] = 'SHA-512'
+        metadata['digests'] = {}
+        for algorithm in self.checksumAlgorithms:
+            metadata['digests'][shared.checksumLabels[algorithm]] = checksums[algorithm]
+        # Phases up to here (writing the metadata file and ejecting the disc
+        # are only in the log)
+        metadata['timing'] = timer.summary()
 
         # Write metadata to file in json format
-        logging.info('*** Writing metadata file ***')
+        self.logger.info('*** Writing metadata file ***')
         metadataFile = os.path.join(self.dirOut, self.metadataFileName)
         try:
             with io.open(metadataFile, 'w', encoding='utf-8') as f:
                 json.dump(metadata, f, indent=4, sort_keys=True)
         except IOError:
             self.successFlag = False
-            logging.error('error while writing metadata file')
+            self.logger.error('error while writing metadata file')
 
-        logging.info('Success: ' + str(self.successFlag))
+        if self.catalogueFile:
+            self.addToCatalogue(metadata)
+
+        self.logger.info('Success: ' + str(self.successFlag))
 
         if self.successFlag:
-            wrappers.ejectDrive(self.omDevice)
-            logging.info('Disc processed without errors')
-            logging.info('Ejecting disc')
+            timer.begin('eject')
+            # After rescue passes on several drives, the disc is in the last one
+            discDrive = self.omDevice
+            if self.rescuePasses:
+                discDrive = self.rescuePasses[-1]['omDevice']
+            if not os.path.isfile(discDrive):
+                wrappers.ejectDrive(discDrive)
+            self.logger.info('Disc processed without errors')
+            self.logger.info('Ejecting disc')
         else:
-            logging.error('One or more errors occurred while processing disc, '
+            self.logger.error('One or more errors occurred while processing disc, '
                           'check log file for details')
 
-        # Set finishedFlag
-        self.finishedFlag = True
+        timer.finish()
+        timer.log()
+        self.timing = timer.summary()
+        self.recordMetrics()
 
-        # Wait 2 seconds to avoid race condition
-        time.sleep(2)
+        # Set finishedFlag, and notify whoever is waiting for this job
+        self.finishedFlag = True
+        if self.finishedCallback is not None:
+            self.finishedCallback(self)
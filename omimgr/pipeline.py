@@ -0,0 +1,306 @@
+#! /usr/bin/env python3
+"""Pipelined checksum generation: hash an image while readom / ddrescue
+are still writing it, and validate and hash a finished image in one scan
+"""
+
+import os
+import re
+import mmap
+import struct
+import threading
+from . import shared
+
+
+class StreamHasher(threading.Thread):
+    """Thread that follows an image file while it is being written, and
+    feeds every new block to the hasher. The digest is then available as soon
+    as the read engine has finished, without reading the image back from disk.
+
+    This only works if the file is written sequentially (which is the case for
+    readom, and for a fresh ddrescue run without any read errors). The caller
+    decides whether the result can be used with the isValid method.
+    """
+
+    def __init__(self, fileIn, algorithms, blocksize=2**20, pollInterval=0.25):
+        """initialise StreamHasher instance"""
+        threading.Thread.__init__(self, daemon=True)
+        self.fileIn = fileIn
+        self.blocksize = blocksize
+        self.pollInterval = pollInterval
+        self.bytesHashed = 0
+        self.m = shared.MultiHasher(algorithms)
+        # Set if the file was truncated or replaced while we were reading it
+        self.outOfOrder = False
+        self.stopEvent = threading.Event()
+
+    def run(self):
+        """Wait for file to appear, then hash it block by block while it grows"""
+
+        f = None
+        while f is None:
+            stopping = self.stopEvent.is_set()
+            try:
+                f = open(self.fileIn, "rb")
+            except FileNotFoundError:
+                if stopping:
+                    # Writer finished without ever creating the file
+                    return
+                self.stopEvent.wait(self.pollInterval)
+            except OSError:
+                self.outOfOrder = True
+                return
+
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            while True:
+                # Check the stop flag before reading, so that after the writer
+                # has finished we still drain everything up to end-of-file
+                stopping = self.stopEvent.is_set()
+                buf = f.read(self.blocksize)
+                if buf:
+                    self.m.update(buf)
+                    self.bytesHashed += len(buf)
+                    continue
+                try:
+                    st = os.stat(self.fileIn)
+                    if st.st_ino != inode or st.st_size < self.bytesHashed:
+                        self.outOfOrder = True
+                        break
+                except OSError:
+                    self.outOfOrder = True
+                    break
+                if stopping:
+                    break
+                self.stopEvent.wait(self.pollInterval)
+
+    def finish(self):
+        """Signal that the writer has finished, and wait until all remaining
+        data are hashed"""
+        self.stopEvent.set()
+        self.join()
+
+    def isValid(self):
+        """Returns True if the digest covers the complete file as it is on disk now"""
+        try:
+            fileSize = os.path.getsize(self.fileIn)
+        except OSError:
+            return False
+        return not self.outOfOrder and self.bytesHashed == fileSize
+
+    def hexdigests(self):
+        """Returns dictionary with hex digest for each algorithm"""
+        return self.m.hexdigests()
+
+
+def startStreamHasher(imageFile, mapFile, readMethod, algorithms, logger=None):
+    """Start a StreamHasher for imageFile if the file is going to be written
+    sequentially from scratch; returns None otherwise"""
+
+    logger = shared.getLogger(logger)
+
+    if os.path.exists(imageFile):
+        # Existing image: readom overwrites it in place, ddrescue fills in
+        # any gaps. Either way we cannot follow the writes.
+        logger.info('pipelined hashing not possible, image file already exists')
+        return None
+    if readMethod == "ddrescue" and os.path.exists(mapFile):
+        logger.info('pipelined hashing not possible, resuming from existing map file')
+        return None
+
+    hasher = StreamHasher(imageFile, algorithms)
+    hasher.start()
+    return hasher
+
+
+# Pass number in ddrescue's copying phase line
+copyingPass = re.compile(r'Pass (\d+)')
+
+
+def rewritingPhases(phases):
+    """Return the ddrescue phases (as named in its status blocks) that come
+    after the first copying pass, and may have rewritten parts of the image"""
+    rewriting = []
+    for phase in phases:
+        if phase.startswith(('Finished', 'Interrupted')):
+            continue
+        match = copyingPass.search(phase)
+        if phase.startswith('Copying') and (match is None or int(match.group(1)) == 1):
+            continue
+        rewriting.append(phase)
+    return rewriting
+
+
+def finishStreamHasher(hasher, readMethod, readErrorFlag, rescuePhases=None,
+                       rescueMap=None, logger=None):
+    """Stop hasher, and return its digests if they can be trusted, or None if a
+    post-hoc checksum is needed. For ddrescue, rescuePhases are the phases it
+    went through, and rescueMap is the mapfile.RescueMap of its mapfile"""
+
+    logger = shared.getLogger(logger)
+
+    if hasher is None:
+        return None
+
+    hasher.finish()
+    # This also stops the hasher's worker threads
+    digests = hasher.hexdigests()
+
+    # ddrescue only writes sequentially if no sectors were skipped on read errors
+    if readMethod == "ddrescue" and readErrorFlag:
+        logger.info('ddrescue reported read errors, falling back to post-hoc checksum')
+        return None
+    # ddrescue's error count can drop back to 0 once trimming or scraping
+    # recovers an area that was skipped (and hashed as zeros) while copying
+    rewriting = rewritingPhases(rescuePhases or [])
+    if readMethod == "ddrescue" and rewriting:
+        logger.info('ddrescue went beyond the first copying pass (' + '; '.join(rewriting) +
+                    '), falling back to post-hoc checksum')
+        return None
+    if readMethod == "ddrescue" and rescueMap is not None:
+        summary = rescueMap.summary()
+        unfinished = sum(summary[name] for name in ['nonTried', 'nonTrimmed',
+                                                    'nonScraped', 'badSector'])
+        if (rescueMap.currentPass or 1) > 1 or unfinished:
+            logger.info('mapfile shows more than one pass or unfinished areas, '
+                        'falling back to post-hoc checksum')
+            return None
+    if not hasher.isValid():
+        logger.info('image was not written sequentially, falling back to post-hoc checksum')
+        return None
+
+    logger.info('pipelined checksum covers ' + str(hasher.bytesHashed) + ' bytes')
+    return digests
+
+
+def parseISO9660(imageBytes, imageSize):
+    """Answer the isolyzer questions we use (success, smallerThanExpected) from
+    the ISO 9660 Primary Volume Descriptor. Returns None if the image contains
+    anything other than a plain ISO 9660 file system (UDF, HFS, High Sierra,
+    Apple partition map), in which case isolyzer must do the full analysis"""
+
+    sectorSize = 2048
+    vdStart = 16 * sectorSize
+
+    if imageSize < vdStart + 2 * sectorSize:
+        return None
+
+    # Same signature check as isolyzer
+    if imageBytes[vdStart + 1:vdStart + 6] != b'CD001' or \
+            imageBytes[vdStart + sectorSize + 1:vdStart + sectorSize + 6] != b'CD001':
+        return None
+
+    # Apple zero block, partition map, Master Directory Block or HFS Plus header
+    if imageBytes[0:2] == b'\x45\x52':
+        return None
+    for pmOffset in [512, 1024, 1536, 2048]:
+        if imageBytes[pmOffset:pmOffset + 2] == b'\x50\x4D':
+            return None
+    if imageBytes[1024:1026] in [b'\x42\x44', b'\xd2\xd7', b'\x48\x2B', b'\x48\x58']:
+        return None
+
+    # Walk the volume descriptor set until the terminator
+    volumeSpaceSize = None
+    logicalBlockSize = None
+    offset = vdStart
+    while offset + sectorSize <= imageSize:
+        vdType = imageBytes[offset]
+        vdIdentifier = imageBytes[offset + 1:offset + 6]
+        if vdIdentifier in [b'BEA01', b'NSR02', b'NSR03', b'TEA01']:
+            # UDF Volume Recognition Sequence
+            return None
+        if vdIdentifier != b'CD001':
+            break
+        # Like isolyzer, the last Primary Volume Descriptor wins
+        if vdType == 1:
+            volumeSpaceSize = struct.unpack('<I', imageBytes[offset + 80:offset + 84])[0]
+            logicalBlockSize = struct.unpack('<H', imageBytes[offset + 128:offset + 130])[0]
+        if vdType == 255:
+            break
+        offset += sectorSize
+
+    # Check the sector after the terminator as well, UDF bridge discs put their
+    # Volume Recognition Sequence there
+    if imageBytes[offset + sectorSize + 1:offset + sectorSize + 6] in \
+            [b'BEA01', b'NSR02', b'NSR03', b'TEA01']:
+        return None
+
+    if volumeSpaceSize is None:
+        return None
+
+    sizeExpected = volumeSpaceSize * logicalBlockSize
+    imageTruncated = imageSize < sizeExpected
+    return True, imageTruncated
+
+
+def runIsolyzer(imageFile):
+    """Run isolyzer on image, and return values of success and
+    smallerThanExpected fields"""
+    # Imported here, as most images are validated from their volume
+    # descriptors, and isolyzer (with ElementTree) is slow to import
+    from isolyzer import isolyzer
+    try:
+        isolyzerResult = isolyzer.processImage(imageFile, 0)
+        # Isolyzer status
+        try:
+            if str(isolyzerResult.find('statusInfo/success').text) == "True":
+                isolyzerSuccess = True
+            else:
+                isolyzerSuccess = False
+        except AttributeError:
+            isolyzerSuccess = False
+
+        # Is ISO image smaller than expected (if True, this indicates the image may be truncated)
+        try:
+            # As bool, like the result of parseISO9660. Depending on the isolyzer
+            # version the element holds a bool or the text 'True' / 'False'
+            imageTruncated = str(isolyzerResult.find('tests/smallerThanExpected').text) == "True"
+        except AttributeError:
+            imageTruncated = True
+
+    except IOError:
+        isolyzerSuccess = False
+        imageTruncated = True
+
+    return isolyzerSuccess, imageTruncated
+
+
+def scanImage(imageFile, algorithms, hashImage=True, blocksize=2**20, logger=None):
+    """Validate image and compute its digests in one scan of the memory-mapped
+    file. The structural checks come from the volume descriptors; isolyzer is
+    only run for images that are not plain ISO 9660. If hashImage is False
+    (because the digests were already computed while the image was written)
+    only the volume descriptors are read.
+    Returns digests (or None), isolyzerSuccess and imageTruncated"""
+
+    logger = shared.getLogger(logger)
+
+    digests = None
+    isoResult = None
+
+    try:
+        with open(imageFile, "rb") as f:
+            imageSize = os.fstat(f.fileno()).st_size
+            if imageSize == 0:
+                if hashImage:
+                    digests = shared.MultiHasher(algorithms).hexdigests()
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    isoResult = parseISO9660(mm, imageSize)
+                    if hashImage:
+                        if hasattr(mm, 'madvise'):
+                            mm.madvise(mmap.MADV_SEQUENTIAL)
+                        m = shared.MultiHasher(algorithms)
+                        for pos in range(0, imageSize, blocksize):
+                            m.update(mm[pos:pos + blocksize])
+                        digests = m.hexdigests()
+    except (IOError, ValueError):
+        digests = None
+
+    if isoResult is not None:
+        isolyzerSuccess, imageTruncated = isoResult
+        logger.info('image validated from ISO 9660 volume descriptors')
+    else:
+        isolyzerSuccess, imageTruncated = runIsolyzer(imageFile)
+        logger.info('image validated with isolyzer')
+
+    return digests, isolyzerSuccess, imageTruncated
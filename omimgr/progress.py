@@ -0,0 +1,202 @@
+#! /usr/bin/env python3
+"""Parsing of ddrescue status output into progress events, and recording of
+progress time series"""
+
+import io
+import os
+import re
+import csv
+import time
+
+# Multipliers for size units used by ddrescue (SI by default, binary
+# prefixes with --binary-prefixes)
+sizeUnits = {'B': 1,
+             'kB': 10**3, 'MB': 10**6, 'GB': 10**9, 'TB': 10**12, 'PB': 10**15,
+             'KiB': 2**10, 'MiB': 2**20, 'GiB': 2**30, 'TiB': 2**40, 'PiB': 2**50}
+
+durationUnits = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+
+
+def parseSize(valueString):
+    """Convert ddrescue size string (e.g. '121307 kB') to number of bytes;
+    returns None if string cannot be parsed"""
+    items = valueString.split()
+    try:
+        number = float(items[0])
+        if len(items) == 1:
+            return int(number)
+        unit = items[1]
+        if unit.endswith('/s'):
+            unit = unit[:-2]
+        return int(number * sizeUnits[unit])
+    except (IndexError, ValueError, KeyError):
+        return None
+
+
+def parseDuration(valueString):
+    """Convert ddrescue duration string (e.g. '1h 2m 3s', '23m', '10 s ago')
+    to number of seconds; returns None for 'n/a' or unparsable strings"""
+    matches = re.findall(r'(\d+(?:\.\d+)?)\s*([dhms])\b', valueString)
+    if not matches:
+        return None
+    seconds = 0
+    for number, unit in matches:
+        seconds += float(number) * durationUnits[unit]
+    return int(seconds)
+
+
+def parsePercentage(valueString):
+    """Convert percentage string (e.g. '2.61%') to float"""
+    try:
+        return float(valueString.strip().rstrip('%'))
+    except ValueError:
+        return None
+
+
+def parseCount(valueString):
+    """Convert count string (e.g. '3') to integer"""
+    try:
+        return int(valueString.strip())
+    except ValueError:
+        return None
+
+
+# ddrescue status item names (both 1.19 and 1.22+ style) mapped to
+# RescueProgress attributes and parser functions
+statusItems = {'ipos': ['ipos', parseSize],
+               'opos': ['opos', parseSize],
+               'non-tried': ['nonTried', parseSize],
+               'non-trimmed': ['nonTrimmed', parseSize],
+               'non-scraped': ['nonScraped', parseSize],
+               'bad-sector': ['badSector', parseSize],
+               'errsize': ['badSector', parseSize],
+               'rescued': ['rescued', parseSize],
+               'pct rescued': ['pctRescued', parsePercentage],
+               'bad areas': ['badAreas', parseCount],
+               'errors': ['readErrors', parseCount],
+               'read errors': ['readErrors', parseCount],
+               'current rate': ['currentRate', parseSize],
+               'average rate': ['averageRate', parseSize],
+               'error rate': ['errorRate', parseSize],
+               'run time': ['runTime', parseDuration],
+               'remaining time': ['remainingTime', parseDuration],
+               'time since last successful read': ['timeSinceLastRead', parseDuration],
+               'successful read': ['timeSinceLastRead', parseDuration]}
+
+
+class RescueProgress:
+    """One ddrescue status block. Sizes are in bytes, rates in bytes per
+    second and times in seconds; values ddrescue did not report are None"""
+
+    # Attributes in the order they are written to the time series
+    fields = ['timestamp', 'phase', 'ipos', 'opos', 'rescued', 'pctRescued',
+              'nonTried', 'nonTrimmed', 'nonScraped', 'badSector', 'badAreas',
+              'readErrors', 'currentRate', 'averageRate', 'errorRate', 'runTime',
+              'remainingTime', 'timeSinceLastRead']
+
+    def __init__(self):
+        """initialise RescueProgress instance"""
+        for field in self.fields:
+            setattr(self, field, None)
+        self.timestamp = round(time.time(), 1)
+
+    def eta(self):
+        """Estimated remaining time in seconds. Uses ddrescue's own estimate
+        if available, otherwise the amount that is not rescued yet and the
+        average rate"""
+        if self.remainingTime is not None:
+            return self.remainingTime
+        if self.rescued is None or not self.pctRescued or not self.averageRate:
+            return None
+        totalSize = self.rescued * 100 / self.pctRescued
+        return int((totalSize - self.rescued) / self.averageRate)
+
+    def asDict(self):
+        """Return all fields as a dictionary"""
+        return {field: getattr(self, field) for field in self.fields}
+
+
+class RescueStatusParser:
+    """Turns ddrescue output lines into RescueProgress events. A status
+    block ends with the line that reports the time since the last successful
+    read, at which point parseLine returns the completed event"""
+
+    phases = ('Copying', 'Trimming', 'Scraping', 'Retrying', 'Finished',
+              'Interrupted', 'Generating', 'Sweeping')
+
+    def __init__(self):
+        """initialise RescueStatusParser instance"""
+        self.current = RescueProgress()
+        self.phase = None
+        self.noEvents = 0
+
+    def isStatusLine(self, line):
+        """Returns True if line is part of a status block (including the
+        line that names the current phase)"""
+        tidy_line = line.strip()
+        if tidy_line.startswith(self.phases):
+            return True
+        key = tidy_line.split(',', 1)[0].split(':', 1)[0].strip()
+        return ':' in tidy_line and key in statusItems
+
+    def parseLine(self, line):
+        """Parse one line of ddrescue output; returns RescueProgress instance if
+        this line completed a status block, and None otherwise"""
+        tidy_line = line.strip()
+        if tidy_line.startswith(self.phases):
+            self.phase = tidy_line
+            return None
+
+        blockComplete = False
+        for item in tidy_line.split(','):
+            if ':' not in item:
+                continue
+            key, value = item.split(':', 1)
+            key = key.strip()
+            if key in statusItems:
+                attribute, parser = statusItems[key]
+                setattr(self.current, attribute, parser(value))
+                if key.endswith('successful read'):
+                    blockComplete = True
+
+        if not blockComplete:
+            return None
+
+        event = self.current
+        event.phase = self.phase
+        event.timestamp = round(time.time(), 1)
+        self.current = RescueProgress()
+        self.noEvents += 1
+        return event
+
+
+class ProgressRecorder:
+    """Writes progress events to a CSV file, one row per event. Rows are
+    appended, so additional ddrescue passes end up in the same file"""
+
+    def __init__(self, fileOut):
+        """initialise ProgressRecorder instance"""
+        self.fileOut = fileOut
+        self.f = None
+        self.writer = None
+        self.noRows = 0
+
+    def add(self, event):
+        """Append event to the time series"""
+        try:
+            if self.f is None:
+                writeHeader = not os.path.isfile(self.fileOut)
+                self.f = io.open(self.fileOut, 'a', encoding='utf-8', newline='')
+                self.writer = csv.writer(self.f)
+                if writeHeader:
+                    self.writer.writerow(RescueProgress.fields)
+            self.writer.writerow([getattr(event, field) for field in RescueProgress.fields])
+            self.noRows += 1
+        except IOError:
+            pass
+
+    def close(self):
+        """Close the time series file"""
+        if self.f is not None:
+            self.f.close()
+            self.f = None
@@ -0,0 +1,179 @@
+#! /usr/bin/env python3
+"""Successive ddrescue passes with several optical drives, against the same
+image and mapfile"""
+
+import os
+from . import wrappers
+from . import shared
+from . import mapfile
+
+
+class PassPolicy:
+    """Defines the ddrescue passes that RescueOrchestrator runs on each drive,
+    and when it gives up
+
+    retries: maximum number of retries (ddrescue -r) per pass
+    directDiscModes: list with the Direct Disc mode setting of each pass on
+        a drive, e.g. [False, True] for a normal pass followed by a direct one
+    minGain: a pass only counts as an improvement if it increases the rescued
+        fraction by more than this
+    patience: stop after this many consecutive passes without improvement
+        (default: number of passes per drive, so one drive that adds nothing)
+    maxPasses: maximum total number of passes (default: no limit)
+    """
+
+    def __init__(self, retries='4', directDiscModes=(False,), minGain=0.0,
+                 patience=None, maxPasses=None):
+        """initialise PassPolicy instance"""
+        self.retries = retries
+        self.directDiscModes = list(directDiscModes)
+        self.minGain = minGain
+        if patience is None:
+            patience = len(self.directDiscModes)
+        self.patience = patience
+        self.maxPasses = maxPasses
+
+    def passes(self, drives):
+        """Yield (drive, directDiscMode) for each pass, drive by drive"""
+        for drive in drives:
+            for directDiscMode in self.directDiscModes:
+                yield drive, directDiscMode
+
+
+class RescueOrchestrator:
+    """Runs ddrescue passes on a list of drives, and moves the disc to the next
+    drive after the passes on the current one are done. The disc starts in
+    the first drive. swapCallback(fromDrive, toDrive) is called after the
+    disc is ejected from fromDrive, and must return once the disc is in
+    toDrive (True), or if the operator wants to stop (False). Without a
+    swapCallback the disc is assumed to move by itself (e.g. an autoloader).
+
+    Stops when the policy says so, once the disc is fully rescued, if the
+    rescued fraction stops improving, or when cancelToken is cancelled.
+    """
+
+    def __init__(self, imageFile, mapFile, drives, policy, swapCallback=None,
+                 progressCallback=None, logger=None, cancelToken=None, rescueMap=None,
+                 logInterval=60.0):
+        """initialise RescueOrchestrator instance"""
+        self.imageFile = imageFile
+        self.mapFile = mapFile
+        self.drives = list(drives)
+        self.policy = policy
+        self.swapCallback = swapCallback
+        self.progressCallback = progressCallback
+        self.logger = shared.getLogger(logger)
+        self.cancelToken = cancelToken
+        if rescueMap is None:
+            rescueMap = mapfile.RescueMap(mapFile)
+        self.rescueMap = rescueMap
+        # Seconds between logged ddrescue status blocks
+        self.logInterval = logInterval
+        # One dictionary per pass
+        self.passes = []
+        self.stopReason = ''
+
+    def rescuedBytes(self):
+        """Number of bytes rescued so far, according to the mapfile"""
+        self.rescueMap.update()
+        return self.rescueMap.rescuedBytes()
+
+    def rescuedFraction(self, rescuedBytes):
+        """Rescued fraction of the disc"""
+        domainSize = self.rescueMap.domainEnd()
+        if domainSize == 0:
+            return 0.0
+        return rescuedBytes / domainSize
+
+    def isCancelled(self):
+        """Returns True if the job was cancelled"""
+        return self.cancelToken is not None and self.cancelToken.isCancelled()
+
+    def moveDisc(self, fromDrive, toDrive):
+        """Eject disc from fromDrive and have the operator put it in toDrive.
+        Returns False if the operator wants to stop"""
+        self.logger.info('*** Moving disc from ' + fromDrive + ' to ' + toDrive + ' ***')
+        if not os.path.isfile(fromDrive):
+            wrappers.ejectDrive(fromDrive)
+        if self.swapCallback is not None and not self.swapCallback(fromDrive, toDrive):
+            return False
+        wrappers.umount(['umount', toDrive], self.logger)
+        return True
+
+    def runPass(self, drive, directDiscMode):
+        """Run one ddrescue pass, and return dictionary that describes it"""
+        rescuedBefore = self.rescuedBytes()
+        args = wrappers.ddrescueArgs(drive, self.imageFile, self.mapFile,
+                                     self.policy.retries, directDiscMode)
+        self.logger.info('*** ddrescue pass ' + str(len(self.passes) + 1) + ' with ' +
+                         drive + ' ***')
+        cmdLine, exitStatus, readErrorFlag, interruptedFlag = \
+            wrappers.ddrescue(args, self.progressCallback, self.logger, self.cancelToken,
+                              self.logInterval)
+        rescuedAfter = self.rescuedBytes()
+
+        ddrescuePass = {'omDevice': drive,
+                        'directDiscMode': directDiscMode,
+                        'readCommandLine': cmdLine,
+                        'exitStatus': exitStatus,
+                        'readErrorFlag': readErrorFlag,
+                        'interruptedFlag': interruptedFlag,
+                        'rescuedBefore': rescuedBefore,
+                        'rescuedAfter': rescuedAfter,
+                        'bytesRecovered': rescuedAfter - rescuedBefore,
+                        'rescuedFraction': round(self.rescuedFraction(rescuedAfter), 6)}
+        self.passes.append(ddrescuePass)
+        self.logger.info('bytes recovered in this pass: ' + str(ddrescuePass['bytesRecovered']))
+        self.logger.info('rescued fraction: ' + str(ddrescuePass['rescuedFraction']))
+        return ddrescuePass
+
+    def run(self):
+        """Run passes until one of the stop conditions is met; returns list
+        with one dictionary per pass"""
+        self.passes = []
+        currentDrive = self.drives[0]
+        noStalled = 0
+        self.stopReason = 'all passes done'
+
+        for drive, directDiscMode in self.policy.passes(self.drives):
+            if self.policy.maxPasses is not None and len(self.passes) >= self.policy.maxPasses:
+                self.stopReason = 'maximum number of passes reached'
+                break
+            if self.isCancelled():
+                self.stopReason = 'interrupted'
+                break
+            if self.passes and self.passes[-1]['rescuedFraction'] >= 1:
+                self.stopReason = 'disc fully rescued'
+                break
+            if drive != currentDrive:
+                if not self.moveDisc(currentDrive, drive):
+                    self.stopReason = 'stopped by operator'
+                    break
+                currentDrive = drive
+
+            ddrescuePass = self.runPass(drive, directDiscMode)
+            if ddrescuePass['interruptedFlag']:
+                self.stopReason = 'interrupted'
+                break
+            gain = self.rescuedFraction(ddrescuePass['bytesRecovered'])
+            # The first pass starts from nothing, so it always counts
+            if len(self.passes) == 1 or gain > self.policy.minGain:
+                noStalled = 0
+            else:
+                noStalled += 1
+            if noStalled >= self.policy.patience:
+                self.stopReason = 'rescued fraction stopped improving'
+                break
+
+        self.logger.info('*** ddrescue passes finished: ' + self.stopReason + ' ***')
+        for drive, bytesRecovered in self.bytesPerDrive().items():
+            self.logger.info('bytes recovered with ' + drive + ': ' + str(bytesRecovered))
+        return self.passes
+
+    def bytesPerDrive(self):
+        """Return dictionary with number of bytes recovered by each drive that was used"""
+        bytesPerDrive = {}
+        for ddrescuePass in self.passes:
+            drive = ddrescuePass['omDevice']
+            bytesPerDrive[drive] = bytesPerDrive.get(drive, 0) + ddrescuePass['bytesRecovered']
+        return bytesPerDrive
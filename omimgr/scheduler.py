@@ -0,0 +1,287 @@
+#! /usr/bin/env python3
+"""Scheduler that images discs in several optical drives at the same time.
+Each drive gets its own worker thread, and each job its own output
+directory, log file and logger.
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from .om import Disc, jobItems
+from .wrappers import CancelToken
+from . import shared
+
+
+def jobLogger(loggerName, logFile):
+    """Return a logger that only writes to logFile (and not to the root
+    logger). The file is written by a separate thread"""
+    logger = logging.getLogger(loggerName)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(shared.queuedFileHandler(
+        logFile, logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')))
+    return logger
+
+
+def closeLogger(logger):
+    """Close and remove all handlers of logger"""
+    for handler in logger.handlers[:]:
+        handler.close()
+        logger.removeHandler(handler)
+
+
+class DriveWorker(threading.Thread):
+    """Worker thread that processes the jobs for one optical drive, one at a time"""
+
+    def __init__(self, omDevice, jobQueue, results, allowFileDevice=False,
+                 overwriteFlag=False, configFile=None, finishedCallback=None):
+        """initialise DriveWorker instance"""
+        threading.Thread.__init__(self, daemon=True)
+        self.omDevice = omDevice
+        self.jobQueue = jobQueue
+        self.results = results
+        # Called with the job once it is finished, before its result is added
+        self.finishedCallback = finishedCallback
+        self.allowFileDevice = allowFileDevice
+        self.overwriteFlag = overwriteFlag
+        self.configFile = configFile
+        self.loggerName = 'omimgr.drive.' + os.path.basename(omDevice)
+        self.busy = False
+
+    def run(self):
+        """Process jobs until None is received"""
+        while True:
+            item = self.jobQueue.get()
+            if item is None:
+                break
+            job, cancelToken = item
+            self.busy = True
+            result = self.runJob(job, cancelToken)
+            if self.finishedCallback is not None:
+                self.finishedCallback(job)
+            cancelToken.close()
+            self.results.append(result)
+            self.busy = False
+
+    def runJob(self, job, cancelToken):
+        """Process one job (dictionary with job items), and return dictionary
+        with the outcome. Cancelling cancelToken interrupts the job"""
+
+        result = {'omDevice': self.omDevice,
+                  'dirOut': job.get('dirOut', ''),
+                  'identifier': job.get('identifier', ''),
+                  'status': 'invalid',
+                  'errors': []}
+
+        if cancelToken.isCancelled():
+            result['status'] = 'cancelled'
+            return result
+
+        disc = Disc()
+        if self.configFile is not None:
+            disc.configFile = self.configFile
+        disc.getConfiguration()
+        if not disc.configSuccess:
+            result['errors'].append('error reading configuration file')
+            return result
+
+        # Defaults from configuration file, then job items
+        disc.readMethod = 'readom'
+        disc.retries = disc.retriesDefault
+        for item, value in job.items():
+            setattr(disc, item, value)
+        disc.omDevice = self.omDevice
+        disc.dirOut = os.path.abspath(disc.dirOut)
+        disc.allowFileDevice = self.allowFileDevice
+
+        disc.validateInput()
+        result['errors'] = disc.getValidationErrors()
+        if result['errors']:
+            return result
+        if not disc.prepareOutput(self.overwriteFlag):
+            result['errors'].append('existing files in ' + disc.dirOut)
+            return result
+
+        try:
+            disc.logger = jobLogger(self.loggerName, disc.logFile)
+        except OSError:
+            result['errors'].append('cannot write log file ' + disc.logFile)
+            return result
+
+        startTime = time.perf_counter()
+        try:
+            disc.processDisc(cancelToken)
+            if disc.needsRescueRetry():
+                disc.logger.info('*** Retrying with ddrescue ***')
+                disc.prepareRescueRetry()
+                disc.processDisc(cancelToken)
+        except Exception as e:
+            disc.logger.error(e, exc_info=True)
+            result['status'] = 'crashed'
+            result['errors'].append(str(e))
+            closeLogger(disc.logger)
+            return result
+        elapsed = time.perf_counter() - startTime
+        closeLogger(disc.logger)
+
+        try:
+            imageSize = os.path.getsize(disc.imageFile)
+        except OSError:
+            imageSize = 0
+
+        if disc.interruptedFlag:
+            result['status'] = 'cancelled'
+        elif disc.successFlag and not disc.readErrorFlag:
+            result['status'] = 'success'
+        else:
+            result['status'] = 'errors'
+        result['readMethod'] = disc.readMethod
+        result['interruptedFlag'] = disc.interruptedFlag
+        result['imageFile'] = disc.imageFile
+        result['imageSize'] = imageSize
+        result['elapsedSeconds'] = round(elapsed, 3)
+        if elapsed > 0:
+            result['MBPerSecond'] = round(imageSize / elapsed / 1e6, 3)
+        return result
+
+
+class Scheduler:
+    """Runs one DriveWorker per optical drive. Jobs are dictionaries with any
+    of the items in om.jobItems; jobs with an omDevice item go to that drive,
+    other jobs to the drive with the fewest queued jobs.
+
+    With an inventory (devices.DeviceInventory), drives that are plugged in
+    get a worker, and drives that are removed no longer get new jobs.
+    """
+
+    def __init__(self, devices=None, allowFileDevice=False, overwriteFlag=False,
+                 configFile=None, inventory=None):
+        """initialise Scheduler instance"""
+        if devices is None:
+            if inventory is not None:
+                devices = [device.path for device in inventory.devices(accessibleOnly=True)]
+            else:
+                devices = [device[0] for device in shared.getOpticalDevices()]
+        self.allowFileDevice = allowFileDevice
+        self.overwriteFlag = overwriteFlag
+        self.configFile = configFile
+        self.devices = []
+        self.results = []
+        self.queues = {}
+        self.workers = {}
+        self.started = False
+        # Protects devices, queues and workers, which inventory events change
+        self.lock = threading.Lock()
+        # Cancellation token of each job, by output directory
+        self.cancelTokens = {}
+        for device in devices:
+            self.addDevice(device)
+        self.inventory = inventory
+        if inventory is not None:
+            inventory.subscribe(self.onDeviceEvent)
+
+    def addDevice(self, device):
+        """Make device available for jobs, with a new worker if it has none"""
+        with self.lock:
+            if device in self.devices:
+                return
+            self.devices.append(device)
+            if device not in self.workers:
+                self.queues[device] = queue.Queue()
+                self.workers[device] = DriveWorker(device, self.queues[device], self.results,
+                                                   self.allowFileDevice, self.overwriteFlag,
+                                                   self.configFile, self.jobFinished)
+                if self.started:
+                    self.workers[device].start()
+
+    def removeDevice(self, device):
+        """Stop giving new jobs to device. Its worker keeps running, so any
+        jobs that are already queued finish (or fail) normally"""
+        with self.lock:
+            if device in self.devices:
+                self.devices.remove(device)
+
+    def onDeviceEvent(self, eventType, device):
+        """Called by the inventory when a drive is plugged in or removed"""
+        if eventType == 'remove' or (eventType == 'change' and not device.accessible):
+            self.removeDevice(device.path)
+        elif device.accessible:
+            self.addDevice(device.path)
+
+    def start(self):
+        """Start all workers"""
+        with self.lock:
+            self.started = True
+            for worker in self.workers.values():
+                worker.start()
+
+    def submit(self, job):
+        """Add job to the queue of a drive. Raises ValueError if the job is
+        invalid, or if its output directory is used by another job"""
+        for item in job:
+            if item not in jobItems:
+                raise ValueError('unknown job item ' + item)
+        if job.get('rescueDrives'):
+            raise ValueError('rescueDrives is not supported by the scheduler, '
+                             'as it uses drives of other workers')
+        if not job.get('dirOut'):
+            raise ValueError('job has no output directory')
+        dirOut = os.path.abspath(job['dirOut'])
+        with self.lock:
+            devices = list(self.devices)
+        if not devices:
+            raise ValueError('no optical devices available')
+
+        device = job.get('omDevice')
+        if device is None:
+            device = min(devices, key=self.queueLength)
+        elif device not in devices:
+            raise ValueError('unknown optical device ' + device)
+
+        with self.lock:
+            if dirOut in self.cancelTokens:
+                raise ValueError('output directory ' + dirOut + ' is used by another job')
+            cancelToken = CancelToken()
+            self.cancelTokens[dirOut] = cancelToken
+            self.queues[device].put((dict(job), cancelToken))
+        return device
+
+    def jobFinished(self, job):
+        """Called by a worker when job is finished; its output directory can
+        then be used by a new job"""
+        with self.lock:
+            self.cancelTokens.pop(os.path.abspath(job['dirOut']), None)
+
+    def cancel(self, dirOut):
+        """Cancel the job with output directory dirOut. A running job is
+        interrupted, a queued one is skipped. Other jobs are not affected"""
+        dirOut = os.path.abspath(dirOut)
+        cancelToken = self.cancelTokens.get(dirOut)
+        if cancelToken is None:
+            raise ValueError('no queued or running job with output directory ' + dirOut)
+        cancelToken.cancel()
+
+    def cancelAll(self):
+        """Cancel all queued and running jobs. Doesn't take the lock, as it
+        is called from signal handlers"""
+        for cancelToken in list(self.cancelTokens.values()):
+            cancelToken.cancel()
+
+    def queueLength(self, device):
+        """Number of jobs that are queued for or running on device"""
+        return self.queues[device].qsize() + int(self.workers[device].busy)
+
+    def join(self):
+        """Wait until all submitted jobs are finished, stop the workers and
+        return list with the outcome of each job"""
+        if self.inventory is not None:
+            self.inventory.unsubscribe(self.onDeviceEvent)
+        with self.lock:
+            for jobQueue in self.queues.values():
+                jobQueue.put(None)
+        for worker in list(self.workers.values()):
+            if worker.is_alive():
+                worker.join()
+        return self.results
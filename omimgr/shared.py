@@ -3,12 +3,23 @@
 
 import os
 import glob
+import time
 import hashlib
+import logging
+import logging.handlers
+import queue
+import threading
 import datetime
-import pytz
 import fcntl
 import struct
-from os.path import basename, dirname
+from functools import lru_cache
+
+# Supported checksum algorithms (hashlib names) and the labels used in the metadata
+checksumLabels = {'md5': 'MD5',
+                  'sha1': 'SHA-1',
+                  'sha256': 'SHA-256',
+                  'sha512': 'SHA-512',
+                  'blake2b': 'BLAKE2b'}
 
 def generate_file_sha512(fileIn):
     """Generate sha512 hash of file"""
@@ -27,39 +38,284 @@ def generate_file_sha512(fileIn):
     return m.hexdigest()
 
 
-def checksumDirectory(directory, extension, checksumFile):
-    """Calculate checksums for all files in directory"""
+def generate_file_digests(fileIn, algorithms):
+    """Generate digests of file for all algorithms in one read; returns
+    dictionary with hex digest for each algorithm"""
+
+    blocksize = 2**20
+    m = MultiHasher(algorithms)
+    with open(fileIn, "rb") as f:
+        while True:
+            buf = f.read(blocksize)
+            if not buf:
+                break
+            m.update(buf)
+    return m.hexdigests()
+
+
+def checksumSidecarName(checksumFile, algorithm):
+    """Return name of checksum file for algorithm. SHA-512 checksums go to
+    checksumFile itself, other algorithms to a file with the same base name
+    and the algorithm as extension (e.g. checksums.md5)"""
+    if algorithm == 'sha512':
+        return checksumFile
+    return os.path.splitext(checksumFile)[0] + '.' + algorithm
+
+
+def getLogger(logger):
+    """Return logger, or the root logger if logger is None"""
+    if logger is None:
+        return logging.getLogger()
+    return logger
+
+
+class BufferedFileHandler(logging.FileHandler):
+    """FileHandler that flushes the file at most once every flushInterval
+    seconds (and when it is closed), instead of after every record"""
+
+    def __init__(self, filename, flushInterval=1.0, encoding=None):
+        """initialise BufferedFileHandler instance"""
+        logging.FileHandler.__init__(self, filename, encoding=encoding)
+        self.flushInterval = flushInterval
+        self.lastFlush = time.monotonic()
+
+    def flush(self):
+        """Flush if flushInterval seconds passed since the last flush"""
+        now = time.monotonic()
+        if now - self.lastFlush >= self.flushInterval:
+            self.forceFlush()
+
+    def forceFlush(self):
+        """Flush now"""
+        logging.FileHandler.flush(self)
+        self.lastFlush = time.monotonic()
+
+    def close(self):
+        """Flush and close the file"""
+        if self.stream is not None:
+            self.forceFlush()
+        logging.FileHandler.close(self)
+
+
+class FlushingQueueListener(logging.handlers.QueueListener):
+    """QueueListener that also flushes its handlers if no record arrived for
+    flushInterval seconds, so buffered records don't wait for the next one"""
+
+    def __init__(self, logQueue, handlers, flushInterval=1.0):
+        """initialise FlushingQueueListener instance"""
+        logging.handlers.QueueListener.__init__(self, logQueue, *handlers,
+                                                respect_handler_level=True)
+        self.flushInterval = flushInterval
+
+    def dequeue(self, block):
+        """Return next record, flushing the handlers while waiting"""
+        while True:
+            try:
+                return self.queue.get(timeout=self.flushInterval)
+            except queue.Empty:
+                for handler in self.handlers:
+                    handler.flush()
+
+
+class QueuedLogHandler(logging.handlers.QueueHandler):
+    """Passes records to handlers (e.g. a BufferedFileHandler) through a queue
+    that is emptied by a dedicated writer thread, so that logging never waits
+    for file I/O. Closing it writes all queued records, and closes handlers"""
+
+    def __init__(self, handlers, flushInterval=1.0):
+        """initialise QueuedLogHandler instance"""
+        logging.handlers.QueueHandler.__init__(self, queue.Queue())
+        self.targets = list(handlers)
+        self.listener = FlushingQueueListener(self.queue, self.targets, flushInterval)
+        self.listener.start()
+
+    def close(self):
+        """Stop writer thread once all records are written, and close handlers"""
+        self.acquire()
+        try:
+            listener = self.listener
+            self.listener = None
+        finally:
+            self.release()
+        if listener is not None:
+            listener.stop()
+            for handler in self.targets:
+                handler.close()
+        logging.handlers.QueueHandler.close(self)
+
 
-    # All files in directory
-    allFiles = glob.glob(directory + "/*." + extension)
+def queuedFileHandler(logFile, formatter, otherHandlers=None, flushInterval=1.0):
+    """Return QueuedLogHandler that writes to logFile (with formatter), and
+    to any otherHandlers"""
+    fileHandler = BufferedFileHandler(logFile, flushInterval)
+    fileHandler.setFormatter(formatter)
+    return QueuedLogHandler([fileHandler] + list(otherHandlers or []), flushInterval)
+
+
+def hashFileTimed(fileIn, algorithms, logger=None):
+    """Generate digests of file, and log size and throughput. Returns
+    dictionary with hex digest for each algorithm"""
+    startTime = time.perf_counter()
+    digests = generate_file_digests(fileIn, algorithms)
+    elapsed = time.perf_counter() - startTime
+    noBytes = os.path.getsize(fileIn)
+    if elapsed > 0:
+        rate = sizeof_fmt(noBytes / elapsed) + '/s'
+    else:
+        rate = 'n/a'
+    getLogger(logger).info('hashed ' + os.path.basename(fileIn) + ' (' + sizeof_fmt(noBytes) +
+                 ') in ' + '%.2f' % elapsed + ' s, ' + rate)
+    return digests
+
+
+def checksumDirectory(directory, extension, checksumFile, precomputed=None,
+                      algorithms=None, workers=1, logger=None, skipFiles=None):
+    """Calculate checksums for all files in directory, and write one checksum
+    file for each algorithm. Files listed in precomputed (dictionary with
+    file names and digests for each algorithm) are not read again, and files
+    listed in skipFiles are left out. If workers is larger than 1, up to that
+    number of files are hashed concurrently.
+    Returns flag that indicates if checksum files were written, and
+    dictionary with file names and digests for each algorithm"""
+
+    if precomputed is None:
+        precomputed = {}
+    if algorithms is None:
+        algorithms = ['sha512']
+
+    # All files in directory, sorted so the order in the checksum file
+    # doesn't depend on the order in which hashing jobs finish
+    allFiles = sorted(glob.glob(directory + "/*." + extension))
+    if skipFiles:
+        allFiles = [f for f in allFiles if os.path.basename(f) not in skipFiles]
 
     # Dictionary for storing results
     checksums = {}
+    for algorithm in algorithms:
+        checksums[algorithm] = {}
 
+    # Digests for each file, and any missing algorithms that still need to be computed
+    fileDigests = {}
+    jobs = {}
     for thisFile in allFiles:
-        hashString = generate_file_sha512(thisFile)
         fName = os.path.basename(thisFile)
-        checksums[fName] = hashString
+        fileDigests[fName] = dict(precomputed.get(fName, {}))
+        missing = [a for a in algorithms if a not in fileDigests[fName]]
+        if missing:
+            jobs[thisFile] = missing
 
-    # Write checksum file
-    try:
-        fChecksum = open(checksumFile, "w", encoding="utf-8")
-        for fName in checksums:
-            lineOut = checksums[fName] + " " + fName + '\n'
-            fChecksum.write(lineOut)
-        fChecksum.close()
-        wroteChecksums = True
-    except IOError:
-        wroteChecksums = False
+    if workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for thisFile, missing in jobs.items():
+                futures[thisFile] = executor.submit(hashFileTimed, thisFile, missing, logger)
+            for thisFile, future in futures.items():
+                fileDigests[os.path.basename(thisFile)].update(future.result())
+    else:
+        for thisFile, missing in jobs.items():
+            fileDigests[os.path.basename(thisFile)].update(hashFileTimed(thisFile, missing, logger))
+
+    for thisFile in allFiles:
+        fName = os.path.basename(thisFile)
+        for algorithm in algorithms:
+            checksums[algorithm][fName] = fileDigests[fName][algorithm]
+
+    # Write checksum files
+    wroteChecksums = True
+    for algorithm in algorithms:
+        try:
+            fChecksum = open(checksumSidecarName(checksumFile, algorithm), "w", encoding="utf-8")
+            for fName in checksums[algorithm]:
+                lineOut = checksums[algorithm][fName] + " " + fName + '\n'
+                fChecksum.write(lineOut)
+            fChecksum.close()
+        except IOError:
+            wroteChecksums = False
 
     return wroteChecksums, checksums
 
+
+class MultiHasher:
+    """Feeds data blocks to several hashlib algorithms at once.
+
+    With more than one algorithm each one gets its own worker thread. Hashlib
+    releases the GIL while hashing large buffers, so the algorithms then run in
+    parallel, and the total time is close to that of the slowest one.
+    """
+
+    def __init__(self, algorithms):
+        """initialise MultiHasher instance"""
+        self.hashers = {}
+        for algorithm in algorithms:
+            self.hashers[algorithm] = hashlib.new(algorithm)
+        self.queues = []
+        self.threads = []
+        if len(self.hashers) > 1:
+            for algorithm in self.hashers:
+                # Bounded queue, so a slow algorithm cannot make us buffer the whole file
+                q = queue.Queue(maxsize=8)
+                t = threading.Thread(target=self._worker,
+                                     args=(self.hashers[algorithm], q),
+                                     daemon=True)
+                t.start()
+                self.queues.append(q)
+                self.threads.append(t)
+
+    @staticmethod
+    def _worker(m, q):
+        """Update hasher m with blocks from queue q until None is received"""
+        while True:
+            buf = q.get()
+            if buf is None:
+                break
+            m.update(buf)
+
+    def update(self, buf):
+        """Add block of data to all hashers"""
+        if self.queues:
+            for q in self.queues:
+                q.put(buf)
+        else:
+            for m in self.hashers.values():
+                m.update(buf)
+
+    def hexdigests(self):
+        """Finish all hashers, and return dictionary with hex digest for each algorithm"""
+        for q in self.queues:
+            q.put(None)
+        for t in self.threads:
+            t.join()
+        self.queues = []
+        self.threads = []
+        digests = {}
+        for algorithm, m in self.hashers.items():
+            digests[algorithm] = m.hexdigest()
+        return digests
+
+
+@lru_cache(maxsize=None)
+def getTimeZone(timeZone):
+    """Return tzinfo object for time zone name (looked up once per name).
+    Uses zoneinfo (Python 3.9+), and pytz for older versions"""
+    try:
+        from zoneinfo import ZoneInfo
+    except ImportError:
+        import pytz
+        return pytz.timezone(timeZone)
+    return ZoneInfo(timeZone)
+
+
 def generateDateTime(timeZone):
     """Generate date / time string in ISO format with added time zone info"""
 
     dateTime = datetime.datetime.now()
-    pst = pytz.timezone(timeZone)
-    dateTime = pst.localize(dateTime)
+    tz = getTimeZone(timeZone)
+    if hasattr(tz, 'localize'):
+        # pytz
+        dateTime = tz.localize(dateTime)
+    else:
+        dateTime = dateTime.replace(tzinfo=tz)
     dateTimeFormatted = dateTime.isoformat()
     return dateTimeFormatted
 
@@ -87,22 +343,14 @@ def getDeviceSize(devPath):
 
 def getOpticalDevices():
     """
-    Return information about optical devices
-    Source: adapted from https://codereview.stackexchange.com/a/152527
+    Return path and size of each optical device that the user can read. This
+    only reads sysfs (see devices.DeviceInventory), so it doesn't block on a
+    drive that is spinning up
     """
+    from .devices import DeviceInventory
 
-    deviceInfo = []
-
-    # Devices
-    drive_glob = '/sys/block/*/device'
-    for d in glob.glob(drive_glob):
-        deviceName = basename(dirname(d))
-        devicePath = '/dev/' + deviceName
-        if deviceName.startswith('sr'): 
-            try:
-                noBytes = getDeviceSize(devicePath)
-                deviceInfo.append([devicePath, sizeof_fmt(noBytes)])
-            except OSError:
-                pass
-
+    inventory = DeviceInventory()
+    deviceInfo = [[device.path, sizeof_fmt(device.size)]
+                  for device in inventory.devices(accessibleOnly=True)]
+    inventory.close()
     return deviceInfo
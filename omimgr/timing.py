@@ -0,0 +1,175 @@
+#! /usr/bin/env python3
+"""Per-phase timing of imaging jobs, with optional profiling"""
+
+import os
+import time
+import weakref
+import threading
+from . import shared
+
+# tracemalloc is process-wide, so memory use is only traced while one job is
+# profiled. Timers that profile and have not finished yet (the timer of a job
+# that crashed drops out once it is garbage collected), and the number of
+# profiling timers created so far
+profilingLock = threading.Lock()
+profilingTimers = weakref.WeakSet()
+noProfilingTimers = 0
+
+
+def addProfilingTimer(timer):
+    """Add timer to the profiling timers; returns True if it is the only one"""
+    global noProfilingTimers
+    with profilingLock:
+        profilingTimers.add(timer)
+        noProfilingTimers += 1
+        return len(profilingTimers) == 1
+
+
+def removeProfilingTimer(timer):
+    """Remove timer from the profiling timers"""
+    with profilingLock:
+        profilingTimers.discard(timer)
+
+
+def profilingState():
+    """Return number of unfinished profiling timers, and the number created
+    so far. If it is the same at the start and end of a phase, and the first
+    number is 1, no other job was profiled during the phase"""
+    with profilingLock:
+        return len(profilingTimers), noProfilingTimers
+
+
+class PhaseTimer:
+    """Records the duration (monotonic clock) of consecutive phases of a job,
+    and optionally the number of bytes each phase processed. begin() ends
+    the current phase and starts the next one.
+
+    If profileFile is set, the thread that uses the timer is profiled with
+    cProfile (the statistics go to profileFile when the timer is finished),
+    and tracemalloc records the peak memory use of each phase. tracemalloc
+    counts the memory of the whole process, so this is only done if no other
+    job is profiled at the same time; a phase during which another job was
+    profiled gets no peak.
+    """
+
+    def __init__(self, profileFile=None, logger=None):
+        """initialise PhaseTimer instance"""
+        self.logger = shared.getLogger(logger)
+        self.profileFile = profileFile
+        self.profiler = None
+        # Dictionary with seconds and bytes of each phase, in order
+        self.phases = {}
+        self.current = None
+        self.startTime = None
+        self.jobStartTime = time.perf_counter()
+        self.tracemalloc = None
+        self.startedTracing = False
+        # profilingState() when tracing started, and at the start of the phase
+        self.tracingState = None
+        self.phaseState = None
+        if profileFile is not None:
+            # Imported here, as profiling is rarely used
+            import cProfile
+            import tracemalloc
+            if addProfilingTimer(self):
+                self.tracemalloc = tracemalloc
+                self.startedTracing = not tracemalloc.is_tracing()
+                if self.startedTracing:
+                    tracemalloc.start()
+                self.tracingState = profilingState()
+            else:
+                self.logger.warning('not tracing memory use of job, another job is profiled')
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # Another profiler is active (e.g. that of another job)
+                self.logger.warning('cannot profile job, another profiler is active')
+                self.profiler = None
+
+    def begin(self, name):
+        """End the current phase (if any) and start phase name"""
+        self.end()
+        self.current = name
+        self.phases[name] = {'seconds': 0.0, 'bytes': None}
+        if self.tracemalloc is not None:
+            self.phaseState = profilingState()
+            if self.phaseState[0] == 1 and hasattr(self.tracemalloc, 'reset_peak'):
+                # Python 3.9+; no other job uses the peak
+                self.tracemalloc.reset_peak()
+        self.startTime = time.perf_counter()
+
+    def end(self):
+        """End the current phase"""
+        if self.current is None:
+            return
+        phase = self.phases[self.current]
+        phase['seconds'] = round(time.perf_counter() - self.startTime, 3)
+        if self.tracemalloc is not None and self.phaseState[0] == 1 and \
+                profilingState() == self.phaseState:
+            phase['peakMemoryBytes'] = self.tracemalloc.get_traced_memory()[1]
+        self.current = None
+
+    def addBytes(self, name, noBytes):
+        """Add noBytes to the number of bytes processed by phase name"""
+        phase = self.phases.setdefault(name, {'seconds': 0.0, 'bytes': None})
+        phase['bytes'] = (phase['bytes'] or 0) + noBytes
+
+    def summary(self):
+        """Return dictionary with seconds, bytes and MB/s of each finished
+        phase, and the total time so far"""
+        phases = {}
+        for name, phase in self.phases.items():
+            if name == self.current:
+                continue
+            phases[name] = dict(phase)
+            if phase['bytes'] is None:
+                del phases[name]['bytes']
+            elif phase['seconds'] > 0:
+                phases[name]['MBPerSecond'] = round(phase['bytes'] / phase['seconds'] / 1e6, 3)
+        return {'phases': phases,
+                'totalSeconds': round(time.perf_counter() - self.jobStartTime, 3)}
+
+    def log(self):
+        """Write summary to the log"""
+        summary = self.summary()
+        for name, phase in summary['phases'].items():
+            items = [key + ': ' + str(value) for key, value in phase.items()]
+            self.logger.info('phase ' + name + ': ' + ', '.join(items))
+        self.logger.info('total time (s): ' + str(summary['totalSeconds']))
+
+    def finish(self):
+        """End the current phase and, if profiling, write the profile and log
+        the top allocation sites"""
+        self.end()
+        if self.profileFile is None:
+            return
+        if self.profiler is not None:
+            self.profiler.disable()
+            try:
+                self.profiler.dump_stats(self.profileFile)
+                self.logger.info('profile written to ' + self.profileFile)
+            except OSError:
+                self.logger.warning('cannot write profile to ' + self.profileFile)
+            self.profiler = None
+        if self.tracemalloc is not None:
+            # Other jobs' allocations would show up too
+            if profilingState() == self.tracingState:
+                for stat in self.tracemalloc.take_snapshot().statistics('lineno')[:10]:
+                    self.logger.info('allocated: ' + str(stat))
+            if self.startedTracing:
+                self.tracemalloc.stop()
+            self.tracemalloc = None
+        removeProfilingTimer(self)
+
+
+def profileFileName(profileDir, identifier):
+    """Return name of profile file in profileDir for job identifier"""
+    name = (identifier or 'omimgr').replace(os.sep, '_') + '-' + time.strftime('%Y%m%dT%H%M%S')
+    profileFile = os.path.join(profileDir, name + '.pstats')
+    # Several jobs (or passes) can start within a second
+    counter = 1
+    while os.path.exists(profileFile):
+        counter += 1
+        profileFile = os.path.join(profileDir, name + '-' + str(counter) + '.pstats')
+    return profileFile
@@ -0,0 +1,95 @@
+#! /usr/bin/env python3
+"""Registry of the external tools omimgr depends on, which caches their
+location and version"""
+
+import os
+import re
+import threading
+from shutil import which
+from . import wrappers
+
+
+class Tool:
+    """Installed (or missing) external tool"""
+
+    def __init__(self, name, path=None, version='', fileKey=None):
+        """initialise Tool instance"""
+        self.name = name
+        # None if the tool is not installed
+        self.path = path
+        # Version string, as reported by '<name> --version'
+        self.version = version
+        # Version number as tuple of integers, e.g. (1, 22) for ddrescue 1.22;
+        # empty if it cannot be parsed
+        self.versionNumber = parseVersionNumber(version)
+        # (mtime, inode, size) of the binary when it was probed
+        self.fileKey = fileKey
+
+    @property
+    def installed(self):
+        """True if the tool was found on the PATH"""
+        return self.path is not None
+
+
+def parseVersionNumber(version):
+    """Return first dotted number in version string as tuple of integers"""
+    match = re.search(r'(\d+(?:\.\d+)+)', version)
+    if match is None:
+        return ()
+    return tuple(int(part) for part in match.group(1).split('.'))
+
+
+def fileKey(path):
+    """Return (mtime, inode, size) of path, or None if it cannot be read"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_ino, st.st_size
+
+
+class ToolRegistry:
+    """Probes each tool once (location with shutil.which, version with
+    '<name> --version'), and returns the cached result after that. A tool is
+    probed again if it is found at another location, or if the binary was
+    replaced (different mtime, inode or size), e.g. after an upgrade.
+    Thread-safe, so validation can run outside the GUI thread.
+    """
+
+    def __init__(self):
+        """initialise ToolRegistry instance"""
+        self.tools = {}
+        self.lock = threading.Lock()
+        self.noProbes = 0
+
+    def probe(self, name, path):
+        """Return Tool instance with the version of the binary at path"""
+        self.noProbes += 1
+        if path is None:
+            return Tool(name)
+        key = fileKey(path)
+        # getVersion looks for the tool name in the output
+        return Tool(name, path, wrappers.getVersion([name]), key)
+
+    def get(self, name):
+        """Return Tool instance for name"""
+        path = which(name)
+        with self.lock:
+            tool = self.tools.get(name)
+            if tool is None or tool.path != path or \
+                    (path is not None and tool.fileKey != fileKey(path)):
+                tool = self.probe(name, path)
+                self.tools[name] = tool
+            return tool
+
+    def invalidate(self, name=None):
+        """Forget cached result for name (all tools if name is None)"""
+        with self.lock:
+            if name is None:
+                self.tools.clear()
+            else:
+                self.tools.pop(name, None)
+
+
+# Shared by all Disc instances
+registry = ToolRegistry()
@@ -1,11 +1,16 @@
 #! /usr/bin/env python3
 """wrapper functions for readom and ddrescue"""
 
-import logging
+import os
+import re
 import time
 import signal
+import threading
+import selectors
 import subprocess as sub
-from . import config
+from . import metrics
+from . import progress
+from . import shared
 
 def getReadErrors(rescueLine):
     """parse ddrescue output line for values of readErrors"""
@@ -21,64 +26,377 @@ def getReadErrors(rescueLine):
     return readErrors
 
 
-def readom(args):
-    """readom wapper function"""
-
-    errorFlag = False
-    interruptedFlag = False
+class CancelToken:
+    """Cancellation token for one imaging job. cancel() can be called from any
+    thread or from a signal handler. The wrapper that runs the job's readom or
+    ddrescue process then interrupts it with SIGINT. If the process hasn't
+    exited after termTimeout seconds it gets SIGTERM, and after another
+    killTimeout seconds SIGKILL.
+
+    A pipe wakes up the OutputReader as soon as cancel() is called, so the
+    tool is interrupted right away, even if it doesn't print anything. Once
+    the token is closed, cancel() only sets the flag (the pipe's file
+    descriptors may have been reused by then).
+    """
+
+    def __init__(self, termTimeout=30, killTimeout=10):
+        """initialise CancelToken instance"""
+        self.termTimeout = termTimeout
+        self.killTimeout = killTimeout
+        self.cancelled = False
+        self.closed = False
+        # Re-entrant, as cancel() can run in a signal handler in the thread
+        # that is closing the token
+        self.lock = threading.RLock()
+        self.wakeupRead, self.wakeupWrite = os.pipe()
+        os.set_blocking(self.wakeupWrite, False)
+
+    def cancel(self):
+        """Request cancellation of the job"""
+        self.cancelled = True
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                os.write(self.wakeupWrite, b'x')
+            except OSError:
+                # Pipe full; the reader is woken up already
+                pass
+
+    def isCancelled(self):
+        """Returns True if cancellation was requested"""
+        return self.cancelled
+
+    def fileno(self):
+        """Read end of the wakeup pipe, becomes readable on cancel()"""
+        return self.wakeupRead
+
+    def close(self):
+        """Close the wakeup pipe"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            fds = [self.wakeupRead, self.wakeupWrite]
+            self.wakeupRead = None
+            self.wakeupWrite = None
+        for fd in fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class OutputReader:
+    """Drains stdout and stderr of a subprocess concurrently, and splits the
+    output into lines. Both newline and carriage return terminate a line; lines
+    that end with a carriage return are progress lines that the tool overwrites
+    in place. Each line is passed to the parser's processLine method.
+
+    Output is read in chunks with os.read as soon as a selector reports it
+    available, so neither pipe can fill up while we wait on the other one.
+    """
+
+    lineEnd = re.compile(b'[\r\n]')
+
+    def __init__(self, p, parser, chunkSize=65536, pollInterval=0.25):
+        """initialise OutputReader instance"""
+        self.p = p
+        self.parser = parser
+        self.chunkSize = chunkSize
+        self.pollInterval = pollInterval
+
+    def emit(self, rawLine, streamName, isProgress):
+        """Decode line, remove any cursor movement escape sequences, and pass
+        result to the parser"""
+        line = rawLine.decode('utf-8', errors='replace').replace("\x1b[A", "")
+        self.parser.processLine(line, streamName, isProgress)
+
+    def run(self):
+        """Read until both streams are closed"""
+        sel = selectors.DefaultSelector()
+        buffers = {}
+        if self.p.stdout is not None:
+            sel.register(self.p.stdout, selectors.EVENT_READ, 'stdout')
+            buffers['stdout'] = b''
+        if self.p.stderr is not None:
+            sel.register(self.p.stderr, selectors.EVENT_READ, 'stderr')
+            buffers['stderr'] = b''
+        cancelToken = self.parser.cancelToken
+        if cancelToken is not None and not cancelToken.isCancelled() \
+                and not cancelToken.closed:
+            sel.register(cancelToken, selectors.EVENT_READ, 'cancel')
+        noOpenStreams = len(buffers)
+
+        while noOpenStreams > 0:
+            for key, _ in sel.select(self.pollInterval):
+                streamName = key.data
+                if streamName == 'cancel':
+                    # Only needed once; parser.poll below does the rest
+                    sel.unregister(key.fileobj)
+                    continue
+                data = os.read(key.fileobj.fileno(), self.chunkSize)
+                if not data:
+                    # End of stream, flush anything that is left
+                    sel.unregister(key.fileobj)
+                    noOpenStreams -= 1
+                    if buffers[streamName]:
+                        self.emit(buffers[streamName], streamName, False)
+                        buffers[streamName] = b''
+                    continue
+
+                buf = buffers[streamName] + data
+                start = 0
+                for match in self.lineEnd.finditer(buf):
+                    self.emit(buf[start:match.start()], streamName, match.group() == b'\r')
+                    start = match.end()
+                buffers[streamName] = buf[start:]
+
+            # Allows the parser to react (e.g. to an interrupt) even if the tool
+            # doesn't produce any output
+            self.parser.poll(self.p)
+
+        sel.close()
+        self.parser.finish()
+
+
+class OutputParser:
+    """Base class for line parsers used with OutputReader. Newline-terminated
+    lines are logged directly; of any progress lines only the most recent one is
+    logged, once the tool moves on to a new line (or exits)."""
+
+    def __init__(self, cmdName, logger=None, cancelToken=None):
+        """initialise OutputParser instance"""
+        self.cmdName = cmdName
+        self.logger = shared.getLogger(logger)
+        self.cancelToken = cancelToken
+        self.errorFlag = False
+        self.interruptedFlag = False
+        self.pendingProgress = ''
+        # Signals that are sent, in this order, to a cancelled process
+        self.pendingSignals = [signal.SIGINT, signal.SIGTERM, signal.SIGKILL]
+        self.lastSignalTime = None
+
+    def processLine(self, line, streamName, isProgress):
+        """Process one line of output"""
+        tidy_line = line.strip('\r\n')
+        if tidy_line.strip() == "":
+            if not isProgress:
+                self.flushProgress()
+            return
+        self.parseLine(tidy_line, streamName)
+        if isProgress:
+            self.pendingProgress = tidy_line
+        else:
+            self.flushProgress()
+            self.logLine(tidy_line, streamName)
+
+    def flushProgress(self):
+        """Log most recent progress line, if any"""
+        if self.pendingProgress != '':
+            self.logger.info(self.pendingProgress)
+            self.pendingProgress = ''
+
+    def logLine(self, line, streamName):
+        """Send line to the logger"""
+        self.logger.info(line)
+
+    def parseLine(self, line, streamName):
+        """Tool-specific parsing of one line; overridden by subclasses"""
+
+    def poll(self, p):
+        """Called after every read cycle, and while waiting for the tool to
+        exit. If the job is cancelled, interrupts the tool with SIGINT, and
+        escalates to SIGTERM and SIGKILL if it doesn't exit in time"""
+        if self.cancelToken is None or not self.cancelToken.isCancelled():
+            return
+        if not self.pendingSignals or p.poll() is not None:
+            return
+
+        now = time.monotonic()
+        if self.lastSignalTime is None:
+            self.interruptedFlag = True
+            self.logger.warning('*** ' + self.cmdName + ' execution interrupted by user ***')
+        else:
+            if self.pendingSignals[0] == signal.SIGTERM:
+                timeout = self.cancelToken.termTimeout
+            else:
+                timeout = self.cancelToken.killTimeout
+            if now - self.lastSignalTime < timeout:
+                return
+            self.logger.warning(self.cmdName + ' did not exit, sending ' +
+                                self.pendingSignals[0].name)
+
+        p.send_signal(self.pendingSignals.pop(0))
+        self.lastSignalTime = now
+
+    def finish(self):
+        """Called after both output streams were closed"""
+        self.flushProgress()
+
+
+class ReadomParser(OutputParser):
+    """Parser for readom output"""
+
+    def parseLine(self, line, streamName):
+        """Scan output for any error references"""
+        if "error" in line.lower():
+            self.errorFlag = True
+
+
+class ProgressLogPolicy:
+    """Decides which ddrescue status blocks are logged. A block is logged if
+    it is the first one, if the phase, the number of read errors or the
+    number of bad areas changed since the last logged block (a transition),
+    or if at least interval seconds have passed since then. With interval 0
+    every block is logged. The last block is always logged, by finish"""
+
+    def __init__(self, interval=60.0):
+        """initialise ProgressLogPolicy instance"""
+        self.interval = interval
+        self.received = 0
+        self.logged = 0
+        self.lastState = None
+        self.lastTime = None
+        # Lines of the most recent block, if it wasn't logged
+        self.pendingLines = []
+
+    def offer(self, lines, event, now=None):
+        """Returns lines of status block (for event) if they must be logged,
+        and an empty list otherwise"""
+        if now is None:
+            now = time.monotonic()
+        self.received += 1
+        state = (event.phase, event.readErrors, event.badAreas)
+        if self.lastTime is None or state != self.lastState or \
+                now - self.lastTime >= self.interval:
+            self.lastState = state
+            self.lastTime = now
+            self.logged += 1
+            self.pendingLines = []
+            return lines
+        self.pendingLines = lines
+        return []
+
+    def finish(self):
+        """Returns lines of the last block if it wasn't logged yet"""
+        lines = self.pendingLines
+        if lines:
+            self.logged += 1
+        self.pendingLines = []
+        return lines
+
+
+class RescueParser(OutputParser):
+    """Parser for ddrescue output. Each completed status block is turned into
+    a progress.RescueProgress event, which is passed to progressCallback.
+    Status blocks are logged according to a ProgressLogPolicy with logInterval;
+    all other lines (including warnings and errors) are logged as usual. A
+    summary of the run is logged at the end"""
+
+    # Cursor movement sequences ddrescue uses to redraw its status block
+    escapeSequence = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+    def __init__(self, cmdName, progressCallback=None, logger=None, cancelToken=None,
+                 logInterval=60.0):
+        """initialise RescueParser instance"""
+        OutputParser.__init__(self, cmdName, logger, cancelToken)
+        self.readErrors = 0
+        self.progressCallback = progressCallback
+        self.statusParser = progress.RescueStatusParser()
+        self.logPolicy = ProgressLogPolicy(logInterval)
+        # Lines of the current status block, and the most recent event
+        self.blockLines = []
+        self.lastEvent = None
+        self.phases = []
+
+    def processLine(self, line, streamName, isProgress):
+        """Collect status block lines; other lines are processed as usual"""
+        tidy_line = self.escapeSequence.sub('', line.strip('\r\n'))
+        if streamName != 'stdout' or not self.statusParser.isStatusLine(tidy_line):
+            OutputParser.processLine(self, tidy_line, streamName, isProgress)
+            return
+        self.flushProgress()
+        self.blockLines.append(tidy_line)
+        self.parseLine(tidy_line, streamName)
+
+    def parseLine(self, line, streamName):
+        """Parse line for value of read errors and other status items"""
+        if "errors:" in line:
+            self.readErrors = getReadErrors(line)
+        if streamName == 'stdout':
+            event = self.statusParser.parseLine(line)
+            if event is not None:
+                self.onStatusBlock(event)
+
+    def onStatusBlock(self, event):
+        """Pass completed status block to progressCallback, and log it if the
+        log policy says so"""
+        self.lastEvent = event
+        if event.phase is not None and event.phase not in self.phases:
+            self.phases.append(event.phase)
+        for line in self.logPolicy.offer(self.blockLines, event):
+            self.logger.info(line)
+        self.blockLines = []
+        if self.progressCallback is not None:
+            self.progressCallback(event)
+
+    def logLine(self, line, streamName):
+        """ddrescue only writes error messages to stderr"""
+        if streamName == 'stderr':
+            self.logger.warning(line)
+        else:
+            self.logger.info(line)
+
+    def finish(self):
+        """Log last status block and summary, and set errorFlag from number
+        of read errors"""
+        OutputParser.finish(self)
+        for line in self.logPolicy.finish() + self.blockLines:
+            self.logger.info(line)
+        self.blockLines = []
+        self.logSummary()
+        metrics.readErrors.inc(self.readErrors, tool=self.cmdName)
+        if self.readErrors != 0:
+            self.errorFlag = True
+
+    def logSummary(self):
+        """Log number of status blocks (received and logged), the phases, and
+        the final status"""
+        self.logger.info(self.cmdName + ' status blocks: ' + str(self.logPolicy.received) +
+                         ', logged: ' + str(self.logPolicy.logged))
+        if self.phases:
+            self.logger.info(self.cmdName + ' phases: ' + '; '.join(self.phases))
+        event = self.lastEvent
+        if event is not None:
+            items = [('pct rescued', event.pctRescued), ('read errors', event.readErrors),
+                     ('bad areas', event.badAreas), ('run time (s)', event.runTime)]
+            self.logger.info(self.cmdName + ' final status: ' +
+                             ', '.join(name + ': ' + str(value) for name, value in items))
+
+
+def runTool(args, parser):
+    """Run readom or ddrescue, and process its output with parser"""
+
+    logger = parser.logger
+    startTime = time.monotonic()
 
     try:
-        p = sub.Popen(args, stdout=sub.PIPE, stderr=sub.PIPE,
-                      shell=False, bufsize=1, universal_newlines=True)
+        p = sub.Popen(args, stdout=sub.PIPE, stderr=sub.PIPE, shell=False)
 
         # Processing of output adapted from DDRescue-GUI by Hamish McIntyre-Bhatty:
         # https://git.launchpad.net/ddrescue-gui/tree/DDRescue_GUI.py
 
-        line = ""
-        char = " "
-
-        # Give readom plenty of time to start.
-        time.sleep(2)
-
-        # Grab information from readom. (After readom exits, attempt to keep reading chars until
-        # the last attempt gave an empty string)
-        while p.poll() is None or char != "":
-            char = p.stderr.read(1)
-            line += char
-
-            # If this is the end of the line, process it, and send the results to the logger
-            if char == "\n":
-                tidy_line = line.replace("\n", "").replace("\r", "").replace("\x1b[A", "")
-
-                if tidy_line != "":
-                    # Scan output for any error references
-                    if "error" in tidy_line.lower():
-                        errorFlag = True
-                    try:
-                        logging.info(tidy_line)
-                    except:
-                        raise
-                        # Handle unexpected errors.
-                        logging.warning("Error parsing readom output!")
-
-                # Reset line.
-                line = ""
-
-                # Interrupt readom if config.interruptFlag is True
-                if config.interruptFlag:
-                    interruptedFlag = True
-                    logging.warning('*** readom execution interrupted by user ***')
-                    p.send_signal(signal.SIGINT)
-                    # Reset interruptFlag to avoid the above commands to be issued numerous
-                    # times while waiting
-                    config.interruptFlag = False
-
-        # Parse any remaining lines afterwards.
-        if line != "":
-            tidy_line = line.replace("\n", "").replace("\r", "").replace("\x1b[A", "")
-            logging.info(tidy_line)
-
-        p.wait()
+        OutputReader(p, parser).run()
+
+        # Keep escalating a cancelled job if the tool closed its output but
+        # hasn't exited yet
+        while True:
+            try:
+                p.wait(timeout=0.25)
+                break
+            except sub.TimeoutExpired:
+                parser.poll(p)
         exitStatus = p.returncode
 
     except Exception:
@@ -89,110 +407,54 @@ def readom(args):
     # Logging
     cmdName = args[0]
     cmdLine = ' '.join(args)
-    logging.info('Command: ' + cmdLine)
+    metrics.toolRuns.inc(tool=cmdName, status=exitStatus)
+    metrics.toolDuration.observe(time.monotonic() - startTime, tool=cmdName)
+    logger.info('Command: ' + cmdLine)
 
     if exitStatus == 0:
-        logging.info(cmdName + ' status: ' + str(exitStatus))
-        logging.info(cmdName + ' errorFlag: ' + str(errorFlag))
+        logger.info(cmdName + ' status: ' + str(exitStatus))
+        logger.info(cmdName + ' errorFlag: ' + str(parser.errorFlag))
     else:
-        logging.error(cmdName + ' status: ' + str(exitStatus))
-        logging.info(cmdName + ' errorFlag: ' + str(errorFlag))
+        logger.error(cmdName + ' status: ' + str(exitStatus))
+        logger.info(cmdName + ' errorFlag: ' + str(parser.errorFlag))
 
-    return cmdLine, exitStatus, errorFlag, interruptedFlag
+    return cmdLine, exitStatus, parser.errorFlag, parser.interruptedFlag
 
 
-def ddrescue(args):
-    """ddrescue wapper function"""
+def readom(args, logger=None, cancelToken=None):
+    """readom wapper function. The process is interrupted once cancelToken
+    (a CancelToken instance) is cancelled"""
+    return runTool(args, ReadomParser(args[0], logger, cancelToken))
 
-    errorFlag = False
-    interruptedFlag = False
-    readErrors = 0
 
-    try:
-        p = sub.Popen(args, stdout=sub.PIPE, stderr=sub.PIPE,
-                      shell=False, bufsize=1, universal_newlines=True)
+def ddrescue(args, progressCallback=None, logger=None, cancelToken=None, logInterval=60.0):
+    """ddrescue wapper function. If progressCallback is set, it is called
+    with a progress.RescueProgress instance for every status update. Status
+    blocks are logged at transitions and every logInterval seconds (see
+    ProgressLogPolicy). The process is interrupted once cancelToken (a
+    CancelToken instance) is cancelled"""
+    return runTool(args, RescueParser(args[0], progressCallback, logger, cancelToken,
+                                      logInterval))
 
-        # Processing of output adapted from DDRescue-GUI by Hamish McIntyre-Bhatty:
-        # https://git.launchpad.net/ddrescue-gui/tree/DDRescue_GUI.py
-
-        line = ""
-        char = " "
-
-        # Give ddrescue plenty of time to start.
-        time.sleep(2)
-
-        # Grab information from ddrescue. (After ddrescue exits, attempt to keep reading chars until
-        # the last attempt gave an empty string)
-        while p.poll() is None or char != "":
-            char = p.stdout.read(1)
-            line += char
-
-            # If this is the end of the line, process it, and send the results to the logger
-            if char == "\n":
-                tidy_line = line.replace("\n", "").replace("\r", "").replace("\x1b[A", "")
-
-                if tidy_line != "":
-
-                    if "errors:" in tidy_line:
-                        # Parse this line for value of read errors
-                        readErrors = getReadErrors(tidy_line)
-                    try:
-                        logging.info(tidy_line)
-                    except:
-                        raise
-                        # Handle unexpected errors. Can happen once in normal operation on
-                        # ddrescue v1.22+
-                        logging.warning("Error parsing ddrescue output!")
-
-                # Reset line.
-                line = ""
-
-                # Interrupt ddrescue if config.interruptFlag is True
-                if config.interruptFlag:
-                    interruptedFlag = True
-                    logging.warning('*** ddrescue execution interrupted by user ***')
-                    p.send_signal(signal.SIGINT)
-                    # Reset interruptFlag to avoid the above commands to be issued numerous
-                    # times while waiting
-                    config.interruptFlag = False
-
-        # Parse any remaining lines afterwards.
-        if line != "":
-            tidy_line = line.replace("\n", "").replace("\r", "").replace("\x1b[A", "")
-            if "errors:" in tidy_line:
-                # Parse this line for value of read errors
-                readErrors = getReadErrors(tidy_line)
-
-            logging.info(tidy_line)
-
-        p.wait()
-        exitStatus = p.returncode
-
-    except Exception:
-        raise
-        # I don't even want to to start thinking how one might end up here ...
-        exitStatus = -99
-
-    if readErrors != 0:
-        errorFlag = True
-
-    # Logging
-    cmdName = args[0]
-    cmdLine = ' '.join(args)
-    logging.info('Command: ' + cmdLine)
-
-    if exitStatus == 0:
-        logging.info(cmdName + ' status: ' + str(exitStatus))
-        logging.info(cmdName + ' errorFlag: ' + str(errorFlag))
-    else:
-        logging.error(cmdName + ' status: ' + str(exitStatus))
-        logging.info(cmdName + ' errorFlag: ' + str(errorFlag))
 
-    return cmdLine, exitStatus, errorFlag, interruptedFlag
+def ddrescueArgs(omDevice, imageFile, mapFile, retries, directDiscMode=False):
+    """Return ddrescue command line as list"""
+    args = ['ddrescue']
+    if directDiscMode:
+        args.append('-d')
+    args.append('-b')
+    args.append('2048')
+    args.append('-r' + str(retries))
+    args.append('-v')
+    args.append(omDevice)
+    args.append(imageFile)
+    args.append(mapFile)
+    return args
 
 
-def umount(args):
+def umount(args, logger=None):
     """umount wapper function"""
+    logger = shared.getLogger(logger)
     try:
         p = sub.Popen(args, stdout=sub.PIPE, stderr=sub.PIPE, shell=False)
         output, errors = p.communicate()
@@ -212,13 +474,13 @@ def umount(args):
     # Logging
     cmdName = args[0]
     cmdLine = ' '.join(args)
-    logging.info('Command: ' + cmdLine)
+    logger.info('Command: ' + cmdLine)
 
     # Umount returns exit status 1 if device not mounted. This is no reason
     # for any concern, so don't report this as an error in the log.
-    logging.info(cmdName + ' status: ' + str(exitStatus))
-    logging.info(cmdName + ' stdout:\n' + outputAsString)
-    logging.info(cmdName + ' stderr:\n' + errorsAsString)
+    logger.info(cmdName + ' status: ' + str(exitStatus))
+    logger.info(cmdName + ' stdout:\n' + outputAsString)
+    logger.info(cmdName + ' stderr:\n' + errorsAsString)
 
     return cmdLine, exitStatus
 
@@ -228,6 +490,7 @@ def getVersion(args):
     args.append('--version')
 
     versionString = ''
+    outputList = []
 
     try:
         p = sub.Popen(args, stdout=sub.PIPE, stderr=sub.PIPE, shell=False)
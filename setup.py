@@ -25,7 +25,7 @@ def find_version(*file_paths):
 
 INSTALL_REQUIRES = [
     'setuptools',
-    'pytz',
+    'pytz; python_version < "3.9"',
     'tkfilebrowser',
     'isolyzer'
 ]
@@ -54,6 +54,8 @@ setup(name='omimgr',
           'omimgr = omimgr.omimgr:main'],
                     'console_scripts': [
                         'omimgr = omimgr.omimgr:main',
+                        'omimgr-cli = omimgr.cli:main',
+                        'omimgr-catalogue = omimgr.catalogue:main',
                         'omimgr-config = omimgr.configure:main']},
       classifiers=[
           'Programming Language :: Python :: 3',]
@@ -0,0 +1,27 @@
+"""pytest configuration: makes omimgr and the helpers in benchmarks/fakes.py
+importable, and provides the fixtures the tests share"""
+
+import os
+import sys
+import pytest
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repoDir)
+sys.path.insert(0, os.path.join(repoDir, 'benchmarks'))
+
+import fakes
+
+
+@pytest.fixture(scope='session', autouse=True)
+def stubs():
+    """Put the readom / ddrescue stand-ins in front of PATH"""
+    fakes.useStubs()
+
+
+@pytest.fixture
+def configFile(tmp_path):
+    """Return configuration file with the default settings"""
+    configFile = str(tmp_path / 'omimgr.json')
+    fakes.writeConfig(configFile)
+    return configFile
+
@@ -0,0 +1,124 @@
+"""Tests for omimgr.autoloader"""
+
+import os
+import json
+from omimgr.autoloader import Autoloader
+from omimgr.scheduler import Scheduler
+from omimgr import devices
+import fakes
+
+
+def imageChecksum(result):
+    """Return checksum of the image of result, from its metadata file"""
+    with open(os.path.join(result['dirOut'], 'metadata.json'), 'r', encoding='utf-8') as f:
+        metadata = json.load(f)
+    return metadata['checksums'][os.path.basename(result['imageFile'])]
+
+
+class Trays:
+    """Tray status of each drive, set by the test; None raises an OSError"""
+
+    def __init__(self, status):
+        """initialise Trays instance"""
+        self.status = dict(status)
+        self.polls = []
+
+    def trayStatus(self, drive):
+        """Tray status function for the autoloader"""
+        self.polls.append(drive)
+        if self.status[drive] is None:
+            raise OSError(5, 'Input/output error')
+        return self.status[drive]
+
+
+def makeAutoloader(tmp_path, configFile, status, identifiers=None):
+    """Return autoloader for a scheduler that is not started (so submitted
+    jobs stay queued), and its Trays"""
+    drives = list(status)
+    scheduler = Scheduler(drives, allowFileDevice=True, configFile=configFile)
+    trays = Trays(status)
+    autoloader = Autoloader(scheduler, str(tmp_path / 'out'), identifiers,
+                            {'readMethod': 'readom'}, pollInterval=1.0, maxInterval=8.0,
+                            trayStatus=trays.trayStatus)
+    return autoloader, trays
+
+
+def testJobsGetNextIdentifier(tmp_path, configFile):
+    autoloader, trays = makeAutoloader(tmp_path, configFile,
+                                       {'/dev/sr0': devices.CDS_DISC_OK,
+                                        '/dev/sr1': devices.CDS_DISC_OK},
+                                       ['a', 'b', 'c'])
+    # Discs that are loaded at the start get a job
+    assert autoloader.poll(now=0) == 2
+    jobs = [autoloader.scheduler.queues[drive].get_nowait()[0] for drive in trays.status]
+    assert [job['identifier'] for job in jobs] == ['a', 'b']
+    assert [job['dirOut'] for job in jobs] == [str(tmp_path / 'out' / identifier)
+                                               for identifier in ['a', 'b']]
+    assert not autoloader.isExhausted()
+
+
+def testDiscInTrayNotImagedTwice(tmp_path, configFile):
+    autoloader, trays = makeAutoloader(tmp_path, configFile,
+                                       {'/dev/sr0': devices.CDS_DISC_OK}, ['a', 'b'])
+    assert autoloader.poll(now=0) == 1
+    autoloader.scheduler.queues['/dev/sr0'].get_nowait()
+    # Same disc after the job, then a new one after the tray was opened
+    assert autoloader.poll(now=1) == 0
+    trays.status['/dev/sr0'] = devices.CDS_TRAY_OPEN
+    assert autoloader.poll(now=2) == 0
+    trays.status['/dev/sr0'] = devices.CDS_DRIVE_NOT_READY
+    assert autoloader.poll(now=3) == 0
+    trays.status['/dev/sr0'] = devices.CDS_DISC_OK
+    assert autoloader.poll(now=4) == 1
+    assert autoloader.isExhausted()
+
+
+def testBusyDriveNotPolled(tmp_path, configFile):
+    autoloader, trays = makeAutoloader(tmp_path, configFile,
+                                       {'/dev/sr0': devices.CDS_DISC_OK}, ['a', 'b'])
+    assert autoloader.poll(now=0) == 1
+    for now in range(1, 10):
+        autoloader.poll(now=now)
+    assert trays.polls == ['/dev/sr0']
+
+
+def testBackOffForDriveThatCannotBePolled(tmp_path, configFile):
+    autoloader, trays = makeAutoloader(tmp_path, configFile, {'/dev/sr0': None}, ['a'])
+    for now in range(40):
+        autoloader.poll(now=now)
+    # Interval doubles from 1 second, up to maxInterval
+    pollTimes = [0, 2, 6, 14, 22, 30, 38]
+    assert len(trays.polls) == len(pollTimes)
+    assert autoloader.intervals['/dev/sr0'] == 8.0
+
+    # Back to the normal interval once the drive answers
+    trays.status['/dev/sr0'] = devices.CDS_TRAY_OPEN
+    autoloader.poll(now=46)
+    assert autoloader.intervals['/dev/sr0'] == 1.0
+
+
+def testLoadedDiscsAreImaged(tmp_path, configFile):
+    drives = fakes.makeFakeDevices(tmp_path, 3, 2**20)
+    brokenDrive = drives.pop()
+    baseDir = tmp_path / 'out'
+    baseDir.mkdir()
+    scheduler = Scheduler(drives + [brokenDrive], allowFileDevice=True, configFile=configFile)
+    trays = fakes.FakeTrays(drives, scheduler, brokenDrive)
+    identifiers = ['disc%04d' % i for i in range(5)]
+    autoloader = Autoloader(scheduler, str(baseDir), identifiers, {'readMethod': 'ddrescue'},
+                            pollInterval=0.05, maxInterval=0.4, trayStatus=trays.trayStatus,
+                            startCallback=trays.onStart, finishCallback=trays.onFinish)
+    scheduler.start()
+    autoloader.start(stopWhenExhausted=True)
+    trays.loadDiscs(len(identifiers), 2**20, 0.1)
+    autoloader.thread.join(timeout=60)
+    results = scheduler.join()
+    autoloader.stop()
+
+    assert sorted(result['identifier'] for result in results) == identifiers
+    for result in results:
+        assert result['status'] == 'success', result['errors']
+        assert imageChecksum(result) == trays.jobDigests[result['identifier']]
+    assert trays.busyPolls == 0
+    brokenGaps = [b - a for a, b in zip(trays.brokenPolls, trays.brokenPolls[1:])]
+    assert brokenGaps and max(brokenGaps) >= 0.2
@@ -0,0 +1,233 @@
+"""Tests for omimgr.catalogue"""
+
+import os
+import sys
+import json
+import time
+import random
+import threading
+import subprocess
+import pytest
+from omimgr.catalogue import Catalogue, parseTimestamp, parseSince
+from omimgr.scheduler import Scheduler
+from omimgr import shared
+import fakes
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def importedTree(tmp_path_factory):
+    """Return (catalogue, jobs, rootDir) for a tree of synthetic jobs (jobs
+    is a list of (dirOut, metadata) tuples) that was imported into a new
+    catalogue"""
+    tempDir = tmp_path_factory.mktemp('catalogue')
+    rootDir = str(tempDir / 'images')
+    jobs = fakes.writeMetadataTree(rootDir, 600)
+    catalogue = Catalogue(str(tempDir / 'catalogue.sqlite'))
+    noImported, failed = catalogue.importTree(rootDir)
+    assert (noImported, failed) == (len(jobs), [])
+    return catalogue, jobs, rootDir
+
+
+def countJobs(catalogue):
+    """Return number of jobs in catalogue"""
+    return sum(row['jobs'] for row in catalogue.driveStatistics())
+
+
+def dirsOf(jobs):
+    """Return sorted output directories of jobs (dictionaries from findJobs)"""
+    return sorted(job['dirOut'] for job in jobs)
+
+
+def runTool(dbFile, *args):
+    """Run omimgr-catalogue with --db dbFile and args; returns exit status and
+    the JSON lines it printed"""
+    tool = subprocess.run([sys.executable, '-m', 'omimgr.catalogue', '--db', dbFile] +
+                          list(args), cwd=repoDir, stdout=subprocess.PIPE,
+                          universal_newlines=True)
+    return tool.returncode, [json.loads(line) for line in tool.stdout.splitlines()]
+
+
+def testImportAgainDoesNotDuplicate(importedTree):
+    catalogue, jobs, rootDir = importedTree
+    assert catalogue.importTree(rootDir) == (len(jobs), [])
+    assert countJobs(catalogue) == len(jobs)
+
+
+def testImportReportsBrokenMetadata(tmp_path):
+    for name, text in [('good', '{"identifier": "good"}'), ('broken', '{"identifier": '),
+                       ('list', '[]')]:
+        (tmp_path / 'tree' / name).mkdir(parents=True)
+        (tmp_path / 'tree' / name / 'metadata.json').write_text(text)
+    catalogue = Catalogue(str(tmp_path / 'catalogue.sqlite'))
+    noImported, failed = catalogue.importTree(str(tmp_path / 'tree'))
+    assert noImported == 1
+    assert sorted(os.path.basename(os.path.dirname(f)) for f in failed) == ['broken', 'list']
+
+
+def testAnswersMatchMetadata(importedTree):
+    catalogue, jobs, rootDir = importedTree
+    since = time.time() - 7 * 86400
+
+    identifier = 'disc%06d' % 300
+    assert dirsOf(catalogue.findJobs(identifier=identifier)) == \
+        [dirOut for dirOut, metadata in jobs if metadata['identifier'] == identifier]
+
+    # Any algorithm, any file, either case
+    for algorithm, fileName in [('MD5', 'disc.iso'), ('SHA-512', 'omimgr.log')]:
+        digest = jobs[200][1]['digests'][algorithm][fileName]
+        assert dirsOf(catalogue.findJobs(digest=digest.upper())) == [jobs[200][0]]
+
+    failedSince = sorted(dirOut for dirOut, metadata in jobs
+                         if not metadata['successFlag'] and
+                         parseTimestamp(metadata['acquisitionStart']) >= since)
+    assert failedSince
+    assert dirsOf(catalogue.findJobs(since=since, failed=True)) == failedSince
+    succeededBefore = sorted(dirOut for dirOut, metadata in jobs
+                             if metadata['successFlag'] and
+                             parseTimestamp(metadata['acquisitionStart']) < since)
+    assert dirsOf(catalogue.findJobs(until=since, failed=False)) == succeededBefore
+
+    throughput = {}
+    for dirOut, metadata in jobs:
+        throughput.setdefault(metadata['omDevice'], []).append(
+            metadata['timing']['phases']['read']['MBPerSecond'])
+    statistics = {row['omDevice']: row for row in catalogue.driveStatistics()}
+    assert sorted(statistics) == sorted(throughput)
+    for drive, values in throughput.items():
+        assert statistics[drive]['jobs'] == len(values)
+        assert statistics[drive]['averageMBPerSecond'] == \
+            pytest.approx(sum(values) / len(values), abs=1e-3)
+
+
+def testFindJobsNewestFirstWithLimit(importedTree):
+    catalogue, jobs, rootDir = importedTree
+    found = catalogue.findJobs(omDevice='/dev/sr1', limit=5)
+    assert len(found) == 5
+    assert all(job['omDevice'] == '/dev/sr1' for job in found)
+    startTimes = [job['startTime'] for job in catalogue.findJobs(omDevice='/dev/sr1')]
+    assert startTimes == sorted(startTimes, reverse=True)
+    assert [job['startTime'] for job in found] == startTimes[:5]
+
+
+def testLatestMetadata(tmp_path):
+    catalogue = Catalogue(str(tmp_path / 'catalogue.sqlite'))
+    rng = random.Random(3)
+    metadata = fakes.syntheticMetadata(rng, 1, time.time())
+    catalogue.addJob(dict(metadata, acquisitionStart='2026-10-01T10:00:00+02:00'),
+                     str(tmp_path / 'first'))
+    catalogue.addJob(dict(metadata, acquisitionStart='2026-10-02T10:00:00+02:00',
+                          notes='second run'), str(tmp_path / 'second'))
+    catalogue.addJob(dict(metadata, acquisitionStart='2026-09-30T10:00:00+02:00'),
+                     str(tmp_path / 'older'))
+
+    latest, dirOut = catalogue.latestMetadata(metadata['identifier'])
+    assert dirOut == str(tmp_path / 'second')
+    assert latest['notes'] == 'second run'
+    assert catalogue.latestMetadata('unknown') == (None, None)
+
+
+def testMetadataOfOlderVersions(tmp_path):
+    # No timing, digests or rescueMap sections, only SHA-512 checksums
+    dirOut = tmp_path / 'old'
+    dirOut.mkdir()
+    (dirOut / 'disc.iso').write_bytes(b'\0' * 4096)
+    metadata = {'identifier': 'old', 'omDevice': '/dev/sr0', 'readMethod': 'readom',
+                'prefix': 'disc', 'extension': 'iso',
+                'acquisitionStart': '2020-01-01T10:00:00+01:00', 'successFlag': True,
+                'omimgrVersion': '0.2.0', 'checksums': {'disc.iso': 'AB' * 64}}
+    catalogue = Catalogue(str(tmp_path / 'catalogue.sqlite'))
+    jobId = catalogue.addJob(metadata, str(dirOut))
+
+    job = catalogue.findJobs(identifier='old')[0]
+    assert job['imageSize'] == 4096
+    assert job['readSeconds'] is None and job['MBPerSecond'] is None
+    assert catalogue.checksums(jobId) == [('disc.iso', 'SHA-512', 'ab' * 64)]
+    assert dirsOf(catalogue.findJobs(digest='ab' * 64)) == [str(dirOut)]
+    assert catalogue.driveStatistics() == [{'omDevice': '/dev/sr0', 'jobs': 1, 'failedJobs': 0,
+                                            'bytesImaged': 4096,
+                                            'averageMBPerSecond': None}]
+
+
+def testConcurrentAdds(tmp_path):
+    dbFile = str(tmp_path / 'catalogue.sqlite')
+    Catalogue(dbFile)
+    errors = []
+
+    def addJobs(threadNo):
+        rng = random.Random(threadNo)
+        threadCatalogue = Catalogue(dbFile)
+        for i in range(25):
+            number = threadNo * 1000 + i
+            try:
+                threadCatalogue.addJob(fakes.syntheticMetadata(rng, number, time.time()),
+                                       str(tmp_path / str(number)))
+            except Exception as e:
+                errors.append(str(e))
+
+    threads = [threading.Thread(target=addJobs, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert countJobs(Catalogue(dbFile)) == 100
+
+
+def testProcessDiscAddsJobs(tmp_path):
+    dbFile = str(tmp_path / 'catalogue.sqlite')
+    configFile = str(tmp_path / 'omimgr.json')
+    fakes.writeConfig(configFile, catalogueFile=dbFile)
+    drives = fakes.makeFakeDevices(tmp_path, 2, 2**20)
+    scheduler = Scheduler(drives, allowFileDevice=True, configFile=configFile)
+    scheduler.start()
+    for i, drive in enumerate(drives):
+        dirOut = tmp_path / ('job' + str(i))
+        dirOut.mkdir()
+        scheduler.submit({'omDevice': drive, 'readMethod': 'ddrescue', 'dirOut': str(dirOut),
+                          'identifier': 'run' + str(i)})
+    results = scheduler.join()
+
+    catalogue = Catalogue(dbFile)
+    for result in results:
+        assert result['status'] == 'success', result['errors']
+        metadata, dirOut = catalogue.latestMetadata(result['identifier'])
+        assert dirOut == result['dirOut']
+        assert metadata['omDevice'] == result['omDevice']
+        imageDigest = shared.generate_file_sha512(result['imageFile'])
+        assert dirsOf(catalogue.findJobs(digest=imageDigest)) == [dirOut]
+
+
+def testCommandLine(importedTree, tmp_path):
+    catalogue, jobs, rootDir = importedTree
+    dbFile = catalogue.dbFile
+
+    status, rows = runTool(dbFile, 'find', '--identifier', 'disc000042', '--checksums',
+                           '--json')
+    assert status == 0
+    assert [row['dirOut'] for row in rows] == [jobs[42][0]]
+    assert {(c['fileName'], c['algorithm'], c['digest']) for c in rows[0]['checksums']} == \
+        {(fileName, algorithm, digest)
+         for algorithm, fileDigests in jobs[42][1]['digests'].items()
+         for fileName, digest in fileDigests.items()}
+
+    digest = jobs[7][1]['digests']['MD5']['disc.iso']
+    status, rows = runTool(dbFile, 'find', '--checksum', digest, '--json')
+    assert [row['dirOut'] for row in rows] == [jobs[7][0]]
+
+    status, rows = runTool(dbFile, 'find', '--since', '7d', '--failed', '--json')
+    since = parseSince('7d')
+    expected = sorted(dirOut for dirOut, metadata in jobs if not metadata['successFlag'] and
+                      parseTimestamp(metadata['acquisitionStart']) >= since)
+    assert sorted(row['dirOut'] for row in rows) == expected
+
+    status, rows = runTool(dbFile, 'drives', '--json')
+    assert sum(row['jobs'] for row in rows) == len(jobs)
+
+    # Import into a new catalogue, and a date that cannot be parsed
+    newDb = str(tmp_path / 'new.sqlite')
+    status, rows = runTool(newDb, 'import', rootDir)
+    assert (status, rows[0]['imported'], rows[0]['failed']) == (0, len(jobs), [])
+    status, rows = runTool(newDb, 'find', '--since', 'yesterday')
+    assert status == 2
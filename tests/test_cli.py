@@ -0,0 +1,55 @@
+"""Tests for omimgr.cli: reading job files"""
+
+import json
+import pytest
+from omimgr import cli
+
+
+def writeJobFile(tmp_path, jobDict):
+    """Write jobDict to a job file; returns its name"""
+    jobFile = str(tmp_path / 'job.json')
+    with open(jobFile, 'w', encoding='utf-8') as f:
+        json.dump(jobDict, f)
+    return jobFile
+
+
+def testValidJobFile(tmp_path):
+    jobDict = {'omDevice': '/dev/sr0', 'dirOut': '/data/disc0001', 'readMethod': 'native',
+               'retries': 2, 'identifier': 'disc0001', 'rescueDirectDiscMode': True,
+               'autoRetry': False, 'rescueDrives': ['/dev/sr1', '/dev/sr2']}
+    assert cli.readJobFile(writeJobFile(tmp_path, jobDict)) == jobDict
+
+    # Retries as a string, and drives as a comma-separated string
+    jobDict = cli.readJobFile(writeJobFile(tmp_path, {'retries': '3',
+                                                      'rescueDrives': '/dev/sr1,/dev/sr2'}))
+    assert jobDict == {'retries': 3, 'rescueDrives': '/dev/sr1,/dev/sr2'}
+
+
+@pytest.mark.parametrize('item, value, expected', [
+    ('rescueDirectDiscMode', 'false', 'true or false'),
+    ('autoRetry', 1, 'true or false'),
+    ('autoRetry', None, 'true or false'),
+    ('retries', 'four', 'an integer'),
+    ('retries', 2.5, 'an integer'),
+    ('retries', True, 'an integer'),
+    ('rescueDrives', ['/dev/sr1', 2], 'a list of drives'),
+    ('rescueDrives', {'drive': '/dev/sr1'}, 'a list of drives'),
+    ('omDevice', ['/dev/sr0'], 'a string'),
+    ('identifier', 1234, 'a string')])
+def testWrongTypeRejected(tmp_path, capsys, item, value, expected):
+    jobFile = writeJobFile(tmp_path, {'omDevice': '/dev/sr0', item: value})
+    with pytest.raises(SystemExit) as excinfo:
+        cli.readJobFile(jobFile)
+    assert excinfo.value.code == cli.EXIT_INVALID_INPUT
+    assert capsys.readouterr().err == \
+        'ERROR: item ' + item + ' in job file ' + jobFile + ' must be ' + expected + '\n'
+
+
+@pytest.mark.parametrize('contents', ['{"unknownItem": 1}', '[]', '{"omDevice": '])
+def testInvalidJobFile(tmp_path, contents):
+    jobFile = str(tmp_path / 'job.json')
+    with open(jobFile, 'w', encoding='utf-8') as f:
+        f.write(contents)
+    with pytest.raises(SystemExit) as excinfo:
+        cli.readJobFile(jobFile)
+    assert excinfo.value.code == cli.EXIT_INVALID_INPUT
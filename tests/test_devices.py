@@ -0,0 +1,79 @@
+"""Tests for omimgr.devices"""
+
+import os
+import queue
+import pytest
+from omimgr.devices import DeviceInventory
+from omimgr.scheduler import Scheduler
+import fakes
+
+
+@pytest.fixture
+def fakeTree(tmp_path):
+    """Return (sysRoot, devRoot) of a fake sysfs tree with two optical drives
+    (sr1 has a disc) and block devices that are not optical drives"""
+    sysRoot = str(tmp_path / 'sys')
+    devRoot = str(tmp_path / 'dev')
+    for i in range(2):
+        fakes.addFakeDrive(sysRoot, devRoot, 'sr' + str(i), size=i * 2**20)
+    for name in ['sda', 'nvme0n1', 'loop0']:
+        os.makedirs(os.path.join(sysRoot, 'block', name, 'device'))
+    return sysRoot, devRoot
+
+
+def nextEvent(events, timeout=5.0):
+    """Return (eventType, device name) of next event"""
+    try:
+        eventType, device = events.get(timeout=timeout)
+    except queue.Empty:
+        pytest.fail('no event within ' + str(timeout) + ' seconds')
+    return eventType, device.name
+
+
+def testInventoryListsOpticalDrivesOnly(fakeTree):
+    inventory = DeviceInventory(*fakeTree)
+    devices = inventory.devices()
+
+    assert [device.name for device in devices] == ['sr0', 'sr1']
+    assert [device.size for device in devices] == [0, 2**20]
+    assert all(device.vendor == 'HL-DT-ST' for device in devices)
+    inventory.close()
+
+
+def testHotplugEvents(fakeTree):
+    sysRoot, devRoot = fakeTree
+    inventory = DeviceInventory(sysRoot, devRoot, pollInterval=0.05)
+    events = queue.Queue()
+    inventory.subscribe(lambda eventType, device: events.put((eventType, device)))
+    inventory.start()
+
+    fakes.addFakeDrive(sysRoot, devRoot, 'sr2')
+    assert nextEvent(events) == ('add', 'sr2')
+    fakes.setFakeDiscSize(sysRoot, 'sr2', 2**20)
+    assert nextEvent(events) == ('change', 'sr2')
+    fakes.removeFakeDrive(sysRoot, devRoot, 'sr2')
+    assert nextEvent(events) == ('remove', 'sr2')
+    inventory.close()
+
+
+def testSchedulerUsesNewDrive(fakeTree, tmp_path, configFile):
+    sysRoot, devRoot = fakeTree
+    inventory = DeviceInventory(sysRoot, devRoot, pollInterval=0.05)
+    scheduler = Scheduler(allowFileDevice=True, configFile=configFile, inventory=inventory)
+    scheduler.start()
+    # Subscribers are called in order, so the scheduler sees events first
+    events = queue.Queue()
+    inventory.subscribe(lambda eventType, device: events.put((eventType, device)))
+    inventory.start()
+    devicesBefore = list(scheduler.devices)
+
+    newDevice = fakes.addFakeDrive(sysRoot, devRoot, 'sr2', size=4 * 2**20)
+    assert nextEvent(events) == ('add', 'sr2')
+    assert scheduler.devices == devicesBefore + [newDevice]
+    dirOut = tmp_path / 'out'
+    dirOut.mkdir()
+    scheduler.submit({'omDevice': newDevice, 'dirOut': str(dirOut), 'readMethod': 'readom'})
+    results = scheduler.join()
+    inventory.close()
+
+    assert [result['status'] for result in results] == ['success']
@@ -0,0 +1,274 @@
+"""Tests for omimgr.manifest, and for the chunk manifest of Disc.processDisc"""
+
+import os
+import io
+import json
+import random
+import hashlib
+import pytest
+from omimgr.om import Disc
+from omimgr.mapfile import RescueMap
+from omimgr import manifest
+from omimgr import native
+from omimgr import shared
+import fakes
+
+chunkSize = 4096
+
+
+def writeMap(mapFile, blocks):
+    """Write ddrescue mapfile with blocks, a list of (pos, size, status)"""
+    with open(mapFile, 'w') as f:
+        f.write('# Mapfile. Created by GNU ddrescue version 1.22\n')
+        f.write('0x00000000     ?               1\n')
+        f.write('#      pos        size  status\n')
+        f.writelines('0x%08X  0x%08X  %s\n' % block for block in blocks)
+
+
+def rescueMapOf(mapFile, blocks):
+    """Write blocks to mapfile; returns its RescueMap"""
+    writeMap(mapFile, blocks)
+    rescueMap = RescueMap(mapFile)
+    rescueMap.update()
+    return rescueMap
+
+
+def chunkDigests(imageFile):
+    """Return digest of every chunk of imageFile"""
+    with open(imageFile, 'rb') as f:
+        data = f.read()
+    return [hashlib.sha256(data[pos:pos + chunkSize]).hexdigest()
+            for pos in range(0, len(data), chunkSize)]
+
+
+def writeAt(imageFile, pos, data):
+    """Write data into imageFile at pos, as ddrescue does"""
+    with open(imageFile, 'r+b') as f:
+        f.seek(pos)
+        f.write(data)
+
+
+def covered(ranges):
+    """Return set of the positions in ranges"""
+    return {pos for start, end in ranges for pos in range(start, end)}
+
+
+def randomRanges(rng, size):
+    """Return sorted list of non-overlapping (start, end) ranges within size"""
+    bounds = sorted(rng.sample(range(size + 1), 2 * rng.randrange(0, 8)))
+    return list(zip(bounds[0::2], bounds[1::2]))
+
+
+def testSubtractRanges():
+    assert manifest.subtractRanges([(0, 100)], []) == [(0, 100)]
+    assert manifest.subtractRanges([(0, 100)], [(10, 20), (30, 40)]) == \
+        [(0, 10), (20, 30), (40, 100)]
+    assert manifest.subtractRanges([(10, 20), (30, 40)], [(0, 100)]) == []
+    # Other ranges that start before, and end after the range
+    assert manifest.subtractRanges([(10, 50)], [(0, 20), (45, 60)]) == [(20, 45)]
+
+    rng = random.Random(1)
+    for _ in range(500):
+        ranges = randomRanges(rng, 200)
+        other = randomRanges(rng, 200)
+        result = manifest.subtractRanges(ranges, other)
+        assert covered(result) == covered(ranges) - covered(other)
+        # Sorted, and no empty or touching ranges
+        assert all(start < end for start, end in result)
+        assert all(a[1] < b[0] for a, b in zip(result, result[1:]))
+
+
+def testMerkleRoot():
+    digests = [hashlib.sha256(bytes([i])).hexdigest() for i in range(5)]
+    leaves = [bytes.fromhex(digest) for digest in digests]
+
+    def node(a, b):
+        return hashlib.sha256(a + b).digest()
+
+    # The odd node at the end moves up unchanged
+    expected = node(node(node(leaves[0], leaves[1]), node(leaves[2], leaves[3])), leaves[4])
+    assert manifest.merkleRoot(digests) == expected.hex()
+    assert manifest.merkleRoot(digests[:1]) == digests[0]
+    assert manifest.merkleRoot([]) == hashlib.sha256().hexdigest()
+
+
+def testOnlyChangedChunksAreHashed(tmp_path):
+    imageFile = str(tmp_path / 'disc.iso')
+    mapFile = str(tmp_path / 'disc.map')
+    manifestFile = str(tmp_path / 'disc.chunks.json')
+    size = 16 * chunkSize
+    data = os.urandom(size)
+
+    # First pass: chunks 5 to 10 not finished, zeros in the image. The
+    # unfinished area starts and ends halfway a chunk
+    start, end = 5 * chunkSize + 1000, 10 * chunkSize + 2048
+    with open(imageFile, 'wb') as f:
+        f.write(data[:start] + b'\0' * (end - start) + data[end:])
+    rescueMap = rescueMapOf(mapFile, [(0, start, '+'), (start, end - start, '-'),
+                                      (end, size - end, '+')])
+    chunkManifest = manifest.ChunkManifest(manifestFile, chunkSize)
+    assert chunkManifest.update(imageFile, rescueMap) == 16
+    assert chunkManifest.digests == chunkDigests(imageFile)
+
+    # Second pass rescues an area within chunk 7, and one that straddles the
+    # boundary of chunks 8 and 9
+    newBlocks = [(0, start, '+'), (start, 7 * chunkSize + 100 - start, '-'),
+                 (7 * chunkSize + 100, 200, '+'),
+                 (7 * chunkSize + 300, 9 * chunkSize - 2048 - 7 * chunkSize - 300, '-'),
+                 (9 * chunkSize - 2048, 4096, '+'),
+                 (9 * chunkSize + 2048, end - 9 * chunkSize - 2048, '-'),
+                 (end, size - end, '+')]
+    for pos, blockSize, status in newBlocks[2:5:2]:
+        writeAt(imageFile, pos, data[pos:pos + blockSize])
+    rescueMap = rescueMapOf(mapFile, newBlocks)
+    finished = manifest.finishedRanges(rescueMap)
+
+    chunkManifest = manifest.ChunkManifest(manifestFile, chunkSize)
+    assert chunkManifest.load()
+    assert chunkManifest.changedChunks(finished, size) == [7, 8, 9]
+    assert chunkManifest.update(imageFile, rescueMap) == 3
+    assert chunkManifest.digests == chunkDigests(imageFile)
+
+    # Nothing changed: nothing hashed, same Merkle root
+    with io.open(manifestFile, 'r', encoding='utf-8') as f:
+        root = json.load(f)['merkleRoot']
+    assert root == manifest.merkleRoot(chunkDigests(imageFile))
+    chunkManifest = manifest.ChunkManifest(manifestFile, chunkSize)
+    assert chunkManifest.update(imageFile, rescueMap) == 0
+    assert chunkManifest.merkleRoot() == root
+    assert chunkManifest.summary()['merkleRoot'] == root
+
+
+def testChangedChunksWhenMapOrImageReplaced(tmp_path):
+    chunkManifest = manifest.ChunkManifest(str(tmp_path / 'disc.chunks.json'), chunkSize)
+    chunkManifest.imageSize = 10 * chunkSize
+    chunkManifest.finished = [(0, 3 * chunkSize), (5 * chunkSize, 10 * chunkSize)]
+
+    # A finished range that is no longer finished, or an image that shrank
+    assert chunkManifest.changedChunks([(0, 3 * chunkSize - 1),
+                                        (5 * chunkSize, 10 * chunkSize)],
+                                       10 * chunkSize) is None
+    assert chunkManifest.changedChunks(chunkManifest.finished, 9 * chunkSize) is None
+    # Nothing new
+    assert chunkManifest.changedChunks(chunkManifest.finished, 10 * chunkSize) == []
+
+    # Image grew from a size that isn't a multiple of the chunk size: the old
+    # last chunk is hashed again, as well as the new ones
+    chunkManifest.imageSize = 10 * chunkSize - 100
+    assert chunkManifest.changedChunks(chunkManifest.finished, 12 * chunkSize) == [9, 10, 11]
+
+
+def testManifestOfOtherChunkSizeNotUsed(tmp_path):
+    imageFile = str(tmp_path / 'disc.iso')
+    manifestFile = str(tmp_path / 'disc.chunks.json')
+    with open(imageFile, 'wb') as f:
+        f.write(os.urandom(8 * chunkSize))
+    rescueMap = rescueMapOf(str(tmp_path / 'disc.map'), [(0, 8 * chunkSize, '+')])
+    manifest.ChunkManifest(manifestFile, chunkSize).update(imageFile, rescueMap)
+
+    chunkManifest = manifest.ChunkManifest(manifestFile, 2 * chunkSize)
+    assert not chunkManifest.load()
+    assert chunkManifest.update(imageFile, rescueMap) == 4
+
+    with open(manifestFile, 'w') as f:
+        f.write('{"chunkSize": ')
+    assert not manifest.ChunkManifest(manifestFile, chunkSize).load()
+
+
+def runDisc(device, dirOut, readMethod, configFile):
+    """Image device into dirOut (which may hold the output of an earlier
+    run) with Disc.processDisc; returns the Disc and its metadata"""
+    disc = Disc()
+    disc.configFile = configFile
+    disc.getConfiguration()
+    disc.readMethod = readMethod
+    disc.retries = 1
+    disc.omDevice = device
+    disc.dirOut = dirOut
+    disc.allowFileDevice = True
+    disc.validateInput()
+    assert disc.prepareOutput(True)
+    disc.processDisc()
+    with io.open(os.path.join(dirOut, disc.metadataFileName), 'r', encoding='utf-8') as f:
+        return disc, json.load(f)
+
+
+def checksumFileNames(dirOut):
+    """Return names of the files in the checksum file of dirOut"""
+    with open(os.path.join(dirOut, 'checksums.sha512'), 'r', encoding='utf-8') as f:
+        return [line.split()[1] for line in f]
+
+
+@pytest.fixture
+def manifestConfig(tmp_path):
+    """Return configuration file with chunk manifests enabled"""
+    configFile = str(tmp_path / 'omimgr.json')
+    fakes.writeConfig(configFile, chunkManifest='True')
+    return configFile
+
+
+@pytest.mark.parametrize('readMethod', ['ddrescue', 'native'])
+def testImageChecksumDeferredWhileReadErrorsRemain(tmp_path, manifestConfig, readMethod,
+                                                  monkeypatch):
+    # Native reader that fails on the ranges in <device>.bad, as the stand-in
+    # for ddrescue does
+    monkeypatch.setattr(native, 'SectorReader', fakes.FaultyReader)
+    # Four chunks of the default size
+    device = fakes.makeFakeDevices(tmp_path, 1, 16 * 2**20)[0]
+    with open(device + '.bad', 'w') as f:
+        f.write('%d %d\n' % (2**19, 4096))
+    dirOut = str(tmp_path / 'out')
+    os.mkdir(dirOut)
+
+    disc, metadata = runDisc(device, dirOut, readMethod, manifestConfig)
+    assert disc.readErrorFlag
+    assert metadata['imageChecksumDeferred']
+    assert 'disc.iso' not in checksumFileNames(dirOut)
+    firstRoot = metadata['chunkManifest']['merkleRoot']
+
+    # The next pass rescues the bad sectors
+    os.remove(device + '.bad')
+    disc, metadata = runDisc(device, dirOut, 'ddrescue', manifestConfig)
+    assert not disc.readErrorFlag
+    assert not metadata['imageChecksumDeferred']
+    assert 'disc.iso' in checksumFileNames(dirOut)
+    assert metadata['checksums']['disc.iso'] == shared.generate_file_sha512(device)
+    # Only the chunk with the bad sectors was hashed again
+    assert metadata['chunkManifest']['noChunksHashed'] == 1
+    assert metadata['chunkManifest']['merkleRoot'] != firstRoot
+
+
+def testManifestRemovedWithReadomOutput(tmp_path, manifestConfig):
+    device = fakes.makeFakeDevices(tmp_path, 1, 2**20)[0]
+    dirOut = str(tmp_path / 'out')
+    os.mkdir(dirOut)
+    disc, metadata = runDisc(device, dirOut, 'ddrescue', manifestConfig)
+    noChunks = metadata['chunkManifest']['noChunks']
+    manifestFile = disc.manifestFile
+
+    # readom output (no map file) next to the manifest of the earlier run;
+    # prepareOutput removes both, so the new manifest is not based on it
+    os.remove(disc.mapFile)
+    with open(disc.imageFile, 'wb') as f:
+        f.write(b'\0' * 2**20)
+    disc = Disc()
+    disc.configFile = manifestConfig
+    disc.getConfiguration()
+    disc.readMethod = 'ddrescue'
+    disc.omDevice = device
+    disc.dirOut = dirOut
+    disc.allowFileDevice = True
+    disc.validateInput()
+    assert disc.outputExistsFlag
+    assert disc.prepareOutput(False)
+    assert not os.path.exists(manifestFile)
+    assert not os.path.exists(disc.imageFile)
+
+    disc.processDisc()
+    with io.open(manifestFile, 'r', encoding='utf-8') as f:
+        digests = json.load(f)['digests']
+    assert len(digests) == noChunks
+    with open(disc.imageFile, 'rb') as f:
+        data = f.read()
+    assert digests[0] == hashlib.sha256(data[:4 * 2**20]).hexdigest()
+    assert shared.generate_file_sha512(disc.imageFile) == shared.generate_file_sha512(device)
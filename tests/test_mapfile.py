@@ -0,0 +1,250 @@
+"""Tests for omimgr.mapfile: incremental updates of a RescueMap against a
+full parse, and its range queries against a computation over all blocks"""
+
+import os
+import random
+import itertools
+import pytest
+from omimgr.mapfile import RescueMap
+
+sectorSize = 2048
+statusCodes = '?*/-+'
+# Modification times of the mapfile versions, so that RescueMap.update sees
+# a change even if the size is the same
+mtimes = itertools.count(10**18, 10**9)
+
+
+def randomBlocks(rng, noSectors, noBlocks):
+    """Return list of (pos, size, status) tuples that cover noSectors
+    sectors, where neighbouring blocks have a different status"""
+    boundaries = sorted(rng.sample(range(1, noSectors), noBlocks - 1))
+    blocks = []
+    start = 0
+    status = None
+    for end in boundaries + [noSectors]:
+        status = rng.choice([code for code in statusCodes if code != status])
+        blocks.append((start * sectorSize, (end - start) * sectorSize, status))
+        start = end
+    return blocks
+
+
+def writeMap(mapFile, blocks, currentPos=0, currentStatus='?', currentPass=1,
+             posFormat='0x%08X', comment='Copying non-tried blocks... Pass 1 (forwards)'):
+    """Write blocks to mapfile, with a new modification time"""
+    with open(mapFile, 'w') as f:
+        f.write('# Mapfile. Created by GNU ddrescue version 1.22\n'
+                '# Command line: ddrescue -b 2048 -r4 /dev/sr0 disc.iso disc.map\n'
+                '# ' + comment + '\n'
+                '# current_pos  current_status  current_pass\n')
+        f.write((posFormat + '     %s               %d\n') %
+                (currentPos, currentStatus, currentPass))
+        f.write('#      pos        size  status\n')
+        f.writelines('0x%08X  0x%08X  %s\n' % block for block in blocks)
+    mtime = next(mtimes)
+    os.utime(mapFile, ns=(mtime, mtime))
+
+
+def overlap(block, start, end):
+    """Number of bytes of block (pos, size, status) within [start, end)"""
+    pos, size, _ = block
+    return max(0, min(pos + size, end) - max(pos, start))
+
+
+def bruteForce(blocks, start, end):
+    """Return answers to the RescueMap range queries for [start, end),
+    computed block by block"""
+    rescued = sum(overlap(block, start, end) for block in blocks if block[2] == '+')
+    badAreas = [(overlap(block, start, end), max(block[0], start)) for block in blocks
+                if block[2] == '-' and overlap(block, start, end) > 0]
+    badBytes = sum(size for size, _ in badAreas)
+    return {'rescuedBytes': rescued,
+            'badSectorBytes': badBytes,
+            'badSectorCount': -(-badBytes // sectorSize),
+            'badAreaCount': len(badAreas),
+            'largestBadAreaSize': max((size for size, _ in badAreas), default=0),
+            'badAreas': badAreas}
+
+
+def checkQueries(rescueMap, blocks, rng, noQueries=200):
+    """Compare range queries of rescueMap with the brute-force answers, for
+    the whole map and for random ranges (not aligned to sectors)"""
+    domainEnd = blocks[-1][0] + blocks[-1][1] if blocks else 0
+    ranges = [(0, domainEnd)]
+    for _ in range(noQueries):
+        start = rng.randrange(domainEnd + 1)
+        ranges.append((start, rng.randrange(start, domainEnd + 1)))
+    for start, end in ranges:
+        expected = bruteForce(blocks, start, end)
+        assert rescueMap.rescuedBytes(start, end) == expected['rescuedBytes']
+        assert rescueMap.badSectorBytes(start, end) == expected['badSectorBytes']
+        assert rescueMap.badSectorCount(start, end) == expected['badSectorCount']
+        assert rescueMap.badAreaCount(start, end) == expected['badAreaCount']
+        largest = rescueMap.largestBadArea(start, end)
+        if expected['largestBadAreaSize'] == 0:
+            assert largest is None
+        else:
+            # Any of the largest areas if there are several
+            assert largest[1] == expected['largestBadAreaSize']
+            assert (largest[1], largest[0]) in expected['badAreas']
+
+
+def checkSameAsFullParse(rescueMap, blocks, chunkSize):
+    """Check that rescueMap holds the same blocks and totals as a new
+    RescueMap that parsed the file from scratch, and as blocks"""
+    full = RescueMap(rescueMap.mapFile, chunkSize=chunkSize)
+    full.update()
+    assert rescueMap.summary() == full.summary()
+    assert list(zip(rescueMap.positions, rescueMap.sizes, rescueMap.statuses.decode())) == \
+        list(zip(full.positions, full.sizes, full.statuses.decode())) == blocks
+    assert rescueMap.totals == full.totals
+    for status in rescueMap.cumulative:
+        assert rescueMap.cumulative[status] == full.cumulative[status]
+    assert rescueMap.badBlocks == full.badBlocks
+
+
+def changeStatuses(rng, blocks, first, number):
+    """Return copy of blocks where number blocks from index first onwards
+    have a new status"""
+    blocks = list(blocks)
+    for i in rng.sample(range(first, len(blocks)), min(number, len(blocks) - first)):
+        pos, size, status = blocks[i]
+        blocks[i] = (pos, size, rng.choice([code for code in statusCodes if code != status]))
+    return blocks
+
+
+def splitBlocks(rng, blocks, first, number):
+    """Return copy of blocks where number blocks from index first onwards
+    are split in two, with a new status for the second part"""
+    blocks = list(blocks)
+    candidates = [i for i in range(first, len(blocks)) if blocks[i][1] > sectorSize]
+    for i in sorted(rng.sample(candidates, min(number, len(candidates))), reverse=True):
+        pos, size, status = blocks[i]
+        headSize = rng.randrange(1, size // sectorSize) * sectorSize
+        newStatus = rng.choice([code for code in statusCodes if code != status])
+        blocks[i:i + 1] = [(pos, headSize, status), (pos + headSize, size - headSize, newStatus)]
+    return blocks
+
+
+def mergeBlocks(rng, blocks, first, number):
+    """Return copy of blocks where number blocks from index first onwards
+    are merged with the next block"""
+    blocks = list(blocks)
+    for _ in range(number):
+        if len(blocks) - 1 <= first:
+            break
+        i = rng.randrange(first, len(blocks) - 1)
+        pos, size, status = blocks[i]
+        blocks[i:i + 2] = [(pos, size + blocks[i + 1][1], status)]
+    return blocks
+
+
+@pytest.mark.parametrize('seed', range(6))
+def testIncrementalUpdatesMatchFullParse(tmp_path, seed):
+    rng = random.Random(seed)
+    chunkSize = 256
+    mapFile = str(tmp_path / 'disc.map')
+    blocks = randomBlocks(rng, 5000, 400)
+    writeMap(mapFile, blocks)
+    rescueMap = RescueMap(mapFile, chunkSize=chunkSize)
+    assert rescueMap.update()
+    assert rescueMap.noParsedBlocks == len(blocks)
+    checkSameAsFullParse(rescueMap, blocks, chunkSize)
+    checkQueries(rescueMap, blocks, rng)
+
+    for step in range(12):
+        change = rng.choice([changeStatuses, splitBlocks, mergeBlocks])
+        number = rng.randrange(1, 20)
+        # From the start, the middle or near the end of the map
+        first = rng.choice([0, len(blocks) // 2, len(blocks) - 2 * number])
+        blocks = change(rng, blocks, max(first, 0), number)
+        header = {}
+        if rng.random() < 0.3:
+            header = {'currentPos': rng.randrange(10**12),
+                      'currentStatus': rng.choice('?*/-+'),
+                      'currentPass': rng.randrange(1, 5),
+                      'posFormat': rng.choice(['0x%08X', '0x%010X']),
+                      'comment': rng.choice(['Trimming failed blocks... (forwards)',
+                                             'Scraping failed blocks... (forwards)'])}
+        writeMap(mapFile, blocks, **header)
+        assert rescueMap.update()
+        assert rescueMap.currentPos == header.get('currentPos', 0)
+        assert rescueMap.currentStatus == header.get('currentStatus', '?')
+        assert rescueMap.currentPass == header.get('currentPass', 1)
+        checkSameAsFullParse(rescueMap, blocks, chunkSize)
+        checkQueries(rescueMap, blocks, rng, 50)
+
+
+def testChangeNearEndOnlyParsesLastChunks(tmp_path):
+    rng = random.Random(10)
+    chunkSize = 256
+    mapFile = str(tmp_path / 'disc.map')
+    blocks = randomBlocks(rng, 20000, 2000)
+    writeMap(mapFile, blocks)
+    rescueMap = RescueMap(mapFile, chunkSize=chunkSize)
+    rescueMap.update()
+
+    blocks = changeStatuses(rng, blocks, len(blocks) - 10, 5)
+    writeMap(mapFile, blocks)
+    assert rescueMap.update()
+    # A block line is 27 bytes, so at most two chunks worth of blocks
+    assert 10 <= rescueMap.noParsedBlocks <= 2 * chunkSize // 27 + 10
+    checkSameAsFullParse(rescueMap, blocks, chunkSize)
+
+    # Unchanged file is not read again
+    assert not rescueMap.update()
+
+    # A header of another size shifts every block, so everything is parsed
+    writeMap(mapFile, blocks, currentPos=2**40, posFormat='0x%010X')
+    assert rescueMap.update()
+    assert rescueMap.noParsedBlocks == len(blocks)
+    checkSameAsFullParse(rescueMap, blocks, chunkSize)
+
+
+def testBadAreasAfterShrinkAndGrow(tmp_path):
+    # The max tree keeps its size when bad areas disappear, and is rebuilt
+    # when there are more of them than it has leaves
+    rng = random.Random(20)
+    mapFile = str(tmp_path / 'disc.map')
+    noSectors = 4000
+    blocks = [(0, noSectors * sectorSize, '+')]
+    rescueMap = RescueMap(mapFile, chunkSize=128)
+    for noBad in [1, 3, 40, 2, 0, 100, 5]:
+        badSectors = sorted(rng.sample(range(0, noSectors, 2), noBad))
+        blocks = []
+        start = 0
+        for sector in badSectors:
+            if sector > start:
+                blocks.append((start * sectorSize, (sector - start) * sectorSize, '+'))
+            blocks.append((sector * sectorSize, sectorSize, '-'))
+            start = sector + 1
+        blocks.append((start * sectorSize, (noSectors - start) * sectorSize, '+'))
+        writeMap(mapFile, blocks)
+        rescueMap.update()
+        assert rescueMap.summary()['badAreas'] == noBad
+        checkSameAsFullParse(rescueMap, blocks, 128)
+        checkQueries(rescueMap, blocks, rng, 50)
+
+
+def testEmptyAndMissingMapfile(tmp_path):
+    mapFile = str(tmp_path / 'disc.map')
+    rescueMap = RescueMap(mapFile)
+    assert not rescueMap.update()
+    assert rescueMap.summary()['noBlocks'] == 0
+
+    blocks = [(0, 10 * sectorSize, '+'), (10 * sectorSize, sectorSize, '-')]
+    writeMap(mapFile, blocks)
+    rescueMap.update()
+    assert rescueMap.badSectorCount() == 1
+
+    # ddrescue has just created the file, and not written the status line yet
+    with open(mapFile, 'w') as f:
+        f.write('# Mapfile. Created by GNU ddrescue version 1.22\n')
+    assert rescueMap.update()
+    assert len(rescueMap) == 0
+    assert rescueMap.rescuedBytes() == 0
+    assert rescueMap.largestBadArea() is None
+
+    writeMap(mapFile, blocks)
+    rescueMap.update()
+    checkSameAsFullParse(rescueMap, blocks, rescueMap.chunkSize)
+    assert rescueMap.largestBadArea() == (10 * sectorSize, sectorSize)
@@ -0,0 +1,306 @@
+"""Tests for omimgr.metrics: the text format, the counters of imaging jobs,
+and the metrics file"""
+
+import os
+import sys
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+import pytest
+from omimgr.om import Disc
+from omimgr.scheduler import Scheduler
+from omimgr.mapfile import RescueMap
+from omimgr import metrics
+from omimgr import native
+import fakes
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def checkExposition(text):
+    """Return samples in text (the text format), and list of problems with
+    the format"""
+    problems = []
+    types = {}
+    helps = set()
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            helps.add(line.split(' ')[2])
+        elif line.startswith('# TYPE '):
+            types[line.split(' ')[2]] = line.split(' ')[3]
+        elif line and not line.startswith('#') and not metrics.sampleLine.match(line):
+            problems.append('cannot parse line: ' + line)
+    samples = metrics.parseSamples(text)
+
+    buckets = {}
+    for name, labels, value in samples:
+        family = name
+        for suffix in ['_bucket', '_sum', '_count']:
+            if name.endswith(suffix) and types.get(name[:-len(suffix)]) == 'histogram':
+                family = name[:-len(suffix)]
+        if family not in types or family not in helps:
+            problems.append(name + ' has no TYPE or HELP line')
+        if name.endswith('_bucket') and family != name:
+            series = tuple(sorted((k, v) for k, v in labels.items() if k != 'le'))
+            buckets.setdefault((family, series), []).append((labels['le'], value))
+
+    counts = {(name[:-6], tuple(sorted(labels.items()))): value
+              for name, labels, value in samples if name.endswith('_count')}
+    for (family, series), values in buckets.items():
+        if values[-1][0] != '+Inf':
+            problems.append(family + ' has no +Inf bucket')
+        if any(b[1] < a[1] for a, b in zip(values, values[1:])):
+            problems.append(family + ' buckets are not cumulative')
+        if counts.get((family, series)) != values[-1][1]:
+            problems.append(family + ' +Inf bucket does not match _count')
+    return samples, problems
+
+
+def sampleTotals(samples, name):
+    """Return sum of the values of all samples called name"""
+    return sum(value for sampleName, labels, value in samples if sampleName == name)
+
+
+def sampleSet(samples):
+    """Return samples as a sorted list of (name, label items, value) tuples"""
+    return sorted((name, tuple(sorted(labels.items())), value)
+                  for name, labels, value in samples)
+
+
+def freshRegistry():
+    """Return new registry with the same metrics as metrics.registry, without values"""
+    registry = metrics.Registry()
+    for metric in metrics.registry.metrics:
+        if isinstance(metric, metrics.Histogram):
+            registry.histogram(metric.name, metric.description, metric.labelNames,
+                               metric.buckets[:-1])
+        else:
+            registry.add(type(metric)(metric.name, metric.description, metric.labelNames))
+    return registry
+
+
+class Scraper(threading.Thread):
+    """Fetches url every interval seconds, and checks each response"""
+
+    def __init__(self, url, interval=0.05):
+        """initialise Scraper instance"""
+        threading.Thread.__init__(self, daemon=True)
+        self.url = url
+        self.interval = interval
+        self.problems = []
+        self.lastCounters = {}
+        self.stopped = threading.Event()
+
+    def scrape(self):
+        """Fetch and check metrics; returns the text"""
+        with urllib.request.urlopen(self.url, timeout=5) as response:
+            contentType = response.headers.get('Content-Type', '')
+            text = response.read().decode('utf-8')
+        if not contentType.startswith('text/plain'):
+            self.problems.append('content type ' + contentType)
+        samples, problems = checkExposition(text)
+        self.problems += problems
+        for name, labels, value in samples:
+            if name.endswith('_total') or name.endswith('_count'):
+                key = (name, tuple(sorted(labels.items())))
+                if value < self.lastCounters.get(key, 0):
+                    self.problems.append(name + ' went down')
+                self.lastCounters[key] = value
+        return text
+
+    def run(self):
+        """Scrape until stopped"""
+        while not self.stopped.wait(self.interval):
+            try:
+                self.scrape()
+            except (OSError, urllib.error.URLError) as e:
+                self.problems.append('scrape failed: ' + str(e))
+
+
+@pytest.fixture(scope='module')
+def imagingRun(tmp_path_factory):
+    """Image two fake drives (one with unreadable sectors) with readom,
+    ddrescue and the native reader, with the metrics file and endpoint
+    enabled, while a scraper checks /metrics. Yields dictionary with the
+    job results, the samples before and after the jobs, the metrics file
+    and the endpoint URL"""
+    tempDir = tmp_path_factory.mktemp('metrics')
+    metricsFile = str(tempDir / 'omimgr.prom')
+    configFile = str(tempDir / 'omimgr.json')
+    # Port 0: any free port
+    fakes.writeConfig(configFile, metricsFile=metricsFile, metricsAddress='127.0.0.1:0')
+    drives = fakes.makeFakeDevices(tempDir, 2)
+    with open(drives[0] + '.bad', 'w') as f:
+        f.write('%d %d\n' % (2**20, 4096))
+
+    disc = Disc()
+    disc.configFile = configFile
+    disc.getConfiguration()
+    disc.startMetrics()
+    assert metrics.exporter.server is not None
+    url = metrics.exporter.server.url()
+    scraper = Scraper(url)
+    # Earlier tests may have counted jobs too
+    samplesBefore = metrics.parseSamples(scraper.scrape())
+    scraper.start()
+
+    scheduler = Scheduler(drives, allowFileDevice=True, configFile=configFile)
+    scheduler.start()
+    for method in ['readom', 'ddrescue', 'native']:
+        for drive in drives:
+            dirOut = tempDir / (os.path.basename(drive) + '-' + method)
+            dirOut.mkdir()
+            scheduler.submit({'omDevice': drive, 'readMethod': method, 'dirOut': str(dirOut)})
+    results = scheduler.join()
+    scraper.stopped.set()
+    scraper.join()
+    samples = metrics.parseSamples(scraper.scrape())
+
+    yield {'results': results, 'samplesBefore': samplesBefore, 'samples': samples,
+           'scrapeProblems': scraper.problems, 'metricsFile': metricsFile, 'url': url}
+    metrics.exporter.stop()
+
+
+def testScrapesAreValid(imagingRun):
+    assert imagingRun['scrapeProblems'] == []
+
+
+def bytesRead(result):
+    """Return bytes the job of result read: the image size for readom, the
+    rescued bytes in the mapfile for ddrescue and the native reader (each job
+    starts without a mapfile)"""
+    if result['readMethod'] == 'readom':
+        return result['imageSize']
+    rescueMap = RescueMap(os.path.splitext(result['imageFile'])[0] + '.map')
+    rescueMap.update()
+    return rescueMap.rescuedBytes()
+
+
+def testCountersMatchJobs(imagingRun):
+    results = imagingRun['results']
+    before = imagingRun['samplesBefore']
+    samples = imagingRun['samples']
+
+    def added(name):
+        return sampleTotals(samples, name) - sampleTotals(before, name)
+
+    assert not any(result['status'] in ['invalid', 'crashed'] for result in results)
+    assert added('omimgr_discs_processed_total') == len(results)
+    assert added('omimgr_bytes_imaged_total') == sum(bytesRead(result) for result in results)
+    # The ddrescue stand-in cannot read the bad sectors of the first drive
+    assert added('omimgr_bytes_imaged_total') == \
+        sum(result['imageSize'] for result in results) - 4096
+    # readom and ddrescue jobs
+    assert added('omimgr_tool_runs_total') == 4
+    ddrescueErrors = [value for name, labels, value in samples
+                      if name == 'omimgr_read_errors_total' and labels['tool'] == 'ddrescue']
+    assert ddrescueErrors and ddrescueErrors[0] > 0
+
+
+def testMetricsFileMatchesEndpoint(imagingRun):
+    metrics.exporter.update()
+    with open(imagingRun['metricsFile'], 'r', encoding='utf-8') as f:
+        fileText = f.read()
+    with urllib.request.urlopen(imagingRun['url'], timeout=5) as response:
+        endpointText = response.read().decode('utf-8')
+    assert sampleSet(metrics.parseSamples(fileText)) == \
+        sampleSet(metrics.parseSamples(endpointText))
+
+    # A later run continues the counters from the metrics file
+    registry = freshRegistry()
+    registry.restore(fileText)
+    expected = [sample for sample in metrics.parseSamples(fileText)
+                if sample[0] != 'omimgr_build_info']
+    assert sampleSet(metrics.parseSamples(registry.render())) == sampleSet(expected)
+
+
+def testOtherPathNotFound(imagingRun):
+    with pytest.raises(urllib.error.HTTPError) as excinfo:
+        urllib.request.urlopen(imagingRun['url'].replace('/metrics', '/other'), timeout=5)
+    assert excinfo.value.code == 404
+
+
+@pytest.mark.parametrize('readMethod', ['ddrescue', 'native'])
+def testContinuedRunCountsRescuedBytes(tmp_path, configFile, monkeypatch, readMethod):
+    # Native reader that fails on the ranges in <device>.bad
+    monkeypatch.setattr(native, 'SectorReader', fakes.FaultyReader)
+    device = fakes.makeFakeDevices(tmp_path, 1, 2**20)[0]
+    with open(device + '.bad', 'w') as f:
+        f.write('%d %d\n' % (2**19, 4096))
+    dirOut = str(tmp_path / 'out')
+    os.mkdir(dirOut)
+
+    def runDisc():
+        disc = Disc()
+        disc.configFile = configFile
+        disc.getConfiguration()
+        disc.readMethod = readMethod
+        disc.retries = 1
+        disc.omDevice = device
+        disc.dirOut = dirOut
+        disc.allowFileDevice = True
+        disc.validateInput()
+        disc.prepareOutput(True)
+        bytesBefore = metrics.bytesImaged.get(drive=device, method=readMethod)
+        disc.processDisc()
+        return disc.timing['phases']['read'], \
+            metrics.bytesImaged.get(drive=device, method=readMethod) - bytesBefore
+
+    readPhase, bytesImaged = runDisc()
+    assert readPhase['bytes'] == bytesImaged == 2**20 - 4096
+
+    # The next run only reads the sectors that were bad
+    open(device + '.bad', 'w').close()
+    readPhase, bytesImaged = runDisc()
+    assert readPhase['bytes'] == bytesImaged == 4096
+    if readPhase['seconds'] > 0:
+        assert readPhase['MBPerSecond'] == round(4096 / readPhase['seconds'] / 1e6, 3)
+
+    # Nothing left to read
+    readPhase, bytesImaged = runDisc()
+    assert readPhase['bytes'] == bytesImaged == 0
+
+
+def testParallelRunsShareMetricsFile(tmp_path):
+    # Each process counts 50 jobs, and updates the file after every job
+    script = '\n'.join([
+        'import sys',
+        'sys.path.insert(0, ' + repr(repoDir) + ')',
+        'from omimgr import metrics',
+        'metrics.exporter.start(sys.argv[1])',
+        'for _ in range(50):',
+        '    metrics.discsProcessed.inc(method="native", result="success")',
+        '    metrics.toolDuration.observe(5, tool="native")',
+        '    metrics.exporter.update()',
+        'metrics.exporter.stop()'])
+    metricsFile = str(tmp_path / 'omimgr.prom')
+    processes = [subprocess.Popen([sys.executable, '-c', script, metricsFile])
+                 for _ in range(4)]
+    assert [process.wait() for process in processes] == [0] * 4
+
+    with open(metricsFile, 'r', encoding='utf-8') as f:
+        samples, problems = checkExposition(f.read())
+    assert problems == []
+    assert sampleTotals(samples, 'omimgr_discs_processed_total') == 200
+    assert sampleTotals(samples, 'omimgr_tool_duration_seconds_count') == 200
+    assert sampleTotals(samples, 'omimgr_tool_duration_seconds_sum') == 1000
+
+
+def testMergeOfOwnValuesKeepsCounters():
+    # Fractional seconds; adding and then subtracting what this process
+    # wrote earlier must not round a counter down
+    registry = freshRegistry()
+    counter = [metric for metric in registry.metrics
+               if metric.name == 'omimgr_read_seconds_total'][0]
+    histogram = [metric for metric in registry.metrics
+                 if metric.name == 'omimgr_phase_duration_seconds'][0]
+    writtenText = ''
+    fileText = ''
+    for i in range(200):
+        counter.inc(0.1 + i / 7, drive='/dev/sr0')
+        histogram.observe(0.3 + i / 3, phase='read')
+        before = (counter.get(drive='/dev/sr0'), histogram.get(phase='read')[1])
+        registry.merge(fileText, writtenText)
+        assert (counter.get(drive='/dev/sr0'), histogram.get(phase='read')[1]) == before
+        writtenText = fileText = registry.render()
@@ -0,0 +1,210 @@
+"""Tests for omimgr.native"""
+
+import os
+import re
+import errno
+import logging
+import subprocess
+import threading
+import pytest
+from omimgr.native import SectorReader
+from omimgr.mapfile import RescueMap
+from omimgr.wrappers import CancelToken
+from omimgr import shared
+import fakes
+
+
+def writeBadRanges(device, ranges):
+    """Make the byte ranges (start, size) of device unreadable"""
+    with open(device + '.bad', 'w') as f:
+        for start, size in ranges:
+            f.write('%d %d\n' % (start, size))
+
+
+def testCleanReadMatchesDisc(tmp_path):
+    disc = fakes.makeFakeDevices(tmp_path, 1, 8 * 2**20)[0]
+    imageFile = str(tmp_path / 'native.iso')
+    reader = SectorReader(disc, imageFile, str(tmp_path / 'native.map'), algorithms=['sha512'])
+
+    assert reader.run() == (0, False, False)
+    discDigest = shared.generate_file_sha512(disc)
+    assert shared.generate_file_sha512(imageFile) == discDigest
+    assert reader.digests['sha512'] == discDigest
+
+
+def testDdrescueContinuesFromMapfile(tmp_path):
+    disc = fakes.makeFakeDevices(tmp_path, 1, 8 * 2**20)[0]
+    writeBadRanges(disc, [(2**20, 2048), (5 * 2**20 + 4096, 4096)])
+    imageFile = str(tmp_path / 'faulty.iso')
+    mapFile = str(tmp_path / 'faulty.map')
+    reader = fakes.FaultyReader(disc, imageFile, mapFile, retries=1)
+
+    assert reader.run() == (0, True, False)
+    assert reader.readErrors == 3
+    rescueMap = RescueMap(mapFile)
+    rescueMap.update()
+    assert rescueMap.summary()['badSector'] == 3 * 2048
+
+    os.remove(disc + '.bad')
+    subprocess.run(['ddrescue', '-b', '2048', disc, imageFile, mapFile],
+                   stdout=subprocess.DEVNULL, check=True)
+    rescueMap.update()
+    assert rescueMap.rescuedBytes() == os.path.getsize(disc)
+    assert shared.generate_file_sha512(imageFile) == shared.generate_file_sha512(disc)
+
+
+def testHashThreadsStopAfterReadError(tmp_path):
+    disc = fakes.makeFakeDevices(tmp_path, 1)[0]
+    writeBadRanges(disc, [(2**20, 2048)])
+    noThreads = threading.active_count()
+    reader = fakes.FaultyReader(disc, str(tmp_path / 'a.iso'), str(tmp_path / 'a.map'),
+                                algorithms=['sha512', 'md5'])
+
+    assert reader.run() == (0, True, False)
+    assert reader.digests is None
+    assert threading.active_count() == noThreads
+
+
+def testCancelBetweenSectors(tmp_path):
+    disc = fakes.makeFakeDevices(tmp_path, 1)[0]
+    # First chunk is read sector by sector
+    writeBadRanges(disc, [(0, 2048)])
+    cancelToken = CancelToken()
+
+    class CancellingReader(fakes.FaultyReader):
+        """Cancels while reading the third sector"""
+
+        def readInto(self, fd, view, offset):
+            if offset == 2 * 2048:
+                cancelToken.cancel()
+            return super().readInto(fd, view, offset)
+
+    reader = CancellingReader(disc, str(tmp_path / 'a.iso'), str(tmp_path / 'a.map'),
+                              cancelToken=cancelToken)
+    exitStatus, readErrorFlag, interruptedFlag = reader.run()
+    cancelToken.close()
+
+    assert interruptedFlag
+    # Sector 0 failed, sectors 1 and 2 were read, the rest was never tried
+    assert reader.status[:3] == b'-++'
+    assert reader.status.count(b'?') == len(reader.status) - 3
+
+
+def openFds():
+    """Return the file descriptors this process has open"""
+    return sorted(os.listdir('/proc/self/fd'))
+
+
+def checkCounts(reader):
+    """Check the running counts of reader against its status array"""
+    assert reader.noRescuedSectors == reader.status.count(b'+')
+    assert reader.noBadSectors == reader.status.count(b'-')
+    assert reader.noBadAreas == len(re.findall(rb'-+', reader.status))
+
+
+def testRunningCountsMatchStatus(tmp_path):
+    disc = fakes.makeFakeDevices(tmp_path, 1, 4 * 2**20)[0]
+    # Bad areas of one and several sectors, next to each other, at the
+    # start and at the end of a chunk, and at the end of the disc
+    size = os.path.getsize(disc)
+    writeBadRanges(disc, [(0, 2048), (4096, 3 * 2048), (3 * 65536 - 2048, 4096),
+                          (10 * 65536, 65536), (size - 4096, 4096)])
+    imageFile = str(tmp_path / 'a.iso')
+    mapFile = str(tmp_path / 'a.map')
+    events = []
+
+    def onProgress(event):
+        checkCounts(reader)
+        events.append(event)
+
+    reader = fakes.FaultyReader(disc, imageFile, mapFile, retries=0, chunkSize=65536,
+                                progressCallback=onProgress, progressInterval=0)
+    assert reader.run() == (0, True, False)
+    checkCounts(reader)
+    assert reader.noBadAreas == 5
+    assert events[-1].badSector == (1 + 3 + 2 + 32 + 2) * 2048
+    assert events[-1].badAreas == 5
+
+    # Next run, from the mapfile of the first run, reads the middle of one bad
+    # area (which splits it), the end of another, and all of the last two
+    writeBadRanges(disc, [(0, 2048), (4096, 2048), (3 * 2048, 2048),
+                          (10 * 65536, 2048), (11 * 65536 - 2048, 2048)])
+    events = []
+    reader = fakes.FaultyReader(disc, imageFile, mapFile, retries=0, chunkSize=65536,
+                                progressCallback=onProgress, progressInterval=0)
+    assert reader.run() == (0, True, False)
+    checkCounts(reader)
+    assert reader.noBadAreas == 4
+    assert events[-1].badAreas == 4
+    assert events[-1].badSector == 5 * 2048
+    assert events[-1].nonTried == 0
+
+
+@pytest.mark.parametrize('badRanges', [[], [(0, 2048)]])
+def testWriteErrorStopsReader(tmp_path, monkeypatch, caplog, badRanges):
+    disc = fakes.makeFakeDevices(tmp_path, 1, 4 * 2**20)[0]
+    # Without bad ranges whole chunks are written, with a bad first sector
+    # the first chunk is read sector by sector
+    writeBadRanges(disc, badRanges)
+    imageFile = str(tmp_path / 'a.iso')
+    mapFile = str(tmp_path / 'a.map')
+    pwrite = os.pwrite
+    # The disk is full after 8 sectors
+    limit = 8 * 2048
+
+    def fullDisk(fd, data, offset):
+        if offset + len(data) > limit:
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        return pwrite(fd, data, offset)
+
+    monkeypatch.setattr(os, 'pwrite', fullDisk)
+    fds = openFds()
+    reader = fakes.FaultyReader(disc, imageFile, mapFile, retries=0, chunkSize=65536,
+                                algorithms=['sha512', 'md5'],
+                                logger=logging.getLogger('test.native'))
+    with caplog.at_level(logging.ERROR, logger='test.native'):
+        exitStatus, readErrorFlag, interruptedFlag = reader.run()
+
+    assert (exitStatus, readErrorFlag, interruptedFlag) == (0, True, False)
+    assert reader.writeFailedFlag
+    assert reader.digests is None
+    assert openFds() == fds
+    assert any('cannot write image file' in record.getMessage() and
+               os.strerror(errno.ENOSPC) in record.getMessage() for record in caplog.records)
+    checkCounts(reader)
+    # Nothing past the sectors that could be written is marked as read
+    assert reader.status.find(b'?') <= limit // 2048
+    assert reader.status.count(b'?') + reader.noRescuedSectors + reader.noBadSectors == \
+        len(reader.status)
+    rescueMap = RescueMap(mapFile)
+    rescueMap.update()
+    assert rescueMap.rescuedBytes() == reader.rescuedBytes == reader.noRescuedSectors * 2048
+
+    # Once there is space again, ddrescue finishes the image
+    monkeypatch.undo()
+    os.remove(disc + '.bad')
+    subprocess.run(['ddrescue', '-b', '2048', disc, imageFile, mapFile],
+                   stdout=subprocess.DEVNULL, check=True)
+    assert shared.generate_file_sha512(imageFile) == shared.generate_file_sha512(disc)
+
+
+def testFilesClosedAfterException(tmp_path):
+    disc = fakes.makeFakeDevices(tmp_path, 1)[0]
+
+    def onProgress(event):
+        raise RuntimeError('progress callback failed')
+
+    fds = openFds()
+    reader = SectorReader(disc, str(tmp_path / 'a.iso'), str(tmp_path / 'a.map'),
+                          progressCallback=onProgress, progressInterval=0)
+    with pytest.raises(RuntimeError):
+        reader.run()
+    assert openFds() == fds
+
+
+def testImageThatCannotBeCreated(tmp_path):
+    disc = fakes.makeFakeDevices(tmp_path, 1)[0]
+    fds = openFds()
+    reader = SectorReader(disc, str(tmp_path / 'missing' / 'a.iso'), str(tmp_path / 'a.map'))
+    assert reader.run() == (1, True, False)
+    assert openFds() == fds
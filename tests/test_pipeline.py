@@ -0,0 +1,240 @@
+"""Tests for omimgr.pipeline, and for the images that Disc.processDisc
+writes with each read method"""
+
+import os
+import struct
+import pytest
+from omimgr.om import Disc
+from omimgr.mapfile import RescueMap
+from omimgr import pipeline
+from omimgr import shared
+import fakes
+
+sectorSize = 2048
+
+
+def imageDisc(device, dirOut, readMethod, configFile):
+    """Image device with Disc.processDisc; returns the Disc"""
+    disc = Disc()
+    disc.configFile = configFile
+    disc.getConfiguration()
+    disc.readMethod = readMethod
+    disc.retries = disc.retriesDefault
+    disc.omDevice = device
+    disc.dirOut = dirOut
+    disc.allowFileDevice = True
+    os.mkdir(dirOut)
+    disc.validateInput()
+    disc.prepareOutput(False)
+    disc.processDisc()
+    return disc
+
+
+def volumeDescriptor(vdType, identifier=b'CD001', volumeSpaceSize=0):
+    """Return volume descriptor sector; volumeSpaceSize is only used for
+    primary and supplementary descriptors"""
+    sector = bytearray(sectorSize)
+    sector[0] = vdType
+    sector[1:6] = identifier
+    sector[6] = 1
+    if vdType in [1, 2]:
+        sector[80:88] = struct.pack('<I', volumeSpaceSize) + struct.pack('>I', volumeSpaceSize)
+        sector[128:132] = struct.pack('<H', sectorSize) + struct.pack('>H', sectorSize)
+    return bytes(sector)
+
+
+def writeImage(imageFile, descriptors, noSectors):
+    """Write image of noSectors sectors with descriptors from sector 16"""
+    with open(imageFile, 'wb') as f:
+        f.write(b'\0' * 16 * sectorSize)
+        f.write(b''.join(descriptors))
+        f.write(b'\0' * (noSectors - 16 - len(descriptors)) * sectorSize)
+
+
+def parsedAndIsolyzer(imageFile):
+    """Return result of parseISO9660 for imageFile, and of isolyzer"""
+    with open(imageFile, 'rb') as f:
+        imageBytes = f.read()
+    return pipeline.parseISO9660(imageBytes, len(imageBytes)), pipeline.runIsolyzer(imageFile)
+
+
+@pytest.mark.parametrize('readMethod', ['readom', 'ddrescue', 'native'])
+def testProcessDiscImageMatchesDisc(tmp_path, configFile, readMethod):
+    device = fakes.makeFakeDevices(tmp_path, 1, 4 * 2**20)[0]
+    disc = imageDisc(device, str(tmp_path / 'out'), readMethod, configFile)
+
+    assert disc.successFlag
+    assert shared.generate_file_sha512(disc.imageFile) == shared.generate_file_sha512(device)
+
+
+@pytest.mark.parametrize('imageSectors', [512, 256])
+def testParsePrimaryVolumeDescriptor(tmp_path, imageSectors):
+    imageFile = str(tmp_path / 'disc.iso')
+    writeImage(imageFile, [volumeDescriptor(1, volumeSpaceSize=512), volumeDescriptor(255)],
+               imageSectors)
+    parsed, isolyzerResult = parsedAndIsolyzer(imageFile)
+
+    assert parsed == (True, imageSectors < 512)
+    assert parsed == isolyzerResult
+
+
+def testParseFakeImageAndTruncatedCopy(tmp_path):
+    imageFile = str(tmp_path / 'disc.iso')
+    fakes.makeFakeImage(imageFile, 2**20)
+    truncatedFile = str(tmp_path / 'truncated.iso')
+    with open(imageFile, 'rb') as fIn, open(truncatedFile, 'wb') as fOut:
+        fOut.write(fIn.read(2**19))
+
+    assert parsedAndIsolyzer(imageFile) == ((True, False), (True, False))
+    assert parsedAndIsolyzer(truncatedFile) == ((True, True), (True, True))
+
+
+@pytest.mark.parametrize('lastVolumeSpaceSize', [400, 900])
+def testMultipleDescriptorsUseLastPrimary(tmp_path, lastVolumeSpaceSize):
+    # Boot record, primary, Joliet supplementary and a second primary
+    imageFile = str(tmp_path / 'disc.iso')
+    descriptors = [volumeDescriptor(0), volumeDescriptor(1, volumeSpaceSize=300),
+                   volumeDescriptor(2, volumeSpaceSize=300),
+                   volumeDescriptor(1, volumeSpaceSize=lastVolumeSpaceSize),
+                   volumeDescriptor(255)]
+    writeImage(imageFile, descriptors, 400)
+    parsed, isolyzerResult = parsedAndIsolyzer(imageFile)
+
+    assert parsed == (True, lastVolumeSpaceSize > 400)
+    assert parsed == isolyzerResult
+
+
+def testImagesLeftToIsolyzer(tmp_path):
+    imageBytes = {}
+    # Random data, and an image too small to hold a descriptor set
+    imageBytes['random'] = os.urandom(64 * sectorSize)
+    imageBytes['small'] = b'\0' * 16 * sectorSize + volumeDescriptor(1, volumeSpaceSize=17)
+    # UDF bridge: Volume Recognition Sequence after the terminator
+    imageBytes['udf'] = (b'\0' * 16 * sectorSize + volumeDescriptor(1, volumeSpaceSize=64) +
+                         volumeDescriptor(255) + volumeDescriptor(0, b'BEA01') +
+                         volumeDescriptor(0, b'NSR02') + b'\0' * 44 * sectorSize)
+    # Only a supplementary descriptor
+    imageBytes['noPrimary'] = (b'\0' * 16 * sectorSize +
+                               volumeDescriptor(2, volumeSpaceSize=64) +
+                               volumeDescriptor(255) + b'\0' * 46 * sectorSize)
+    # Apple partition map
+    imageBytes['apple'] = (b'\0' * 512 + b'PM' + b'\0' * (16 * sectorSize - 514) +
+                           volumeDescriptor(1, volumeSpaceSize=64) +
+                           volumeDescriptor(255) + b'\0' * 46 * sectorSize)
+
+    for name, data in imageBytes.items():
+        assert pipeline.parseISO9660(data, len(data)) is None, name
+
+    # scanImage then gets its answers from isolyzer
+    imageFile = str(tmp_path / 'random.iso')
+    with open(imageFile, 'wb') as f:
+        f.write(imageBytes['random'])
+    digests, success, truncated = pipeline.scanImage(imageFile, ['sha512'])
+    assert (success, truncated) == pipeline.runIsolyzer(imageFile)
+    assert digests['sha512'] == shared.generate_file_sha512(imageFile)
+
+
+def testRewritingPhases():
+    phases = ['Copying non-tried blocks... Pass 1 (forwards)',
+              'Copying non-tried blocks... Pass 2 (backwards)',
+              'Trimming failed blocks... (forwards)',
+              'Scraping failed blocks... (forwards)',
+              'Retrying bad sectors... Retry 1 (forwards)',
+              'Finished', 'Interrupted by user']
+
+    assert pipeline.rewritingPhases(phases[:1] + phases[5:]) == []
+    assert pipeline.rewritingPhases(phases) == phases[1:5]
+
+
+def writeMapfile(mapFile, blocks, currentPass=1):
+    """Write ddrescue mapfile with blocks, a list of (pos, size, status)"""
+    with open(mapFile, 'w') as f:
+        f.write('# Mapfile. Created by GNU ddrescue version 1.22\n')
+        f.write('# current_pos  current_status  current_pass\n')
+        f.write('0x00000000     +               %d\n' % currentPass)
+        f.write('#      pos        size  status\n')
+        for pos, size, status in blocks:
+            f.write('0x%08X  0x%08X  %s\n' % (pos, size, status))
+
+
+def hashedImage(tmp_path, size=2**20):
+    """Write image sequentially while a StreamHasher follows it; returns the
+    hasher (not yet finished) and the digest of the image"""
+    imageFile = str(tmp_path / 'disc.iso')
+    hasher = pipeline.StreamHasher(imageFile, ['sha512'], blocksize=2**16, pollInterval=0.01)
+    hasher.start()
+    data = os.urandom(size)
+    with open(imageFile, 'wb') as f:
+        for pos in range(0, size, 2**16):
+            f.write(data[pos:pos + 2**16])
+            f.flush()
+    return hasher, shared.generate_file_sha512(imageFile)
+
+
+def rescueMapOf(tmp_path, blocks, currentPass=1):
+    """Return RescueMap of a mapfile with blocks"""
+    mapFile = str(tmp_path / 'disc.map')
+    writeMapfile(mapFile, blocks, currentPass)
+    rescueMap = RescueMap(mapFile)
+    rescueMap.update()
+    return rescueMap
+
+
+def testStreamHasherDigestsAfterCleanPass(tmp_path):
+    hasher, digest = hashedImage(tmp_path)
+    rescueMap = rescueMapOf(tmp_path, [(0, 2**20, '+')])
+    phases = ['Copying non-tried blocks... Pass 1 (forwards)', 'Finished']
+
+    digests = pipeline.finishStreamHasher(hasher, 'ddrescue', False, phases, rescueMap)
+    assert digests['sha512'] == digest
+
+
+@pytest.mark.parametrize('phase', ['Copying non-tried blocks... Pass 2 (backwards)',
+                                   'Trimming failed blocks... (forwards)',
+                                   'Scraping failed blocks... (forwards)',
+                                   'Retrying bad sectors... Retry 1 (forwards)'])
+def testFallbackAfterFirstCopyingPass(tmp_path, phase):
+    hasher, digest = hashedImage(tmp_path)
+    rescueMap = rescueMapOf(tmp_path, [(0, 2**20, '+')])
+    phases = ['Copying non-tried blocks... Pass 1 (forwards)', phase, 'Finished']
+
+    assert pipeline.finishStreamHasher(hasher, 'ddrescue', False, phases, rescueMap) is None
+
+
+@pytest.mark.parametrize('blocks, currentPass', [
+    ([(0, 2**19, '+'), (2**19, 2**19, '?')], 1),
+    ([(0, 2**19, '+'), (2**19, 2048, '*'), (2**19 + 2048, 2**19 - 2048, '+')], 1),
+    ([(0, 2**19, '+'), (2**19, 2048, '/'), (2**19 + 2048, 2**19 - 2048, '+')], 1),
+    ([(0, 2**19, '+'), (2**19, 2048, '-'), (2**19 + 2048, 2**19 - 2048, '+')], 1),
+    ([(0, 2**20, '+')], 3)])
+def testFallbackForUnfinishedMapfile(tmp_path, blocks, currentPass):
+    hasher, digest = hashedImage(tmp_path)
+    rescueMap = rescueMapOf(tmp_path, blocks, currentPass)
+    phases = ['Copying non-tried blocks... Pass 1 (forwards)', 'Finished']
+
+    assert pipeline.finishStreamHasher(hasher, 'ddrescue', False, phases, rescueMap) is None
+
+
+def testFallbackOnReadErrors(tmp_path):
+    hasher, digest = hashedImage(tmp_path)
+    assert pipeline.finishStreamHasher(hasher, 'ddrescue', True) is None
+    assert pipeline.finishStreamHasher(None, 'readom', False) is None
+
+
+def testReadomIgnoresRescuePhases(tmp_path):
+    hasher, digest = hashedImage(tmp_path)
+    phases = ['Trimming failed blocks... (forwards)']
+
+    digests = pipeline.finishStreamHasher(hasher, 'readom', False, phases)
+    assert digests['sha512'] == digest
+
+
+def testFallbackWhenImageRewritten(tmp_path):
+    hasher, digest = hashedImage(tmp_path)
+    # Image replaced by a smaller file after the hasher read it
+    hasher.finish()
+    os.remove(hasher.fileIn)
+    with open(hasher.fileIn, 'wb') as f:
+        f.write(b'\0' * 2**19)
+
+    assert pipeline.finishStreamHasher(hasher, 'readom', False) is None
@@ -0,0 +1,179 @@
+"""Tests for omimgr.progress, with the ddrescue 1.22 transcript in
+benchmarks/transcripts and status blocks written out below"""
+
+import os
+import re
+import csv
+import pytest
+from omimgr.progress import (RescueStatusParser, RescueProgress, ProgressRecorder,
+                             parseSize, parseDuration)
+
+transcript = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'benchmarks', 'transcripts', 'ddrescue-1.22.txt')
+
+copyingPhase = 'Copying non-tried blocks... Pass 1 (forwards)'
+
+# Status block of ddrescue 1.22 with --binary-prefixes, while scraping after
+# read errors: no rescued data for a while, so the current rate is 0
+binaryBlock = """\
+Scraping failed blocks... (forwards)
+     ipos:    1024 MiB, non-trimmed:        0 B,  current rate:       0 B/s
+     opos:    1024 MiB, non-scraped:   12.5 KiB,  average rate:   1.25 MiB/s
+non-tried:        0 B,  bad-sector:   1536 KiB,    error rate:    2048 B/s
+  rescued:   3.25 GiB,   bad areas:       17,        run time:  1h 2m 3s
+pct rescued:    99.50%, read errors:       40,  remaining time:         n/a
+                              time since last successful read:     10m 5s"""
+
+# Block of a run that has not read anything yet
+startBlock = """\
+     ipos:        0 B, non-trimmed:        0 B,  current rate:        0 B/s
+     opos:        0 B, non-scraped:        0 B,  average rate:        0 B/s
+non-tried:    4700 MB,  bad-sector:        0 B,    error rate:        0 B/s
+  rescued:        0 B,   bad areas:        0,        run time:         0s
+pct rescued:     0.00%, read errors:        0,  remaining time:         n/a
+                              time since last successful read:         n/a"""
+
+
+def transcriptLines():
+    """Return lines of the transcript, as the ddrescue output parser passes
+    them on (split at line ends and carriage returns, without the cursor
+    movement escape sequences)"""
+    with open(transcript, 'rb') as f:
+        data = f.read().decode('utf-8')
+    return [line.replace('\x1b[A', '') for line in re.split(r'\r\n|\r|\n', data)]
+
+
+def fieldsOf(event):
+    """Return fields of event, without the timestamp"""
+    fields = event.asDict()
+    del fields['timestamp']
+    return fields
+
+
+def parseLines(lines):
+    """Return events of parser for lines"""
+    parser = RescueStatusParser()
+    events = [parser.parseLine(line) for line in lines]
+    return [event for event in events if event is not None], parser
+
+
+@pytest.mark.parametrize('valueString, expected', [
+    ('0 B', 0), ('131072 B', 131072), ('694157 kB', 694157000), ('3211 kB/s', 3211000),
+    ('12 MB', 12 * 10**6), ('4.7 GB', 4700000000), ('1 TB', 10**12),
+    ('1536 KiB', 1536 * 1024), ('1.25 MiB/s', 1310720), ('3.25 GiB', 3489660928),
+    ('2 TiB', 2 * 2**40), ('42', 42),
+    ('n/a', None), ('', None), ('12 parsecs', None), ('kB 12', None)])
+def testParseSize(valueString, expected):
+    assert parseSize(valueString) == expected
+
+
+@pytest.mark.parametrize('valueString, expected', [
+    ('0s', 0), ('216s', 216), ('23m', 1380), ('1h 2m 3s', 3723), ('2d 1h', 176400),
+    ('10 s ago', 10), ('1.5m', 90), ('n/a', None), ('', None), ('soon', None)])
+def testParseDuration(valueString, expected):
+    assert parseDuration(valueString) == expected
+
+
+def testTranscriptEvents():
+    lines = transcriptLines()
+    parser = RescueStatusParser()
+    statusLines = [line for line in lines if parser.isStatusLine(line)]
+    events, parser = parseLines(lines)
+
+    # One event per status block; the phase line follows the first block
+    assert len(events) == 217 == parser.noEvents
+    assert events[0].phase is None
+    assert all(event.phase == copyingPhase for event in events[1:])
+    assert len(statusLines) == 217 * 6 + 217 + 1
+
+    assert fieldsOf(events[0]) == {
+        'phase': None, 'ipos': 0, 'opos': 0, 'nonTried': 694157000, 'nonTrimmed': 0, 'nonScraped': 0,
+        'badSector': 0, 'rescued': 0, 'pctRescued': 0.0, 'badAreas': 0, 'readErrors': 0,
+        'currentRate': 3211000, 'averageRate': 3198000, 'errorRate': 0, 'runTime': 0,
+        'remainingTime': 216, 'timeSinceLastRead': None}
+    last = events[-1]
+    assert fieldsOf(last) == {
+        'phase': copyingPhase, 'ipos': 693633000, 'opos': 693633000, 'nonTried': 524000,
+        'nonTrimmed': 0, 'nonScraped': 0, 'badSector': 131072, 'rescued': 693633000,
+        'pctRescued': 99.92, 'badAreas': 2, 'readErrors': 2, 'currentRate': 3211000,
+        'averageRate': 3198000, 'errorRate': 0, 'runTime': 216, 'remainingTime': 0,
+        'timeSinceLastRead': None}
+    assert last.eta() == 0
+
+    for previous, event in zip(events, events[1:]):
+        assert event.runTime == previous.runTime + 1
+        assert event.rescued >= previous.rescued
+        assert event.ipos == event.opos
+        assert event.nonTried <= previous.nonTried
+
+
+def testBinaryPrefixesAndMissingValues():
+    events, parser = parseLines(binaryBlock.splitlines())
+
+    assert len(events) == 1
+    event = events[0]
+    assert fieldsOf(event) == {
+        'phase': 'Scraping failed blocks... (forwards)', 'ipos': 2**30, 'opos': 2**30,
+        'nonTried': 0, 'nonTrimmed': 0, 'nonScraped': 12800, 'badSector': 1536 * 1024,
+        'rescued': 3489660928, 'pctRescued': 99.5, 'badAreas': 17, 'readErrors': 40,
+        'currentRate': 0, 'averageRate': 1310720, 'errorRate': 2048, 'runTime': 3723,
+        'remainingTime': None, 'timeSinceLastRead': 605}
+    # No estimate from ddrescue, so from the average rate
+    totalSize = 3489660928 * 100 / 99.5
+    assert event.eta() == int((totalSize - 3489660928) / 1310720)
+
+
+def testEtaWithoutRate():
+    events, parser = parseLines(startBlock.splitlines())
+    event = events[0]
+    assert (event.averageRate, event.pctRescued, event.remainingTime) == (0, 0.0, None)
+    assert event.eta() is None
+
+    # Rates that ddrescue could not compute
+    event = RescueProgress()
+    event.rescued = 10**6
+    event.pctRescued = 50.0
+    event.averageRate = parseSize('n/a')
+    assert event.averageRate is None
+    assert event.eta() is None
+    event.averageRate = 10**5
+    assert event.eta() == 10
+
+
+def readRows(fileOut):
+    """Return rows of CSV file as dictionaries with the values as strings"""
+    with open(fileOut, 'r', encoding='utf-8', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def testRecorderRows(tmp_path):
+    fileOut = str(tmp_path / 'disc.progress.csv')
+    events, parser = parseLines(transcriptLines())
+
+    recorder = ProgressRecorder(fileOut)
+    for event in events[:100]:
+        recorder.add(event)
+    recorder.close()
+    # A second pass appends to the same file, without a second header
+    recorder = ProgressRecorder(fileOut)
+    for event in events[100:]:
+        recorder.add(event)
+    recorder.close()
+
+    with open(fileOut, 'r', encoding='utf-8') as f:
+        header = f.readline().strip()
+    assert header == ','.join(RescueProgress.fields)
+    rows = readRows(fileOut)
+    assert len(rows) == len(events)
+    assert recorder.noRows == len(events) - 100
+    for row, event in zip(rows, events):
+        # None is written as an empty field
+        assert row == {field: '' if getattr(event, field) is None else str(getattr(event, field))
+                       for field in RescueProgress.fields}
+
+
+def testRecorderIgnoresWriteErrors(tmp_path):
+    recorder = ProgressRecorder(str(tmp_path / 'missing' / 'disc.progress.csv'))
+    recorder.add(RescueProgress())
+    recorder.close()
+    assert recorder.noRows == 0
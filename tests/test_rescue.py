@@ -0,0 +1,167 @@
+"""Tests for omimgr.rescue: the stop conditions of RescueOrchestrator, and
+the bytes recovered by each drive, with copies of one fake disc as drives
+that each have their own unreadable sectors"""
+
+import os
+import shutil
+from omimgr.rescue import PassPolicy, RescueOrchestrator
+from omimgr.wrappers import CancelToken
+from omimgr import shared
+import fakes
+
+sectorSize = 2048
+
+
+def makeDrives(tmp_path, badSectors, size=4 * 2**20):
+    """Return copies of one fake disc of size bytes, one per item of
+    badSectors, the list of sectors the drive cannot read"""
+    drives = [str(tmp_path / ('sr' + str(i))) for i in range(len(badSectors))]
+    fakes.makeFakeImage(drives[0], size)
+    for drive, sectors in zip(drives, badSectors):
+        if drive != drives[0]:
+            shutil.copy(drives[0], drive)
+        with open(drive + '.bad', 'w') as f:
+            for sector in sectors:
+                f.write('%d %d\n' % (sector * sectorSize, sectorSize))
+    return drives
+
+
+def expectedRecovered(drives, badSectors):
+    """Return number of bytes each pass recovers if the disc goes through the
+    drives in order, one pass each"""
+    noSectors = os.path.getsize(drives[0]) // sectorSize
+    remaining = set(range(noSectors))
+    recovered = []
+    for sectors in badSectors:
+        readable = remaining - set(sectors)
+        recovered.append(len(readable) * sectorSize)
+        remaining -= readable
+    return recovered
+
+
+def rescueDisc(tmp_path, drives, policy=None, swapResult=True, cancelToken=None):
+    """Run RescueOrchestrator on drives; returns it, and the (from, to)
+    drive of each swap"""
+    swaps = []
+
+    def swapCallback(fromDrive, toDrive):
+        swaps.append((fromDrive, toDrive))
+        return swapResult
+
+    if policy is None:
+        policy = PassPolicy('1')
+    orchestrator = RescueOrchestrator(str(tmp_path / 'disc.iso'), str(tmp_path / 'disc.map'),
+                                      drives, policy, swapCallback, cancelToken=cancelToken)
+    orchestrator.run()
+    return orchestrator, swaps
+
+
+def testStopsOnceFullyRescued(tmp_path):
+    drives = makeDrives(tmp_path, [[], [100], [200]])
+    orchestrator, swaps = rescueDisc(tmp_path, drives)
+
+    assert orchestrator.stopReason == 'disc fully rescued'
+    assert len(orchestrator.passes) == 1
+    assert swaps == []
+    assert orchestrator.passes[0]['rescuedFraction'] == 1
+    assert shared.generate_file_sha512(orchestrator.imageFile) == \
+        shared.generate_file_sha512(drives[0])
+
+
+def testAllDrivesUsed(tmp_path):
+    # Sector 300 is unreadable in every drive, and each drive reads some of
+    # the sectors the one before it couldn't
+    badSectors = [[10, 11, 300, 1000], [300, 500, 1000], [20, 300, 1500]]
+    drives = makeDrives(tmp_path, badSectors)
+    orchestrator, swaps = rescueDisc(tmp_path, drives)
+
+    assert orchestrator.stopReason == 'all passes done'
+    assert swaps == [(drives[0], drives[1]), (drives[1], drives[2])]
+    assert [ddrescuePass['omDevice'] for ddrescuePass in orchestrator.passes] == drives
+    lastPass = orchestrator.passes[-1]
+    assert lastPass['rescuedAfter'] == os.path.getsize(drives[0]) - sectorSize
+    assert lastPass['rescuedFraction'] < 1
+
+
+def testBytesPerDrive(tmp_path):
+    badSectors = [list(range(100, 140)) + [900], list(range(120, 130)), [900, 901],
+                  list(range(100, 200))]
+    drives = makeDrives(tmp_path, badSectors)
+    orchestrator, swaps = rescueDisc(tmp_path, drives)
+
+    recovered = expectedRecovered(drives, badSectors)
+    assert recovered[-1] == 0
+    assert [ddrescuePass['bytesRecovered'] for ddrescuePass in orchestrator.passes] == \
+        recovered[:3]
+    assert orchestrator.bytesPerDrive() == dict(zip(drives[:3], recovered[:3]))
+    for ddrescuePass in orchestrator.passes:
+        assert ddrescuePass['rescuedAfter'] - ddrescuePass['rescuedBefore'] == \
+            ddrescuePass['bytesRecovered']
+    assert orchestrator.passes[-1]['rescuedAfter'] == sum(recovered)
+    # The third drive finished the disc, so the fourth is not used
+    assert orchestrator.stopReason == 'disc fully rescued'
+    assert shared.generate_file_sha512(orchestrator.imageFile) == \
+        shared.generate_file_sha512(drives[0])
+
+
+def testStopsWhenDriveAddsNothing(tmp_path):
+    # The second drive can't read anything the first one couldn't
+    badSectors = [[50, 51, 700], [50, 51, 700, 800], [51]]
+    drives = makeDrives(tmp_path, badSectors)
+    orchestrator, swaps = rescueDisc(tmp_path, drives)
+
+    assert orchestrator.stopReason == 'rescued fraction stopped improving'
+    assert [ddrescuePass['bytesRecovered'] for ddrescuePass in orchestrator.passes] == \
+        expectedRecovered(drives, badSectors)[:2]
+    assert orchestrator.passes[1]['bytesRecovered'] == 0
+    assert swaps == [(drives[0], drives[1])]
+
+    # With more patience the third drive gets its turn
+    os.remove(orchestrator.imageFile)
+    os.remove(orchestrator.mapFile)
+    orchestrator, swaps = rescueDisc(tmp_path, drives, PassPolicy('1', patience=2))
+    assert len(orchestrator.passes) == 3
+    assert orchestrator.stopReason == 'all passes done'
+
+
+def testMaximumNumberOfPasses(tmp_path):
+    badSectors = [[10, 20, 30], [20, 30], [30]]
+    drives = makeDrives(tmp_path, badSectors)
+    orchestrator, swaps = rescueDisc(tmp_path, drives, PassPolicy('1', maxPasses=2))
+
+    assert orchestrator.stopReason == 'maximum number of passes reached'
+    assert [ddrescuePass['omDevice'] for ddrescuePass in orchestrator.passes] == drives[:2]
+    assert swaps == [(drives[0], drives[1])]
+
+    # Two passes per drive also count against the maximum
+    os.remove(orchestrator.imageFile)
+    os.remove(orchestrator.mapFile)
+    policy = PassPolicy('1', directDiscModes=[False, True], patience=2, maxPasses=3)
+    orchestrator, swaps = rescueDisc(tmp_path, drives, policy)
+    assert [(ddrescuePass['omDevice'], ddrescuePass['directDiscMode'])
+            for ddrescuePass in orchestrator.passes] == \
+        [(drives[0], False), (drives[0], True), (drives[1], False)]
+    assert orchestrator.stopReason == 'maximum number of passes reached'
+
+
+def testOperatorQuitsAtSwap(tmp_path):
+    drives = makeDrives(tmp_path, [[10, 11], [], []])
+    orchestrator, swaps = rescueDisc(tmp_path, drives, swapResult=False)
+
+    assert orchestrator.stopReason == 'stopped by operator'
+    assert swaps == [(drives[0], drives[1])]
+    assert len(orchestrator.passes) == 1
+    assert orchestrator.bytesPerDrive() == {drives[0]: os.path.getsize(drives[0]) -
+                                            2 * sectorSize}
+
+
+def testCancelledBeforeFirstPass(tmp_path):
+    drives = makeDrives(tmp_path, [[], []])
+    cancelToken = CancelToken()
+    cancelToken.cancel()
+    orchestrator, swaps = rescueDisc(tmp_path, drives, cancelToken=cancelToken)
+    cancelToken.close()
+
+    assert orchestrator.stopReason == 'interrupted'
+    assert orchestrator.passes == []
+    assert orchestrator.bytesPerDrive() == {}
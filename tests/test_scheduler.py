@@ -0,0 +1,102 @@
+"""Tests for omimgr.scheduler, and the cancellation tokens of its jobs"""
+
+import os
+import json
+import time
+import pytest
+from omimgr.scheduler import Scheduler
+from omimgr.wrappers import CancelToken
+from omimgr import shared
+import fakes
+
+
+def imageChecksum(result):
+    """Return checksum of the image of result, from its metadata file"""
+    with open(os.path.join(result['dirOut'], 'metadata.json'), 'r', encoding='utf-8') as f:
+        metadata = json.load(f)
+    return metadata['checksums'][os.path.basename(result['imageFile'])]
+
+
+def waitForResults(scheduler, noResults, timeout=30):
+    """Wait until scheduler has noResults results"""
+    deadline = time.monotonic() + timeout
+    while len(scheduler.results) < noResults:
+        assert time.monotonic() < deadline, 'jobs did not finish'
+        time.sleep(0.05)
+
+
+@pytest.mark.parametrize('readMethod', ['readom', 'ddrescue', 'native'])
+def testImagesMatchDevices(tmp_path, configFile, readMethod):
+    devices = fakes.makeFakeDevices(tmp_path, 3)
+    scheduler = Scheduler(devices, allowFileDevice=True, configFile=configFile)
+    scheduler.start()
+    for i, device in enumerate(devices):
+        dirOut = tmp_path / ('job' + str(i))
+        dirOut.mkdir()
+        scheduler.submit({'omDevice': device, 'dirOut': str(dirOut), 'readMethod': readMethod,
+                          'identifier': 'disc' + str(i)})
+    results = scheduler.join()
+
+    assert len(results) == len(devices)
+    for result in results:
+        assert result['status'] == 'success', result['errors']
+        assert imageChecksum(result) == shared.generate_file_sha512(result['omDevice'])
+
+
+def testFinishedJobFreesOutputDirectory(tmp_path, configFile):
+    device = fakes.makeFakeDevices(tmp_path, 1)[0]
+    dirOut = tmp_path / 'job'
+    dirOut.mkdir()
+    job = {'omDevice': device, 'dirOut': str(dirOut), 'readMethod': 'ddrescue'}
+    scheduler = Scheduler([device], allowFileDevice=True, configFile=configFile)
+    scheduler.start()
+    scheduler.submit(job)
+    with pytest.raises(ValueError):
+        scheduler.submit(job)
+    waitForResults(scheduler, 1)
+
+    assert scheduler.cancelTokens == {}
+    # Nothing left to cancel
+    scheduler.cancelAll()
+    with pytest.raises(ValueError):
+        scheduler.cancel(str(dirOut))
+    scheduler.submit(job)
+    results = scheduler.join()
+    assert [result['status'] for result in results] == ['success', 'success']
+
+
+def testCancelQueuedJob(tmp_path, configFile):
+    device = fakes.makeFakeDevices(tmp_path, 1)[0]
+    dirOuts = []
+    for i in range(2):
+        dirOuts.append(tmp_path / ('job' + str(i)))
+        dirOuts[-1].mkdir()
+    scheduler = Scheduler([device], allowFileDevice=True, configFile=configFile)
+    for dirOut in dirOuts:
+        scheduler.submit({'omDevice': device, 'dirOut': str(dirOut), 'readMethod': 'readom'})
+    # Not started yet, so both jobs are queued
+    scheduler.cancel(str(dirOuts[1]))
+    scheduler.start()
+    results = scheduler.join()
+    statusByDir = {result['dirOut']: result['status'] for result in results}
+    assert statusByDir[str(dirOuts[0])] == 'success'
+    assert statusByDir[str(dirOuts[1])] == 'cancelled'
+
+
+def testClosedCancelTokenDoesNotWrite():
+    token = CancelToken()
+    token.close()
+    # Most likely re-uses the descriptors of the token's pipe
+    readFd, writeFd = os.pipe()
+    try:
+        token.cancel()
+        assert token.isCancelled()
+        assert token.wakeupRead is None and token.wakeupWrite is None
+        os.set_blocking(readFd, False)
+        with pytest.raises(BlockingIOError):
+            os.read(readFd, 1)
+    finally:
+        os.close(readFd)
+        os.close(writeFd)
+    # Closing twice is harmless
+    token.close()
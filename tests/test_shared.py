@@ -0,0 +1,86 @@
+"""Tests for the queued log handler of omimgr.shared"""
+
+import time
+import logging
+import threading
+from omimgr import shared
+
+
+def makeLogger(name, handler):
+    """Return logger that only logs to handler"""
+    logger = logging.getLogger('test.' + name)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(handler)
+    return logger
+
+
+def readLines(logFile):
+    """Return lines of logFile"""
+    with open(logFile, 'r', encoding='utf-8') as f:
+        return f.read().splitlines()
+
+
+def testRecordsFromThreadsWrittenInOrder(tmp_path):
+    logFile = str(tmp_path / 'omimgr.log')
+    handler = shared.queuedFileHandler(logFile, logging.Formatter('%(message)s'),
+                                       flushInterval=0.05)
+    logger = makeLogger('threads', handler)
+    noThreads = 8
+    noRecords = 2000
+    # Records are numbered in the order in which they are logged
+    lock = threading.Lock()
+    numbers = iter(range(noThreads * noRecords))
+
+    def logRecords(threadNo):
+        for i in range(noRecords):
+            with lock:
+                logger.info('%d %d %d', next(numbers), threadNo, i)
+
+    threads = [threading.Thread(target=logRecords, args=(i,)) for i in range(noThreads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Stops the listener once everything is written
+    handler.close()
+    logger.removeHandler(handler)
+
+    lines = [line.split() for line in readLines(logFile)]
+    assert [int(line[0]) for line in lines] == list(range(noThreads * noRecords))
+    for threadNo in range(noThreads):
+        assert [int(line[2]) for line in lines if int(line[1]) == threadNo] == \
+            list(range(noRecords))
+    assert handler.listener is None
+    handler.close()
+
+
+def testBufferedRecordsFlushedWhileIdle(tmp_path):
+    logFile = str(tmp_path / 'omimgr.log')
+    handler = shared.queuedFileHandler(logFile, logging.Formatter('%(message)s'),
+                                       flushInterval=0.05)
+    logger = makeLogger('idle', handler)
+    logger.info('first')
+    logger.info('second')
+
+    # No further records: the listener flushes the file after flushInterval
+    deadline = time.monotonic() + 5
+    while readLines(logFile) != ['first', 'second'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert readLines(logFile) == ['first', 'second']
+    handler.close()
+    logger.removeHandler(handler)
+
+
+def testBufferedFileHandlerFlushesAtInterval(tmp_path):
+    logFile = str(tmp_path / 'omimgr.log')
+    handler = shared.BufferedFileHandler(logFile, flushInterval=3600)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger = makeLogger('buffered', handler)
+    logger.info('buffered')
+    assert readLines(logFile) == []
+
+    # Closing writes what is left
+    handler.close()
+    logger.removeHandler(handler)
+    assert readLines(logFile) == ['buffered']
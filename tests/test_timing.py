@@ -0,0 +1,91 @@
+"""Tests for omimgr.timing: phase durations and bytes, and the memory
+tracing of profiled jobs"""
+
+import gc
+import time
+import tracemalloc
+from omimgr import timing
+
+
+def testPhasesAndThroughput():
+    timer = timing.PhaseTimer()
+    timer.begin('read')
+    time.sleep(0.01)
+    timer.addBytes('read', 10**6)
+    timer.begin('validate')
+    summary = timer.summary()
+
+    # The current phase is left out
+    assert list(summary['phases']) == ['read']
+    read = summary['phases']['read']
+    assert read['bytes'] == 10**6
+    assert read['MBPerSecond'] == round(10**6 / read['seconds'] / 1e6, 3)
+    assert 'peakMemoryBytes' not in read
+
+    timer.finish()
+    assert list(timer.summary()['phases']) == ['read', 'validate']
+    assert 'bytes' not in timer.summary()['phases']['validate']
+
+
+def testPeakMemoryOfEachPhase(tmp_path):
+    timer = timing.PhaseTimer(str(tmp_path / 'job.pstats'))
+    assert tracemalloc.is_tracing()
+    timer.begin('big')
+    data = bytearray(20 * 2**20)
+    del data
+    timer.begin('small')
+    data = bytearray(2**20)
+    del data
+    timer.finish()
+
+    phases = timer.summary()['phases']
+    assert phases['big']['peakMemoryBytes'] >= 20 * 2**20
+    assert phases['small']['peakMemoryBytes'] < 20 * 2**20
+    assert (tmp_path / 'job.pstats').exists()
+    assert not tracemalloc.is_tracing()
+
+
+def testOnlyOneJobTracesMemory(tmp_path):
+    first = timing.PhaseTimer(str(tmp_path / 'first.pstats'))
+    first.begin('read')
+    # A second job starts while the first one reads; it does not trace, and
+    # the peak of the first one's phase would include its memory
+    second = timing.PhaseTimer(str(tmp_path / 'second.pstats'))
+    assert second.tracemalloc is None
+    second.begin('read')
+    first.begin('validate')
+    second.finish()
+    # The second job finished before this phase started
+    first.begin('checksums')
+    first.finish()
+
+    phases = first.summary()['phases']
+    assert 'peakMemoryBytes' not in phases['read']
+    assert 'peakMemoryBytes' not in phases['validate']
+    assert 'peakMemoryBytes' in phases['checksums']
+    assert 'peakMemoryBytes' not in second.summary()['phases']['read']
+    assert not tracemalloc.is_tracing()
+
+    # Both finished, so the next job traces again
+    third = timing.PhaseTimer(str(tmp_path / 'third.pstats'))
+    assert third.tracemalloc is not None
+    third.finish()
+    assert not tracemalloc.is_tracing()
+
+
+def testTimerOfCrashedJobDropsOut(tmp_path):
+    crashed = timing.PhaseTimer(str(tmp_path / 'crashed.pstats'))
+    crashed.begin('read')
+    # The job ends without finishing the timer
+    crashed.profiler.disable()
+    del crashed
+    gc.collect()
+
+    timer = timing.PhaseTimer(str(tmp_path / 'job.pstats'))
+    assert timer.tracemalloc is not None
+    timer.begin('read')
+    timer.finish()
+    assert 'peakMemoryBytes' in timer.summary()['phases']['read']
+    # Started by the crashed job, which never stopped it
+    assert timer.startedTracing is False
+    tracemalloc.stop()
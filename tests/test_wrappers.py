@@ -0,0 +1,292 @@
+"""Tests for omimgr.wrappers: the output reader and parsers, with the readom
+and ddrescue transcripts in benchmarks/transcripts, and the interruption of
+a cancelled tool"""
+
+import os
+import re
+import sys
+import time
+import signal
+import logging
+import pytest
+from omimgr import wrappers
+import bench_reader
+
+copyingPhase = 'Copying non-tried blocks... Pass 1 (forwards)'
+
+
+class RecordList(logging.Handler):
+    """Logging handler that keeps (level name, message) of every record"""
+
+    def __init__(self):
+        """initialise RecordList instance"""
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        """Keep record"""
+        self.records.append((record.levelname, record.getMessage()))
+
+
+def makeLogger(name):
+    """Return logger that only logs to a new RecordList, and the RecordList"""
+    records = RecordList()
+    logger = logging.getLogger('test.wrappers.' + name)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.handlers = [records]
+    return logger, records
+
+
+def readTranscript(fileName):
+    """Return contents of transcript"""
+    with open(os.path.join(bench_reader.transcriptsDir, fileName), 'rb') as f:
+        return f.read()
+
+
+def replay(fileName, stream, parser, chunkSize):
+    """Replay transcript on stream (stdout or stderr) of a stand-in process,
+    and read it with an OutputReader that reads at most chunkSize bytes at a
+    time, so lines (and escape sequences) are split across reads"""
+    p = bench_reader.startStub(os.path.join(bench_reader.transcriptsDir, fileName), stream, 1)
+    wrappers.OutputReader(p, parser, chunkSize=chunkSize).run()
+    p.wait()
+
+
+def feed(parser, data, streamName='stdout'):
+    """Pass data to parser as OutputReader does, in one go"""
+    lines = re.split(rb'([\r\n])', data)
+    for line, lineEnd in zip(lines[0::2], lines[1::2] + [b'']):
+        if line or lineEnd:
+            parser.processLine(line.decode('utf-8').replace('\x1b[A', ''), streamName,
+                               lineEnd == b'\r')
+    parser.finish()
+
+
+def nonBlankLines(data):
+    """Return every line of data that isn't blank, without escape sequences"""
+    lines = [line.replace('\x1b[A', '') for line in re.split(r'[\r\n]', data.decode('utf-8'))]
+    return [line for line in lines if line.strip()]
+
+
+@pytest.mark.parametrize('chunkSize', [1, 3, 7, 65536])
+def testReadomTranscript(chunkSize):
+    logger, records = makeLogger('readom' + str(chunkSize))
+    parser = wrappers.ReadomParser('readom', logger)
+    replay('readom.txt', 'stderr', parser, chunkSize)
+
+    # Of each run of progress lines only the last one is logged, before the
+    # line that ends the run
+    expected = []
+    for line in readTranscript('readom.txt').decode('utf-8').split('\n'):
+        parts = line.split('\r')
+        expected += [part for part in parts[:-1] if part.strip()][-1:]
+        expected += [part for part in parts[-1:] if part.strip()]
+    assert records.records == [('INFO', line) for line in expected]
+    assert records.records[-4:] == [('INFO', 'addr:   338880 cnt: 64'),
+                                    ('INFO', 'addr:   338942 cnt: 14'),
+                                    ('INFO', 'Time total: 95.312sec'),
+                                    ('INFO', 'Read 677884.00 kB at 7112.3 kB/sec.')]
+    assert not parser.errorFlag
+    assert parser.pendingProgress == ''
+
+
+def testReadomErrors():
+    logger, records = makeLogger('readomErrors')
+    parser = wrappers.ReadomParser('readom', logger)
+    feed(parser, b'addr:        0 cnt: 64\raddr:       64 cnt: 64\r'
+                 b'readom: Input/output error. read_g1: scsi sendcmd: no error\n'
+                 b'addr:      128 cnt: 64\r', 'stderr')
+
+    assert records.records == [
+        ('INFO', 'addr:       64 cnt: 64'),
+        ('INFO', 'readom: Input/output error. read_g1: scsi sendcmd: no error'),
+        ('INFO', 'addr:      128 cnt: 64')]
+    assert parser.errorFlag
+
+
+@pytest.mark.parametrize('chunkSize', [1, 3, 7, 65536])
+def testDdrescueTranscriptEveryBlockLogged(chunkSize):
+    logger, records = makeLogger('ddrescue' + str(chunkSize))
+    events = []
+    parser = wrappers.RescueParser('ddrescue', events.append, logger, logInterval=0)
+    replay('ddrescue-1.22.txt', 'stdout', parser, chunkSize)
+
+    summary = [('INFO', 'ddrescue status blocks: 217, logged: 217'),
+               ('INFO', 'ddrescue phases: ' + copyingPhase),
+               ('INFO', 'ddrescue final status: pct rescued: 99.92, read errors: 2, '
+                        'bad areas: 2, run time (s): 216')]
+    expected = [('INFO', line) for line in nonBlankLines(readTranscript('ddrescue-1.22.txt'))]
+    assert records.records == expected + summary
+    assert len(events) == 217
+    assert parser.readErrors == 2
+    assert parser.errorFlag
+    assert parser.phases == [copyingPhase]
+
+
+def testDdrescueTransitionsLogged():
+    logger, records = makeLogger('ddrescueTransitions')
+    events = []
+    parser = wrappers.RescueParser('ddrescue', events.append, logger, logInterval=3600)
+    feed(parser, readTranscript('ddrescue-1.22.txt'))
+
+    # First block, and each block where the phase, read errors or bad areas
+    # changed; the last block is logged by finish
+    states = [(event.phase, event.readErrors, event.badAreas) for event in events]
+    logged = [0] + [i for i in range(1, len(states)) if states[i] != states[i - 1]]
+    logged.append(len(events) - 1)
+    assert parser.logPolicy.logged == len(logged)
+    assert records.records[-3] == ('INFO', 'ddrescue status blocks: 217, logged: ' +
+                                   str(len(logged)))
+    iposLines = [line for line in nonBlankLines(readTranscript('ddrescue-1.22.txt'))
+                 if line.strip().startswith('ipos:')]
+    assert [message for level, message in records.records if message in iposLines] == \
+        [iposLines[i] for i in logged]
+
+
+def testDdrescueStderr():
+    logger, records = makeLogger('ddrescueStderr')
+    parser = wrappers.RescueParser('ddrescue', logger=logger, logInterval=0)
+    parser.processLine('ddrescue: Can\'t open input file: No medium found', 'stderr', False)
+    # Status items on stderr are not part of a status block
+    parser.processLine('  rescued:   3.25 GiB,   bad areas:       17,', 'stderr', False)
+    parser.finish()
+
+    assert records.records == [
+        ('WARNING', 'ddrescue: Can\'t open input file: No medium found'),
+        ('WARNING', '  rescued:   3.25 GiB,   bad areas:       17,'),
+        ('INFO', 'ddrescue status blocks: 0, logged: 0')]
+    assert parser.lastEvent is None
+    assert not parser.errorFlag
+
+
+def testGetReadErrors():
+    assert wrappers.getReadErrors('pct rescued:    99.92%, read errors:        2,  '
+                                  'remaining time:         0s') == 2
+    # ddrescue 1.19
+    assert wrappers.getReadErrors('  rescued:   694157 kB,  errsize:    131 kB,  '
+                                  'errors:       3') == 3
+
+
+# Stand-in that records the signals it gets in a file, ignores those named
+# on its command line, and says it is ready once the handlers are set. With
+# 'close' it closes its output streams first, so the escalation happens
+# while runTool waits for it to exit
+SIGNAL_STUB = """
+import os
+import sys
+import time
+import signal
+signalsFile = sys.argv[1]
+def record(signalNumber, frame):
+    with open(signalsFile, 'a') as f:
+        f.write(signal.Signals(signalNumber).name + '\\n')
+    if signal.Signals(signalNumber).name not in sys.argv[2:]:
+        sys.exit(1)
+signal.signal(signal.SIGINT, record)
+signal.signal(signal.SIGTERM, record)
+print('ready', flush=True)
+if 'close' in sys.argv[2:]:
+    os.close(1)
+    os.close(2)
+while True:
+    time.sleep(0.01)
+"""
+
+
+class CancellingParser(wrappers.OutputParser):
+    """Cancels the job as soon as the stand-in is ready"""
+
+    def parseLine(self, line, streamName):
+        """Cancel on the ready line"""
+        if line == 'ready':
+            self.cancelTime = time.monotonic()
+            self.cancelToken.cancel()
+
+
+def runSignalStub(tmp_path, ignored, close=False):
+    """Run SIGNAL_STUB that ignores the signals in ignored, and cancel it
+    once it is ready. Returns the parser, its log records, the signals the
+    stand-in got, and the time from cancelling to its exit"""
+    signalsFile = str(tmp_path / 'signals')
+    logger, records = makeLogger('signals' + ''.join(ignored) + str(close))
+    cancelToken = wrappers.CancelToken(termTimeout=0.3, killTimeout=0.3)
+    parser = CancellingParser('stub', logger, cancelToken)
+    args = [sys.executable, '-c', SIGNAL_STUB, signalsFile] + ignored + (['close'] if close else [])
+    cmdLine, exitStatus, errorFlag, interruptedFlag = wrappers.runTool(args, parser)
+    assert interruptedFlag == parser.interruptedFlag
+    elapsed = time.monotonic() - parser.cancelTime
+    cancelToken.close()
+    try:
+        with open(signalsFile, 'r') as f:
+            signalsReceived = f.read().split()
+    except FileNotFoundError:
+        signalsReceived = []
+    return parser, exitStatus, records.records, signalsReceived, elapsed
+
+
+def testStubThatExitsOnSigint(tmp_path):
+    parser, exitStatus, records, signalsReceived, elapsed = runSignalStub(tmp_path, [])
+
+    assert parser.interruptedFlag
+    assert signalsReceived == ['SIGINT']
+    assert exitStatus == 1
+    assert ('WARNING', '*** stub execution interrupted by user ***') in records
+    assert not any('did not exit' in message for level, message in records)
+    assert parser.pendingSignals == [signal.SIGTERM, signal.SIGKILL]
+
+
+@pytest.mark.parametrize('close', [False, True])
+def testEscalationToSigterm(tmp_path, close):
+    parser, exitStatus, records, signalsReceived, elapsed = \
+        runSignalStub(tmp_path, ['SIGINT'], close)
+
+    assert parser.interruptedFlag
+    assert signalsReceived == ['SIGINT', 'SIGTERM']
+    assert exitStatus == 1
+    assert ('WARNING', 'stub did not exit, sending SIGTERM') in records
+    assert not any('SIGKILL' in message for level, message in records)
+    assert elapsed >= 0.3
+
+
+@pytest.mark.parametrize('close', [False, True])
+def testEscalationToSigkill(tmp_path, close):
+    parser, exitStatus, records, signalsReceived, elapsed = \
+        runSignalStub(tmp_path, ['SIGINT', 'SIGTERM'], close)
+
+    assert parser.interruptedFlag
+    assert signalsReceived == ['SIGINT', 'SIGTERM']
+    assert exitStatus == -signal.SIGKILL
+    warnings = [message for level, message in records if level == 'WARNING']
+    assert warnings == ['*** stub execution interrupted by user ***',
+                        'stub did not exit, sending SIGTERM',
+                        'stub did not exit, sending SIGKILL']
+    assert parser.pendingSignals == []
+    assert elapsed >= 0.6
+
+
+def testCancelAfterClose():
+    cancelToken = wrappers.CancelToken()
+    cancelToken.close()
+    cancelToken.close()
+    assert cancelToken.fileno() is None
+
+    # Only sets the flag, as the closed descriptors may be reused; a pipe
+    # that gets one of their numbers is not written to
+    reusedRead, reusedWrite = os.pipe()
+    cancelToken.cancel()
+    assert cancelToken.isCancelled()
+    os.set_blocking(reusedRead, False)
+    with pytest.raises(BlockingIOError):
+        os.read(reusedRead, 1)
+    os.close(reusedRead)
+    os.close(reusedWrite)
+
+
+def testCancelWithFullPipe():
+    cancelToken = wrappers.CancelToken()
+    for _ in range(100000):
+        cancelToken.cancel()
+    assert cancelToken.isCancelled()
+    assert os.read(cancelToken.fileno(), 1) == b'x'
+    cancelToken.close()